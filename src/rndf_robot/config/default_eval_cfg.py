@@ -76,6 +76,10 @@ _C.DISTRACTOR.SCALE = [1.5] * 3
 _C.OPTIMIZER = CN()
 _C.OPTIMIZER.SHAPE_PCD_PTS_N = 1500
 _C.OPTIMIZER.QUERY_PCD_PTS_N = 500
+# memory budget (in MB) for encoding the shape point clouds, the batch of initializations
+# is split into micro-batches that fit within it, which lets dgcnn models optimize 10
+# initializations rather than 5. 0 disables micro-batching
+_C.OPTIMIZER.LATENT_MEM_BUDGET_MB = 2048
 
 # shapenet IDs that are weird that we know to avoid
 _C.MUG = CN()
@@ -0,0 +1,418 @@
+"""
+Generate the NeRF datasets of the relation evaluation scenes, without running the evaluation.
+
+This only sets up the simulation and the NeRF cameras: no NDF models, target descriptors,
+optimizers or meshcat. Every trial samples its objects like the eval does with --per_trial_seed
+(see rndf_robot.eval.scene_sampling), steps the physics until they come to rest, renders the
+NeRF views and writes them straight to <nerf_datasets>/<exp>/trial_<i>. The trials can be
+spread over several supervised worker processes, and an interrupted run picks up where it
+stopped (see rndf_robot.eval.resume).
+
+    python -m rndf_robot.data_gen.generate_nerf_datasets --parent_class syn_rack_easy --child_class mug \\
+        --rel_demo_exp release_demos/mug_on_rack_relation --is_child_shapenet_obj --exp mug_on_rack --num_workers 8
+"""
+import argparse
+import glob
+import json
+import os, os.path as osp
+import sys
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+import pybullet as p
+import trimesh
+
+from loguru import logger
+from airobot.utils.pb_util import create_pybullet_client, TextureModder
+
+from rndf_robot.config.default_eval_cfg import get_eval_cfg_defaults
+from rndf_robot.config.default_nerf_cfg import get_nerf_cfg
+from rndf_robot.data_gen.precompute_vhacd import MESH_DATA_DIRS, get_decomposed, load_manifest, default_manifest_path
+from rndf_robot.eval.parallel_eval import supervise_workers
+from rndf_robot.eval.results_store import results_fname, append_result, merge_results
+from rndf_robot.eval.resume import load_completed_trials, clean_unfinished_trials, partial_trial_dir, finalize_trial_dir
+from rndf_robot.eval.scene_sampling import (
+    PCL, make_pc_master_dict, mesh_files, sample_object_ids, fit_container_scale, sample_object)
+from rndf_robot.eval.seeding import trial_rngs
+from rndf_robot.nerf.async_writer import AsyncDatasetWriter
+from rndf_robot.nerf.dataset import ENCODINGS, write_instant_ngp_dataset
+from rndf_robot.nerf.upload_datasets import upload_datasets_to_logger
+from rndf_robot.nerf.uploader import LocalFSBackend, upload_dataset_dir
+from rndf_robot.robot.capture import MultiCamCapture, RendererPool
+from rndf_robot.robot.multicam import MultiCams
+from rndf_robot.utils import util, path_util
+from rndf_robot.utils.body_pool import BodyPool
+from rndf_robot.utils.eval_gen_utils import constraint_obj_world, safeCollisionFilterPair, step_until_settled
+from rndf_robot.utils.jsonl import append_jsonl, load_jsonl
+from rndf_robot.utils.profiling import TrialProfiler, format_trial_records
+
+
+def get_dataset_dir(args) -> str:
+    if args.dataset_dir is not None:
+        return args.dataset_dir
+    return osp.join(path_util.get_rndf_nerf_datasets(), args.exp)
+
+
+def load_demos(rel_demo_exp: str):
+    """
+    Returns:
+        3-element tuple containing
+        - str: The demo folder
+        - list: The demo file names
+        - list: The loaded demos
+    """
+    demo_path = osp.join(path_util.get_rndf_data(), 'relation_demos', rel_demo_exp)
+    demo_files = [fn for fn in sorted(os.listdir(demo_path)) if fn.endswith('.npz')]
+    demos = [np.load(osp.join(demo_path, fn), allow_pickle=True) for fn in demo_files]
+    return demo_path, demo_files, demos
+
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level='DEBUG' if args.debug else 'INFO')
+
+    dataset_dir = get_dataset_dir(args)
+    util.safe_makedirs(dataset_dir)
+    demo_path, demo_files, demos = load_demos(args.rel_demo_exp)
+    if args.test_on_train:
+        args.num_iterations = len(demos)
+        logger.warning(f'Generating the demo scenes, overriding num_iterations to {args.num_iterations} = len(demos)')
+
+    cfg = get_eval_cfg_defaults()
+    config_fname = osp.join(path_util.get_rndf_config(), 'eval_cfgs', args.config)
+    if osp.exists(config_fname):
+        cfg.merge_from_file(config_fname)
+    else:
+        logger.info(f'Config file {config_fname} does not exist, using defaults')
+    table_z = cfg.TABLE_Z
+
+    parent_class, child_class = args.parent_class, args.child_class
+    pc_master_dict = make_pc_master_dict(
+        parent_class, child_class, args.parent_load_pose_type, args.child_load_pose_type, cfg, demos)
+    mesh_data_dirs = {k: osp.join(path_util.get_rndf_obj_descriptions(), v) for k, v in MESH_DATA_DIRS.items()}
+    vhacd_manifest_path = default_manifest_path()
+    vhacd_manifest = load_manifest(vhacd_manifest_path) if osp.exists(vhacd_manifest_path) else None
+
+    def ensure_decomposed(obj_file):
+        get_decomposed(obj_file, vhacd_manifest, allow_compute=args.allow_vhacd)
+
+    #####################################################################################
+    # headless simulation, only ever advanced by stepping it
+
+    pb_client = create_pybullet_client(gui=False, opengl_render=True, realtime=False)
+    client_id = pb_client.get_client_id()
+    # the eval renders without shadows too
+    p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, 0, physicsClientId=client_id)
+    physics_dt = p.getPhysicsEngineParameters(physicsClientId=client_id)['fixedTimeStep']
+    body_pool = BodyPool(client_id=client_id, max_parked=args.body_pool_size)
+
+    table_urdf_fname = osp.join(path_util.get_rndf_descriptions(), 'hanging/table/table.urdf')
+    table_id = pb_client.load_urdf(table_urdf_fname, [0.5, 0.0, 0.375], cfg.TABLE_ORI, scaling=1.0)
+    table_base_id = 0
+    texture_modder = TextureModder(client_id)
+    nerf_cfg = get_nerf_cfg()
+    nerf_cams = MultiCams(nerf_cfg.CAMERA, pb_client, n_cams=nerf_cfg.N_CAMERAS)
+    renderer_pool = None
+    if args.render_clients > 0:
+        renderer_pool = RendererPool(nerf_cfg.CAMERA, nerf_cfg.N_CAMERAS, args.render_clients, client_id=client_id)
+    nerf_capture = MultiCamCapture(nerf_cams, renderer_pool)
+    nerf_capture.register_body(table_id, dict(kind='urdf', file=table_urdf_fname, scale=1.0))
+    if args.plane_texture == 'plane':
+        plane_id = pb_client.load_urdf('plane.urdf', [0, 0, 0.7])
+        nerf_capture.register_body(plane_id, dict(kind='urdf', file='plane.urdf', scale=1.0))
+    # with --nerf_write_threads, the datasets are written in the background while the next trials are simulated,
+    # and the trials are finished (folder renamed, results recorded) by the writer threads, one at a time
+    nerf_writer = None
+    if args.nerf_write_threads > 0:
+        nerf_writer = AsyncDatasetWriter(args.nerf_write_threads, args.nerf_write_queue, args.nerf_encoding,
+                                         args.nerf_png_compress_level)
+    finish_lock = threading.Lock()
+
+    full_cfg_dict = dict(args.__dict__)
+    full_cfg_dict.update(util.cn2dict(cfg))
+    if args.worker_id <= 0:
+        with open(osp.join(dataset_dir, 'full_exp_cfg.json'), 'w', encoding='utf-8') as f:
+            json.dump(full_cfg_dict, f, ensure_ascii=False, indent=4)
+
+    status_f = os.fdopen(args.status_fd, 'w', buffering=1) if args.status_fd >= 0 else None
+
+    trial_metrics_fname = osp.join(
+        dataset_dir, 'trial_metrics.jsonl' if args.worker_id < 0 else f'trial_metrics_worker_{args.worker_id}.jsonl')
+
+    status_lock = threading.Lock()
+
+    def report_status(msg):
+        """Tell the supervisor (see parallel_eval.supervise_workers) how far this worker is"""
+        if status_f is not None:
+            # the trials can be finished by the NeRF writer threads
+            with status_lock:
+                status_f.write(msg + '\n')
+
+    def spawn_object(obj):
+        """Load a trial object (or reuse a parked one) the same way the eval does"""
+        obj_id, _ = body_pool.acquire(
+            obj['mesh_file_dec'], obj['mesh_scale'],
+            lambda: pb_client.load_geom(
+                'mesh', mass=0.01, mesh_scale=obj['mesh_scale'],
+                visualfile=obj['mesh_file_dec'], collifile=obj['mesh_file_dec'],
+                base_pos=obj['pos'], base_ori=obj['ori']),
+            obj['pos'], obj['ori'])
+        texture_modder.set_rgba(obj_id, -1, obj['rgba'])
+        safeCollisionFilterPair(bodyUniqueIdA=obj_id, bodyUniqueIdB=table_id, linkIndexA=-1, linkIndexB=table_base_id, enableCollision=False)
+        p.changeDynamics(obj_id, -1, lateralFriction=0.5, linearDamping=5, angularDamping=5)
+        if obj['constrain']:
+            constraint_obj_world(obj_id, obj['pos'], obj['ori'])
+        safeCollisionFilterPair(obj_id, table_id, -1, table_base_id, enableCollision=True)
+        nerf_capture.register_body(obj_id, dict(kind='mesh', file=obj['mesh_file_dec'], scale=obj['mesh_scale']), obj['rgba'])
+        return obj_id
+
+    def settle(body_ids, duration):
+        n_steps = step_until_settled(
+            body_ids, max_steps=int(round(duration / physics_dt)),
+            lin_vel_thresh=args.settle_lin_vel_thresh, ang_vel_thresh=args.settle_ang_vel_thresh, client_id=client_id)
+        logger.debug(f'Physics settled after {n_steps} steps ({n_steps * physics_dt:.2f}s simulated)')
+
+    def run_trial(iteration):
+        trial_start_time = time.perf_counter()
+        profiler = TrialProfiler()
+        report_status(f'start {iteration}')
+
+        np_rng, py_rng = trial_rngs(args.seed, iteration, stream=0)
+        demo_idx = iteration % len(demos)
+        parent_id, child_id = sample_object_ids(pc_master_dict, demo_idx, args.test_on_train, py_rng)
+        parent_obj_file, parent_obj_file_dec = mesh_files(mesh_data_dirs[parent_class], parent_id, args.is_parent_shapenet_obj)
+        child_obj_file, child_obj_file_dec = mesh_files(mesh_data_dirs[child_class], child_id, args.is_child_shapenet_obj)
+
+        new_parent_scale = None
+        if parent_class == 'syn_container' and child_class == 'bottle':
+            with profiler.span('setup/load_meshes'):
+                ensure_decomposed(parent_obj_file)
+                ensure_decomposed(child_obj_file)
+                new_parent_scale, _, _ = fit_container_scale(
+                    trimesh.load(parent_obj_file_dec), trimesh.load(child_obj_file_dec), pc_master_dict, np_rng)
+
+        objects = {}
+        for pc in PCL:
+            objects[pc] = sample_object(
+                pc, pc_master_dict,
+                parent_obj_file if pc == 'parent' else child_obj_file,
+                parent_obj_file_dec if pc == 'parent' else child_obj_file_dec,
+                demo_idx, table_z, rand_mesh_scale=args.rand_mesh_scale,
+                scale_default=new_parent_scale if pc == 'parent' else None,
+                np_rng=np_rng, py_rng=py_rng)
+
+        # the parent settles on its own first, then the child is added, like in the eval
+        body_ids = []
+        for pc in PCL:
+            with profiler.span('setup/load_meshes'):
+                ensure_decomposed(objects[pc]['mesh_file'])
+                body_ids.append(spawn_object(objects[pc]))
+            with profiler.span('setup/settle'):
+                settle(body_ids, 1.5)
+
+        # only the color and depth buffers are needed
+        with profiler.span('setup/nerf_capture'):
+            nerf_rgbs, nerf_depths, _ = nerf_capture.capture(get_rgb=True, get_depth=True, get_seg=False)
+        profiler.add('setup', time.perf_counter() - trial_start_time)
+
+        execute_start_time = time.perf_counter()
+        nerf_dir = partial_trial_dir(dataset_dir, iteration)
+        util.safe_makedirs(nerf_dir)
+        demo_metadata = {
+            "demo_path": demo_path,
+            "demo_file": demo_files[demo_idx],
+            "multi_obj_names": demos[demo_idx]["multi_obj_names"].item(),
+        }
+        metadata = {
+            "demo": demo_metadata if args.test_on_train else None,
+            "parent_id": parent_id,
+            "child_id": child_id,
+            "is_parent_shapenet_obj": args.is_parent_shapenet_obj,
+            "is_child_shapenet_obj": args.is_child_shapenet_obj,
+            "mesh_file": objects['child']['mesh_file'],
+            "test_on_train": args.test_on_train,
+            "generate_dataset_only": True,
+        }
+
+        def finish_trial():
+            with finish_lock:
+                with profiler.span('execute/save_results'):
+                    finalize_trial_dir(dataset_dir, iteration)
+                    append_result(results_fname(dataset_dir, args.worker_id), dict(
+                        time=time.time(),
+                        exp=args.exp,
+                        seed=args.seed,
+                        worker_id=args.worker_id,
+                        trial=iteration,
+                        demo_idx=demo_idx,
+                        parent_class=parent_class,
+                        child_class=child_class,
+                        parent_id=parent_id,
+                        child_id=child_id,
+                        is_parent_shapenet_obj=args.is_parent_shapenet_obj,
+                        is_child_shapenet_obj=args.is_child_shapenet_obj,
+                        mesh_file=objects['child']['mesh_file'],
+                        generate_dataset_only=True,
+                    ))
+                report_status(f'done {iteration}')
+                logger.info(f'Trial {iteration}: wrote {len(nerf_rgbs)} views of parent {parent_id}, child {child_id}')
+                append_jsonl(trial_metrics_fname, profiler.record(
+                    trial=iteration, worker_id=args.worker_id, parent_id=parent_id, child_id=child_id))
+
+        with profiler.span('execute/cleanup'):
+            for obj_id in body_ids:
+                nerf_capture.unregister_body(obj_id)
+                body_pool.release(obj_id)
+
+        # the images are captured, they can be written after the objects are gone
+        if nerf_writer is not None:
+            profiler.add('execute', time.perf_counter() - execute_start_time)
+            nerf_writer.submit(nerf_cams, nerf_rgbs, nerf_depths, nerf_dir, extra_files={'rndf_metadata.json': metadata},
+                               on_done=finish_trial, profiler=profiler)
+        else:
+            with profiler.span('execute/nerf_write'):
+                write_instant_ngp_dataset(nerf_cams, nerf_rgbs, nerf_depths, nerf_dir, encoding=args.nerf_encoding,
+                                          png_compress_level=args.nerf_png_compress_level,
+                                          extra_files={'rndf_metadata.json': metadata})
+            profiler.add('execute', time.perf_counter() - execute_start_time)
+            finish_trial()
+
+    run_start_time = time.perf_counter()
+    run_start_timestamp = time.time()
+    if status_f is not None:
+        # run the tasks (lines of trial indices) from the supervisor until it closes stdin
+        report_status('ready')
+        for line in sys.stdin:
+            for iteration in line.split():
+                run_trial(int(iteration))
+    else:
+        trial_indices = list(range(args.start_iteration, args.num_iterations))
+        done_trials = load_completed_trials(dataset_dir)
+        clean_unfinished_trials(dataset_dir, trial_indices, done_trials)
+        if not args.no_resume:
+            trial_indices = [iteration for iteration in trial_indices if iteration not in done_trials]
+        for iteration in trial_indices:
+            run_trial(iteration)
+    if nerf_writer is not None:
+        nerf_writer.close()
+    if renderer_pool is not None:
+        renderer_pool.close()
+    logger.info('Stage timing:\n' + format_trial_records(
+        [r for r in load_jsonl([trial_metrics_fname]) if r['start_time'] >= run_start_timestamp],
+        time.perf_counter() - run_start_time))
+
+
+def run_parallel(args):
+    """Generate the trials with args.num_workers supervised worker processes (see parallel_eval.py)"""
+    dataset_dir = get_dataset_dir(args)
+    util.safe_makedirs(dataset_dir)
+    if args.test_on_train:
+        args.num_iterations = len(load_demos(args.rel_demo_exp)[2])
+
+    trial_indices = list(range(args.start_iteration, args.num_iterations))
+    done_trials = load_completed_trials(dataset_dir)
+    clean_unfinished_trials(dataset_dir, trial_indices, done_trials)
+    if not args.no_resume:
+        trial_indices = [iteration for iteration in trial_indices if iteration not in done_trials]
+
+    logger.info(f'Generating {len(trial_indices)} trials with {args.num_workers} workers')
+    run_start_timestamp = time.time()
+    supervised = supervise_workers(
+        osp.abspath(__file__), sys.argv[1:], trial_indices, args.num_workers, log_dir=dataset_dir,
+        eval_save_dir=dataset_dir, trial_timeout=args.trial_timeout, max_retries=args.max_trial_retries,
+        trials_per_task=args.trials_per_task, worker_flags=())
+    if len(supervised['failed']) > 0:
+        logger.warning(f'Trials {supervised["failed"]} failed {args.max_trial_retries + 1} times and have no dataset')
+    merge_results(dataset_dir, range(args.start_iteration, args.num_iterations))
+    trial_records = load_jsonl(sorted(glob.glob(osp.join(dataset_dir, 'trial_metrics_worker_*.jsonl'))))
+    logger.info('Stage timing of all workers:\n' + format_trial_records(
+        [r for r in trial_records if r['start_time'] >= run_start_timestamp]))
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Generate the NeRF datasets of the relation evaluation scenes')
+    parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parent_class', type=str, required=True)
+    parser.add_argument('--child_class', type=str, required=True)
+    parser.add_argument('--rel_demo_exp', type=str, required=True,
+                        help='Demos whose objects and start poses are used with demo_pose and --test_on_train')
+    parser.add_argument('--is_parent_shapenet_obj', action='store_true')
+    parser.add_argument('--is_child_shapenet_obj', action='store_true')
+    parser.add_argument('--parent_load_pose_type', type=str, default='demo_pose', help='Must be in [any_pose, demo_pose, random_upright]')
+    parser.add_argument('--child_load_pose_type', type=str, default='demo_pose', help='Must be in [any_pose, demo_pose, random_upright]')
+    parser.add_argument('--rand_mesh_scale', action='store_true')
+    parser.add_argument('--test_on_train', action='store_true')
+    parser.add_argument('--config', type=str, default='base_cfg')
+    parser.add_argument('--exp', type=str, default='debug_eval')
+    parser.add_argument('--dataset_dir', type=str, default=None,
+                        help='Where to write the trials, defaults to <nerf_datasets>/<exp>')
+    parser.add_argument('--num_iterations', type=int, default=100)
+    parser.add_argument('--start_iteration', type=int, default=0)
+    parser.add_argument('--plane-texture', type=str, choices={'plane', 'none'}, default='plane')
+    parser.add_argument('--body_pool_size', type=int, default=8,
+                        help='Maximum number of removed objects kept loaded for reuse in later trials, 0 disables reuse')
+    parser.add_argument('--allow_vhacd', action='store_true',
+                        help='Run V-HACD for meshes without a precomputed decomposition, instead of failing')
+    parser.add_argument('--settle_lin_vel_thresh', type=float, default=1e-3,
+                        help='Linear speed (m/s) below which objects count as at rest')
+    parser.add_argument('--settle_ang_vel_thresh', type=float, default=1e-2,
+                        help='Angular speed (rad/s) below which objects count as at rest')
+    parser.add_argument('--no_resume', action='store_true',
+                        help='Generate all the trials again, instead of skipping the ones already in the dataset folder')
+    parser.add_argument('--upload', action='store_true', help='Upload the datasets to ml-logger when done')
+    parser.add_argument('--upload_store', type=str, default=None,
+                        help='Upload the datasets incrementally to this content-addressed store folder when done '
+                             '(see rndf_robot.nerf.uploader), instead of ml-logger')
+    parser.add_argument('--logger_suffix', type=str, default='debug',
+                        help='Suffix to add to the logger prefix which is just the args.exp')
+    parser.add_argument('--render_clients', type=int, default=0,
+                        help='If > 0, render the NeRF cameras of each worker in this many renderer processes in parallel')
+    parser.add_argument('--nerf_encoding', type=str, choices=ENCODINGS, default='png',
+                        help='How to store the images: PNGs, raw .npy files per frame, or one packed .npy array '
+                             'of each kind per trial')
+    parser.add_argument('--nerf_png_compress_level', type=int, default=6,
+                        help='zlib level of the PNGs, from 0 (fastest, largest) to 9')
+    parser.add_argument('--nerf_write_threads', type=int, default=0,
+                        help='If > 0, write the datasets in the background with this many threads')
+    parser.add_argument('--nerf_write_queue', type=int, default=2,
+                        help='Number of trials whose dataset can wait to be written with --nerf_write_threads')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='If > 1, generate the trials in this many supervised worker processes')
+    parser.add_argument('--worker_id', type=int, default=-1, help='Set by the parallel runner')
+    parser.add_argument('--status_fd', type=int, default=-1, help='Set by the parallel runner')
+    parser.add_argument('--trial_timeout', type=float, default=600.0,
+                        help='Seconds a worker may spend on a trial before it is killed and the trial is retried')
+    parser.add_argument('--max_trial_retries', type=int, default=2)
+    parser.add_argument('--trials_per_task', type=int, default=4,
+                        help='Number of trials handed to a worker at a time')
+    args = parser.parse_args(argv)
+    if args.test_on_train:
+        assert args.start_iteration == 0, 'If generating the demo scenes, start iteration must be 0'
+        assert args.parent_load_pose_type == 'demo_pose' and args.child_load_pose_type == 'demo_pose', \
+            'Must use demo poses when generating the demo scenes'
+    assert args.num_workers > 0, '--num_workers must be positive'
+    assert args.trials_per_task > 0, '--trials_per_task must be positive'
+    assert args.render_clients >= 0, "--render_clients can't be negative"
+    assert args.nerf_write_threads >= 0 and args.nerf_write_queue > 0
+    assert 0 <= args.nerf_png_compress_level <= 9, '--nerf_png_compress_level must be in [0, 9]'
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    start_time = time.perf_counter()
+    if args.num_workers > 1 and args.worker_id < 0:
+        run_parallel(args)
+    else:
+        main(args)
+    logger.info(f'Generated the datasets in {time.perf_counter() - start_time:.2f}s')
+
+    if args.upload_store is not None and args.worker_id < 0:
+        upload_dataset_dir(get_dataset_dir(args), LocalFSBackend(args.upload_store), name=f'{args.exp}/{args.logger_suffix}')
+        logger.info(f'NeRF datasets uploaded to {args.upload_store}')
+    elif args.upload and args.worker_id < 0:
+        dataset_prefix = upload_datasets_to_logger(get_dataset_dir(args), exp_name=f'{args.exp}/{args.logger_suffix}')
+        logger.info(f'NeRF datasets uploaded to ml-logger with prefix {dataset_prefix}')
@@ -0,0 +1,261 @@
+"""
+Precompute the V-HACD convex decompositions (the _dec.obj files) of all the evaluation
+meshes, so the eval and data generation scripts only have to read them.
+
+The decompositions are computed in a process pool, every output is written to a temporary
+file and renamed, and a manifest with the source hash, the V-HACD parameters, the output
+path and the extents/bounding box of every decomposed mesh is saved next to the meshes.
+Meshes whose source and parameters didn't change since the last run are skipped. The paths in
+the manifest are relative to the object descriptions directory, so it stays valid when the
+directory is moved or mounted somewhere else.
+
+    python -m rndf_robot.data_gen.precompute_vhacd --num_workers 16
+"""
+import argparse
+import hashlib
+import json
+import os, os.path as osp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pybullet as p
+import trimesh
+
+from loguru import logger
+
+from rndf_robot.utils import path_util
+
+
+# mesh directories of the object classes, relative to the object descriptions directory
+MESH_DATA_DIRS = {
+    'mug': 'mug_centered_obj_normalized',
+    'bottle': 'bottle_centered_obj_normalized',
+    'bowl': 'bowl_centered_obj_normalized',
+    'syn_rack_easy': 'syn_racks_easy_obj',
+    'syn_container': 'box_containers_unnormalized'
+}
+
+VHACD_PARAMS = dict(
+    concavity=0.0025,
+    alpha=0.04,
+    beta=0.05,
+    gamma=0.00125,
+    minVolumePerCH=0.0001,
+    resolution=1000000,
+    depth=20,
+    planeDownsampling=4,
+    convexhullDownsampling=4,
+    pca=0,
+    mode=0,
+    convexhullApproximation=1,
+)
+
+MANIFEST_FNAME = 'vhacd_manifest.json'
+
+
+def default_manifest_path() -> str:
+    return osp.join(path_util.get_rndf_obj_descriptions(), MANIFEST_FNAME)
+
+
+def manifest_key(path: str, root: Optional[str] = None) -> str:
+    """Path of a file in the manifest, relative to root (the object descriptions directory by default)"""
+    root = path_util.get_rndf_obj_descriptions() if root is None else root
+    return osp.relpath(osp.abspath(path), osp.abspath(root)).replace(os.sep, '/')
+
+
+def decomposed_path(obj_file: str) -> str:
+    """Path of the decomposed mesh for a source .obj file"""
+    return obj_file.split('.obj')[0] + '_dec.obj'
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """sha256 of the file contents"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_mesh_files(mesh_dir: str) -> List[str]:
+    """
+    Source meshes in one of the mesh data dirs, either ShapeNet style (<id>/models/model_normalized.obj)
+    or flat (<id>.obj). Decomposed meshes are skipped
+    """
+    mesh_files = []
+    for fn in sorted(os.listdir(mesh_dir)):
+        if '_dec' in fn:
+            continue
+        path = osp.join(mesh_dir, fn)
+        if osp.isdir(path):
+            path = osp.join(path, 'models/model_normalized.obj')
+            if osp.exists(path):
+                mesh_files.append(path)
+        elif fn.endswith('.obj'):
+            mesh_files.append(path)
+    return mesh_files
+
+
+def decompose_mesh(obj_file: str, params: Optional[Dict] = None, root: Optional[str] = None) -> Dict:
+    """
+    Run V-HACD on a mesh and write the decomposed mesh next to it (through a temporary file,
+    so concurrent readers never see a partial mesh)
+
+    Returns:
+        dict: Manifest entry for the mesh
+    """
+    params = VHACD_PARAMS if params is None else params
+    obj_file_dec = decomposed_path(obj_file)
+    tmp_fname = f'{obj_file_dec[:-len(".obj")]}.tmp.{os.getpid()}.obj'
+    log_fname = f'{tmp_fname}.log'
+    try:
+        p.vhacd(obj_file, tmp_fname, log_fname, **params)
+        os.replace(tmp_fname, obj_file_dec)
+    finally:
+        for fname in (tmp_fname, log_fname):
+            if osp.exists(fname):
+                os.remove(fname)
+    return manifest_entry(obj_file, params, root)
+
+
+def manifest_entry(obj_file: str, params: Optional[Dict] = None, root: Optional[str] = None) -> Dict:
+    """Manifest entry for a mesh whose decomposition exists"""
+    params = VHACD_PARAMS if params is None else params
+    obj_file_dec = decomposed_path(obj_file)
+    mesh = trimesh.load(obj_file_dec, force='mesh')
+    return dict(
+        source=manifest_key(obj_file, root),
+        source_sha256=file_hash(obj_file),
+        params=params,
+        output=manifest_key(obj_file_dec, root),
+        extents=np.asarray(mesh.extents).tolist(),
+        bounds=np.asarray(mesh.bounds).tolist(),
+    )
+
+
+def load_manifest(manifest_path: str, root: Optional[str] = None) -> Dict[str, Dict]:
+    """
+    Manifest of the decomposed meshes, source path (see manifest_key) -> entry (empty if there is
+    no manifest yet). The absolute paths of older manifests are made relative to root
+    """
+    if not osp.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+    for key in [key for key in manifest if osp.isabs(key)]:
+        entry = manifest.pop(key)
+        entry.update(source=manifest_key(entry['source'], root), output=manifest_key(entry['output'], root))
+        manifest[manifest_key(key, root)] = entry
+    return manifest
+
+
+def save_manifest(manifest: Dict[str, Dict], manifest_path: str) -> None:
+    tmp_fname = f'{manifest_path}.tmp.{os.getpid()}'
+    with open(tmp_fname, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_fname, manifest_path)
+
+
+def is_up_to_date(entry: Optional[Dict], obj_file: str, params: Optional[Dict] = None) -> bool:
+    """Check whether a manifest entry matches the current source mesh, parameters and output"""
+    params = VHACD_PARAMS if params is None else params
+    return entry is not None and entry['params'] == params and osp.exists(decomposed_path(obj_file)) \
+        and entry['source_sha256'] == file_hash(obj_file)
+
+
+def precompute(mesh_files: Sequence[str], manifest_path: str, num_workers: int = 1,
+               params: Optional[Dict] = None, force: bool = False, root: Optional[str] = None) -> Dict[str, Dict]:
+    """
+    Decompose all the meshes that aren't up to date in the manifest, and update the manifest.
+    Existing decompositions that aren't in the manifest yet are added as they are, unless force is set
+
+    Args:
+        root (str): Directory the paths in the manifest are relative to, see manifest_key
+
+    Returns:
+        dict: The updated manifest
+    """
+    params = VHACD_PARAMS if params is None else params
+    manifest = load_manifest(manifest_path, root)
+    todo = []
+    for obj_file in mesh_files:
+        key = manifest_key(obj_file, root)
+        if not force and is_up_to_date(manifest.get(key), obj_file, params):
+            continue
+        if not force and key not in manifest and osp.exists(decomposed_path(obj_file)):
+            # decomposed before there was a manifest
+            manifest[key] = manifest_entry(obj_file, params, root)
+            continue
+        todo.append(obj_file)
+    logger.info(f'{len(mesh_files) - len(todo)} of {len(mesh_files)} meshes are up to date, decomposing {len(todo)}')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(decompose_mesh, obj_file, params, root): obj_file for obj_file in todo}
+        for i, future in enumerate(as_completed(futures)):
+            obj_file = futures[future]
+            try:
+                manifest[manifest_key(obj_file, root)] = future.result()
+            except Exception as e:
+                logger.error(f'Decomposing {obj_file} failed: {e}')
+                failed.append(obj_file)
+                continue
+            logger.info(f'[{i + 1}/{len(todo)}] Decomposed {obj_file}')
+            if (i + 1) % 50 == 0:
+                # save progress, so an interrupted run doesn't start over
+                save_manifest(manifest, manifest_path)
+
+    save_manifest(manifest, manifest_path)
+    if len(failed) > 0:
+        raise RuntimeError(f'Decomposing {len(failed)} meshes failed: {failed}')
+    return manifest
+
+
+def get_decomposed(obj_file: str, manifest: Optional[Dict[str, Dict]] = None, allow_compute: bool = False,
+                   root: Optional[str] = None) -> str:
+    """
+    Path of the precomputed decomposition of a mesh
+
+    Args:
+        manifest (dict): If given, the mesh also has to be in the manifest
+        allow_compute (bool): Run V-HACD if the decomposition is missing, instead of raising
+        root (str): Directory the paths in the manifest are relative to, see manifest_key
+    """
+    obj_file_dec = decomposed_path(obj_file)
+    missing = not osp.exists(obj_file_dec) or (manifest is not None and manifest_key(obj_file, root) not in manifest)
+    if missing:
+        if not allow_compute:
+            raise FileNotFoundError(
+                f'No precomputed V-HACD decomposition for {obj_file}, '
+                f'run python -m rndf_robot.data_gen.precompute_vhacd first')
+        logger.warning(f'Decomposing {obj_file} with V-HACD, this can take a while')
+        entry = decompose_mesh(obj_file, root=root)
+        if manifest is not None:
+            manifest[manifest_key(obj_file, root)] = entry
+    return obj_file_dec
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Precompute the V-HACD decompositions of the evaluation meshes')
+    parser.add_argument('--classes', type=str, nargs='+', default=sorted(MESH_DATA_DIRS.keys()),
+                        choices=sorted(MESH_DATA_DIRS.keys()))
+    parser.add_argument('--manifest', type=str, default=None,
+                        help=f'Manifest path, defaults to {MANIFEST_FNAME} in the object descriptions directory')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--force', action='store_true', help='Decompose all the meshes again')
+    args = parser.parse_args(argv)
+
+    manifest_path = default_manifest_path() if args.manifest is None else args.manifest
+    mesh_files = []
+    for obj_class in args.classes:
+        mesh_dir = osp.join(path_util.get_rndf_obj_descriptions(), MESH_DATA_DIRS[obj_class])
+        class_mesh_files = source_mesh_files(mesh_dir)
+        logger.info(f'Found {len(class_mesh_files)} {obj_class} meshes in {mesh_dir}')
+        mesh_files.extend(class_mesh_files)
+    precompute(mesh_files, manifest_path, num_workers=args.num_workers, force=args.force)
+    logger.info(f'Wrote manifest to {manifest_path}')
+
+
+if __name__ == '__main__':
+    main()
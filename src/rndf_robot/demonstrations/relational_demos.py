@@ -24,6 +24,7 @@ from rndf_robot.utils.eval_gen_utils import constraint_obj_world, safeCollisionF
 
 from rndf_robot.config.default_eval_cfg import get_eval_cfg_defaults
 from rndf_robot.utils.pb2mc.pybullet_meshcat import PyBulletMeshcat
+from rndf_robot.data_gen.precompute_vhacd import get_decomposed
 
 from rndf_robot.share.globals import (
     SHAPENET_ID_DICT, bad_shapenet_mug_ids_list, bad_shapenet_bowls_ids_list, bad_shapenet_bottles_ids_list)
@@ -490,27 +491,8 @@ def main(args):
                             else:
                                 mesh_scale=[1.0] * 3
 
-                        # convert mesh with vhacd
-                        obj_obj_file_dec = fname.split('.obj')[0] + '_dec.obj'
-                        if not osp.exists(obj_obj_file_dec):
-                            print('converting via VHACD')
-                            p.vhacd(
-                                fname,
-                                obj_obj_file_dec,
-                                'log.txt',
-                                concavity=0.0025,
-                                alpha=0.04,
-                                beta=0.05,
-                                gamma=0.00125,
-                                minVolumePerCH=0.0001,
-                                resolution=1000000,
-                                depth=20,
-                                planeDownsampling=4,
-                                convexhullDownsampling=4,
-                                pca=0,
-                                mode=0,
-                                convexhullApproximation=1
-                            )
+                        # convert mesh with vhacd (usually precomputed with rndf_robot.data_gen.precompute_vhacd)
+                        obj_obj_file_dec = get_decomposed(fname, allow_compute=True)
                         obj_file_to_load = obj_obj_file_dec
                         mesh = trimesh.load(obj_file_to_load)
                         upright_rot = np.eye(4)
@@ -1,8 +1,6 @@
-import colorsys
 import os, os.path as osp
 import sys
 import random
-from itertools import cycle
 from loguru import logger
 
 import numpy as np
@@ -12,7 +10,9 @@ import torch
 import argparse
 import shutil
 import threading
+import queue
 import copy
+import glob
 import json
 import trimesh
 
@@ -25,44 +25,52 @@ from airobot.utils.pb_util import create_pybullet_client, TextureModder
 from airobot.sensor.camera.rgbdcam_pybullet import RGBDCameraPybullet
 
 import rndf_robot.model.vnn_occupancy_net_pointnet_dgcnn as vnn_occupancy_network
+from rndf_robot.model.weight_registry import NDFWeightRegistry
 from rndf_robot.config.default_nerf_cfg import get_nerf_cfg
 from rndf_robot.nerf.copy_datasets import copy_nerf_datasets
-from rndf_robot.nerf.dataset import write_instant_ngp_dataset
+from rndf_robot.nerf.async_writer import AsyncDatasetWriter
+from rndf_robot.nerf.dataset import ENCODINGS, write_instant_ngp_dataset
+from rndf_robot.nerf.packed import pack_nerf_datasets
 from rndf_robot.nerf.upload_datasets import upload_datasets_to_logger
+from rndf_robot.nerf.uploader import LocalFSBackend, upload_dataset_dir
 from rndf_robot.utils import util, path_util
 
 from rndf_robot.opt.optimizer import OccNetOptimizer
+from rndf_robot.opt.descriptor_projection import DescriptorProjection
 from rndf_robot.robot.multicam import MultiCams
+from rndf_robot.robot.capture import MultiCamCapture, RendererPool
 from rndf_robot.config.default_eval_cfg import get_eval_cfg_defaults
 from rndf_robot.share.globals import bad_shapenet_mug_ids_list, bad_shapenet_bowls_ids_list, bad_shapenet_bottles_ids_list
-from rndf_robot.utils.pb2mc.pybullet_meshcat import PyBulletMeshcat
-from rndf_robot.utils.eval_gen_utils import constraint_obj_world, safeCollisionFilterPair, safeRemoveConstraint
-
-from rndf_robot.eval.relation_tools.multi_ndf import infer_relation_intersection, create_target_descriptors
+from rndf_robot.data_gen.precompute_vhacd import MESH_DATA_DIRS, get_decomposed, load_manifest, default_manifest_path
+from rndf_robot.utils.pb2mc.pybullet_meshcat import PyBulletMeshcat, NullVisualizer
+from rndf_robot.utils.scene_snapshot import SceneSnapshots
+from rndf_robot.utils.body_pool import BodyPool
+from rndf_robot.utils.jsonl import append_jsonl, load_jsonl
+from rndf_robot.utils.profiling import TrialProfiler, format_trial_records
+from rndf_robot.utils.eval_gen_utils import constraint_obj_world, safeCollisionFilterPair, safeRemoveConstraint, step_until_settled
+
+from rndf_robot.eval.relation_tools.multi_ndf import infer_relation_intersection, infer_relation_intersection_batch, create_target_descriptors
+from rndf_robot.eval.results_store import results_fname, append_result, load_run_results
+from rndf_robot.eval.resume import load_completed_trials, clean_unfinished_trials, partial_trial_dir, finalize_trial_dir
+from rndf_robot.eval.parallel_eval import shard_trials, supervise_workers, merge_worker_results
+from rndf_robot.eval.seeding import seed_trial, trial_rngs
+from rndf_robot.eval.scene_sampling import (
+    PCL, UPRIGHT_ORIENTATIONS, make_pc_master_dict, mesh_files, sample_object_ids, fit_container_scale, sample_object)
 
 
 NOISE_VALUE_LIST = [0.01, 0.02, 0.03, 0.04, 0.06, 0.08, 0.16, 0.24, 0.32, 0.4]
 
 
-def random_color() -> (float, float, float):
-    """
-    Generate a random color. Use HSV so that the colors are evenly distributed.
-    Returns a tuple of 3 floats in the range [0, 1]
-    """
-    h, s, v = [random.random() for i in range(3)]
-    r, g, b = colorsys.hsv_to_rgb(h, s, v)
-    return r, g, b
-
-
-def pb2mc_update(recorder, mc_vis, stop_event, run_event):
+def pb2mc_update(recorder, mc_vis, stop_event, run_event, publish=True, rate=230.0):
     iters = 0
     # while True:
     while not stop_event.is_set():
         run_event.wait()
         iters += 1
         recorder.add_keyframe()
-        recorder.update_meshcat_current_state(mc_vis)
-        time.sleep(1/230.0)
+        if publish:
+            recorder.update_meshcat_current_state(mc_vis)
+        time.sleep(1/rate)
 
 
 def create_target_desc_subdir(demo_path, parent_model_path, child_model_path):
@@ -78,29 +86,7 @@ def create_target_desc_subdir(demo_path, parent_model_path, child_model_path):
     return dirname
 
 
-def main(args):
-
-    #####################################################################################
-    # set up all generic experiment info
-    assert args.relation_method in ['intersection', 'ebm'], 'Invalid argument for --relation_method'
-
-    if args.debug:
-        set_log_level('debug')
-    else:
-        set_log_level('info')
-        # By default, loguru log level is DEBUG so let's set it to INFO
-        logger.remove()
-        logger.add(sys.stderr, level="INFO")
-
-    signal.signal(signal.SIGINT, util.signal_handler)
-
-    demo_path  = osp.join(path_util.get_rndf_data(), 'relation_demos', args.rel_demo_exp)
-    demo_files = [fn for fn in sorted(os.listdir(demo_path)) if fn.endswith('.npz')]
-    demos = []
-    for f in demo_files:
-        demo = np.load(demo_path+'/'+f, allow_pickle=True)
-        demos.append(demo)
-
+def get_eval_save_dir(args):
     parent_model_name_full = args.parent_model_path.split('ndf_vnn/')[-1]
     child_model_name_full = args.child_model_path.split('ndf_vnn/')[-1]
 
@@ -128,16 +114,55 @@ def main(args):
     eval_save_dir = osp.join(eval_save_dir_root, experiment_name_spec_model)
     util.safe_makedirs(eval_save_dir_root)
     util.safe_makedirs(eval_save_dir)
+    return eval_save_dir
+
+
+def main(args):
+
+    #####################################################################################
+    # set up all generic experiment info
+    assert args.relation_method in ['intersection', 'ebm'], 'Invalid argument for --relation_method'
+
+    if args.debug:
+        set_log_level('debug')
+    else:
+        set_log_level('info')
+        # By default, loguru log level is DEBUG so let's set it to INFO
+        logger.remove()
+        logger.add(sys.stderr, level="INFO")
 
-    zmq_url = 'tcp://127.0.0.1:6000'
-    log_warn(f'Starting meshcat at zmq_url: {zmq_url}')
-    mc_vis = meshcat.Visualizer(zmq_url=zmq_url)
-    mc_vis['scene'].delete()
+    signal.signal(signal.SIGINT, util.signal_handler)
+
+    demo_path  = osp.join(path_util.get_rndf_data(), 'relation_demos', args.rel_demo_exp)
+    demo_files = [fn for fn in sorted(os.listdir(demo_path)) if fn.endswith('.npz')]
+    demos = []
+    for f in demo_files:
+        demo = np.load(demo_path+'/'+f, allow_pickle=True)
+        demos.append(demo)
+
+    if args.test_on_train:
+        assert args.start_iteration == 0, "If testing on train, start iteration must be 0"
+        og_num_iterations = args.num_iterations
+        args.num_iterations = len(demos)
+        log_warn(
+            f"Testing on train, overriding num_iterations to {args.num_iterations} = len(demos) "
+            f"from {og_num_iterations}"
+        )
+
+    eval_save_dir = get_eval_save_dir(args)
+
+    if args.disable_meshcat or args.meshcat_record:
+        mc_vis = NullVisualizer()
+    else:
+        zmq_url = 'tcp://127.0.0.1:6000'
+        log_warn(f'Starting meshcat at zmq_url: {zmq_url}')
+        mc_vis = meshcat.Visualizer(zmq_url=zmq_url)
+        mc_vis['scene'].delete()
 
     pb_client = create_pybullet_client(
         gui=args.pybullet_viz,
         opengl_render=True,
-        realtime=True,
+        realtime=not args.step_physics,
         server=args.pybullet_server,
         # Note: you can just modify this method in airobot in place for now
         # options=(
@@ -155,7 +180,48 @@ def main(args):
         # Disable shadows
         p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, 0, physicsClientId=pb_client.get_client_id())
 
-    recorder = PyBulletMeshcat(pb_client=pb_client)
+    # With --step_physics, realtime simulation stays off and the simulation is only advanced
+    # by stepping it until the objects come to rest, instead of sleeping while it runs in realtime
+    physics_dt = p.getPhysicsEngineParameters(physicsClientId=pb_client.get_client_id())['fixedTimeStep']
+
+    def set_step_sim(step_mode):
+        if not args.step_physics:
+            pb_client.set_step_sim(step_mode)
+
+    def run_physics(duration, body_ids):
+        """Let the simulation run for (up to) duration seconds of simulated time"""
+        if args.step_physics:
+            n_steps = step_until_settled(
+                body_ids, max_steps=int(round(duration / physics_dt)),
+                lin_vel_thresh=args.settle_lin_vel_thresh, ang_vel_thresh=args.settle_ang_vel_thresh,
+                client_id=pb_client.get_client_id(), step_callback=record_step_callback)
+            log_debug(f'Physics settled after {n_steps} steps ({n_steps * physics_dt:.2f}s simulated, budget {duration:.2f}s)')
+        else:
+            time.sleep(duration)
+
+    # the success checks branch off one snapshot of the scene before the placement
+    snapshots = SceneSnapshots(client_id=pb_client.get_client_id())
+    # objects that come back in later trials are reused instead of loaded again
+    body_pool = BodyPool(client_id=pb_client.get_client_id(), max_parked=args.body_pool_size)
+
+    recorder = PyBulletMeshcat(
+        pb_client=pb_client, headless=args.disable_meshcat,
+        max_keyframes=args.meshcat_max_keyframes if args.meshcat_max_keyframes > 0 else None,
+        pos_tol=args.meshcat_pos_tol, rot_tol=args.meshcat_rot_tol,
+        # when stepping, the keyframes are recorded from the stepping loop on the main client
+        client_id=pb_client.get_client_id() if args.meshcat_record and args.step_physics else None)
+
+    # with --meshcat_record, keyframes are recorded every record_every physics steps, and
+    # timestamped with the simulated time so the replay runs at the simulated rate
+    record_every = max(1, int(round(1.0 / (args.meshcat_record_rate * physics_dt))))
+    n_physics_steps = [0]
+
+    def record_step(i):
+        n_physics_steps[0] += 1
+        if n_physics_steps[0] % record_every == 0:
+            recorder.add_keyframe(t=n_physics_steps[0] * physics_dt)
+
+    record_step_callback = record_step if args.meshcat_record and args.step_physics else None
     recorder.clear()
 
     torch.manual_seed(args.seed)
@@ -195,15 +261,17 @@ def main(args):
     parent_model = vnn_occupancy_network.VNNOccNet(latent_dim=256, model_type='pointnet', return_features=True, sigmoid=True)
     child_model = vnn_occupancy_network.VNNOccNet(latent_dim=256, model_type='pointnet', return_features=True, sigmoid=True)
 
+    # checkpoints are read from disk once, and weights are only copied back into
+    # the models if something modified them since the last call
+    weight_registry = NDFWeightRegistry()
+
     def load_ndf_weights():
-        map_device = torch.device('cpu')
         if torch.cuda.is_available():
             parent_model.cuda()
             child_model.cuda()
-            map_device = torch.device('cuda')
 
-        parent_model.load_state_dict(torch.load(parent_model_path, map_location=map_device))
-        child_model.load_state_dict(torch.load(child_model_path, map_location=map_device))
+        weight_registry.restore(parent_model, parent_model_path)
+        weight_registry.restore(child_model, child_model_path)
 
     cams = MultiCams(cfg.CAMERA, pb_client, n_cams=cfg.N_CAMERAS)
     cam_info = {}
@@ -221,14 +289,16 @@ def main(args):
     #####################################################################################
     # load all the multi class mesh info
 
-    mesh_data_dirs = {
-        'mug': 'mug_centered_obj_normalized', 
-        'bottle': 'bottle_centered_obj_normalized', 
-        'bowl': 'bowl_centered_obj_normalized',
-        'syn_rack_easy': 'syn_racks_easy_obj',
-        'syn_container': 'box_containers_unnormalized'
-    }
-    mesh_data_dirs = {k: osp.join(path_util.get_rndf_obj_descriptions(), v) for k, v in mesh_data_dirs.items()}
+    mesh_data_dirs = {k: osp.join(path_util.get_rndf_obj_descriptions(), v) for k, v in MESH_DATA_DIRS.items()}
+
+    # the V-HACD decompositions are precomputed with rndf_robot.data_gen.precompute_vhacd
+    vhacd_manifest_path = default_manifest_path()
+    vhacd_manifest = load_manifest(vhacd_manifest_path) if osp.exists(vhacd_manifest_path) else None
+    if vhacd_manifest is None:
+        log_warn(f'No V-HACD manifest at {vhacd_manifest_path}, only checking that the decomposed meshes exist')
+
+    def ensure_decomposed(obj_file):
+        get_decomposed(obj_file, vhacd_manifest, allow_compute=args.allow_vhacd)
 
     bad_ids = {
         'syn_rack_easy': [],
@@ -238,14 +308,6 @@ def main(args):
         'syn_container': []
     }
 
-    upright_orientation_dict = {
-        'mug': common.euler2quat([np.pi/2, 0, 0]).tolist(), 
-        'bottle': common.euler2quat([np.pi/2, 0, 0]).tolist(), 
-        'bowl': common.euler2quat([np.pi/2, 0, 0]).tolist(),
-        'syn_rack_easy': common.euler2quat([0, 0, 0]).tolist(),
-        'syn_container': common.euler2quat([0, 0, 0]).tolist(),
-    }
-
     mesh_names = {}
     for k, v in mesh_data_dirs.items():
         # get train samples
@@ -266,13 +328,8 @@ def main(args):
 
     obj_classes = list(mesh_names.keys())
 
-    scale_high, scale_low = cfg.MESH_SCALE_HIGH, cfg.MESH_SCALE_LOW
-    scale_default = cfg.MESH_SCALE_DEFAULT
-
     # cfg.OBJ_SAMPLE_Y_HIGH_LOW = [0.3, -0.3]
     cfg.OBJ_SAMPLE_Y_HIGH_LOW = [-0.35, 0.175]
-    x_low, x_high = cfg.OBJ_SAMPLE_X_HIGH_LOW
-    y_low, y_high = cfg.OBJ_SAMPLE_Y_HIGH_LOW
     table_z = cfg.TABLE_Z
 
     #####################################################################################
@@ -283,83 +340,13 @@ def main(args):
     is_parent_shapenet_obj = args.is_parent_shapenet_obj
     is_child_shapenet_obj = args.is_child_shapenet_obj
 
-    pcl = ['parent', 'child']
-    pc_master_dict = dict(parent={}, child={})
-    pc_master_dict['parent']['class'] = parent_class
-    pc_master_dict['child']['class'] = child_class
-    
-    valid_load_pose_types = ['any_pose', 'demo_pose', 'random_upright']
-    assert args.parent_load_pose_type in valid_load_pose_types, f'Invalid string value for args.parent_load_pose_type! Must be in {", ".join(valid_load_pose_types)}'
-    assert args.child_load_pose_type in valid_load_pose_types, f'Invalid string value for args.child_load_pose_type! Must be in {", ".join(valid_load_pose_types)}'
-
-    pc_master_dict['parent']['load_pose_type'] = args.parent_load_pose_type
-    pc_master_dict['child']['load_pose_type'] = args.child_load_pose_type
-
-    # load in ids for objects that can be used for testing
-    pc_master_dict['parent']['test_ids'] = np.loadtxt(osp.join(path_util.get_rndf_share(), '%s_test_object_split.txt' % parent_class), dtype=str).tolist()
-    pc_master_dict['child']['test_ids'] = np.loadtxt(osp.join(path_util.get_rndf_share(), '%s_test_object_split.txt' % child_class), dtype=str).tolist()
-
-    # process these to remove the file type
-    pc_master_dict['parent']['test_ids'] = [val.split('.')[0] for val in pc_master_dict['parent']['test_ids']]
-    pc_master_dict['child']['test_ids'] = [val.split('.')[0] for val in pc_master_dict['child']['test_ids']]
+    pcl = list(PCL)
+    pc_master_dict = make_pc_master_dict(
+        parent_class, child_class, args.parent_load_pose_type, args.child_load_pose_type, cfg, demos)
 
     log_info(f'Test ids (parent): {", ".join(pc_master_dict["parent"]["test_ids"])}')
     log_info(f'Test ids (child): {", ".join(pc_master_dict["child"]["test_ids"])}')
 
-    for pc in pcl:
-        object_class = pc_master_dict[pc]['class']
-        if object_class == 'mug':
-            avoid_ids = bad_shapenet_mug_ids_list + cfg.MUG.AVOID_SHAPENET_IDS
-        elif object_class == 'bowl':
-            avoid_ids = bad_shapenet_bowls_ids_list + cfg.BOWL.AVOID_SHAPENET_IDS
-        elif object_class == 'bottle':
-            avoid_ids = bad_shapenet_bottles_ids_list + cfg.BOTTLE.AVOID_SHAPENET_IDS
-        else:
-            avoid_ids = []
-
-        pc_master_dict[pc]['avoid_ids'] = avoid_ids
-
-    pc_master_dict['parent']['xhl'] = [x_high, x_low]
-    # pc_master_dict['parent']['yhl'] = [y_high, 0.075]
-    pc_master_dict['parent']['yhl'] = [0.2, 0.075]
-    # pc_master_dict['parent']['yhl'] = [y_high, 0.05]
-
-    pc_master_dict['child']['xhl'] = [x_high, x_low]
-    # pc_master_dict['child']['yhl'] = [-0.2, y_low]
-    pc_master_dict['child']['yhl'] = [-0.2, -0.3]
-    # pc_master_dict['child']['yhl'] = [-0.075, y_low]
-    # pc_master_dict['child']['yhl'] = [-0.05, y_low]
-
-    # get the class specific ranges for scaling the objects
-    for pc in pcl:
-        if pc_master_dict[pc]['class'] == 'mug':
-            pc_master_dict[pc]['scale_hl'] = [0.35, 0.25]
-            pc_master_dict[pc]['scale_default'] = 0.3
-        if pc_master_dict[pc]['class'] == 'bowl':
-            pc_master_dict[pc]['scale_hl'] = [0.325, 0.15]
-            pc_master_dict[pc]['scale_default'] = 0.3
-        if pc_master_dict[pc]['class'] == 'bottle':
-            pc_master_dict[pc]['scale_hl'] = [0.35, 0.2]
-            pc_master_dict[pc]['scale_default'] = 0.3
-        if pc_master_dict[pc]['class'] == 'syn_rack_easy':
-            # pc_master_dict[pc]['scale_hl'] = [1.1, 0.9]
-            # pc_master_dict[pc]['scale_default'] = 1.0
-            pc_master_dict[pc]['scale_hl'] = [0.35, 0.25]
-            pc_master_dict[pc]['scale_default'] = 0.3
-        if pc_master_dict[pc]['class'] == 'syn_container':
-            pc_master_dict[pc]['scale_hl'] = [1.1, 0.9]
-            pc_master_dict[pc]['scale_default'] = 1.0
-
-    # pc_master_dict['parent']['scale_hl'] = [0.45, 0.25]
-    # pc_master_dict['parent']['scale_default'] = 0.3
-    # pc_master_dict['child']['scale_hl'] = [1.1, 0.9]
-    # pc_master_dict['child']['scale_default'] = 1.0
-
-    # pc_master_dict['parent']['scale_hl'] = [1.1, 0.9]
-    # pc_master_dict['parent']['scale_default'] = 1.0
-    # pc_master_dict['child']['scale_hl'] = [0.45, 0.25]
-    # pc_master_dict['child']['scale_default'] = 0.3
-
     pc_master_dict['parent']['model_path'] = parent_model_path
     pc_master_dict['child']['model_path'] = child_model_path
 
@@ -380,11 +367,6 @@ def main(args):
             pc_master_dict[pc]['demo_start_pcds'].append(s_pcd)
             pc_master_dict[pc]['demo_final_pcds'].append(f_pcd)
 
-    # load data from demos in case we want to test on the shapes we trained on
-    for pc in pcl:
-        pc_master_dict[pc]['demo_ids'] = [dat['multi_object_ids'].item()[pc] for dat in demos]
-        pc_master_dict[pc]['demo_start_poses'] = [dat['multi_obj_start_obj_pose'].item()[pc] for dat in demos]
-
     #####################################################################################
     # prepare the target descriptors
 
@@ -414,6 +396,7 @@ def main(args):
                 skip_alignment=args.skip_alignment, n_demos=n_demos, manual_target_idx=args.target_idx,
                 add_noise=add_noise, interaction_pt_noise_std=noise_value,
                 use_keypoint_offset=use_keypoint_offset, keypoint_offset_params=keypoint_offset_params,
+                projection_dim=args.desc_proj_dim if args.desc_proj_dim > 0 else None,
                 visualize=True, mc_vis=mc_vis)
 
     if osp.exists(target_desc_fname):
@@ -429,8 +412,10 @@ def main(args):
         parent_query_points = target_descriptors_data['parent_query_points']
         child_query_points = copy.deepcopy(parent_query_points)
 
-        log_info(f'Making a copy of the target descriptors in eval folder')
-        shutil.copy(target_desc_fname, eval_save_dir)
+        if args.worker_id < 0:
+            # with parallel workers, the runner already made the copy
+            log_info(f'Making a copy of the target descriptors in eval folder')
+            shutil.copy(target_desc_fname, eval_save_dir)
 
         parent_optimizer = OccNetOptimizer(
             parent_model,
@@ -448,9 +433,27 @@ def main(args):
 
         parent_optimizer.setup_meshcat(mc_vis)
         child_optimizer.setup_meshcat(mc_vis)
+
+        if args.desc_proj_dim > 0:
+            for label, optimizer, overall_target_desc in [
+                    ('parent', parent_optimizer, parent_overall_target_desc),
+                    ('child', child_optimizer, child_overall_target_desc)]:
+                desc_projection = DescriptorProjection.from_npz(target_descriptors_data, label)
+                if desc_projection is None or desc_projection.dim < args.desc_proj_dim:
+                    log_warn(f'No {label} descriptor projection with at least {args.desc_proj_dim} components '
+                             f'in {target_desc_fname}, fitting one on the target descriptors. Use --new_descriptors '
+                             f'to fit on all the aligned demo descriptors instead')
+                    desc_projection = DescriptorProjection.fit(overall_target_desc, args.desc_proj_dim)
+                desc_projection = desc_projection.truncate(min(args.desc_proj_dim, desc_projection.dim))
+                log_info(f'Matching {label} descriptors in {desc_projection.dim} dimensions, '
+                         f'explained variance ratio: {desc_projection.explained_variance_ratio:.4f}')
+                optimizer.set_descriptor_projection(desc_projection)
     else:
         raise RuntimeError("Is this ever raised? Comment by willshen@")
 
+    if args.prepare_only:
+        return
+
     #########################################################################
     # Set up the relational energy model
 
@@ -476,15 +479,39 @@ def main(args):
     # Add plane
     if args.plane_texture == "plane":
         # We set the height of the plane to 0.7 so it's closer to the table
-        _ = pb_client.load_urdf("plane.urdf", [0, 0, 0.7])
+        plane_id = pb_client.load_urdf("plane.urdf", [0, 0, 0.7])
         # This doesn't work
         # recorder.register_object(plane_id, osp.join(pybullet_data.getDataPath(), "plane.urdf"))
 
+    # the observation cameras are few and small, only the NeRF cameras are worth spreading over renderer processes
+    obs_capture = MultiCamCapture(cams)
+    nerf_renderer_pool = None
+    if args.render_clients > 0 and not args.disable_nerf_cams:
+        nerf_renderer_pool = RendererPool(
+            nerf_cfg.CAMERA, nerf_cfg.N_CAMERAS, args.render_clients, client_id=pb_client.get_client_id(),
+            shadows=args.pybullet_debug_viz)
+    nerf_capture = MultiCamCapture(nerf_cams, nerf_renderer_pool)
+    nerf_capture.register_body(table_id, dict(kind='urdf', file=table_urdf_fname, scale=1.0))
+    if args.plane_texture == "plane":
+        nerf_capture.register_body(plane_id, dict(kind='urdf', file="plane.urdf", scale=1.0))
+    # with --nerf_write_threads, the NeRF datasets are written in the background and the trials are
+    # finished (folder renamed, results recorded) by the writer threads, one at a time
+    nerf_writer = None
+    if args.nerf_write_threads > 0 and not args.disable_nerf_cams:
+        nerf_writer = AsyncDatasetWriter(args.nerf_write_threads, args.nerf_write_queue, args.nerf_encoding,
+                                         args.nerf_png_compress_level)
+    finish_lock = threading.Lock()
+
     rec_stop_event = threading.Event()
     rec_run_event = threading.Event()
-    rec_th = threading.Thread(target=pb2mc_update, args=(recorder, mc_vis, rec_stop_event, rec_run_event))# , mc_vis))
-    rec_th.daemon = True
-    rec_th.start()
+    if not args.disable_meshcat and not (args.meshcat_record and args.step_physics):
+        # headless runs don't have an update thread at all, pausing it is a no-op
+        rec_th = threading.Thread(
+            target=pb2mc_update, args=(recorder, mc_vis, rec_stop_event, rec_run_event),
+            kwargs=dict(publish=not args.meshcat_record,
+                        rate=args.meshcat_record_rate if args.meshcat_record else 230.0))
+        rec_th.daemon = True
+        rec_th.start()
 
     pause_mc_thread = lambda pause_bool : rec_run_event.clear() if pause_bool else rec_run_event.set()
     pause_mc_thread(False)
@@ -511,463 +538,474 @@ def main(args):
     for k, v in util.cn2dict(cfg).items():
         full_cfg_dict[k] = v
     full_cfg_fname = osp.join(eval_save_dir, 'full_exp_cfg.txt')
-    json.dump(full_cfg_dict, open(full_cfg_fname, 'w', encoding='utf-8'), ensure_ascii=False, indent=4)
+    if args.worker_id <= 0:
+        # only one of the parallel workers writes the shared config
+        json.dump(full_cfg_dict, open(full_cfg_fname, 'w', encoding='utf-8'), ensure_ascii=False, indent=4)
 
     #####################################################################################
     # start experiment: sample parent and child object on each iteration and infer the relation
     place_success_list = []
 
-    demo_indices_cycle = cycle(range(len(demos)))
+    if args.status_fd >= 0:
+        # supervised worker, the trials come from the supervisor (which also takes care of resuming)
+        trial_indices = []
+        status_f = os.fdopen(args.status_fd, 'w', buffering=1)
+    elif args.worker_id >= 0:
+        trial_indices = shard_trials(args.start_iteration, args.num_iterations, args.num_workers, args.worker_id)
+        log_info(f'Worker {args.worker_id}/{args.num_workers} running trials: {trial_indices}')
+    else:
+        trial_indices = list(range(args.start_iteration, args.num_iterations))
+
+    status_lock = threading.Lock()
+
+    def report_status(msg):
+        """Tell the supervisor (see parallel_eval.supervise_workers) how far this worker is"""
+        if args.status_fd >= 0:
+            # the trials can be finished by the NeRF writer threads
+            with status_lock:
+                status_f.write(msg + '\n')
+
+    # resume: skip the trials that are already in the results log, and clean up after interrupted ones
+    done_trials = load_completed_trials(eval_save_dir)
+    clean_unfinished_trials(eval_save_dir, trial_indices, done_trials)
+    if not args.no_resume:
+        skipped_trials = [iteration for iteration in trial_indices if iteration in done_trials]
+        if len(skipped_trials) > 0:
+            log_info(f'Resuming, skipping {len(skipped_trials)} completed trials: {skipped_trials}')
+            if not args.per_trial_seed:
+                log_warn('Resuming without --per_trial_seed, the remaining trials get different seeds than in an uninterrupted run')
+            place_success_list = [bool(record['place_success']) for record in load_run_results(eval_save_dir)
+                                  if record['trial'] in skipped_trials]
+        trial_indices = [iteration for iteration in trial_indices if iteration not in done_trials]
+
+    def spawn_object(obj, pos, ori):
+        """
+        Load a trial object into the simulator at pos/ori (or reuse a parked body with the same
+        mesh and scale), and constrain it to the world frame pose it was sampled at if needed
+        """
+        obj_id, _ = body_pool.acquire(
+            obj['mesh_file_dec'], obj['mesh_scale'],
+            lambda: pb_client.load_geom(
+                'mesh',
+                mass=0.01,
+                mesh_scale=obj['mesh_scale'],
+                visualfile=obj['mesh_file_dec'],
+                collifile=obj['mesh_file_dec'],
+                base_pos=pos,
+                base_ori=ori),
+            pos, ori)
 
-    if args.test_on_train:
-        assert args.start_iteration == 0, "If testing on train, start iteration must be 0"
-        og_num_iterations = args.num_iterations
-        args.num_iterations = len(demos)
-        log_warn(
-            f"Testing on train, overriding num_iterations to {args.num_iterations} = len(demos) "
-            f"from {og_num_iterations}"
-        )
+        # change the texture
+        texture_modder.set_rgba(obj_id, -1, obj['rgba'])
+
+        # register the object with the meshcat visualizer
+        recorder.register_object(obj_id, obj['mesh_file_dec'], scaling=obj['mesh_scale'])
+        nerf_capture.register_body(obj_id, dict(kind='mesh', file=obj['mesh_file_dec'], scale=obj['mesh_scale']), obj['rgba'])
+
+        # safeCollisionFilterPair(bodyUniqueIdA=obj_id, bodyUniqueIdB=table_id, linkIndexA=-1, linkIndexB=rack_link_id, enableCollision=False)
+        safeCollisionFilterPair(bodyUniqueIdA=obj_id, bodyUniqueIdB=table_id, linkIndexA=-1, linkIndexB=table_base_id, enableCollision=False)
+        p.changeDynamics(obj_id, -1, lateralFriction=0.5, linearDamping=5, angularDamping=5)
+
+        # depending on the object/pose type, constrain the object to its world frame pose
+        o_cid = None
+        if obj['constrain']:
+            o_cid = constraint_obj_world(obj_id, obj['pos'], obj['ori'])
+            set_step_sim(False)
+        obj['o_cid'] = o_cid
+
+        # safeCollisionFilterPair(obj_id, table_id, -1, -1, enableCollision=True)
+        safeCollisionFilterPair(obj_id, table_id, -1, table_base_id, enableCollision=True)
+
+        obj['pb_obj_id'] = obj_id
+        return obj_id
+
+    def remove_objects(trial):
+        for pc in pcl:
+            obj_id = trial['objects'][pc]['pb_obj_id']
+            body_pool.release(obj_id)
+            recorder.remove_object(obj_id, mc_vis)
+            nerf_capture.unregister_body(obj_id)
+            trial['objects'][pc]['pb_obj_id'] = None
+
+    def stash_objects(trial):
+        """Remember where the trial objects came to rest and take them out of the scene"""
+        for pc in pcl:
+            obj = trial['objects'][pc]
+            obj['settled_pose'] = np.concatenate(pb_client.get_body_state(obj['pb_obj_id'])[:2]).tolist()
+        pause_mc_thread(True)
+        remove_objects(trial)
+        pause_mc_thread(False)
+
+    def restore_objects(trial):
+        """Put stashed trial objects back into the scene, at rest where they were observed"""
+        for pc in pcl:
+            obj = trial['objects'][pc]
+            spawn_object(obj, obj['settled_pose'][:3], obj['settled_pose'][3:])
+
+    def setup_trial(iteration):
+        """
+        Sample the parent/child objects and their poses for a trial, load them into the scene
+        and capture the observations (segmented point clouds and NeRF images)
+        """
+        trial_start_time = time.perf_counter()
+        profiler = TrialProfiler(sync_cuda=args.profile_sync_cuda)
+        report_status(f'start {iteration}')
 
-    for iteration in range(args.start_iteration, args.num_iterations):
         #####################################################################################
         # set up the trial
 
+        if args.per_trial_seed:
+            # scene sampling draws from its own generators, so it doesn't depend on (or interfere
+            # with) what the optimizer draws, possibly concurrently in --pipeline mode
+            np_rng, py_rng = trial_rngs(args.seed, iteration, stream=0)
+        else:
+            np_rng, py_rng = np.random, random
+
         # Cycle through the demos instead of just randomly sampling
         # demo_idx = np.random.randint(len(demos))
-        demo_idx = next(demo_indices_cycle)
+        demo_idx = iteration % len(demos)
         # willshen@ comment, unused variable so commented out
         # demo = demos[demo_idx]
+        parent_id, child_id = sample_object_ids(pc_master_dict, demo_idx, args.test_on_train, py_rng)
         if args.test_on_train:
-            parent_id = pc_master_dict['parent']['demo_ids'][demo_idx]
-            child_id = pc_master_dict['child']['demo_ids'][demo_idx]
             log_info(f"Using demo {demo_idx} for parent and child objects")
-        else:
-            parent_id = random.sample(pc_master_dict['parent']['test_ids'], 1)[0]
-            child_id = random.sample(pc_master_dict['child']['test_ids'], 1)[0]
-
-        if '_dec' in parent_id:
-            parent_id = parent_id.replace('_dec', '')
-        if '_dec' in child_id:
-            child_id = child_id.replace('_dec', '')
 
         id_str = f'Parent ID: {parent_id}, Child ID: {child_id}'
         log_info(id_str)
 
-        # make folder for saving this trial
-        eval_iter_dir = osp.join(eval_save_dir, f'trial_{iteration}')
+        # make folder for saving this trial, it is moved to trial_<iteration> once the trial is done
+        eval_iter_dir = partial_trial_dir(eval_save_dir, iteration)
         util.safe_makedirs(eval_iter_dir)
+        if args.meshcat_record:
+            recorder.start_recording()
 
         #####################################################################################
         # load parent/child objects into the scene -- mesh file, pose, and pybullet object id
 
-        if is_parent_shapenet_obj:
-            parent_obj_file = osp.join(mesh_data_dirs[parent_class], parent_id, 'models/model_normalized.obj')
-            parent_obj_file_dec = parent_obj_file.split('.obj')[0] + '_dec.obj'
-        else:
-            parent_obj_file = osp.join(mesh_data_dirs[parent_class], parent_id + '.obj')
-            parent_obj_file_dec = parent_obj_file.split('.obj')[0] + '_dec.obj'
-
-        if is_child_shapenet_obj:
-            child_obj_file = osp.join(mesh_data_dirs[child_class], child_id, 'models/model_normalized.obj')
-            child_obj_file_dec = child_obj_file.split('.obj')[0] + '_dec.obj'
-        else:
-            child_obj_file = osp.join(mesh_data_dirs[child_class], child_id + '.obj')
-            child_obj_file_dec = child_obj_file.split('.obj')[0] + '_dec.obj'
+        parent_obj_file, parent_obj_file_dec = mesh_files(mesh_data_dirs[parent_class], parent_id, is_parent_shapenet_obj)
+        child_obj_file, child_obj_file_dec = mesh_files(mesh_data_dirs[child_class], child_id, is_child_shapenet_obj)
 
         new_parent_scale = None
         # check if bottle/container are the right sizes
         if parent_class == 'syn_container' and child_class == 'bottle':
-            if not osp.exists(parent_obj_file_dec):
-                p.vhacd(
-                    parent_obj_file,
-                    parent_obj_file_dec,
-                    'log.txt',
-                    concavity=0.0025,
-                    alpha=0.04,
-                    beta=0.05,
-                    gamma=0.00125,
-                    minVolumePerCH=0.0001,
-                    resolution=1000000,
-                    depth=20,
-                    planeDownsampling=4,
-                    convexhullDownsampling=4,
-                    pca=0,
-                    mode=0,
-                    convexhullApproximation=1
-                )
-            if not osp.exists(child_obj_file_dec):
-                p.vhacd(
-                    child_obj_file,
-                    child_obj_file_dec,
-                    'log.txt',
-                    concavity=0.0025,
-                    alpha=0.04,
-                    beta=0.05,
-                    gamma=0.00125,
-                    minVolumePerCH=0.0001,
-                    resolution=1000000,
-                    depth=20,
-                    planeDownsampling=4,
-                    convexhullDownsampling=4,
-                    pca=0,
-                    mode=0,
-                    convexhullApproximation=1
-                )
-
-            container_mesh = trimesh.load(parent_obj_file_dec)
-            bottle_mesh = trimesh.load(child_obj_file_dec)
-            container_mesh.apply_scale(pc_master_dict['parent']['scale_default'])
-            bottle_mesh.apply_scale(pc_master_dict['child']['scale_default'])
-
-            # make upright
-            container_upright_orientation = upright_orientation_dict['syn_container']
-            bottle_upright_orientation = upright_orientation_dict['bottle']
-            container_upright_mat = np.eye(4); container_upright_mat[:-1, :-1] = common.quat2rot(container_upright_orientation)
-            bottle_upright_mat = np.eye(4); bottle_upright_mat[:-1, :-1] = common.quat2rot(bottle_upright_orientation)
-
-            container_mesh.apply_transform(container_upright_mat)
-            bottle_mesh.apply_transform(bottle_upright_mat)
-
-            # get the 2D projection of the vertices
-            container_2d = np.asarray(container_mesh.vertices)[:, :-1]
-            bottle_2d = np.asarray(bottle_mesh.vertices)[:, :-1]
-            container_flat = np.hstack([container_2d, np.zeros(container_2d.shape[0]).reshape(-1, 1)])
-            bottle_flat = np.hstack([bottle_2d, np.zeros(bottle_2d.shape[0]).reshape(-1, 1)])
-
-            container_box = trimesh.PointCloud(container_flat).bounding_box
-            bottle_box = trimesh.PointCloud(bottle_flat).bounding_box
+            with profiler.span('setup/load_meshes'):
+                ensure_decomposed(parent_obj_file)
+                ensure_decomposed(child_obj_file)
+
+                container_mesh = trimesh.load(parent_obj_file_dec)
+                bottle_mesh = trimesh.load(child_obj_file_dec)
+            new_parent_scale, container_box, bottle_box = fit_container_scale(
+                container_mesh, bottle_mesh, pc_master_dict, np_rng)
 
             with recorder.meshcat_scene_lock:
                 util.meshcat_trimesh_show(mc_vis, 'scene/container_box', container_box.to_mesh().apply_translation([0.0, 0.2, 0.0]), color=(255, 0, 0))
                 util.meshcat_trimesh_show(mc_vis, 'scene/bottle_box', bottle_box.to_mesh().apply_translation([0.0, -0.2, 0.0]), color=(0, 0, 255))
 
-            container_extents = container_box.extents
-            bottle_extents = bottle_box.extents
-
-            if np.max(bottle_extents) > (0.75 * np.min(container_extents[:-1])):
-                # scale up the container size so that the bottle is more likely to fit inside
-                new_parent_scale = np.max(bottle_extents) * (np.random.random() * (2 - 1.5) + 1.5) / np.min(container_extents[:-1])
-
-            ext_str = f'\nContainer extents: {", ".join([str(val) for val in container_extents])}, \nBottle extents: {", ".join([str(val) for val in bottle_extents])}\n'
+            ext_str = f'\nContainer extents: {", ".join([str(val) for val in container_box.extents])}, \nBottle extents: {", ".join([str(val) for val in bottle_box.extents])}\n'
             log_info(ext_str)
+            if new_parent_scale is not None:
+                log_warn(f'Setting new parent scale to: {new_parent_scale:.3f} to ensure parent is large enough for child')
 
+        # sample both objects before loading them, the loading and settling doesn't draw random numbers
+        objects = {}
         for pc in pcl:
-            # get the mesh files we will use
-            pc_master_dict[pc]['mesh_file'] = parent_obj_file if pc == 'parent' else child_obj_file
-            pc_master_dict[pc]['mesh_file_dec'] = parent_obj_file_dec if pc == 'parent' else child_obj_file_dec
-
-            # get the object scales we will use
-            scale_high, scale_low = pc_master_dict[pc]['scale_hl']
-            if pc == 'parent':
-                if new_parent_scale is None:
-                    scale_default = pc_master_dict[pc]['scale_default']
-                else:
-                    log_warn(f'Setting new parent scale to: {new_parent_scale:.3f} to ensure parent is large enough for child')
-                    scale_default = new_parent_scale
-            else:
-                scale_default = pc_master_dict[pc]['scale_default']
-
-            if args.rand_mesh_scale:
-                mesh_scale = [np.random.random() * (scale_high - scale_low) + scale_low] * 3
-            else:
-                mesh_scale=[scale_default] * 3
-
-            pc_master_dict[pc]['mesh_scale'] = mesh_scale
-
-            object_class = pc_master_dict[pc]['class']
-            upright_orientation = upright_orientation_dict[object_class]
-
-            # sample a pose to use for each object, depending on distribution of poses for this run
-            load_pose_type = pc_master_dict[pc]['load_pose_type']
-            x_high, x_low = pc_master_dict[pc]['xhl']
-            y_high, y_low = pc_master_dict[pc]['yhl']
-
-            if load_pose_type == 'any_pose':
-                if object_class in ['bowl', 'bottle']:
-                    rp = np.random.rand(2) * (2 * np.pi / 3) - (np.pi / 3)
-                    ori = common.euler2quat([rp[0], rp[1], 0]).tolist()
-                else:
-                    rpy = np.random.rand(3) * (2 * np.pi / 3) - (np.pi / 3)
-                    ori = common.euler2quat([rpy[0], rpy[1], rpy[2]]).tolist()
-
-                pos = [
-                    np.random.random() * (x_high - x_low) + x_low,
-                    np.random.random() * (y_high - y_low) + y_low,
-                    table_z]
-                pose = pos + ori
-                rand_yaw_T = util.rand_body_yaw_transform(pos, min_theta=-np.pi, max_theta=np.pi)
-                pose_w_yaw = util.transform_pose(util.list2pose_stamped(pose), util.pose_from_matrix(rand_yaw_T))
-                pos, ori = util.pose_stamped2list(pose_w_yaw)[:3], util.pose_stamped2list(pose_w_yaw)[3:]
-            else:
-                if load_pose_type == 'demo_pose':
-                    obj_start_pose_demo = pc_master_dict[pc]['demo_start_poses'][demo_idx]
-                    pos, ori = obj_start_pose_demo[:3], obj_start_pose_demo[3:]
-                else:
-                    pos = [np.random.random() * (x_high - x_low) + x_low, np.random.random() * (y_high - y_low) + y_low, table_z]
-                    pose = util.list2pose_stamped(pos + upright_orientation)
-                    rand_yaw_T = util.rand_body_yaw_transform(pos, min_theta=-np.pi, max_theta=np.pi)
-                    pose_w_yaw = util.transform_pose(pose, util.pose_from_matrix(rand_yaw_T))
-                    pos, ori = util.pose_stamped2list(pose_w_yaw)[:3], util.pose_stamped2list(pose_w_yaw)[3:]
-
-            # convert mesh with vhacd
-            obj_obj_file, obj_obj_file_dec = pc_master_dict[pc]['mesh_file'], pc_master_dict[pc]['mesh_file_dec']
-
-            if not osp.exists(obj_obj_file_dec):
-                p.vhacd(
-                    obj_obj_file,
-                    obj_obj_file_dec,
-                    'log.txt',
-                    concavity=0.0025,
-                    alpha=0.04,
-                    beta=0.05,
-                    gamma=0.00125,
-                    minVolumePerCH=0.0001,
-                    resolution=1000000,
-                    depth=20,
-                    planeDownsampling=4,
-                    convexhullDownsampling=4,
-                    pca=0,
-                    mode=0,
-                    convexhullApproximation=1
-                )
-
-            # load the object into the simulator
-            obj_id = pb_client.load_geom(
-                'mesh',
-                mass=0.01,
-                mesh_scale=mesh_scale,
-                visualfile=obj_obj_file_dec,
-                collifile=obj_obj_file_dec,
-                base_pos=pos,
-                base_ori=ori)
-
-            # change the texture
-            random_rgba = [*random_color(), 1.0]
-            texture_modder.set_rgba(obj_id, -1, random_rgba)
-
-            # register the object with the meshcat visualizer
-            recorder.register_object(obj_id, obj_obj_file_dec, scaling=mesh_scale)
-
-            # safeCollisionFilterPair(bodyUniqueIdA=obj_id, bodyUniqueIdB=table_id, linkIndexA=-1, linkIndexB=rack_link_id, enableCollision=False)
-            safeCollisionFilterPair(bodyUniqueIdA=obj_id, bodyUniqueIdB=table_id, linkIndexA=-1, linkIndexB=table_base_id, enableCollision=False)
-            p.changeDynamics(obj_id, -1, lateralFriction=0.5, linearDamping=5, angularDamping=5)
-
-            # depending on the object/pose type, constrain the object to its world frame pose
-            o_cid = None
-            if (object_class in ['syn_rack_easy', 'syn_rack_hard', 'syn_rack_med']) or (load_pose_type == 'any_pose' and pc == 'child'):
-                o_cid = constraint_obj_world(obj_id, pos, ori)
-                pb_client.set_step_sim(False)
-            pc_master_dict[pc]['o_cid'] = o_cid
-
-            # safeCollisionFilterPair(obj_id, table_id, -1, -1, enableCollision=True)
-            safeCollisionFilterPair(obj_id, table_id, -1, table_base_id, enableCollision=True)
+            objects[pc] = sample_object(
+                pc, pc_master_dict,
+                parent_obj_file if pc == 'parent' else child_obj_file,
+                parent_obj_file_dec if pc == 'parent' else child_obj_file_dec,
+                demo_idx, table_z, rand_mesh_scale=args.rand_mesh_scale,
+                scale_default=new_parent_scale if pc == 'parent' else None,
+                np_rng=np_rng, py_rng=py_rng)
+
+        trial_obj_ids = []
+        for pc in pcl:
+            obj = objects[pc]
+            with profiler.span('setup/load_meshes'):
+                # the mesh needs to be converted with vhacd
+                ensure_decomposed(obj['mesh_file'])
 
-            time.sleep(1.5)
+                # load the object into the simulator
+                obj_id = spawn_object(obj, obj['pos'], obj['ori'])
+            trial_obj_ids.append(obj_id)
 
-            pc_master_dict[pc]['pb_obj_id'] = obj_id
+            with profiler.span('setup/settle'):
+                run_physics(1.5, trial_obj_ids)
 
         # get object point cloud
-        depth_imgs = []
-        seg_idxs = []
-        obj_pcd_pts = []
-
         pc_obs_info = {}
         pc_obs_info['pcd'] = {}
         pc_obs_info['pcd_pts'] = {}
         pc_obs_info['pcd_pts']['parent'] = []
         pc_obs_info['pcd_pts']['child'] = []
 
-        obj_pose_world = p.getBasePositionAndOrientation(obj_id)
-        obj_pose_world = util.list2pose_stamped(list(obj_pose_world[0]) + list(obj_pose_world[1]))
-        for i, cam in enumerate(cams.cams):
-            # get image and raw point cloud
-            rgb, depth, seg = cam.get_images(get_rgb=True, get_depth=True, get_seg=True)
-            # plt.figure()
-            # plt.imshow(rgb)
-            # plt.title(f"{iteration}_cam{i}_rgb")
-            # plt.show()
-            pts_raw, _ = cam.get_pcd(in_world=True, rgb_image=rgb, depth_image=depth, depth_min=0.0, depth_max=np.inf)
-
-            # flatten and find corresponding pixels in segmentation mask
-            flat_seg = seg.flatten()
-            flat_depth = depth.flatten()
-
-            for pc in pcl:
-                obj_id = pc_master_dict[pc]['pb_obj_id']
-                obj_inds = np.where(flat_seg == obj_id)
-                seg_depth = flat_depth[obj_inds[0]]
-
-                obj_pts = pts_raw[obj_inds[0], :]
-                # obj_pcd_pts.append(util.crop_pcd(obj_pts))
-                pc_obs_info['pcd_pts'][pc].append(util.crop_pcd(obj_pts))
-
-            depth_imgs.append(seg_depth)
-            seg_idxs.append(obj_inds)
+        # the point clouds only need depth and segmentation
+        with profiler.span('setup/capture'):
+            _, depths, segs = obs_capture.capture(get_rgb=False, get_depth=True, get_seg=True)
 
-        # merge point clouds from different views, and filter weird artifacts away from the object
-        for pc, obj_pcd_pts in pc_obs_info['pcd_pts'].items():
-            target_obj_pcd_obs = np.concatenate(obj_pcd_pts, axis=0)  # object shape point cloud
-            target_pts_mean = np.mean(target_obj_pcd_obs, axis=0)
-            inliers = np.where(np.linalg.norm(target_obj_pcd_obs - target_pts_mean, 2, 1) < 0.2)[0]
-            target_obj_pcd_obs = target_obj_pcd_obs[inliers]
+        # only back-project the pixels of the objects
+        with profiler.span('setup/pcd_fusion'):
+            obj_ids = [objects[pc]['pb_obj_id'] for pc in pcl]
+            obj_pts = obs_capture.segmented_points(depths, segs, obj_ids, depth_min=0.0, depth_max=np.inf)
+            for pc, obj_id in zip(pcl, obj_ids):
+                pc_obs_info['pcd_pts'][pc] = [util.crop_pcd(pts) for pts in obj_pts[obj_id]]
 
-            pc_obs_info['pcd'][pc] = target_obj_pcd_obs
+        # merge point clouds from different views, and filter weird artifacts away from the object
+        with profiler.span('setup/pcd_fusion'):
+            for pc, obj_pcd_pts in pc_obs_info['pcd_pts'].items():
+                target_obj_pcd_obs = np.concatenate(obj_pcd_pts, axis=0)  # object shape point cloud
+                target_pts_mean = np.mean(target_obj_pcd_obs, axis=0)
+                inliers = np.where(np.linalg.norm(target_obj_pcd_obs - target_pts_mean, 2, 1) < 0.2)[0]
+                target_obj_pcd_obs = target_obj_pcd_obs[inliers]
 
-        parent_pcd = pc_obs_info['pcd']['parent']
-        child_pcd = pc_obs_info['pcd']['child']
+                pc_obs_info['pcd'][pc] = target_obj_pcd_obs
 
         # Take NeRF images of static scene
         nerf_rgbs = []
         nerf_depths = []
         nerf_cam_start_time = time.perf_counter()
         if not args.disable_nerf_cams:
-            for i, cam in enumerate(nerf_cams.cams):
-                rgb, depth, seg = cam.get_images(get_rgb=True, get_depth=True, get_seg=True)
-                nerf_rgbs.append(rgb)
-                nerf_depths.append(depth)
+            with profiler.span('setup/nerf_capture'):
+                nerf_rgbs, nerf_depths, _ = nerf_capture.capture(get_rgb=True, get_depth=True, get_seg=False)
             log_info(f"Capturing NeRF cameras took: {time.perf_counter() - nerf_cam_start_time:.2f}s")
 
-        metrics = {"exp": args.exp, "trial": iteration, "generate_dataset_only": args.generate_dataset_only}
-        success_crit_dict = {}
-        kvs = {}
+        profiler.add('setup', time.perf_counter() - trial_start_time)
 
-        if not args.generate_dataset_only:
-            log_info(f'[INTERSECTION], Loading model weights for multi NDF inference')
+        trial = dict(
+            iteration=iteration,
+            demo_idx=demo_idx,
+            parent_id=parent_id,
+            child_id=child_id,
+            eval_iter_dir=eval_iter_dir,
+            objects=objects,
+            pc_obs_info=pc_obs_info,
+            nerf_rgbs=nerf_rgbs,
+            nerf_depths=nerf_depths,
+            metrics={"exp": args.exp, "trial": iteration, "generate_dataset_only": args.generate_dataset_only},
+            profiler=profiler,
+            stage_times=profiler.stage_times,
+        )
+        return trial
+
+    def optimize_trial(trial, pause_vis=True):
+        """Infer the relative transformation to apply to the child object"""
+        if args.generate_dataset_only:
+            return
+        opt_start_time = time.perf_counter()
+        if args.per_trial_seed:
+            seed_trial(args.seed, trial['iteration'], stream=1)
+
+        parent_pcd = trial['pc_obs_info']['pcd']['parent']
+        child_pcd = trial['pc_obs_info']['pcd']['child']
+
+        profiler = trial['profiler']
+        log_info(f'[INTERSECTION], Loading model weights for multi NDF inference')
+        with profiler.span('optimize/load_weights'):
             load_ndf_weights()
+        if pause_vis:
             pause_mc_thread(True)
-            opt_start_time = time.perf_counter()
-            if args.skip_opt:
-                # Just keep the current pose if skipping optimization
-                relative_trans = np.eye(4)
-            else:
+        if args.skip_opt:
+            # Just keep the current pose if skipping optimization
+            relative_trans = np.eye(4)
+        else:
+            parent_optimizer.set_profiler(profiler)
+            child_optimizer.set_profiler(profiler)
+            try:
                 relative_trans = infer_relation_intersection(
                     mc_vis, parent_optimizer, child_optimizer,
                     parent_overall_target_desc, child_overall_target_desc,
                     parent_pcd, child_pcd, parent_query_points, child_query_points, opt_visualize=args.opt_visualize)
-            opt_end_time = time.perf_counter()
-            metrics["infer_relation_intersection_time"] = opt_end_time - opt_start_time
-            log_info(f'[INTERSECTION], Inference took: {opt_end_time - opt_start_time:.2f}s')
+            finally:
+                parent_optimizer.set_profiler(None)
+                child_optimizer.set_profiler(None)
+        opt_end_time = time.perf_counter()
+        trial['metrics']["infer_relation_intersection_time"] = opt_end_time - opt_start_time
+        log_info(f'[INTERSECTION], Inference took: {opt_end_time - opt_start_time:.2f}s')
+        if pause_vis:
             pause_mc_thread(False)
 
-            time.sleep(1.0)
+        trial['relative_trans'] = relative_trans
+        profiler.add('optimize', time.perf_counter() - opt_start_time)
+
+    def optimize_trials_batch(trials):
+        """Infer the relative transformations for several trials at once, as one batched problem"""
+        if args.generate_dataset_only:
+            return
+        opt_start_time = time.perf_counter()
+        if args.per_trial_seed:
+            seed_trial(args.seed, trials[0]['iteration'], stream=1)
+
+        # the phases of the batch are timed once, and split between the trials below
+        batch_profiler = TrialProfiler(sync_cuda=args.profile_sync_cuda)
+        log_info(f'[INTERSECTION], Loading model weights for multi NDF inference')
+        with batch_profiler.span('optimize/load_weights'):
+            load_ndf_weights()
+        pause_mc_thread(True)
+        if args.skip_opt:
+            relative_trans_list = [np.eye(4) for _ in trials]
+        else:
+            parent_optimizer.set_profiler(batch_profiler)
+            child_optimizer.set_profiler(batch_profiler)
+            try:
+                relative_trans_list = infer_relation_intersection_batch(
+                    parent_optimizer, child_optimizer,
+                    parent_overall_target_desc, child_overall_target_desc,
+                    [trial['pc_obs_info']['pcd']['parent'] for trial in trials],
+                    [trial['pc_obs_info']['pcd']['child'] for trial in trials],
+                    parent_query_points)
+            finally:
+                parent_optimizer.set_profiler(None)
+                child_optimizer.set_profiler(None)
+        pause_mc_thread(False)
+        opt_time = time.perf_counter() - opt_start_time
+        log_info(f'[INTERSECTION], Batched inference for {len(trials)} trials took: {opt_time:.2f}s')
+
+        # the batch is optimized together, so each trial gets an equal share of the time
+        for trial, relative_trans in zip(trials, relative_trans_list):
+            trial['relative_trans'] = relative_trans
+            trial['metrics']["infer_relation_intersection_time"] = opt_time / len(trials)
+            trial['profiler'].add('optimize', opt_time / len(trials))
+            for stage, stage_time in batch_profiler.stage_times.items():
+                trial['profiler'].add(stage, stage_time / len(trials))
+
+    def execute_trial(trial):
+        """
+        Apply the inferred transformation, check whether the placement succeeded, save the
+        results and the NeRF dataset of the trial, and remove the objects from the scene
+        """
+        execute_start_time = time.perf_counter()
+        profiler = trial['profiler']
+        iteration = trial['iteration']
+        parent_id, child_id = trial['parent_id'], trial['child_id']
+        objects = trial['objects']
+        pc_obs_info = trial['pc_obs_info']
+        metrics = trial['metrics']
+        success_crit_dict = {}
+        kvs = {}
+
+        if objects['parent']['pb_obj_id'] is None:
+            with profiler.span('execute/restore'):
+                restore_objects(trial)
+
+        check_start_time = time.perf_counter()
+        if not args.generate_dataset_only:
+            relative_trans = trial['relative_trans']
 
             # apply the inferred transformation by updating the pose of the child object
-            parent_obj_id = pc_master_dict['parent']['pb_obj_id']
-            child_obj_id = pc_master_dict['child']['pb_obj_id']
+            parent_obj_id = objects['parent']['pb_obj_id']
+            child_obj_id = objects['child']['pb_obj_id']
+            run_physics(1.0, [parent_obj_id, child_obj_id])
             start_child_pose = np.concatenate(pb_client.get_body_state(child_obj_id)[:2]).tolist()
             start_child_pose_mat = util.matrix_from_pose(util.list2pose_stamped(start_child_pose))
             final_child_pose_mat = np.matmul(relative_trans, start_child_pose_mat)
 
             start_parent_pose = np.concatenate(pb_client.get_body_state(parent_obj_id)[:2]).tolist()
             start_parent_pose_mat = util.matrix_from_pose(util.list2pose_stamped(start_parent_pose))
-            upright_orientation = upright_orientation_dict[pc_master_dict['parent']['class']]
+            upright_orientation = UPRIGHT_ORIENTATIONS[pc_master_dict['parent']['class']]
             upright_parent_ori_mat = common.quat2rot(upright_orientation)
 
-            pb_client.set_step_sim(True)
             if pc_master_dict['parent']['load_pose_type'] == 'any_pose':
                 # get the relative transformation to make it upright
                 upright_parent_pose_mat = copy.deepcopy(start_parent_pose_mat); upright_parent_pose_mat[:-1, :-1] = upright_parent_ori_mat
                 relative_upright_pose_mat = np.matmul(upright_parent_pose_mat, np.linalg.inv(start_parent_pose_mat))
 
                 upright_parent_pos, upright_parent_ori = start_parent_pose[:3], common.rot2quat(upright_parent_ori_mat)
-                pb_client.reset_body(parent_obj_id, upright_parent_pos, upright_parent_ori)
-
                 final_child_pose_mat = np.matmul(relative_upright_pose_mat, final_child_pose_mat)
 
             final_child_pose_list = util.pose_stamped2list(util.pose_from_matrix(final_child_pose_mat))
             final_child_pos, final_child_ori = final_child_pose_list[:3], final_child_pose_list[3:]
 
-            # apply computed final pose by resetting the state
-            pb_client.reset_body(child_obj_id, final_child_pos, final_child_ori)
-            if pc_master_dict['parent']['class'] not in ['syn_rack_easy', 'syn_rack_med']:
-                safeRemoveConstraint(pc_master_dict['parent']['o_cid'])
-            if pc_master_dict['child']['class'] not in ['syn_rack_easy', 'syn_rack_med']:
-                safeRemoveConstraint(pc_master_dict['child']['o_cid'])
-
-            final_child_pcd = util.transform_pcd(pc_obs_info['pcd']['child'], relative_trans)
-            with recorder.meshcat_scene_lock:
-                util.meshcat_pcd_show(mc_vis, final_child_pcd, color=[255, 0, 255], name='scene/final_child_pcd')
-            # safeCollisionFilterPair(pc_master_dict['child']['pb_obj_id'], table_id, -1, -1, enableCollision=False)
-            safeCollisionFilterPair(pc_master_dict['child']['pb_obj_id'], table_id, -1, table_base_id, enableCollision=False)
-
-            time.sleep(3.0)
-
-            # turn on the physics and let things settle to evaluate success/failure
-            pb_client.set_step_sim(False)
-
-            # evaluation criteria
-            time.sleep(2.0)
-
-            obj_surf_contacts = p.getContactPoints(pc_master_dict['child']['pb_obj_id'], pc_master_dict['parent']['pb_obj_id'], -1, -1)
-            touching_surf = len(obj_surf_contacts) > 0
-            success_crit_dict['touching_surf'] = touching_surf
-            if parent_class == 'syn_container' and child_class == 'bottle':
-                bottle_final_pose = np.concatenate(p.getBasePositionAndOrientation(pc_master_dict['child']['pb_obj_id'])[:2]).tolist()
-
-                # get the y-axis in the body frame
-                bottle_body_y = common.quat2rot(bottle_final_pose[3:])[:, 1]
-                bottle_body_y = bottle_body_y / np.linalg.norm(bottle_body_y)
-
-                # get the angle deviation from the vertical
-                angle_from_upright = util.angle_from_3d_vectors(bottle_body_y, np.array([0, 0, 1]))
-                bottle_upright = angle_from_upright < args.upright_ori_diff_thresh
-                success_crit_dict['bottle_upright'] = bottle_upright
-
-                kvs['Angle From Upright'] = angle_from_upright
-
-            # take an image to make sure it looks good (post-process)
-            eval_rgb = eval_cam.get_images(get_rgb=True)[0]
-            eval_img_fname = osp.join(eval_imgs_dir, f'{iteration}.png')
-            util.np2img(eval_rgb.astype(np.uint8), eval_img_fname)
-
-            ##########################################################################
-            # upside down check for too much inter-penetration
-            pb_client.set_step_sim(True)
-
-            # remove constraints, if there are any
-            safeRemoveConstraint(pc_master_dict['parent']['o_cid'])
-            safeRemoveConstraint(pc_master_dict['child']['o_cid'])
-
-            # first, reset everything
-            pb_client.reset_body(parent_obj_id, start_parent_pose[:3], start_parent_pose[3:])
-            pb_client.reset_body(child_obj_id, start_child_pose[:3], start_child_pose[3:])
-
-            # then, compute a new position + orientation for the parent object, that is upside down
-            upside_down_ori_mat = np.matmul(common.euler2rot([np.pi, 0, 0]), upright_parent_ori_mat)
-            upside_down_pose_mat = np.eye(4); upside_down_pose_mat[:-1, :-1] = upside_down_ori_mat; upside_down_pose_mat[:-1, -1] = start_parent_pose[:3]
-            upside_down_pose_mat[2, -1] += 0.15  # move up in z a bit
-            parent_upside_down_pose_list = util.pose_stamped2list(util.pose_from_matrix(upside_down_pose_mat))
-
-            # reset parent to this state and constrain to world
-            pb_client.reset_body(parent_obj_id, parent_upside_down_pose_list[:3], parent_upside_down_pose_list[3:])
-            ud_cid = constraint_obj_world(parent_obj_id, parent_upside_down_pose_list[:3], parent_upside_down_pose_list[3:])
-
-            # get the final relative pose of the child object
-            final_child_pose_parent = util.convert_reference_frame(
-                pose_source=util.pose_from_matrix(final_child_pose_mat),
-                pose_frame_target=util.pose_from_matrix(start_parent_pose_mat),
-                pose_frame_source=util.unit_pose()
-            )
-            # get the final world frame pose of the child object in upside down pose
-            final_child_pose_upside_down = util.convert_reference_frame(
-                pose_source=final_child_pose_parent,
-                pose_frame_target=util.unit_pose(),
-                pose_frame_source=util.pose_from_matrix(upside_down_pose_mat)
-            )
-            final_child_pose_upside_down_list = util.pose_stamped2list(final_child_pose_upside_down)
-            final_child_pose_upside_down_mat = util.matrix_from_pose(final_child_pose_upside_down)
-
-            # reset child to this state
-            pb_client.reset_body(child_obj_id, final_child_pose_upside_down_list[:3], final_child_pose_upside_down_list[3:])
-
-            # turn on the simulation and wait for a couple seconds
-            pb_client.set_step_sim(False)
-            time.sleep(2.0)
-
-            # check if they are still in contact (they shouldn't be)
-            ud_obj_surf_contacts = p.getContactPoints(parent_obj_id, child_obj_id, -1, -1)
-            ud_touching_surf = len(ud_obj_surf_contacts) > 0
-            success_crit_dict['fell_off_upside_down'] = not ud_touching_surf
+            def placement_check():
+                if pc_master_dict['parent']['load_pose_type'] == 'any_pose':
+                    pb_client.reset_body(parent_obj_id, upright_parent_pos, upright_parent_ori)
+
+                # apply computed final pose by resetting the state
+                pb_client.reset_body(child_obj_id, final_child_pos, final_child_ori)
+                if pc_master_dict['parent']['class'] not in ['syn_rack_easy', 'syn_rack_med']:
+                    safeRemoveConstraint(objects['parent']['o_cid'])
+                if pc_master_dict['child']['class'] not in ['syn_rack_easy', 'syn_rack_med']:
+                    safeRemoveConstraint(objects['child']['o_cid'])
+
+                final_child_pcd = util.transform_pcd(pc_obs_info['pcd']['child'], relative_trans)
+                with recorder.meshcat_scene_lock:
+                    util.meshcat_pcd_show(mc_vis, final_child_pcd, color=[255, 0, 255], name='scene/final_child_pcd')
+                # safeCollisionFilterPair(pc_master_dict['child']['pb_obj_id'], table_id, -1, -1, enableCollision=False)
+                safeCollisionFilterPair(child_obj_id, table_id, -1, table_base_id, enableCollision=False)
+
+                if not args.step_physics:
+                    # the simulation is paused here, this only gives the visualization time to catch up
+                    time.sleep(3.0)
+
+                # turn on the physics and let things settle to evaluate success/failure
+                set_step_sim(False)
+
+                # evaluation criteria
+                run_physics(2.0, [parent_obj_id, child_obj_id])
+
+                obj_surf_contacts = p.getContactPoints(child_obj_id, parent_obj_id, -1, -1)
+                crit = dict(touching_surf=len(obj_surf_contacts) > 0)
+                if parent_class == 'syn_container' and child_class == 'bottle':
+                    bottle_final_pose = np.concatenate(p.getBasePositionAndOrientation(child_obj_id)[:2]).tolist()
+
+                    # get the y-axis in the body frame
+                    bottle_body_y = common.quat2rot(bottle_final_pose[3:])[:, 1]
+                    bottle_body_y = bottle_body_y / np.linalg.norm(bottle_body_y)
+
+                    # get the angle deviation from the vertical
+                    angle_from_upright = util.angle_from_3d_vectors(bottle_body_y, np.array([0, 0, 1]))
+                    crit['bottle_upright'] = angle_from_upright < args.upright_ori_diff_thresh
+
+                    kvs['Angle From Upright'] = angle_from_upright
+
+                # take an image to make sure it looks good (post-process)
+                eval_rgb = eval_cam.get_images(get_rgb=True)[0]
+                eval_img_fname = osp.join(eval_imgs_dir, f'{iteration}.png')
+                util.np2img(eval_rgb.astype(np.uint8), eval_img_fname)
+
+                # pause the simulation again, so the next check starts from the snapshot
+                set_step_sim(True)
+                return crit
+
+            def upside_down_check():
+                """Check for too much inter-penetration: upside down, the child should fall off the parent"""
+                # remove constraints, if there are any
+                safeRemoveConstraint(objects['parent']['o_cid'])
+                safeRemoveConstraint(objects['child']['o_cid'])
+
+                # compute a new position + orientation for the parent object, that is upside down
+                upside_down_ori_mat = np.matmul(common.euler2rot([np.pi, 0, 0]), upright_parent_ori_mat)
+                upside_down_pose_mat = np.eye(4); upside_down_pose_mat[:-1, :-1] = upside_down_ori_mat; upside_down_pose_mat[:-1, -1] = start_parent_pose[:3]
+                upside_down_pose_mat[2, -1] += 0.15  # move up in z a bit
+                parent_upside_down_pose_list = util.pose_stamped2list(util.pose_from_matrix(upside_down_pose_mat))
+
+                # reset parent to this state and constrain to world
+                pb_client.reset_body(parent_obj_id, parent_upside_down_pose_list[:3], parent_upside_down_pose_list[3:])
+                ud_cid = constraint_obj_world(parent_obj_id, parent_upside_down_pose_list[:3], parent_upside_down_pose_list[3:])
+
+                # final pose of the child object relative to the parent, moved along with the parent to its upside down pose
+                final_child_pose_upside_down_mat = np.matmul(
+                    upside_down_pose_mat, np.matmul(np.linalg.inv(start_parent_pose_mat), final_child_pose_mat))
+                final_child_pose_upside_down_list = util.pose_stamped2list(util.pose_from_matrix(final_child_pose_upside_down_mat))
+
+                # reset child to this state
+                pb_client.reset_body(child_obj_id, final_child_pose_upside_down_list[:3], final_child_pose_upside_down_list[3:])
+
+                # turn on the simulation and wait for a couple seconds
+                set_step_sim(False)
+                run_physics(2.0, [parent_obj_id, child_obj_id])
+
+                # check if they are still in contact (they shouldn't be)
+                ud_obj_surf_contacts = p.getContactPoints(parent_obj_id, child_obj_id, -1, -1)
+                return dict(fell_off_upside_down=len(ud_obj_surf_contacts) == 0)
+
+            # both checks start from the scene as it was before the placement (the constraints
+            # are not part of the snapshot, so the placement check goes first)
+            set_step_sim(True)
+            snapshots.save('start')
+            checks = snapshots.run_branches('start', {'placement': placement_check, 'upside_down': upside_down_check})
+            snapshots.remove('start')
+            for crit in checks.values():
+                success_crit_dict.update(crit)
+            profiler.add('execute/success_check', time.perf_counter() - check_start_time)
 
         #########################################################################
 
@@ -990,85 +1028,226 @@ def main(args):
         id_str = f', parent_id: {parent_id}, child_id: {child_id}'
         log_info(log_str + id_str)
 
-        eval_iter_dir = osp.join(eval_save_dir, f'trial_{iteration}')
+        eval_iter_dir = trial['eval_iter_dir']
         util.safe_makedirs(eval_iter_dir)
-        sample_fname = osp.join(eval_iter_dir, 'success_rate_relation.npz')
-        full_cfg_fname = osp.join(eval_iter_dir, 'full_config.json')
-        results_txt_fname = osp.join(eval_iter_dir, 'results.txt')
-        np.savez(
-            sample_fname,
-            parent_id=parent_id,
-            child_id=child_id,
-            is_parent_shapenet_obj=is_parent_shapenet_obj,
-            is_child_shapenet_obj=is_child_shapenet_obj,
-            success_criteria_dict=success_crit_dict,
-            place_success=place_success,
-            place_success_list=place_success_list,
-            mesh_file=obj_obj_file,
-            args=args.__dict__,
-            cfg=util.cn2dict(cfg),
-        )
-        json.dump(full_cfg_dict, open(full_cfg_fname, 'w', encoding='utf-8'), ensure_ascii=False, indent=4)
-
-        results_txt_dict = {}
-        results_txt_dict['place_success'] = place_success
-        results_txt_dict['place_success_list'] = place_success_list
-        results_txt_dict['current_success_rate'] = sum(place_success_list) / float(len(place_success_list))
-        results_txt_dict['success_criteria_dict'] = success_crit_dict
-        open(results_txt_fname, 'w').write(str(results_txt_dict))
 
         # eval_img_fname2 = osp.join(eval_iter_dir, f'{iteration}.png')
         # util.np2img(eval_rgb.astype(np.uint8), eval_img_fname2)
 
-        # Write NeRF images
-        if not args.disable_nerf_cams:
-            nerf_dir = osp.join(eval_iter_dir, 'nerf_dataset')
-            util.safe_makedirs(nerf_dir)
-            write_instant_ngp_dataset(nerf_cams, nerf_rgbs, nerf_depths, nerf_dir)
-
-            demo_metadata = {
-                "demo_path": demo_path,
-                "demo_file": demo_files[demo_idx],
-                "multi_obj_names": demos[demo_idx]["multi_obj_names"].item(),
-            }
-
-            metadata = {
-                "demo": demo_metadata if args.test_on_train else None,
-                "parent_id": parent_id,
-                "child_id": child_id,
-                "is_parent_shapenet_obj": is_parent_shapenet_obj,
-                "is_child_shapenet_obj": is_child_shapenet_obj,
-                "mesh_file": obj_obj_file,
-                "test_on_train": args.test_on_train,
-                "generate_dataset_only": args.generate_dataset_only,
-            }
-            metadata_fname = osp.join(nerf_dir, 'rndf_metadata.json')
-            with open(metadata_fname, 'w') as f:
-                json.dump(metadata, f, indent=2, default=str)
-
-            # Metrics that Will added
-            metrics["rndf_results"] = {
-                "place_success": place_success,
-                "success_criteria_dict": success_crit_dict,
-            }
-            metrics_fname = osp.join(nerf_dir, "rndf_metrics.json")
-            with open(metrics_fname, "w") as f:
-                json.dump(metrics, f, indent=2, default=str)
+        if args.meshcat_record:
+            recording_fname = osp.join(eval_iter_dir, 'meshcat_recording.npz')
+            recorder.stop_recording(recording_fname)
+            log_info(f'Saved meshcat recording to {recording_fname}')
 
-            log_info(f"Wrote NeRF dataset to {nerf_dir}")
+        with profiler.span('execute/cleanup'):
+            pause_mc_thread(True)
+            remove_objects(trial)
+            mc_vis['scene/child_pcd_refine'].delete()
+            mc_vis['scene/child_pcd_refine_1'].delete()
+            mc_vis['scene/final_child_pcd'].delete()
+            pause_mc_thread(False)
 
-        pause_mc_thread(True)
-        for pc in pcl:
-            obj_id = pc_master_dict[pc]['pb_obj_id']
-            pb_client.remove_body(obj_id)
-            recorder.remove_object(obj_id, mc_vis)
-        mc_vis['scene/child_pcd_refine'].delete()
-        mc_vis['scene/child_pcd_refine_1'].delete()
-        mc_vis['scene/final_child_pcd'].delete()
-        pause_mc_thread(False)
+        def finish_trial():
+            # the trial is recorded once, when it is done (the config of the run is in full_exp_cfg.txt),
+            # and only after its folder is in place, so a recorded trial always has all its outputs
+            with finish_lock:
+                with profiler.span('execute/save_results'):
+                    finalize_trial_dir(eval_save_dir, iteration)
+                    append_result(run_results_fname, dict(
+                        time=time.time(),
+                        exp=args.exp,
+                        seed=args.seed,
+                        worker_id=args.worker_id,
+                        trial=iteration,
+                        demo_idx=trial['demo_idx'],
+                        parent_class=parent_class,
+                        child_class=child_class,
+                        parent_id=parent_id,
+                        child_id=child_id,
+                        is_parent_shapenet_obj=is_parent_shapenet_obj,
+                        is_child_shapenet_obj=is_child_shapenet_obj,
+                        mesh_file=objects['child']['mesh_file'],
+                        place_success=bool(place_success),
+                        success_criteria={k: bool(v) for k, v in success_crit_dict.items()},
+                        kvs={k: float(v) for k, v in kvs.items() if k != 'Place Success'},
+                        infer_relation_intersection_time=metrics.get('infer_relation_intersection_time'),
+                    ))
+                report_status(f'done {iteration}')
+
+                append_jsonl(trial_metrics_fname, profiler.record(
+                    trial=iteration, worker_id=args.worker_id, parent_id=parent_id, child_id=child_id,
+                    place_success=bool(place_success)))
+
+        if args.disable_nerf_cams:
+            profiler.add('execute', time.perf_counter() - execute_start_time)
+            finish_trial()
+            return
+
+        # Write NeRF images, after everything else of the trial is in its folder
+        nerf_dir = osp.join(eval_iter_dir, 'nerf_dataset')
+        util.safe_makedirs(nerf_dir)
+
+        demo_idx = trial['demo_idx']
+        demo_metadata = {
+            "demo_path": demo_path,
+            "demo_file": demo_files[demo_idx],
+            "multi_obj_names": demos[demo_idx]["multi_obj_names"].item(),
+        }
+
+        metadata = {
+            "demo": demo_metadata if args.test_on_train else None,
+            "parent_id": parent_id,
+            "child_id": child_id,
+            "is_parent_shapenet_obj": is_parent_shapenet_obj,
+            "is_child_shapenet_obj": is_child_shapenet_obj,
+            "mesh_file": objects['child']['mesh_file'],
+            "test_on_train": args.test_on_train,
+            "generate_dataset_only": args.generate_dataset_only,
+        }
+
+        # Metrics that Will added
+        metrics["rndf_results"] = {
+            "place_success": place_success,
+            "success_criteria_dict": success_crit_dict,
+        }
+        # a copy, the profiler keeps adding to the stage times while the dataset is written
+        metrics["stage_times"] = dict(trial['stage_times'])
+        extra_files = {'rndf_metadata.json': metadata, 'rndf_metrics.json': metrics}
+
+        # the images are only kept until they are written, not with the completed trials
+        nerf_rgbs, nerf_depths = trial.pop('nerf_rgbs'), trial.pop('nerf_depths')
+        if nerf_writer is not None:
+            profiler.add('execute', time.perf_counter() - execute_start_time)
+            nerf_writer.submit(nerf_cams, nerf_rgbs, nerf_depths, nerf_dir,
+                               extra_files=extra_files, on_done=finish_trial, profiler=profiler)
+        else:
+            with profiler.span('execute/nerf_write'):
+                write_instant_ngp_dataset(nerf_cams, nerf_rgbs, nerf_depths, nerf_dir,
+                                          encoding=args.nerf_encoding, png_compress_level=args.nerf_png_compress_level,
+                                          extra_files=extra_files)
+            log_info(f"Wrote NeRF dataset to {nerf_dir}")
+            profiler.add('execute', time.perf_counter() - execute_start_time)
+            finish_trial()
+
+    def run_pipelined(trial_indices):
+        """
+        Run the trials as a three stage pipeline. The main thread alternates between setting up
+        and capturing upcoming trials and executing/checking optimized ones, while the optimization
+        of the trials in between runs in a second thread. Each trial's objects are taken out of
+        the scene after the capture and put back for the execution, so trials don't interact.
+        """
+        # trials that are captured and waiting to be optimized, and optimized and waiting to be executed
+        opt_queue = queue.Queue(maxsize=args.pipeline_depth)
+        exec_queue = queue.Queue(maxsize=args.pipeline_depth)
+
+        def optimize_worker():
+            while True:
+                trial = opt_queue.get()
+                if trial is None:
+                    return
+                try:
+                    optimize_trial(trial, pause_vis=False)
+                except Exception as e:
+                    trial['error'] = e
+                exec_queue.put(trial)
+
+        opt_th = threading.Thread(target=optimize_worker, daemon=True)
+        opt_th.start()
+
+        pending = list(trial_indices)
+        n_in_flight = 0
+        completed = []
+        while len(pending) > 0 or n_in_flight > 0:
+            can_setup = len(pending) > 0 and n_in_flight < args.pipeline_depth
+            wait_start_time = time.perf_counter()
+            try:
+                # finish optimized trials first, only block when there is nothing new to set up
+                trial = exec_queue.get(block=not can_setup)
+            except queue.Empty:
+                trial = setup_trial(pending.pop(0))
+                stash_objects(trial)
+                opt_queue.put(trial)
+                n_in_flight += 1
+                continue
+
+            trial['profiler'].add('execute_wait', time.perf_counter() - wait_start_time)
+            n_in_flight -= 1
+            if 'error' in trial:
+                opt_queue.put(None)
+                raise trial['error']
+            execute_trial(trial)
+            completed.append(trial)
+
+        opt_queue.put(None)
+        opt_th.join()
+        return completed
+
+    def run_batched(trial_indices):
+        """
+        Set up and capture args.batch_scenes trials, optimize all of them in one batched problem,
+        then execute them one by one. The objects of a trial are taken out of the scene after the
+        capture and put back for the execution, so trials don't interact.
+        """
+        trial_indices = list(trial_indices)
+        completed = []
+        for batch_start in range(0, len(trial_indices), args.batch_scenes):
+            trials = []
+            for iteration in trial_indices[batch_start:batch_start + args.batch_scenes]:
+                trial = setup_trial(iteration)
+                stash_objects(trial)
+                trials.append(trial)
+            optimize_trials_batch(trials)
+            for trial in trials:
+                execute_trial(trial)
+                completed.append(trial)
+        return completed
+
+    # one record per trial with its results, appended to the results of earlier runs in this folder
+    run_results_fname = results_fname(eval_save_dir, args.worker_id)
+    # one record per trial with its stage times and resource usage, the workers of a parallel run write their own files
+    # (appended to as well, so resuming keeps the metrics of the earlier trials)
+    trial_metrics_fname = osp.join(
+        eval_save_dir, 'trial_metrics.jsonl' if args.worker_id < 0 else f'trial_metrics_worker_{args.worker_id}.jsonl')
+
+    def run_trials(trial_indices):
+        if args.pipeline:
+            return run_pipelined(trial_indices)
+        elif args.batch_scenes > 1:
+            return run_batched(trial_indices)
+        completed = []
+        for iteration in trial_indices:
+            trial = setup_trial(iteration)
+            optimize_trial(trial)
+            execute_trial(trial)
+            completed.append(trial)
+        return completed
+
+    run_start_time = time.perf_counter()
+    run_start_timestamp = time.time()
+    if args.status_fd >= 0:
+        # run the tasks (lines of trial indices) from the supervisor until it closes stdin
+        report_status('ready')
+        completed_trials = []
+        for line in sys.stdin:
+            completed_trials += run_trials([int(iteration) for iteration in line.split()])
+    else:
+        completed_trials = run_trials(trial_indices)
+    if nerf_writer is not None:
+        nerf_writer.close()
+    log_info(f'Body pool: loaded {body_pool.n_loaded} objects, reused {body_pool.n_reused}')
+    log_info('Stage timing:\n' + format_trial_records(
+        [r for r in load_jsonl([trial_metrics_fname]) if r['start_time'] >= run_start_timestamp],
+        time.perf_counter() - run_start_time))
+    log_info(f'Per-trial metrics written to {trial_metrics_fname}')
+    if nerf_renderer_pool is not None:
+        nerf_renderer_pool.close()
 
     #########################################################################
     # Completed all trials, let's copy the NeRF datasets to their own directory
+    copy_and_upload_nerf_datasets(args, eval_save_dir)
+
+
+def copy_and_upload_nerf_datasets(args, eval_save_dir):
     # Just use the experiment name provided in the args so we don't make things
     # too complicated.
     if args.disable_nerf_cams or args.disable_nerf_dataset_copy:
@@ -1077,17 +1256,92 @@ def main(args):
 
     # Copy datasets for this experiment to the nerf_datasets directory
     nerf_dataset_dir = osp.join(path_util.get_rndf_nerf_datasets(), args.exp)
-    os.makedirs(nerf_dataset_dir, exist_ok=True)
-    copy_nerf_datasets(eval_dir=eval_save_dir, target_dir=nerf_dataset_dir)
-    log_info(f"NeRF datasets copied to {nerf_dataset_dir}")
+    if args.pack_nerf_datasets:
+        # a few large arrays instead of a copy of every image
+        pack_nerf_datasets(eval_save_dir, nerf_dataset_dir)
+        shutil.copy(osp.join(eval_save_dir, 'full_exp_cfg.txt'), osp.join(nerf_dataset_dir, 'full_exp_cfg.json'))
+        log_info(f"NeRF datasets packed to {nerf_dataset_dir}")
+    else:
+        os.makedirs(nerf_dataset_dir, exist_ok=True)
+        copy_nerf_datasets(eval_dir=eval_save_dir, target_dir=nerf_dataset_dir)
+        log_info(f"NeRF datasets copied to {nerf_dataset_dir}")
+
+    if args.upload_store is not None:
+        # only the files that are not in the store yet are sent
+        upload_dataset_dir(nerf_dataset_dir, LocalFSBackend(args.upload_store), name=f"{args.exp}/{args.logger_suffix}")
+        log_info(f"NeRF datasets uploaded to {args.upload_store}")
+        return
 
     # Copy datasets to ml-logger
     dataset_prefix = upload_datasets_to_logger(nerf_dataset_dir, exp_name=f"{args.exp}/{args.logger_suffix}")
     log_info(f"NeRF datasets uploaded to ml-logger with prefix {dataset_prefix}")
 
 
+def run_parallel(args):
+    """
+    Run the trials with args.num_workers supervised headless worker processes (see parallel_eval.py),
+    then merge their results and copy the NeRF datasets like a sequential run would
+    """
+    # create the eval folder and the target descriptors once, so the workers don't race to do it
+    prepare_args = copy.copy(args)
+    prepare_args.prepare_only = True
+    prepare_args.disable_meshcat = True
+    prepare_args.meshcat_record = False
+    prepare_args.pybullet_viz = False
+    prepare_args.pybullet_server = False
+    main(prepare_args)
+    eval_save_dir = get_eval_save_dir(args)
+
+    # resume: skip the trials that are already in the results log, and clean up after interrupted ones
+    trial_indices = list(range(args.start_iteration, prepare_args.num_iterations))
+    done_trials = load_completed_trials(eval_save_dir)
+    clean_unfinished_trials(eval_save_dir, trial_indices, done_trials)
+    if not args.no_resume:
+        trial_indices = [iteration for iteration in trial_indices if iteration not in done_trials]
+
+    log_info(f'Running {len(trial_indices)} trials with {args.num_workers} workers')
+    run_start_timestamp = time.time()
+    supervised = supervise_workers(
+        osp.abspath(__file__), sys.argv[1:], trial_indices, args.num_workers, log_dir=eval_save_dir,
+        eval_save_dir=eval_save_dir, trial_timeout=args.trial_timeout, max_retries=args.max_trial_retries,
+        trials_per_task=args.trials_per_task)
+    if len(supervised['failed']) > 0:
+        log_warn(f'Trials {supervised["failed"]} failed {args.max_trial_retries + 1} times and have no results')
+    merge_worker_results(eval_save_dir, range(args.start_iteration, prepare_args.num_iterations))
+    # the metrics files also hold the trials of earlier (resumed) runs
+    trial_records = load_jsonl(sorted(glob.glob(osp.join(eval_save_dir, 'trial_metrics_worker_*.jsonl'))))
+    log_info('Stage timing of all workers:\n' + format_trial_records(
+        [r for r in trial_records if r['start_time'] >= run_start_timestamp]))
+
+    copy_and_upload_nerf_datasets(args, eval_save_dir)
+
+
 def validate_args(args):
     """ Additional checks Will Shen added to make life easier. """
+    assert args.worker_id < args.num_workers, "--worker_id must be smaller than --num_workers"
+    assert args.trial_timeout > 0, "--trial_timeout must be positive"
+    assert args.max_trial_retries >= 0, "--max_trial_retries can't be negative"
+    assert args.trials_per_task > 0, "--trials_per_task must be positive"
+    assert args.render_clients >= 0, "--render_clients can't be negative"
+    assert args.nerf_write_threads >= 0 and args.nerf_write_queue > 0
+    assert 0 <= args.nerf_png_compress_level <= 9, "--nerf_png_compress_level must be in [0, 9]"
+    if args.pipeline:
+        assert args.pipeline_depth > 0, "--pipeline_depth must be positive"
+        assert not args.opt_visualize, "--opt_visualize is not supported with --pipeline"
+        if not args.per_trial_seed:
+            # the setup of the next trials and the optimization run concurrently, without per-trial
+            # seeds they would draw from the same global generators in a nondeterministic order
+            log_warn('--pipeline implies --per_trial_seed')
+            args.per_trial_seed = True
+    assert args.batch_scenes > 0, "--batch_scenes must be positive"
+    if args.meshcat_record:
+        assert not args.disable_meshcat, "--meshcat_record needs the meshcat recorder, don't use --disable_meshcat"
+        assert not args.pipeline and args.batch_scenes == 1, \
+            "--meshcat_record records one trial at a time, it is not supported with --pipeline or --batch_scenes"
+        assert args.meshcat_record_rate > 0, "--meshcat_record_rate must be positive"
+    if args.batch_scenes > 1:
+        assert not args.pipeline, "--batch_scenes is not supported with --pipeline"
+        assert not args.opt_visualize, "--opt_visualize is not supported with --batch_scenes"
     if args.test_on_train:
         assert args.parent_load_pose_type == "demo_pose", \
             "Must use demo poses for parent when test on train enabled"
@@ -1150,6 +1404,9 @@ if __name__ == "__main__":
     parser.add_argument('--target_idx', type=int, default=-1)
     parser.add_argument('--query_scale', type=float, default=0.025)
     parser.add_argument('--target_rounds', type=int, default=3)
+    parser.add_argument('--desc_proj_dim', type=int, default=0,
+                        help='If > 0, match descriptors in a PCA-reduced space with this many dimensions. '
+                             'The projection is fitted when creating target descriptors and stored with them')
 
     # some threshold
     parser.add_argument('--upright_ori_diff_thresh', type=float, default=np.deg2rad(15))
@@ -1169,16 +1426,95 @@ if __name__ == "__main__":
     parser.add_argument("--pybullet_debug_viz", action="store_true",
                         help="Enable debug visualization in PyBullet (makes things slower)")
     parser.add_argument("--disable_nerf_cams", action="store_true", help="Disable capturing NeRF dataset")
+    parser.add_argument("--render_clients", type=int, default=0,
+                        help="If > 0, render the NeRF cameras in this many renderer processes in parallel, "
+                             "instead of one after the other in the simulation client")
+    parser.add_argument("--nerf_encoding", type=str, choices=ENCODINGS, default="png",
+                        help="How to store the NeRF images: PNGs, raw .npy files per frame, or one packed .npy "
+                             "array of each kind per trial")
+    parser.add_argument("--nerf_png_compress_level", type=int, default=6,
+                        help="zlib level of the NeRF PNGs, from 0 (fastest, largest) to 9")
+    parser.add_argument("--nerf_write_threads", type=int, default=0,
+                        help="If > 0, write the NeRF datasets in the background with this many threads")
+    parser.add_argument("--nerf_write_queue", type=int, default=2,
+                        help="Number of trials whose NeRF dataset can wait to be written with --nerf_write_threads")
+    parser.add_argument("--pack_nerf_datasets", action="store_true",
+                        help="Instead of copying the NeRF datasets, pack them into a few memory mappable arrays "
+                             "(see rndf_robot.nerf.packed)")
+    parser.add_argument("--upload_store", type=str, default=None,
+                        help="Upload the NeRF datasets incrementally to this content-addressed store folder "
+                             "(see rndf_robot.nerf.uploader), instead of ml-logger")
     parser.add_argument("--disable_nerf_dataset_copy", action="store_true",
                         help="Disable copying NeRF dataset to the dedicated rndf_robot/nerf_datasets folder")
 
     parser.add_argument("--generate_dataset_only", action="store_true",
                         help="Only generate the datasets, skip any actual evaluation.")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="If > 1, run the trials in this many headless worker processes (implies --step_physics, "
+                             "--per_trial_seed and --disable_meshcat in the workers)")
+    parser.add_argument("--worker_id", type=int, default=-1,
+                        help="Set by the parallel runner, index of this worker (and of its shard of trials without a supervisor)")
+    parser.add_argument("--status_fd", type=int, default=-1,
+                        help="Set by the parallel runner, the worker reads its trials from stdin and reports its progress on this file descriptor")
+    parser.add_argument("--isolate_trials", action="store_true",
+                        help="Run the trials in supervised worker processes even with --num_workers 1, so crashes and hangs only cost a retry")
+    parser.add_argument("--trial_timeout", type=float, default=1800.0,
+                        help="Seconds a worker may spend on a trial before it is killed and the trial is retried")
+    parser.add_argument("--max_trial_retries", type=int, default=2,
+                        help="Number of times a trial whose worker crashed or hung is retried")
+    parser.add_argument("--trials_per_task", type=int, default=1,
+                        help="Number of trials handed to a worker at a time (more trials per task let --pipeline or --batch_scenes overlap them)")
+    parser.add_argument("--per_trial_seed", action="store_true",
+                        help="Reseed the random number generators at the start of every trial from the seed and "
+                             "the trial index, so each trial can be reproduced on its own")
+    parser.add_argument("--disable_meshcat", action="store_true",
+                        help="Run without a meshcat server, nothing is visualized")
+    parser.add_argument("--meshcat_max_keyframes", type=int, default=1000,
+                        help="Number of most recent simulator keyframes kept by the meshcat recorder (<= 0 keeps all)")
+    parser.add_argument("--meshcat_pos_tol", type=float, default=1e-4,
+                        help="Only resend an object's pose to meshcat once it moved by more than this (m)")
+    parser.add_argument("--meshcat_rot_tol", type=float, default=1e-3,
+                        help="Only resend an object's pose to meshcat once it rotated by more than this (rad)")
+    parser.add_argument("--meshcat_record", action="store_true",
+                        help="Don't stream to a meshcat server, record the simulator state of every trial to "
+                             "trial_<i>/meshcat_recording.npz instead (replay with rndf_robot.utils.pb2mc.recording)")
+    parser.add_argument("--meshcat_record_rate", type=float, default=30.0,
+                        help="Keyframes per second (of simulated time with --step_physics) in the recordings")
+    parser.add_argument("--body_pool_size", type=int, default=8,
+                        help="Maximum number of removed objects kept loaded (out of view) for reuse in later trials "
+                             "with the same mesh and scale, 0 disables reuse")
+    parser.add_argument("--allow_vhacd", action="store_true",
+                        help="Run V-HACD during the eval for meshes without a precomputed decomposition, instead of "
+                             "failing (precompute them with python -m rndf_robot.data_gen.precompute_vhacd)")
+    parser.add_argument("--no_resume", action="store_true",
+                        help="Run all the trials again, instead of skipping the ones already in the results log of the eval folder")
+    parser.add_argument("--profile_sync_cuda", action="store_true",
+                        help="Synchronize CUDA at the end of every timed span, so the per-trial stage times (trial_metrics*.jsonl) attribute GPU work correctly")
+    parser.add_argument("--prepare_only", action="store_true",
+                        help="Only set up the eval folder and the target descriptors, don't run any trials")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap the trials: set up/capture the next trials and execute/check the previous ones "
+                             "while the current one is being optimized (implies --per_trial_seed)")
+    parser.add_argument("--pipeline_depth", type=int, default=2,
+                        help="Maximum number of trials in flight between the stages with --pipeline")
+    parser.add_argument("--batch_scenes", type=int, default=1,
+                        help="If > 1, capture this many trials and optimize all of them in one batched problem "
+                             "before executing them")
+    parser.add_argument("--step_physics", action="store_true",
+                        help="Step the simulation deterministically (not in realtime) until objects come to rest, "
+                             "instead of sleeping while it runs. The sleep durations are used as step budgets")
+    parser.add_argument("--settle_lin_vel_thresh", type=float, default=1e-3,
+                        help="Linear speed (m/s) below which objects count as at rest with --step_physics")
+    parser.add_argument("--settle_ang_vel_thresh", type=float, default=1e-2,
+                        help="Angular speed (rad/s) below which objects count as at rest with --step_physics")
 
     args = parser.parse_args()
     validate_args(args)
     start_time = time.perf_counter()
-    main(args)
+    if (args.num_workers > 1 or args.isolate_trials) and args.worker_id < 0:
+        run_parallel(args)
+    else:
+        main(args)
     end_time = time.perf_counter()
 
     duration = end_time - start_time
@@ -0,0 +1,249 @@
+"""
+Run the relation evaluation with several headless worker processes.
+
+Every worker runs the evaluation script on the trials a supervisor hands out, in its own
+pybullet DIRECT client, with its own copy of the NDF models. Workers that crash or hang
+are replaced, and their trials retried. Each trial reseeds the
+random number generators from (seed, trial index) (see rndf_robot.eval.seeding), so a trial
+gives the same result no matter which worker runs it. Workers write their trials into the shared eval directory,
+and the per-trial results are merged afterwards so the directory looks like it was
+produced by one sequential run.
+"""
+import os, os.path as osp
+import selectors
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Sequence
+
+from loguru import logger
+
+from rndf_robot.eval.results_store import merge_results
+from rndf_robot.eval.resume import load_completed_trials, clean_unfinished_trials
+
+
+# flags that make no sense in a headless worker
+_NON_WORKER_FLAGS = ('--pybullet_viz', '--pybullet_server')
+_WORKER_FLAGS = ('--disable_meshcat', '--step_physics', '--per_trial_seed', '--disable_nerf_dataset_copy')
+
+
+def shard_trials(start_iteration: int, num_iterations: int, num_workers: int, worker_id: int) -> List[int]:
+    """
+    Trial indices run by one worker. Trials are dealt out round-robin, so every worker
+    gets a similar mix of demos (which are cycled through by trial index)
+    """
+    assert 0 <= worker_id < num_workers, f'Invalid worker id {worker_id} for {num_workers} workers'
+    return list(range(start_iteration + worker_id, num_iterations, num_workers))
+
+
+def worker_argv(argv: Sequence[str], worker_id: int, worker_flags: Sequence[str] = _WORKER_FLAGS) -> List[str]:
+    """Command line for a worker, based on the command line the runner was started with"""
+    argv = [a for a in argv if a not in _NON_WORKER_FLAGS]
+    worker_flags = list(worker_flags)
+    if '--meshcat_record' in argv and '--disable_meshcat' in worker_flags:
+        # recording works headless (the keyframes are taken from the stepping loop), so keep the recorder
+        worker_flags.remove('--disable_meshcat')
+    return argv + ['--worker_id', str(worker_id)] + worker_flags
+
+
+class _WorkerSlot:
+    """A supervised worker process, the trials it was given and what it reported about them"""
+    def __init__(self, worker_id: int, proc: subprocess.Popen, status_fd: int, log_f):
+        self.worker_id = worker_id
+        self.proc = proc
+        self.status_fd = status_fd
+        self.log_f = log_f
+        self.buf = b''
+        self.eof = False
+        self.ready = False
+        # trials sent to the worker that aren't done yet, and those of them it started
+        self.task: List[int] = []
+        self.started = set()
+        self.last_progress = time.monotonic()
+
+    def close(self) -> None:
+        os.close(self.status_fd)
+        self.log_f.close()
+
+
+def supervise_workers(script: str, argv: Sequence[str], trial_indices: Sequence[int], num_workers: int,
+                      log_dir: str, eval_save_dir: str, trial_timeout: float = 1800.0, startup_timeout: float = 900.0,
+                      max_retries: int = 2, trials_per_task: int = 1, threads_per_worker: Optional[int] = None,
+                      worker_flags: Sequence[str] = _WORKER_FLAGS) -> Dict:
+    """
+    Run trial_indices in num_workers copies of script, handing out tasks of trials_per_task trials
+    to whichever worker is free. The output of each worker goes to worker_<id>.log in log_dir.
+
+    A worker loads everything once and then runs the tasks it reads from stdin (one line of trial
+    indices per task), reporting "ready", "start <i>" and "done <i>" on the file descriptor given
+    with --status_fd. A worker that exits, or makes no progress for trial_timeout seconds
+    (startup_timeout before it is ready), is killed and replaced by a new one, which starts from
+    the on-disk caches (target descriptors, decompositions) the first worker used. The trials it
+    had started are retried up to max_retries times, after the outputs they left behind are removed.
+    The trials it hadn't started yet go back to the queue as they are. worker_flags are added to
+    the command line of every worker (the defaults are the flags of the evaluation script).
+
+    Returns:
+        dict: The trials that are done, and those that failed max_retries + 1 times
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    env = dict(os.environ)
+    # keep the workers from oversubscribing the cores with intra-op threads
+    env['OMP_NUM_THREADS'] = str(threads_per_worker)
+    env['MKL_NUM_THREADS'] = str(threads_per_worker)
+
+    pending = deque(trial_indices)
+    attempts = defaultdict(int)
+    done, failed = [], []
+    slots: Dict[int, _WorkerSlot] = {}
+    n_starts = defaultdict(int)
+    # workers that died before they were ready, since the last one that got ready
+    startup_failures = 0
+    sel = selectors.DefaultSelector()
+
+    def start_worker(worker_id):
+        n_starts[worker_id] += 1
+        status_r, status_w = os.pipe()
+        log_fname = osp.join(log_dir, f'worker_{worker_id}.log')
+        cmd = [sys.executable, script] + worker_argv(argv, worker_id, worker_flags) + ['--status_fd', str(status_w)]
+        # restarted workers append to the log of the one they replace
+        log_f = open(log_fname, 'a' if n_starts[worker_id] > 1 else 'w')
+        logger.info(f'Starting worker {worker_id}, logging to {log_fname}')
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log_f, stderr=subprocess.STDOUT, env=env,
+                                pass_fds=(status_w,), text=True)
+        os.close(status_w)
+        slot = _WorkerSlot(worker_id, proc, status_r, log_f)
+        sel.register(status_r, selectors.EVENT_READ, slot)
+        slots[worker_id] = slot
+
+    def stop_worker(slot, timeout=0.0):
+        """Close the stdin of a worker, kill it if it hasn't exited after timeout seconds, and release its pipes and log"""
+        try:
+            slot.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            slot.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            slot.proc.kill()
+            slot.proc.wait()
+        if not slot.eof:
+            sel.unregister(slot.status_fd)
+        slot.close()
+        del slots[slot.worker_id]
+
+    def retire_worker(slot, reason):
+        """Kill a worker that died or hangs, and requeue (or give up on) its trials"""
+        nonlocal startup_failures
+        logger.error(f'Worker {slot.worker_id} {reason}, running trials {slot.task}')
+        stop_worker(slot)
+        if not slot.ready:
+            startup_failures += 1
+            # a worker that can't even start (e.g., a bad argument) is not restarted forever
+            if startup_failures > max_retries:
+                raise RuntimeError(f'Workers failed to start {startup_failures} times in a row, see the logs in {log_dir}')
+        completed = load_completed_trials(eval_save_dir)
+        for iteration in reversed(slot.task):
+            if iteration in completed:
+                # it finished, the worker died before reporting it
+                done.append(iteration)
+                continue
+            if iteration in slot.started:
+                attempts[iteration] += 1
+                clean_unfinished_trials(eval_save_dir, [iteration], set())
+                if attempts[iteration] > max_retries:
+                    logger.error(f'Trial {iteration} failed {attempts[iteration]} times, giving up on it')
+                    failed.append(iteration)
+                    continue
+                logger.warning(f'Retrying trial {iteration} (attempt {attempts[iteration] + 1})')
+            pending.appendleft(iteration)
+
+    def handle_message(slot, msg):
+        nonlocal startup_failures
+        kind, *rest = msg.split()
+        if kind == 'ready':
+            slot.ready = True
+            startup_failures = 0
+        elif kind == 'start':
+            slot.started.add(int(rest[0]))
+        elif kind == 'done':
+            iteration = int(rest[0])
+            slot.task.remove(iteration)
+            slot.started.discard(iteration)
+            done.append(iteration)
+            logger.info(f'Worker {slot.worker_id} finished trial {iteration} ({len(done)}/{len(trial_indices)} done)')
+        slot.last_progress = time.monotonic()
+
+    try:
+        while len(pending) > 0 or any(len(slot.task) > 0 for slot in slots.values()):
+            # keep num_workers workers running while there is work left
+            for worker_id in range(num_workers):
+                if worker_id not in slots and len(pending) > 0:
+                    start_worker(worker_id)
+
+            # hand out tasks to the idle workers
+            for slot in slots.values():
+                if slot.ready and len(slot.task) == 0 and len(pending) > 0:
+                    slot.task = [pending.popleft() for _ in range(min(trials_per_task, len(pending)))]
+                    slot.started = set()
+                    slot.last_progress = time.monotonic()
+                    try:
+                        slot.proc.stdin.write(' '.join(str(iteration) for iteration in slot.task) + '\n')
+                        slot.proc.stdin.flush()
+                    except BrokenPipeError:
+                        # it died, noticed below
+                        pass
+
+            for key, _ in sel.select(timeout=1.0):
+                slot = key.data
+                data = os.read(slot.status_fd, 4096)
+                if len(data) == 0:
+                    # the worker is exiting, noticed below
+                    sel.unregister(slot.status_fd)
+                    slot.eof = True
+                    continue
+                slot.buf += data
+                *lines, slot.buf = slot.buf.split(b'\n')
+                for line in lines:
+                    handle_message(slot, line.decode())
+
+            now = time.monotonic()
+            for slot in list(slots.values()):
+                timeout = trial_timeout if slot.ready else startup_timeout
+                if slot.proc.poll() is not None:
+                    retire_worker(slot, f'exited with code {slot.proc.returncode}')
+                elif (len(slot.task) > 0 or not slot.ready) and now - slot.last_progress > timeout:
+                    retire_worker(slot, f'made no progress for {timeout:.0f}s')
+
+        # no more work, the workers exit once their stdin is closed
+        for slot in list(slots.values()):
+            stop_worker(slot, timeout=60)
+    finally:
+        # on an error, don't leave the remaining workers running
+        for slot in list(slots.values()):
+            stop_worker(slot)
+        sel.close()
+    logger.info(f'{len(done)} trials done, {len(failed)} failed: {sorted(failed)}')
+    return dict(done=sorted(done), failed=sorted(failed))
+
+
+def merge_worker_results(eval_save_dir: str, trial_indices: Sequence[int]) -> Dict:
+    """
+    Merge the results files of the workers into the results.jsonl of the run, in trial order,
+    as if the trials had been run sequentially
+
+    Returns:
+        dict: Merged results with the trial indices, per-trial success and the success rate
+    """
+    records = merge_results(eval_save_dir, trial_indices)
+    merged_trials = [record['trial'] for record in records]
+    missing = sorted(set(trial_indices) - set(merged_trials))
+    if len(missing) > 0:
+        logger.warning(f'No results for trials {missing} in {eval_save_dir}')
+    place_success_list = [bool(record['place_success']) for record in records]
+
+    success_rate = sum(place_success_list) / float(len(place_success_list)) if len(place_success_list) > 0 else 0.0
+    logger.info(f'Merged {len(merged_trials)} trials, place success rate: {success_rate:.3f}')
+    return dict(trials=merged_trials, place_success_list=place_success_list, success_rate=success_rate)
@@ -1,7 +1,7 @@
 import os, os.path as osp
 import sys
 import random
-from typing import Dict
+from typing import Dict, Tuple
 
 import numpy as np
 import torch
@@ -12,6 +12,7 @@ from airobot import log_info, log_warn, log_debug, log_critical
 
 from rndf_robot.utils import util
 from rndf_robot.opt.optimizer import OccNetOptimizer
+from rndf_robot.opt.descriptor_projection import DescriptorProjection, format_projection_report
 
 
 def infer_relation_intersection(mc_vis, parent_optimizer, child_optimizer, parent_target_desc, child_target_desc, 
@@ -45,6 +46,43 @@ def infer_relation_intersection(mc_vis, parent_optimizer, child_optimizer, paren
     return relative_transformation
 
 
+def infer_relation_intersection_batch(parent_optimizer, child_optimizer, parent_target_descs, child_target_descs,
+                                      parent_pcds, child_pcds, parent_query_points, *args, **kwargs):
+    """
+    Same as infer_relation_intersection, but for K independent scenes at once. The parent
+    and child hypotheses of all scenes are optimized as one batched problem each, and the
+    best hypothesis is picked per scene.
+
+    Args:
+        parent_target_descs, child_target_descs (torch.Tensor or list): Target descriptors,
+            shared by all scenes or one per scene (see optimize_transform_implicit_batch)
+        parent_pcds, child_pcds (list): K point clouds of the parent/child object in each scene
+        parent_query_points (np.ndarray): P x 3 query points of the parent
+
+    Returns:
+        list: K relative transformations to apply to the child objects
+    """
+    log_info(f"Optimizing parent descriptors for {len(parent_pcds)} scenes")
+    out_parent_feat = parent_optimizer.optimize_transform_implicit_batch(
+        parent_pcds, parent_target_descs, ee=True)
+    parent_feat_pose_mats_list, best_parent_idxs, _, _ = out_parent_feat
+
+    # the child query points are placed on the best parent pose of each scene
+    child_query_points_list = [
+        util.transform_pcd(parent_query_points, parent_feat_pose_mats[best_parent_idx])
+        for parent_feat_pose_mats, best_parent_idx in zip(parent_feat_pose_mats_list, best_parent_idxs)]
+
+    log_info(f"Optimizing child descriptors for {len(child_pcds)} scenes")
+    out_child_feat = child_optimizer.optimize_transform_implicit_batch(
+        child_pcds, child_target_descs, query_pts_list=child_query_points_list, ee=False)
+    child_feat_pose_mats_list, best_child_idxs, _, _ = out_child_feat
+
+    relative_transformations = [
+        child_feat_pose_mats[best_child_idx]
+        for child_feat_pose_mats, best_child_idx in zip(child_feat_pose_mats_list, best_child_idxs)]
+    return relative_transformations
+
+
 def filter_parent_child_pcd(pf_pcd, cf_pcd):
     # filter out some noisy points
 
@@ -88,7 +126,7 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
                               skip_alignment=False, n_demos='all', manual_target_idx=-1,
                               add_noise=False, interaction_pt_noise_std=0.01, 
                               use_keypoint_offset=False, keypoint_offset_params=None,
-                              visualize=False, mc_vis=None):
+                              projection_dim=None, visualize=False, mc_vis=None):
     """
     Create a .npz file containing information about a relational multi-object
     task. Will create target pose descriptors for parent object and child
@@ -124,6 +162,9 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
         keypoint_offset_params (dict): Contains keyword arguments for passing to the
             function which initializes the keypoint position using an offset from one 
             of the points on the object.
+        projection_dim (int): If not None, fit a PCA DescriptorProjection with this many
+            components to the aligned demo descriptors and save it along with the target 
+            descriptors, so the optimizer can match descriptors in the reduced space
         visualize (bool): If True, use meshcat to visualize what's going on while building
             target descriptors. meshcat.Visualizer handler must be passed in if using visualization
         mc_vis (meshcat.Visualzer): meshcat handler
@@ -313,6 +354,10 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
     parent_descriptor_variance_list = []
     child_descriptor_variance_list = []
 
+    # descriptors from the latest alignment round, used for fitting the descriptor projection
+    parent_proj_fit_descs = None
+    child_proj_fit_descs = None
+
     # Additional data for the parent or child in each demo, store the latest align round data here
     parent_out_data: Dict[int, Dict] = {}
     child_out_data: Dict[int, Dict] = {}
@@ -385,6 +430,10 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
 
         for it in range(alignment_rounds):
             print(f"Alignment round {it + 1}/{alignment_rounds}")
+            # descriptors of the other object at the aligned poses, demo idx -> input, encoded
+            # per model in one padded batch once all the demos of the round are aligned
+            parent_desc_inputs: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
+            child_desc_inputs: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
             for idx in demo_idxs:
                 print(
                     f'\n\nAligning demo number: {idx} to target demo number: {target_idx}, '
@@ -422,8 +471,7 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
                             "alignment_round": it,
                         }
 
-                        child_out_desc = child_optimizer.get_pose_descriptor(child_pcd, parent_out_tf_best).detach()
-                        child_last_outdesc[idx] = child_out_desc
+                        child_desc_inputs[idx] = child_optimizer.pose_descriptor_input(child_pcd, parent_out_tf_best)
 
                         out_child_sanity = child_optimizer.optimize_transform_implicit(child_pcd, target_act_hat=child_target_desc, return_score_list=True, return_final_desc=True, visualize=visualize)
 
@@ -448,8 +496,7 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
                             "alignment_round": it,
                         }
 
-                        parent_out_desc = parent_optimizer.get_pose_descriptor(parent_pcd, child_out_tf_best).detach()
-                        parent_last_outdesc[idx] = parent_out_desc
+                        parent_desc_inputs[idx] = parent_optimizer.pose_descriptor_input(parent_pcd, child_out_tf_best)
 
                         out_parent_sanity = parent_optimizer.optimize_transform_implicit(parent_pcd, target_act_hat=parent_target_desc, return_score_list=True, return_final_desc=True, visualize=visualize)
 
@@ -457,6 +504,13 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
                             util.meshcat_frame_show(mc_vis, f'scene/out_{idx}_tf_best_child', child_out_tf_best)
                             util.meshcat_pcd_show(mc_vis, child_out_qp, color=[255, 0, 255], name=f'scene/out_{idx}_qp_child')
 
+            for optimizer, desc_inputs, last_outdesc in [
+                    (parent_optimizer, parent_desc_inputs, parent_last_outdesc),
+                    (child_optimizer, child_desc_inputs, child_last_outdesc)]:
+                if len(desc_inputs) > 0:
+                    for idx, desc in zip(desc_inputs, optimizer.get_pose_descriptors(list(desc_inputs.values()))):
+                        last_outdesc[idx] = desc
+
             # get new target descriptor
             if it < 1:
                 parent_target_stack = torch.stack([parent_target_desc, parent_target_desc_orig] + parent_last_outdesc, 0)
@@ -467,6 +521,8 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
 
             parent_target_desc = torch.mean(parent_target_stack, 0).detach()
             child_target_desc = torch.mean(child_target_stack, 0).detach()
+            parent_proj_fit_descs = parent_target_stack.detach()
+            child_proj_fit_descs = child_target_stack.detach()
 
             parent_var = torch.var(parent_target_stack, 0).mean().detach().item()
             child_var = torch.var(child_target_stack, 0).mean().detach().item()
@@ -483,6 +539,21 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
     parent_descriptor_variance = np.asarray(parent_descriptor_variance_list)
     child_descriptor_variance = np.asarray(child_descriptor_variance_list)
 
+    projection_data = {}
+    if projection_dim is not None:
+        if parent_proj_fit_descs is None:
+            log_warn('No alignment rounds were run, fitting descriptor projections on the target descriptors only')
+            parent_proj_fit_descs = torch.stack(parent_target_desc_list, 0)
+            child_proj_fit_descs = torch.stack(child_target_desc_list, 0)
+        for label, fit_descs, overall_desc in [
+                ('parent', parent_proj_fit_descs, parent_overall_target_desc), 
+                ('child', child_proj_fit_descs, child_overall_target_desc)]:
+            fit_descs = fit_descs.reshape((fit_descs.size(0), -1, fit_descs.size(-1)))
+            desc_projection = DescriptorProjection.fit(fit_descs, projection_dim)
+            projection_data.update(desc_projection.to_npz_dict(label))
+            report = desc_projection.report(fit_descs, overall_desc.reshape(fit_descs.shape[1:]))
+            log_info(f'[create_target_descriptors] {label} descriptor projection report:\n{format_projection_report(report)}')
+
     # Run some asserts to make sure the additional data we write out is correct
     # 1. Either parent or child should have output data
     assert parent_out_data or child_out_data, "Both parent and child out data are empty dicts"
@@ -524,4 +595,5 @@ def create_target_descriptors(parent_model, child_model, pc_demo_dict, target_de
         parent_out_data=parent_out_data,
         child_out_data=child_out_data,
         demo_ids=demo_ids,
+        **projection_data,
     )
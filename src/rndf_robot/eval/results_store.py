@@ -0,0 +1,234 @@
+"""
+Append-only results of the relation evaluation, and a SQLite index to query them across runs.
+
+Every run appends one JSON line per finished trial to results.jsonl in its eval folder
+(results_worker_<i>.jsonl for the workers of a parallel run, merged into results.jsonl at
+the end). A trial is only ever written once, so the cost of a trial doesn't grow with the
+number of trials. If a trial shows up more than once (e.g., a run was restarted), the last
+record wins.
+
+The index scans experiment folders for results files and only reads what was appended since
+the last scan, so it stays fast over thousands of runs:
+
+    python -m rndf_robot.eval.results_store eval_data --group_by exp parent_class child_class
+"""
+import argparse
+import fnmatch
+import glob
+import json
+import os, os.path as osp
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from loguru import logger
+
+from rndf_robot.utils.jsonl import append_jsonl, decode_line, read_jsonl
+
+
+RESULTS_FNAME = 'results.jsonl'
+INDEX_FNAME = 'results_index.sqlite'
+
+# columns of the trials table that can be filtered and grouped by
+QUERY_COLUMNS = ('run_dir', 'exp', 'parent_class', 'child_class', 'parent_id', 'child_id', 'seed', 'worker_id', 'trial')
+
+
+def results_fname(eval_save_dir: str, worker_id: int = -1) -> str:
+    """Results file of a run, or of one of its parallel workers"""
+    fname = RESULTS_FNAME if worker_id < 0 else f'results_worker_{worker_id}.jsonl'
+    return osp.join(eval_save_dir, fname)
+
+
+def append_result(fname: str, record: Dict) -> None:
+    """
+    Append one trial record, and make sure it is on disk before returning. A partial last line
+    (from a killed run) is removed first
+    """
+    append_jsonl(fname, record, fsync=True)
+
+
+def read_results(fname: str) -> List[Dict]:
+    """Records of a results file. A partial last line (from a killed run) and corrupted lines are skipped"""
+    return read_jsonl(fname)
+
+
+def load_run_results(eval_save_dir: str) -> List[Dict]:
+    """Trial records of a run (including unmerged worker files), one per trial in trial order"""
+    by_trial = {}
+    for fname in sorted(glob.glob(osp.join(eval_save_dir, 'results*.jsonl'))):
+        for record in read_results(fname):
+            old_record = by_trial.get(record['trial'])
+            if old_record is None or record.get('time', 0.0) >= old_record.get('time', 0.0):
+                by_trial[record['trial']] = record
+    return [by_trial[trial] for trial in sorted(by_trial.keys())]
+
+
+def merge_results(eval_save_dir: str, trial_indices: Sequence[int]) -> List[Dict]:
+    """
+    Write the records of trial_indices from all the results files of a run into its results.jsonl,
+    in trial order (the worker files are kept, they don't change the query results)
+    """
+    trial_indices = set(trial_indices)
+    records = [r for r in load_run_results(eval_save_dir) if r['trial'] in trial_indices]
+    fname = results_fname(eval_save_dir)
+    tmp_fname = f'{fname}.tmp.{os.getpid()}'
+    with open(tmp_fname, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_fname, fname)
+    return records
+
+
+class ResultsIndex:
+    """
+    SQLite index over the results files of many runs. Every results file remembers how far it
+    was read, so updating the index only reads the lines that were appended since (files that
+    were replaced, e.g. by merge_results, are read again).
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                inode INTEGER NOT NULL,
+                offset INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS trials (
+                run_dir TEXT NOT NULL,
+                trial INTEGER NOT NULL,
+                exp TEXT,
+                parent_class TEXT,
+                child_class TEXT,
+                parent_id TEXT,
+                child_id TEXT,
+                seed INTEGER,
+                worker_id INTEGER,
+                place_success INTEGER,
+                time REAL,
+                record TEXT,
+                PRIMARY KEY (run_dir, trial)
+            );
+            CREATE INDEX IF NOT EXISTS trials_exp ON trials (exp);
+            CREATE INDEX IF NOT EXISTS trials_classes ON trials (parent_class, child_class);
+        ''')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def update(self, roots: Sequence[str]) -> int:
+        """
+        Add the new records of all the results files under roots to the index
+
+        Returns:
+            int: Number of records read
+        """
+        n_records = 0
+        with self.conn:
+            for fname in find_results_files(roots):
+                n_records += self._update_file(fname)
+        return n_records
+
+    def _update_file(self, fname: str) -> int:
+        path = osp.abspath(fname)
+        row = self.conn.execute('SELECT inode, offset FROM files WHERE path = ?', (path,)).fetchone()
+        st = os.stat(path)
+        offset = 0 if row is None or row[0] != st.st_ino or st.st_size < row[1] else row[1]
+        if st.st_size == offset:
+            return 0
+
+        run_dir = osp.dirname(path)
+        rows = []
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # partial line of a run that is still writing, read it next time
+                    break
+                offset += len(line)
+                record = decode_line(path, line.decode())
+                if record is None:
+                    continue
+                rows.append((
+                    run_dir, record['trial'], record.get('exp'), record.get('parent_class'), record.get('child_class'),
+                    record.get('parent_id'), record.get('child_id'), record.get('seed'), record.get('worker_id'),
+                    int(bool(record.get('place_success'))), record.get('time', 0.0), line.decode().strip()))
+        # a trial can be in several files of a run (worker and merged files, restarted runs), the newest record wins
+        self.conn.executemany('''
+            INSERT INTO trials VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (run_dir, trial) DO UPDATE SET
+                exp = excluded.exp, parent_class = excluded.parent_class, child_class = excluded.child_class,
+                parent_id = excluded.parent_id, child_id = excluded.child_id, seed = excluded.seed,
+                worker_id = excluded.worker_id, place_success = excluded.place_success,
+                time = excluded.time, record = excluded.record
+            WHERE excluded.time >= trials.time
+        ''', rows)
+        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (path, st.st_ino, offset))
+        return len(rows)
+
+    def query(self, group_by: Sequence[str] = ('exp',), where: Optional[Dict[str, str]] = None) -> List[Dict]:
+        """
+        Number of trials and success rate per group
+
+        Args:
+            group_by (list): Columns to group by, from QUERY_COLUMNS
+            where (dict): column -> glob pattern (e.g., {'exp': 'mug_*'}) the trials have to match
+        """
+        where = {} if where is None else where
+        for column in list(group_by) + list(where.keys()):
+            assert column in QUERY_COLUMNS, f'Unknown column {column}, must be in {QUERY_COLUMNS}'
+        group_cols = ', '.join(group_by)
+        sql = f'SELECT {group_cols + ", " if group_cols else ""}COUNT(*), SUM(place_success) FROM trials'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(f'CAST({column} AS TEXT) GLOB ?' for column in where)
+        if group_cols:
+            sql += f' GROUP BY {group_cols} ORDER BY {group_cols}'
+        rows = []
+        for row in self.conn.execute(sql, list(where.values())):
+            n_trials, n_success = row[-2], row[-1] or 0
+            rows.append(dict(zip(group_by, row[:-2]), n_trials=n_trials, n_success=n_success,
+                             success_rate=n_success / n_trials if n_trials > 0 else 0.0))
+        return rows
+
+
+def find_results_files(roots: Sequence[str]) -> Iterator[str]:
+    """Results files under roots. The trial folders of a run are not searched"""
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('trial_')]
+            for fn in filenames:
+                if fnmatch.fnmatch(fn, 'results*.jsonl'):
+                    yield osp.join(dirpath, fn)
+
+
+def format_query(rows: Sequence[Dict], group_by: Sequence[str]) -> str:
+    columns = list(group_by) + ['n_trials', 'success_rate']
+    table = [[str(row[c]) if c != 'success_rate' else f'{row[c]:.3f}' for c in columns] for row in rows]
+    widths = [max([len(c)] + [len(r[i]) for r in table]) for i, c in enumerate(columns)]
+    lines = [' | '.join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines += [' | '.join(v.ljust(w) for v, w in zip(r, widths)) for r in table]
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Index and query the results of relation evaluation runs')
+    parser.add_argument('roots', type=str, nargs='+', help='Folders to search for results files')
+    parser.add_argument('--db', type=str, default=None, help=f'Index file, defaults to {INDEX_FNAME} in the first root')
+    parser.add_argument('--group_by', type=str, nargs='*', default=['exp'], choices=QUERY_COLUMNS)
+    for column in ('exp', 'parent_class', 'child_class'):
+        parser.add_argument(f'--{column}', type=str, default=None, help=f'Only trials whose {column} matches this glob')
+    args = parser.parse_args(argv)
+
+    db_path = osp.join(args.roots[0], INDEX_FNAME) if args.db is None else args.db
+    index = ResultsIndex(db_path)
+    n_records = index.update(args.roots)
+    logger.info(f'Indexed {n_records} new trial records into {db_path}')
+    where = {column: getattr(args, column) for column in ('exp', 'parent_class', 'child_class')
+             if getattr(args, column) is not None}
+    print(format_query(index.query(args.group_by, where), args.group_by))
+    index.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Crash-safe resuming of evaluation runs.
+
+A trial writes its outputs into a hidden .partial_trial_<i> folder, which is renamed to
+trial_<i> once everything is written, and only then is the trial recorded in the results
+log of the run (see results_store.py). The results log is the manifest of completed trials:
+when a run is restarted, the recorded trials are skipped, and the folders of trials that
+were interrupted (partial folders, and finished folders that didn't make it into the log)
+are removed before they run again. With --per_trial_seed, the rerun trials get the same
+seeds as in an uninterrupted run. A run killed while recording a trial leaves a partial last
+line in the log: it is ignored when reading, and cut off by the next append, so the run can be
+resumed any number of times.
+"""
+import os, os.path as osp
+import shutil
+from typing import List, Sequence, Set
+
+from loguru import logger
+
+from rndf_robot.eval.results_store import load_run_results
+
+
+def trial_dir(eval_save_dir: str, iteration: int) -> str:
+    return osp.join(eval_save_dir, f'trial_{iteration}')
+
+
+def partial_trial_dir(eval_save_dir: str, iteration: int) -> str:
+    """Folder a trial writes into until it is finished (hidden, so globbing for trial outputs skips it)"""
+    return osp.join(eval_save_dir, f'.partial_trial_{iteration}')
+
+
+def load_completed_trials(eval_save_dir: str) -> Set[int]:
+    """Trials of the run in eval_save_dir that are recorded in its results log"""
+    return {record['trial'] for record in load_run_results(eval_save_dir)}
+
+
+def clean_unfinished_trials(eval_save_dir: str, trial_indices: Sequence[int], completed: Set[int]) -> List[str]:
+    """
+    Remove the outputs of the trials in trial_indices that are not completed
+
+    Returns:
+        list: The removed folders
+    """
+    removed = []
+    for iteration in trial_indices:
+        if iteration in completed:
+            continue
+        for dirname in (partial_trial_dir(eval_save_dir, iteration), trial_dir(eval_save_dir, iteration)):
+            if osp.exists(dirname):
+                shutil.rmtree(dirname)
+                removed.append(dirname)
+    if len(removed) > 0:
+        logger.warning(f'Removed the outputs of {len(removed)} unfinished trials: {removed}')
+    return removed
+
+
+def finalize_trial_dir(eval_save_dir: str, iteration: int) -> str:
+    """
+    Move the partial folder of a finished trial to its final place (replacing the folder of an
+    earlier run of the trial, if there is one)
+
+    Returns:
+        str: The final trial folder
+    """
+    src = partial_trial_dir(eval_save_dir, iteration)
+    dst = trial_dir(eval_save_dir, iteration)
+    if osp.exists(dst):
+        shutil.rmtree(dst)
+    os.replace(src, dst)
+    # make the rename durable before the trial is recorded as completed
+    dir_fd = os.open(eval_save_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return dst
@@ -0,0 +1,235 @@
+"""
+Sampling the parent/child objects of a trial: which meshes, at what scale, pose and color.
+
+This is shared by the relation evaluation and the NeRF dataset generation
+(rndf_robot.data_gen.generate_nerf_datasets), so both produce the same scenes for the same
+seed and trial index. Nothing here touches the simulator, the objects are sampled first
+and loaded by the caller.
+"""
+import colorsys
+import os.path as osp
+import random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import trimesh
+
+from airobot.utils import common
+
+from rndf_robot.utils import util, path_util
+from rndf_robot.share.globals import bad_shapenet_mug_ids_list, bad_shapenet_bowls_ids_list, bad_shapenet_bottles_ids_list
+
+
+PCL = ('parent', 'child')
+
+LOAD_POSE_TYPES = ('any_pose', 'demo_pose', 'random_upright')
+
+UPRIGHT_ORIENTATIONS = {
+    'mug': common.euler2quat([np.pi/2, 0, 0]).tolist(),
+    'bottle': common.euler2quat([np.pi/2, 0, 0]).tolist(),
+    'bowl': common.euler2quat([np.pi/2, 0, 0]).tolist(),
+    'syn_rack_easy': common.euler2quat([0, 0, 0]).tolist(),
+    'syn_container': common.euler2quat([0, 0, 0]).tolist(),
+}
+
+# class -> ([scale high, scale low], default scale)
+SCALE_RANGES = {
+    'mug': ([0.35, 0.25], 0.3),
+    'bowl': ([0.325, 0.15], 0.3),
+    'bottle': ([0.35, 0.2], 0.3),
+    'syn_rack_easy': ([0.35, 0.25], 0.3),
+    'syn_container': ([1.1, 0.9], 1.0),
+}
+
+# classes that are constrained to the pose they are sampled at
+CONSTRAINED_CLASSES = ('syn_rack_easy', 'syn_rack_hard', 'syn_rack_med')
+
+
+def random_color(rng=random) -> (float, float, float):
+    """
+    Generate a random color. Use HSV so that the colors are evenly distributed.
+    Returns a tuple of 3 floats in the range [0, 1]
+    """
+    h, s, v = [rng.random() for i in range(3)]
+    r, g, b = colorsys.hsv_to_rgb(h, s, v)
+    return r, g, b
+
+
+def avoid_ids(object_class: str, cfg) -> List[str]:
+    """Shapenet ids that should not be used for object_class"""
+    if object_class == 'mug':
+        return bad_shapenet_mug_ids_list + cfg.MUG.AVOID_SHAPENET_IDS
+    elif object_class == 'bowl':
+        return bad_shapenet_bowls_ids_list + cfg.BOWL.AVOID_SHAPENET_IDS
+    elif object_class == 'bottle':
+        return bad_shapenet_bottles_ids_list + cfg.BOTTLE.AVOID_SHAPENET_IDS
+    return []
+
+
+def load_test_ids(object_class: str) -> List[str]:
+    """Ids of the objects of object_class that can be used for testing"""
+    test_ids = np.loadtxt(osp.join(path_util.get_rndf_share(), '%s_test_object_split.txt' % object_class), dtype=str).tolist()
+    # process these to remove the file type
+    return [val.split('.')[0] for val in test_ids]
+
+
+def make_pc_master_dict(parent_class: str, child_class: str, parent_load_pose_type: str, child_load_pose_type: str,
+                        cfg, demos: Sequence) -> Dict:
+    """
+    Everything needed to sample the parent and child objects of a trial: their class, test ids,
+    scale ranges, position ranges, load pose type, and the object ids and start poses of the demos
+
+    Args:
+        cfg (CfgNode): Eval config, for the x range and the ids to avoid
+        demos (list): Loaded relation demos (.npz files)
+    """
+    for load_pose_type in (parent_load_pose_type, child_load_pose_type):
+        assert load_pose_type in LOAD_POSE_TYPES, f'Invalid load pose type {load_pose_type}! Must be in {", ".join(LOAD_POSE_TYPES)}'
+
+    x_low, x_high = cfg.OBJ_SAMPLE_X_HIGH_LOW
+    pc_master_dict = dict(parent={}, child={})
+    for pc, object_class, load_pose_type in [('parent', parent_class, parent_load_pose_type),
+                                             ('child', child_class, child_load_pose_type)]:
+        pc_master_dict[pc]['class'] = object_class
+        pc_master_dict[pc]['load_pose_type'] = load_pose_type
+        pc_master_dict[pc]['test_ids'] = load_test_ids(object_class)
+        pc_master_dict[pc]['avoid_ids'] = avoid_ids(object_class, cfg)
+        pc_master_dict[pc]['xhl'] = [x_high, x_low]
+        # get the class specific ranges for scaling the objects
+        if object_class in SCALE_RANGES:
+            pc_master_dict[pc]['scale_hl'], pc_master_dict[pc]['scale_default'] = SCALE_RANGES[object_class]
+
+        # load data from demos in case we want to test on the shapes we trained on
+        pc_master_dict[pc]['demo_ids'] = [dat['multi_object_ids'].item()[pc] for dat in demos]
+        pc_master_dict[pc]['demo_start_poses'] = [dat['multi_obj_start_obj_pose'].item()[pc] for dat in demos]
+
+    # parent on the left of the table, child on the right
+    pc_master_dict['parent']['yhl'] = [0.2, 0.075]
+    pc_master_dict['child']['yhl'] = [-0.2, -0.3]
+    return pc_master_dict
+
+
+def mesh_files(mesh_data_dir: str, obj_id: str, is_shapenet_obj: bool) -> Tuple[str, str]:
+    """
+    Returns:
+        2-element tuple containing
+        - str: The mesh file of an object
+        - str: Its convex decomposition
+    """
+    if is_shapenet_obj:
+        obj_file = osp.join(mesh_data_dir, obj_id, 'models/model_normalized.obj')
+    else:
+        obj_file = osp.join(mesh_data_dir, obj_id + '.obj')
+    return obj_file, obj_file.split('.obj')[0] + '_dec.obj'
+
+
+def sample_object_ids(pc_master_dict: Dict, demo_idx: int, test_on_train: bool, py_rng=random) -> Tuple[str, str]:
+    """Parent and child object ids of a trial, from the test ids or from its demo"""
+    if test_on_train:
+        parent_id = pc_master_dict['parent']['demo_ids'][demo_idx]
+        child_id = pc_master_dict['child']['demo_ids'][demo_idx]
+    else:
+        parent_id = py_rng.sample(pc_master_dict['parent']['test_ids'], 1)[0]
+        child_id = py_rng.sample(pc_master_dict['child']['test_ids'], 1)[0]
+    return parent_id.replace('_dec', ''), child_id.replace('_dec', '')
+
+
+def fit_container_scale(container_mesh: trimesh.Trimesh, bottle_mesh: trimesh.Trimesh, pc_master_dict: Dict,
+                        np_rng=np.random) -> Tuple[Optional[float], trimesh.primitives.Box, trimesh.primitives.Box]:
+    """
+    Check if the bottle fits into the container at their default scales
+
+    Returns:
+        3-element tuple containing
+        - float: A larger scale for the container so the bottle is more likely to fit, or None if it fits
+        - trimesh.primitives.Box: The 2D bounding box of the upright container
+        - trimesh.primitives.Box: The 2D bounding box of the upright bottle
+    """
+    container_mesh = container_mesh.copy().apply_scale(pc_master_dict['parent']['scale_default'])
+    bottle_mesh = bottle_mesh.copy().apply_scale(pc_master_dict['child']['scale_default'])
+
+    # make upright
+    container_upright_mat = np.eye(4); container_upright_mat[:-1, :-1] = common.quat2rot(UPRIGHT_ORIENTATIONS['syn_container'])
+    bottle_upright_mat = np.eye(4); bottle_upright_mat[:-1, :-1] = common.quat2rot(UPRIGHT_ORIENTATIONS['bottle'])
+    container_mesh.apply_transform(container_upright_mat)
+    bottle_mesh.apply_transform(bottle_upright_mat)
+
+    # get the 2D projection of the vertices
+    container_2d = np.asarray(container_mesh.vertices)[:, :-1]
+    bottle_2d = np.asarray(bottle_mesh.vertices)[:, :-1]
+    container_flat = np.hstack([container_2d, np.zeros(container_2d.shape[0]).reshape(-1, 1)])
+    bottle_flat = np.hstack([bottle_2d, np.zeros(bottle_2d.shape[0]).reshape(-1, 1)])
+
+    container_box = trimesh.PointCloud(container_flat).bounding_box
+    bottle_box = trimesh.PointCloud(bottle_flat).bounding_box
+
+    new_parent_scale = None
+    if np.max(bottle_box.extents) > (0.75 * np.min(container_box.extents[:-1])):
+        # scale up the container size so that the bottle is more likely to fit inside
+        new_parent_scale = np.max(bottle_box.extents) * (np_rng.random_sample() * (2 - 1.5) + 1.5) / np.min(container_box.extents[:-1])
+    return new_parent_scale, container_box, bottle_box
+
+
+def sample_object(pc: str, pc_master_dict: Dict, mesh_file: str, mesh_file_dec: str, demo_idx: int, table_z: float,
+                  rand_mesh_scale: bool = False, scale_default: Optional[float] = None,
+                  np_rng=np.random, py_rng=random) -> Dict:
+    """
+    Sample the scale, pose and color of the parent or child object of a trial
+
+    Args:
+        pc (str): 'parent' or 'child'
+        scale_default (float): Scale to use instead of the default scale of the class (without rand_mesh_scale)
+
+    Returns:
+        dict: mesh_file, mesh_file_dec, mesh_scale, pos, ori, constrain (whether to constrain the
+            object to its pose) and rgba
+    """
+    obj = dict(mesh_file=mesh_file, mesh_file_dec=mesh_file_dec)
+
+    # get the object scales we will use
+    scale_high, scale_low = pc_master_dict[pc]['scale_hl']
+    if scale_default is None:
+        scale_default = pc_master_dict[pc]['scale_default']
+    if rand_mesh_scale:
+        obj['mesh_scale'] = [np_rng.random_sample() * (scale_high - scale_low) + scale_low] * 3
+    else:
+        obj['mesh_scale'] = [scale_default] * 3
+
+    object_class = pc_master_dict[pc]['class']
+    upright_orientation = UPRIGHT_ORIENTATIONS[object_class]
+
+    # sample a pose to use for each object, depending on distribution of poses for this run
+    load_pose_type = pc_master_dict[pc]['load_pose_type']
+    x_high, x_low = pc_master_dict[pc]['xhl']
+    y_high, y_low = pc_master_dict[pc]['yhl']
+
+    if load_pose_type == 'any_pose':
+        if object_class in ['bowl', 'bottle']:
+            rp = np_rng.rand(2) * (2 * np.pi / 3) - (np.pi / 3)
+            ori = common.euler2quat([rp[0], rp[1], 0]).tolist()
+        else:
+            rpy = np_rng.rand(3) * (2 * np.pi / 3) - (np.pi / 3)
+            ori = common.euler2quat([rpy[0], rpy[1], rpy[2]]).tolist()
+
+        pos = [
+            np_rng.random_sample() * (x_high - x_low) + x_low,
+            np_rng.random_sample() * (y_high - y_low) + y_low,
+            table_z]
+        pose = pos + ori
+        rand_yaw_T = util.rand_body_yaw_transform(pos, min_theta=-np.pi, max_theta=np.pi, rng=np_rng)
+        pose_w_yaw = util.transform_pose(util.list2pose_stamped(pose), util.pose_from_matrix(rand_yaw_T))
+        pos, ori = util.pose_stamped2list(pose_w_yaw)[:3], util.pose_stamped2list(pose_w_yaw)[3:]
+    elif load_pose_type == 'demo_pose':
+        obj_start_pose_demo = pc_master_dict[pc]['demo_start_poses'][demo_idx]
+        pos, ori = obj_start_pose_demo[:3], obj_start_pose_demo[3:]
+    else:
+        pos = [np_rng.random_sample() * (x_high - x_low) + x_low, np_rng.random_sample() * (y_high - y_low) + y_low, table_z]
+        pose = util.list2pose_stamped(pos + upright_orientation)
+        rand_yaw_T = util.rand_body_yaw_transform(pos, min_theta=-np.pi, max_theta=np.pi, rng=np_rng)
+        pose_w_yaw = util.transform_pose(pose, util.pose_from_matrix(rand_yaw_T))
+        pos, ori = util.pose_stamped2list(pose_w_yaw)[:3], util.pose_stamped2list(pose_w_yaw)[3:]
+
+    obj['pos'], obj['ori'] = pos, ori
+    obj['constrain'] = (object_class in CONSTRAINED_CLASSES) or (load_pose_type == 'any_pose' and pc == 'child')
+    obj['rgba'] = [*random_color(py_rng), 1.0]
+    return obj
@@ -0,0 +1,39 @@
+"""
+Per-trial seeds of the evaluation and dataset generation runs. Each trial reseeds the random
+number generators from (seed, trial index), so a trial gives the same result no matter which
+worker runs it, whether it is pipelined, or whether the run was resumed.
+
+Torch is only imported by seed_trial, so the scripts that only sample scenes don't load it.
+"""
+import random
+from typing import Tuple
+
+import numpy as np
+
+
+def trial_seed(seed: int, iteration: int, stream: int = 0) -> int:
+    """
+    Seed for one trial, derived from the experiment seed and the trial index. Different
+    streams give independent seeds for the different parts of a trial (e.g., sampling
+    the scene and running the optimizer)
+    """
+    return int(np.random.SeedSequence([seed, iteration, stream]).generate_state(1)[0])
+
+
+def seed_trial(seed: int, iteration: int, stream: int = 0) -> None:
+    """Reseed the global python, numpy and torch generators for a trial"""
+    import torch
+
+    s = trial_seed(seed, iteration, stream)
+    random.seed(s)
+    np.random.seed(s)
+    torch.manual_seed(s)
+
+
+def trial_rngs(seed: int, iteration: int, stream: int = 0) -> Tuple[np.random.RandomState, random.Random]:
+    """
+    Numpy and python generators for a trial. They produce the same numbers as the global
+    generators would after seed_trial, without touching the global state
+    """
+    s = trial_seed(seed, iteration, stream)
+    return np.random.RandomState(s), random.Random(s)
@@ -12,24 +12,28 @@ EPS = 1e-6
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
-def knn(x, k):
+def knn(x, k, mask=None):
     inner = -2*torch.matmul(x.transpose(2, 1), x)
     xx = torch.sum(x**2, dim=1, keepdim=True)
     pairwise_distance = -xx - inner - xx.transpose(2, 1)
+
+    if mask is not None:
+        # padded points (mask == False) can never be selected as neighbors
+        pairwise_distance = pairwise_distance.masked_fill(~mask[:, None, :], -float('inf'))
  
     idx = pairwise_distance.topk(k=k, dim=-1)[1]   # (batch_size, num_points, k)
     return idx
 
 
-def get_graph_feature(x, k=20, idx=None, x_coord=None):
+def get_graph_feature(x, k=20, idx=None, x_coord=None, mask=None):
     batch_size = x.size(0)
     num_points = x.size(3)
     x = x.view(batch_size, -1, num_points)
     if idx is None:
         if x_coord is not None: # dynamic knn graph
-            idx = knn(x_coord, k=k)   # (batch_size, num_points, k)
+            idx = knn(x_coord, k=k, mask=mask)   # (batch_size, num_points, k)
         else:             # fixed knn graph with input point coordinates
-            idx = knn(x, k=k)
+            idx = knn(x, k=k, mask=mask)
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
 
@@ -50,12 +54,12 @@ def get_graph_feature(x, k=20, idx=None, x_coord=None):
     return feature
 
 
-def get_graph_feature_cross(x, k=20, idx=None):
+def get_graph_feature_cross(x, k=20, idx=None, mask=None):
     batch_size = x.size(0)
     num_points = x.size(3)
     x = x.view(batch_size, -1, num_points)
     if idx is None:
-        idx = knn(x, k=k)   # (batch_size, num_points, k)
+        idx = knn(x, k=k, mask=mask)   # (batch_size, num_points, k)
 
     idx_base = torch.arange(0, batch_size, device=device).view(-1, 1, 1)*num_points
 
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from rndf_robot.model.layers_equi import *
 
 def maxpool(x, dim=-1, keepdim=False):
@@ -11,11 +14,50 @@ def meanpool(x, dim=-1, keepdim=False):
     out = x.mean(dim=dim, keepdim=keepdim)
     return out
 
+
+def masked_meanpool(x, mask=None, dim=-1, keepdim=False):
+    ''' Mean over the points (last) dimension, ignoring the padded points.
+
+    Args:
+        x (torch.Tensor): B x ... x N features
+        mask (torch.Tensor): B x N bool, True for valid points. If None, this is just meanpool
+    '''
+    if mask is None:
+        return meanpool(x, dim=dim, keepdim=keepdim)
+    assert dim == -1, 'masked_meanpool only supports pooling over the last (points) dimension'
+    mask = mask.view((mask.size(0),) + (1,) * (x.dim() - 2) + (mask.size(-1),)).to(x.dtype)
+    out = (x * mask).sum(dim=-1, keepdim=keepdim) / mask.sum(dim=-1, keepdim=keepdim).clamp(min=1)
+    return out
+
+@contextmanager
+def frozen_running_stats(module, enabled=True):
+    ''' Batch norms of module that still normalize with the batch statistics in train mode, but
+    leave their running statistics (and num_batches_tracked) as they are.
+
+    The batch norms keep tracking the statistics with a momentum of 0 rather than not tracking
+    them, so they save the same tensors for backward (which checkpointing checks).
+    '''
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)
+           and m.training and m.track_running_stats] if enabled else []
+    saved = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(bns, saved):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
 class VNN_DGCNN(nn.Module):
-    def __init__(self, c_dim=128, dim=3, hidden_dim=64, k=20):
+    def __init__(self, c_dim=128, dim=3, hidden_dim=64, k=20, use_checkpoint=False):
         super(VNN_DGCNN, self).__init__()
         self.c_dim = c_dim
+        self.hidden_dim = hidden_dim
         self.k = k
+        # recompute the graph features of each layer in the backward pass instead of storing them
+        self.use_checkpoint = use_checkpoint
 
         self.conv1 = VNLinearLeakyReLU(2, hidden_dim)
         self.conv2 = VNLinearLeakyReLU(hidden_dim*2, hidden_dim)
@@ -29,29 +71,62 @@ class VNN_DGCNN(nn.Module):
 
         self.conv_c = VNLinearLeakyReLU(hidden_dim*4, c_dim, dim=4, share_nonlinearity=True)
 
-    def forward(self, x):
+    def estimate_memory_per_sample(self, num_points, requires_grad=False):
+        ''' Rough estimate of the peak memory (in bytes) used by forward for each point cloud.
+
+        Dominated by the B x C x 3 x N x k graph features: the 2 * hidden_dim input of each layer
+        and about ten hidden_dim sized intermediates of VNLinearLeakyReLU. Without autograd (or with
+        checkpointing) only one layer is alive at a time, otherwise all of them are kept.
+        '''
+        n_edges = num_points * self.k
+        knn_floats = 3 * num_points * num_points
+        layer_floats = 12 * self.hidden_dim * 3 * n_edges
+        if requires_grad and not self.use_checkpoint:
+            total_floats = 4 * layer_floats + knn_floats
+        else:
+            total_floats = layer_floats + knn_floats
+        return 4 * total_floats
+
+    def _edge_conv(self, x, conv, pool, mask=None):
+        x = get_graph_feature(x, k=self.k, mask=mask)
+        x = conv(x)
+        return pool(x)
+
+    def _checkpointed_edge_conv(self, x, conv, pool, mask=None):
+        # the layer runs a second time in the backward pass, where its batch norms must still
+        # normalize with the batch statistics but not update their running statistics again
+        calls = [0]
+
+        def edge_conv(x, mask):
+            recompute = calls[0] > 0
+            calls[0] += 1
+            with frozen_running_stats(conv, enabled=recompute):
+                return self._edge_conv(x, conv, pool, mask)
+
+        return checkpoint(edge_conv, x, mask, use_reentrant=False)
+
+    def forward(self, x, mask=None):
+        '''
+        Args:
+            x (torch.Tensor): B x N x 3 point clouds, possibly padded
+            mask (torch.Tensor): Optional B x N bool mask, True for valid (non-padded) points
+        '''
 
         batch_size = x.size(0)
         x = x.unsqueeze(1).transpose(2, 3)
-        x = get_graph_feature(x, k=self.k)
-        x = self.conv1(x)
-        x1 = self.pool1(x)
-
-        x = get_graph_feature(x1, k=self.k)
-        x = self.conv2(x)
-        x2 = self.pool2(x)
-
-        x = get_graph_feature(x2, k=self.k)
-        x = self.conv3(x)
-        x3 = self.pool3(x)
 
-        x = get_graph_feature(x3, k=self.k)
-        x = self.conv4(x)
-        x4 = self.pool4(x)
+        layers = [(self.conv1, self.pool1), (self.conv2, self.pool2), (self.conv3, self.pool3), (self.conv4, self.pool4)]
+        layer_outs = []
+        for conv, pool in layers:
+            if self.use_checkpoint and torch.is_grad_enabled():
+                x = self._checkpointed_edge_conv(x, conv, pool, mask)
+            else:
+                x = self._edge_conv(x, conv, pool, mask)
+            layer_outs.append(x)
 
-        x = torch.cat((x1, x2, x3, x4), dim=1)
+        x = torch.cat(layer_outs, dim=1)
         x = self.conv_c(x)
-        x = x.mean(dim=-1, keepdim=False)
+        x = masked_meanpool(x, mask, dim=-1, keepdim=False)
 
         return x
 
@@ -63,7 +138,8 @@ class VNNOccNet(nn.Module):
                  sigmoid=True,
                  return_features=False, 
                  acts='all',
-                 scaling=10.0):
+                 scaling=10.0,
+                 checkpoint_encoder=False):
         super().__init__()
 
         self.latent_dim = latent_dim
@@ -72,7 +148,9 @@ class VNNOccNet(nn.Module):
 
         if model_type == 'dgcnn':
             self.model_type = 'dgcnn'
-            self.encoder = VNN_DGCNN(c_dim=latent_dim) # modified resnet-18
+            # checkpoint_encoder trades compute for memory when training (train_vnn_occupancy_net.py --checkpoint_encoder),
+            # inference extracts the latents without autograd anyway
+            self.encoder = VNN_DGCNN(c_dim=latent_dim, use_checkpoint=checkpoint_encoder) # modified resnet-18
         else:
             self.model_type = 'pointnet'
             self.encoder = VNN_ResnetPointnet(c_dim=latent_dim) # modified resnet-18
@@ -86,7 +164,7 @@ class VNNOccNet(nn.Module):
         enc_in = input['point_cloud'] * self.scaling 
         query_points = input['coords'] * self.scaling 
 
-        z = self.encoder(enc_in)
+        z = self.encoder(enc_in, mask=input.get('mask'))
 
         if self.return_features:
             out_dict['occ'], out_dict['features'] = self.decoder(query_points, z)
@@ -95,17 +173,34 @@ class VNNOccNet(nn.Module):
 
         return out_dict
 
-    def extract_latent(self, input):
+    def extract_latent(self, input, mem_budget=None):
+        ''' Encode the point clouds in input['point_cloud'].
+
+        Args:
+            input (dict): Must contain 'point_cloud', B x N x 3. May contain 'mask', B x N bool,
+                True for valid points, for batches of padded point clouds of different sizes
+            mem_budget (int): Optional memory budget in bytes. If given, the batch is split into
+                micro-batches that are each expected to fit within the budget. Note that in
+                train mode this changes the batch norm statistics.
+        '''
         enc_in = input['point_cloud'] * self.scaling 
-        z = self.encoder(enc_in)
+        mask = input.get('mask')
+        if mem_budget is None:
+            return self.encoder(enc_in, mask=mask)
+
+        per_sample = self.encoder.estimate_memory_per_sample(enc_in.size(1), requires_grad=torch.is_grad_enabled())
+        micro_batch_size = max(1, int(mem_budget // per_sample))
+        if micro_batch_size >= enc_in.size(0):
+            return self.encoder(enc_in, mask=mask)
+        enc_in_mbs = enc_in.split(micro_batch_size, dim=0)
+        mask_mbs = mask.split(micro_batch_size, dim=0) if mask is not None else [None] * len(enc_in_mbs)
+        z = torch.cat([self.encoder(enc_in_mb, mask=mask_mb) for enc_in_mb, mask_mb in zip(enc_in_mbs, mask_mbs)], dim=0)
         return z
 
     def forward_latent(self, z, coords):
-        out_dict = {}
         coords = coords * self.scaling 
-        out_dict['occ'], out_dict['features'] = self.decoder(coords, z)
-
-        return out_dict['features']
+        # only run the decoder layers needed for the descriptor, skip the occupancy head
+        return self.decoder.forward_features(coords, z)
 
 class VNN_ResnetPointnet(nn.Module):
     ''' DGCNN-based VNN encoder network with ResNet blocks.
@@ -133,6 +228,7 @@ class VNN_ResnetPointnet(nn.Module):
 
         self.actvn_c = VNLeakyReLU(hidden_dim, negative_slope=0.2, share_nonlinearity=False)
         self.pool = meanpool
+        self.hidden_dim = hidden_dim
 
         if meta_output == 'invariant_latent':
             self.std_feature = VNStdFeature(c_dim, dim=3, normalize_frame=True, use_batchnorm=False)
@@ -142,37 +238,58 @@ class VNN_ResnetPointnet(nn.Module):
         elif meta_output == 'equivariant_latent_linear':
             self.vn_inv = VNLinear(c_dim, 3)
 
-    def forward(self, p):
+    def estimate_memory_per_sample(self, num_points, requires_grad=False):
+        ''' Rough estimate of the peak memory (in bytes) used by forward for each point cloud.
+
+        Dominated by the 128 x 3 x N x k output of conv_pos on the input graph features, and the
+        intermediates of the same size in its VNLinearLeakyReLU.
+        '''
+        n_edges = num_points * self.k
+        knn_floats = 3 * num_points * num_points
+        graph_floats = 4 * 3 * 3 * n_edges + 8 * 128 * 3 * n_edges
+        block_floats = 5 * 4 * 2 * self.hidden_dim * 3 * num_points
+        if requires_grad:
+            total_floats = graph_floats + 5 * block_floats + knn_floats
+        else:
+            total_floats = max(graph_floats, block_floats) + knn_floats
+        return 4 * total_floats
+
+    def forward(self, p, mask=None):
+        '''
+        Args:
+            p (torch.Tensor): B x N x 3 point clouds, possibly padded
+            mask (torch.Tensor): Optional B x N bool mask, True for valid (non-padded) points
+        '''
         batch_size = p.size(0)
         p = p.unsqueeze(1).transpose(2, 3)
         #mean = get_graph_mean(p, k=self.k)
         #mean = p_trans.mean(dim=-1, keepdim=True).expand(p_trans.size())
-        feat = get_graph_feature_cross(p, k=self.k)
+        feat = get_graph_feature_cross(p, k=self.k, mask=mask)
         net = self.conv_pos(feat)
         net = self.pool(net, dim=-1)
 
         net = self.fc_pos(net)
 
         net = self.block_0(net)
-        pooled = self.pool(net, dim=-1, keepdim=True).expand(net.size())
+        pooled = masked_meanpool(net, mask, dim=-1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=1)
 
         net = self.block_1(net)
-        pooled = self.pool(net, dim=-1, keepdim=True).expand(net.size())
+        pooled = masked_meanpool(net, mask, dim=-1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=1)
 
         net = self.block_2(net)
-        pooled = self.pool(net, dim=-1, keepdim=True).expand(net.size())
+        pooled = masked_meanpool(net, mask, dim=-1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=1)
 
         net = self.block_3(net)
-        pooled = self.pool(net, dim=-1, keepdim=True).expand(net.size())
+        pooled = masked_meanpool(net, mask, dim=-1, keepdim=True).expand(net.size())
         net = torch.cat([net, pooled], dim=1)
 
         net = self.block_4(net)
 
         # Recude to  B x F
-        net = self.pool(net, dim=-1)
+        net = masked_meanpool(net, mask, dim=-1)
 
         c = self.fc_c(self.actvn_c(net))
 
@@ -237,12 +354,8 @@ class DecoderInner(nn.Module):
         else:
             self.actvn = lambda x: F.leaky_relu(x, 0.2)
 
-    def forward(self, p, z, c=None, **kwargs):
+    def _input_features(self, p, z, c=None):
         batch_size, T, D = p.size()
-        acts = []
-        acts_inp = []
-        acts_first_rn = []
-        acts_inp_first_rn = []
 
         if isinstance(c, tuple):
             c, c_meta = c
@@ -263,6 +376,44 @@ class DecoderInner(nn.Module):
             c_inv = (c * c_dir).sum(-1).unsqueeze(1).repeat(1, T, 1)
             net = torch.cat([net, net_c, c_inv], dim=2)
 
+        return net
+
+    def forward_features(self, p, z, c=None, **kwargs):
+        ''' Features-only forward pass.
+
+        Only runs the layers that the descriptor selected by ``acts`` depends on,
+        and never evaluates the occupancy head. The output matches the features
+        returned by ``forward`` when ``return_features=True``.
+        '''
+        net = self._input_features(p, z, c)
+
+        if self.acts in ['inp', 'inp_first_rn']:
+            acts = net
+        else:
+            acts = [net]
+            net = self.fc_in(net)
+            acts.append(net)
+            net = self.block0(net)
+            if self.acts == 'first_rn':
+                acts = net
+            else:
+                acts.append(net)
+                for block in [self.block1, self.block2, self.block3, self.block4]:
+                    net = block(net)
+                    acts.append(net)
+                acts = torch.cat(acts, dim=-1)
+
+        acts = F.normalize(acts, p=2, dim=-1)
+        return acts
+
+    def forward(self, p, z, c=None, **kwargs):
+        acts = []
+        acts_inp = []
+        acts_first_rn = []
+        acts_inp_first_rn = []
+
+        net = self._input_features(p, z, c)
+
         acts.append(net)
         acts_inp.append(net)
         acts_inp_first_rn.append(net)
@@ -299,6 +450,8 @@ class DecoderInner(nn.Module):
                 acts = torch.cat(acts, dim=-1)
             elif self.acts == 'inp':
                 acts = torch.cat(acts_inp, dim=-1)
+            elif self.acts == 'first_rn':
+                acts = torch.cat(acts_first_rn, dim=-1)
             elif self.acts == 'last':
                 acts = last_act
             elif self.acts == 'inp_first_rn':
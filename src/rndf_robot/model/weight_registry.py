@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os, os.path as osp
+import weakref
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from loguru import logger
+
+
+_ALIGNMENT = 64
+
+
+def default_cache_dir() -> str:
+    """Per-user cache folder for the flat checkpoints (the checkpoint folders may be read-only or shared)"""
+    return osp.join(os.environ.get('XDG_CACHE_HOME', osp.expanduser('~/.cache')), 'rndf_robot', 'weight_cache')
+
+
+def checkpoint_hash(path: str, chunk_size: int = 1 << 20) -> str:
+    """sha256 of the checkpoint file contents"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _torch_to_numpy_dtype(dtype: torch.dtype) -> Optional[np.dtype]:
+    try:
+        return torch.empty(0, dtype=dtype).numpy().dtype
+    except TypeError:
+        # e.g. bfloat16 has no numpy equivalent
+        return None
+
+
+def write_flat_checkpoint(state_dict: Dict[str, torch.Tensor], bin_fname: str, index_fname: str) -> None:
+    """
+    Write a state dict as one contiguous binary blob plus a JSON index with the
+    name, dtype, shape and byte offset of every tensor. Both files are written
+    to a temporary name first and renamed, so readers never see a partial file.
+    """
+    index = {}
+    offset = 0
+    tmp_bin_fname = f'{bin_fname}.tmp.{os.getpid()}'
+    with open(tmp_bin_fname, 'wb') as f:
+        for name, tensor in state_dict.items():
+            arr = tensor.detach().cpu().contiguous().numpy()
+            pad = (-offset) % _ALIGNMENT
+            f.write(b'\0' * pad)
+            offset += pad
+            f.write(arr.tobytes())
+            index[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'offset': offset}
+            offset += arr.nbytes
+    tmp_index_fname = f'{index_fname}.tmp.{os.getpid()}'
+    with open(tmp_index_fname, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_bin_fname, bin_fname)
+    os.replace(tmp_index_fname, index_fname)
+
+
+def read_flat_checkpoint(bin_fname: str, index_fname: str) -> Dict[str, torch.Tensor]:
+    """
+    Memory-map a checkpoint written with write_flat_checkpoint. The returned tensors
+    are copy-on-write views of the file, so reading them is essentially free and the
+    pages of the file are shared through the page cache by all processes that map it.
+    """
+    with open(index_fname, 'r') as f:
+        index = json.load(f)
+    if osp.getsize(bin_fname) == 0:
+        return {name: torch.from_numpy(np.zeros(info['shape'], dtype=np.dtype(info['dtype'])))
+                for name, info in index.items()}
+    buf = np.memmap(bin_fname, dtype=np.uint8, mode='c')
+    state_dict = {}
+    for name, info in index.items():
+        dtype = np.dtype(info['dtype'])
+        count = int(np.prod(info['shape'])) if len(info['shape']) > 0 else 1
+        arr = np.frombuffer(buf, dtype=dtype, count=count, offset=info['offset']).reshape(info['shape'])
+        state_dict[name] = torch.from_numpy(arr)
+    return state_dict
+
+
+class NDFWeightRegistry:
+    """
+    Loads each NDF checkpoint once and restores model weights from an in-memory
+    snapshot, only when something changed.
+
+    Checkpoints are converted on first use into a flat, memory-mapped format keyed by
+    the sha256 of the checkpoint contents (stored in cache_dir), so the snapshot costs no
+    extra memory. Restoring still copies the weights into the model (load_state_dict, and
+    the models usually live on the GPU), so every model holds its own copy of the weights.
+    Restoring a model is skipped when none of its parameters/buffers were replaced or
+    modified in place since the last restore (tracked with the tensor version counters),
+    and when the checkpoint file on disk is unchanged.
+    """
+    def __init__(self, cache_dir: Optional[str] = None):
+        """
+        Args:
+            cache_dir (str): Directory for the flat checkpoint files. If None,
+                default_cache_dir() is used
+        """
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        # checkpoint path -> (stat signature, content hash, memory-mapped state dict)
+        self._snapshots: Dict[str, Tuple[Tuple, str, Dict[str, torch.Tensor]]] = {}
+        # model -> (checkpoint path, content hash, per-tensor fingerprint)
+        self._restored: 'weakref.WeakKeyDictionary[nn.Module, Tuple[str, str, Dict[str, Tuple[int, int]]]]' = \
+            weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def _stat_signature(path: str) -> Tuple:
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def _fingerprint(model: nn.Module) -> Dict[str, Tuple[int, int]]:
+        # _version is bumped by every in-place op (optimizer steps, copy_, etc.), and
+        # data_ptr changes when a parameter gets replaced
+        return {name: (t.data_ptr(), t._version) for name, t in model.state_dict(keep_vars=True).items()}
+
+    def _cache_fnames(self, content_hash: str) -> Tuple[str, str]:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return osp.join(self.cache_dir, f'{content_hash}.bin'), osp.join(self.cache_dir, f'{content_hash}.json')
+
+    def get_state_dict(self, path: str) -> Tuple[str, Dict[str, torch.Tensor]]:
+        """
+        Get the (memory-mapped, read-only) state dict for a checkpoint, along with
+        its content hash. The checkpoint is only read from disk the first time, or
+        if the file has changed since.
+        """
+        path = osp.abspath(path)
+        signature = self._stat_signature(path)
+        if path in self._snapshots and self._snapshots[path][0] == signature:
+            return self._snapshots[path][1], self._snapshots[path][2]
+
+        content_hash = checkpoint_hash(path)
+        bin_fname, index_fname = self._cache_fnames(content_hash)
+        if not (osp.exists(bin_fname) and osp.exists(index_fname)):
+            logger.info(f'[NDFWeightRegistry] Converting {path} to flat checkpoint {bin_fname}')
+            state_dict = torch.load(path, map_location=torch.device('cpu'))
+            convertible = all(
+                isinstance(v, torch.Tensor) and _torch_to_numpy_dtype(v.dtype) is not None
+                for v in state_dict.values())
+            if not convertible:
+                logger.warning(f'[NDFWeightRegistry] {path} contains entries that cannot be memory-mapped, keeping it in memory')
+                self._snapshots[path] = (signature, content_hash, state_dict)
+                return content_hash, state_dict
+            write_flat_checkpoint(state_dict, bin_fname, index_fname)
+
+        state_dict = read_flat_checkpoint(bin_fname, index_fname)
+        self._snapshots[path] = (signature, content_hash, state_dict)
+        return content_hash, state_dict
+
+    def restore(self, model: nn.Module, path: str) -> bool:
+        """
+        Make sure the model holds the weights from the checkpoint at path
+
+        Returns:
+            bool: True if the weights had to be copied into the model, False if they
+                were already up to date
+        """
+        content_hash, state_dict = self.get_state_dict(path)
+        restored = self._restored.get(model)
+        if restored is not None:
+            restored_path, restored_hash, fingerprint = restored
+            if restored_path == osp.abspath(path) and restored_hash == content_hash \
+                    and fingerprint == self._fingerprint(model):
+                logger.debug(f'[NDFWeightRegistry] Weights for {path} unchanged, skipping restore')
+                return False
+
+        model.load_state_dict(state_dict)
+        self._restored[model] = (osp.abspath(path), content_hash, self._fingerprint(model))
+        return True
@@ -0,0 +1,151 @@
+"""
+Write the NeRF datasets of the trials in the background, so the simulator can move on to the
+next trial while the images are encoded.
+
+The frames of a dataset are written by a pool of threads (PIL and zlib release the GIL while
+encoding, and the images don't have to be copied to another process), one task per frame. The
+task that writes the last frame of a dataset writes its transforms, its extra json files and
+then its completion marker, and calls the on_done callback of the dataset. At most max_pending
+datasets are held in memory, submit blocks until one of them is done.
+"""
+import os.path as osp
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+
+from rndf_robot.nerf.dataset import (
+    camera_params, make_frame_dirs, mark_complete, write_frame, write_json, write_packed_frames, write_transforms)
+
+if TYPE_CHECKING:
+    from rndf_robot.robot.multicam import MultiCams
+
+
+class AsyncDatasetWriter:
+    """
+    Args:
+        num_threads (int): Number of writer threads
+        max_pending (int): Number of datasets that can be submitted and not written yet
+        encoding (str): See rndf_robot.nerf.dataset.ENCODINGS
+        png_compress_level (int): zlib level of the PNGs, 0 (fastest) to 9 (smallest)
+    """
+    def __init__(self, num_threads: int = 4, max_pending: int = 2, encoding: str = 'png',
+                 png_compress_level: int = 6, aabb_scale: int = 4, scale: float = 1.0):
+        assert num_threads > 0 and max_pending > 0
+        self.encoding = encoding
+        self.png_compress_level = png_compress_level
+        self.aabb_scale = aabb_scale
+        self.scale = scale
+
+        self._pool = ThreadPoolExecutor(num_threads, thread_name_prefix='nerf_writer')
+        self._pending = threading.BoundedSemaphore(max_pending)
+        # number of submitted datasets that are not done, and the first error of any of them
+        self._cond = threading.Condition()
+        self._n_running = 0
+        self._error = None
+
+    def _raise_error(self):
+        with self._cond:
+            error, self._error = self._error, None
+        if error is not None:
+            raise RuntimeError('Writing a NeRF dataset failed') from error
+
+    def submit(self, cams: 'MultiCams', rgbs: List[np.ndarray], depths: List[np.ndarray], nerf_dir: str,
+               extra_files: Optional[Dict[str, Dict]] = None, on_done: Optional[Callable[[], None]] = None,
+               profiler=None) -> None:
+        """
+        Write a dataset in the background, like rndf_robot.nerf.dataset.write_instant_ngp_dataset.
+        The images must not be modified afterwards. Raises the error of a dataset that failed
+        since the last call.
+
+        Args:
+            on_done (callable): Called from a writer thread once the dataset is complete
+            profiler (TrialProfiler): Gets the time spent writing under 'execute/nerf_write'
+        """
+        self._raise_error()
+        self._pending.acquire()
+        with self._cond:
+            self._n_running += 1
+
+        try:
+            cam_params = camera_params(cams)
+            make_frame_dirs(nerf_dir, self.encoding)
+        except BaseException:
+            self._finish(None, None)
+            raise
+
+        if self.encoding == 'packed':
+            tasks = [(write_packed_frames, (nerf_dir, rgbs, None)), (write_packed_frames, (nerf_dir, None, depths))]
+        else:
+            tasks = [(write_frame, (nerf_dir, i, rgb, depth, self.encoding, self.png_compress_level))
+                     for i, (rgb, depth) in enumerate(zip(rgbs, depths))]
+        if len(tasks) == 0:
+            tasks = [(lambda: None, ())]
+
+        job = dict(n_left=len(tasks), failed=False, lock=threading.Lock())
+
+        def finalize():
+            write_transforms(cam_params, nerf_dir, self.aabb_scale, self.scale, self.encoding)
+            for fname, data in (extra_files or {}).items():
+                write_json(osp.join(nerf_dir, fname), data)
+            mark_complete(nerf_dir, self.encoding)
+            logger.debug(f'Wrote NeRF dataset to {nerf_dir}')
+
+        def run(fn, fn_args):
+            error = None
+            try:
+                if profiler is not None:
+                    with profiler.span('execute/nerf_write'):
+                        fn(*fn_args)
+                else:
+                    fn(*fn_args)
+            except BaseException as e:
+                error = e
+            with job['lock']:
+                job['n_left'] -= 1
+                job['failed'] = job['failed'] or error is not None
+                last = job['n_left'] == 0
+            if error is None and last and not job['failed']:
+                try:
+                    finalize()
+                    if on_done is not None:
+                        on_done()
+                except BaseException as e:
+                    error = e
+            if error is not None or last:
+                self._finish(error, last)
+
+        for fn, fn_args in tasks:
+            self._pool.submit(run, fn, fn_args)
+
+    def _finish(self, error: Optional[BaseException], last: Optional[bool]):
+        """Record the error of a dataset and/or that it is done (last is None: done without its tasks)"""
+        with self._cond:
+            if error is not None:
+                logger.error(f'Writing a NeRF dataset failed: {error!r}')
+                if self._error is None:
+                    self._error = error
+            if last is None or last:
+                self._n_running -= 1
+                self._pending.release()
+                self._cond.notify_all()
+
+    def wait(self) -> None:
+        """Wait until all the submitted datasets are done, and raise the error of one that failed"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._n_running == 0)
+        self._raise_error()
+
+    def close(self) -> None:
+        try:
+            self.wait()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,58 +1,183 @@
-import glob
+"""
+Collect the NeRF datasets of an eval folder (trial_<i>/nerf_dataset) into their own folder
+(trial_<i>), incrementally.
+
+The target folder has a manifest with the size, mtime and content hash of every file of every
+trial. A sync only hashes the source files whose size or mtime changed since the last sync, only
+copies the trials whose content changed, and removes the trials that are not in the eval folder
+anymore. Files are hardlinked when the eval folder and the target are on the same filesystem, and
+copied by a pool of threads otherwise. A trial is assembled next to its target and moved in
+place once it is complete, so an interrupted sync never leaves a partial trial behind.
+
+Note that a hardlinked file is the same file in both folders, don't modify the datasets in place
+(the eval never does, it writes new trials). Use link=False to always copy.
+"""
+import hashlib
 import json
 import os
 import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import Dict, Optional
 
 from loguru import logger
 
-_regex_pattern = r".*(trial_\d+)\/nerf_dataset"
+MANIFEST_FNAME = "rndf_manifest.json"
+
+_trial_regex = re.compile(r"^trial_\d+$")
+
+
+def find_nerf_datasets(eval_dir: str) -> Dict[str, str]:
+    """The NeRF datasets of the trials of an eval folder, trial name -> dataset folder, sorted by trial index"""
+    datasets = {}
+    for entry in os.scandir(eval_dir):
+        nerf_dataset_path = os.path.join(entry.path, "nerf_dataset")
+        if entry.is_dir() and _trial_regex.match(entry.name) and os.path.isdir(nerf_dataset_path):
+            datasets[entry.name] = nerf_dataset_path
+    return dict(sorted(datasets.items(), key=lambda item: int(item[0].split("_")[-1])))
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _list_files(dataset_dir: str) -> Dict[str, os.stat_result]:
+    """Relative path -> stat of all the files in dataset_dir"""
+    files = {}
+    for root, _, fnames in os.walk(dataset_dir):
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            files[os.path.relpath(path, dataset_dir)] = os.stat(path)
+    return files
+
+
+def fingerprint_dataset(dataset_dir: str, previous: Optional[Dict] = None, pool: Optional[ThreadPoolExecutor] = None) -> Dict:
+    """
+    The files of a dataset with their size, mtime and content hash. The hashes of the files
+    with the same size and mtime as in previous (the files of an earlier fingerprint) are reused.
+
+    Returns:
+        dict: files (relative path -> dict(size, mtime_ns, sha256)) and sha256, the hash of the dataset
+    """
+    previous = previous or {}
+    files = {}
+    to_hash = []
+    for relpath, stat in _list_files(dataset_dir).items():
+        prev = previous.get(relpath)
+        if prev is not None and prev["size"] == stat.st_size and prev["mtime_ns"] == stat.st_mtime_ns:
+            files[relpath] = prev
+        else:
+            files[relpath] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            to_hash.append(relpath)
+
+    paths = [os.path.join(dataset_dir, relpath) for relpath in to_hash]
+    hashes = pool.map(hash_file, paths) if pool is not None else map(hash_file, paths)
+    for relpath, sha256 in zip(to_hash, hashes):
+        files[relpath]["sha256"] = sha256
+
+    h = hashlib.sha256()
+    for relpath in sorted(files):
+        h.update(f"{relpath}\0{files[relpath]['sha256']}\n".encode())
+    return dict(files=files, sha256=h.hexdigest())
+
+
+def _link_or_copy(src: str, dst: str, link: bool) -> bool:
+    """Hardlink src to dst if link is set and possible, copy it otherwise. Returns whether it was linked"""
+    if link:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return False
+
+
+def _load_manifest(target_dir: str) -> Dict:
+    manifest_fname = os.path.join(target_dir, MANIFEST_FNAME)
+    if not os.path.exists(manifest_fname):
+        return {"trials": {}}
+    with open(manifest_fname) as f:
+        return json.load(f)
+
 
+def _write_json(fname: str, data: Dict) -> None:
+    with open(fname + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(fname + ".tmp", fname)
 
-def copy_nerf_datasets(eval_dir: str, target_dir: str) -> None:
+
+def copy_nerf_datasets(eval_dir: str, target_dir: str, link: bool = True, num_threads: int = 8) -> Dict:
     """
-    Find all NeRF datasets (named nerf_dataset) and copy them to the target_dir
-    under their respective trial name.
+    Sync the NeRF datasets (trial_<i>/nerf_dataset) of eval_dir to target_dir/trial_<i>, see the
+    module docstring.
 
     Also copy the full_exp_cfg.txt and other useful files.
+
+    Args:
+        link (bool): Hardlink the files when possible, instead of copying them
+
+    Returns:
+        dict: The names of the trials that were copied, unchanged and removed
     """
-    num_datasets = 0
-    og_dataset_path_to_new_path = {}
-
-    # Clear the target directory
-    if os.path.exists(target_dir):
-        shutil.rmtree(target_dir)
-        os.makedirs(target_dir)
-        logger.debug(f"Removed and recreated {target_dir}")
-
-    # Glob eval directory recursively to find directories named nerf_dataset
-    for nerf_dataset_path in glob.glob(eval_dir + "/**/nerf_dataset", recursive=True):
-        # Extract trial name from path
-        trial_name = re.match(_regex_pattern, nerf_dataset_path).group(1)
-        target_trial_dir = os.path.join(target_dir, trial_name)
-
-        # Copy dataset to target_trial_dir using shutil
-        if os.path.exists(target_trial_dir):
-            raise RuntimeError(
-                f"Target directory {target_trial_dir} already exists!"
-                "Check the `eval_dir` does not contain multiple experiments."
-            )
-        shutil.copytree(nerf_dataset_path, target_trial_dir)
-        logger.debug(f"Copied {nerf_dataset_path} to {target_trial_dir}")
-
-        # Using the relative path to the target directory
-        og_dataset_path_to_new_path[nerf_dataset_path] = trial_name
-        num_datasets += 1
-
-    # Find full_exp_cfg.txt and target_descriptors.npz and copy it to the target_dir
+    os.makedirs(target_dir, exist_ok=True)
+    manifest = _load_manifest(target_dir)
+    datasets = find_nerf_datasets(eval_dir)
+    # hardlinks only work within a filesystem, don't even try otherwise
+    link = link and os.stat(eval_dir).st_dev == os.stat(target_dir).st_dev
+
+    stats = dict(copied=[], unchanged=[], removed=[])
+    n_linked = n_copied_files = 0
+    with ThreadPoolExecutor(num_threads) as pool:
+        for trial_name, nerf_dataset_path in datasets.items():
+            target_trial_dir = os.path.join(target_dir, trial_name)
+            prev = manifest["trials"].get(trial_name)
+            fingerprint = fingerprint_dataset(
+                nerf_dataset_path, prev["files"] if prev is not None and prev["source"] == nerf_dataset_path else None, pool)
+            if prev is not None and prev["sha256"] == fingerprint["sha256"] and os.path.isdir(target_trial_dir):
+                manifest["trials"][trial_name] = dict(source=nerf_dataset_path, **fingerprint)
+                stats["unchanged"].append(trial_name)
+                continue
+
+            # assemble the trial next to its target, then swap it in
+            tmp_trial_dir = os.path.join(target_dir, f".sync_{trial_name}")
+            if os.path.exists(tmp_trial_dir):
+                shutil.rmtree(tmp_trial_dir)
+            for relpath in fingerprint["files"]:
+                os.makedirs(os.path.dirname(os.path.join(tmp_trial_dir, relpath)), exist_ok=True)
+            linked = list(pool.map(
+                lambda relpath: _link_or_copy(
+                    os.path.join(nerf_dataset_path, relpath), os.path.join(tmp_trial_dir, relpath), link),
+                fingerprint["files"]))
+            n_linked += sum(linked)
+            n_copied_files += len(linked) - sum(linked)
+            if os.path.exists(target_trial_dir):
+                shutil.rmtree(target_trial_dir)
+            os.rename(tmp_trial_dir, target_trial_dir)
+            manifest["trials"][trial_name] = dict(source=nerf_dataset_path, **fingerprint)
+            stats["copied"].append(trial_name)
+            logger.debug(f"Copied {nerf_dataset_path} to {target_trial_dir}")
+
+    # trials that are not in the eval folder anymore
+    target_trials = {entry.name for entry in os.scandir(target_dir) if entry.is_dir() and _trial_regex.match(entry.name)}
+    for trial_name in sorted((set(manifest["trials"]) | target_trials) - set(datasets)):
+        shutil.rmtree(os.path.join(target_dir, trial_name), ignore_errors=True)
+        manifest["trials"].pop(trial_name, None)
+        stats["removed"].append(trial_name)
+    _write_json(os.path.join(target_dir, MANIFEST_FNAME), manifest)
+
+    # Copy full_exp_cfg.txt and target_descriptors.npz to the target_dir
     for filename, new_extension in [
         ("full_exp_cfg.txt", "json"),
         ("target_descriptors.npz", None),
     ]:
-        matching_paths = glob.glob(eval_dir + f"/**/{filename}", recursive=True)
-        assert len(matching_paths) == 1, f"Found {len(matching_paths)} {filename} files"
-        path = matching_paths[0]
+        path = os.path.join(eval_dir, filename)
+        assert os.path.exists(path), f"Found no {filename} file in {eval_dir}"
         # Replace extension if necessary
         target_path = os.path.join(target_dir, filename)
         if new_extension is not None:
@@ -63,16 +188,19 @@ def copy_nerf_datasets(eval_dir: str, target_dir: str) -> None:
 
     # Write a debug JSON file
     debug = {
-        "num_datasets": num_datasets,
-        "og_dataset_path_to_new_path": og_dataset_path_to_new_path,
+        "num_datasets": len(datasets),
+        "og_dataset_path_to_new_path": {path: trial_name for trial_name, path in datasets.items()},
         "timestamp": str(datetime.now()),
+        **{f"num_{k}": len(v) for k, v in stats.items()},
     }
-    with open(os.path.join(target_dir, "rndf_debug.json"), "w") as f:
-        json.dump(debug, f, indent=2)
+    _write_json(os.path.join(target_dir, "rndf_debug.json"), debug)
 
     logger.success(
-        f"Found {num_datasets} datasets in {eval_dir} and copied them to {target_dir}"
+        f"Found {len(datasets)} datasets in {eval_dir}: copied {len(stats['copied'])} to {target_dir} "
+        f"({n_linked} files linked, {n_copied_files} copied), {len(stats['unchanged'])} unchanged, "
+        f"removed {len(stats['removed'])}"
     )
+    return stats
 
 
 if __name__ == "__main__":
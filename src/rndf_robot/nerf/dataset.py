@@ -7,19 +7,35 @@ Thanks to Yen-Chen Lin and the Instant-NGP team!
 """
 import copy
 import json
+import os
 import os.path as osp
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
 
 import numpy as np
+from PIL import Image
 from tqdm import tqdm
 
-from rndf_robot.robot.multicam import MultiCams
 from rndf_robot.utils import util
 
+if TYPE_CHECKING:
+    from rndf_robot.robot.multicam import MultiCams
+
 _robot_to_graphics_rotation = np.array([[0, 1, 0], [0, 0, 1], [1, 0, 0]])
 graphics_transformation = np.eye(4)
 graphics_transformation[:3, :3] = _robot_to_graphics_rotation
 
+# How the frames are stored:
+# - png: rgbs/NNN.png (uint8) and depths/NNN.png (uint16, mm)
+# - npy: rgbs/NNN.npy and depths/NNN.npy, same dtypes, no compression
+# - packed: rgbs.npy (N, H, W, 3) and depths.npy (N, H, W), one file per trial
+ENCODINGS = ("png", "npy", "packed")
+
+# Written last, once everything else of the dataset is on disk
+COMPLETE_MARKER = ".complete"
+
+# The depth images are in mm
+DEPTH_SCALE = 1000.0
+
 
 def convert_pose(c2w: np.ndarray) -> np.ndarray:
     """Convert a pose from pybullet convention to OpenGL camera convention (I think)."""
@@ -106,67 +122,128 @@ def unnormalize_transforms(
     return unnormalized_transforms
 
 
-def write_instant_ngp_dataset(
-    cams: MultiCams,
-    rgbs: List[np.ndarray],
-    depths: List[np.ndarray],
-    nerf_dir: str,
-    aabb_scale: int = 4,
-    scale: float = 1.0,
-) -> None:
-    # Write RGB and depth images to disk
-    metadata = []
-    util.safe_makedirs(osp.join(nerf_dir, "rgbs"))
-    util.safe_makedirs(osp.join(nerf_dir, "depths"))
-
-    for i, (cam, rgb, depth) in enumerate(zip(cams.cams, rgbs, depths)):
-        img_fname = f"{i:03d}.png"
-        util.np2img(
-            rgb.astype(np.uint8),
-            osp.join(
-                nerf_dir,
-                "rgbs",
-                img_fname,
-            ),
-        )
-        # Depth is float32, convert to uint16 and use mm as unit (i.e., depth scale = 1000)
-        depth_uint16 = (depth * 1000).astype(np.uint16)
-        util.np2img(
-            depth_uint16,
-            osp.join(
-                nerf_dir,
-                "depths",
-                img_fname,
-            ),
-        )
-
+def camera_params(cams: "MultiCams") -> Dict:
+    """
+    The poses (Instant-NGP convention), intrinsics and image size of the cameras, which is all
+    the writer needs from them. Get them in the thread that owns the simulator, the rest of
+    the writing can happen anywhere.
+    """
+    c2ws = []
+    for cam in cams.cams:
         c2w = cam.get_cam_ext()
         # Uncomment to convert to graphics convention.
         # nerfstudio uses z-up by default which is same as robot convention as we're fine
         # c2w = graphics_transformation @ c2w
 
         # Convert to Instant-NGP convention
-        c2w = convert_pose(c2w)
+        c2ws.append(convert_pose(c2w))
+
+    intrinsic_matrix = np.asarray(cams.intrinsic_matrix)
+    assert intrinsic_matrix.shape == (3, 3)
+    return {
+        "c2ws": c2ws,
+        "intrinsic_matrix": intrinsic_matrix,
+        "w": cams.width,
+        "h": cams.height,
+    }
+
+
+def depth_to_uint16(depth: np.ndarray) -> np.ndarray:
+    """Depth is float32, convert to uint16 and use mm as unit (i.e., depth scale = 1000)"""
+    if depth.dtype == np.uint16:
+        # already in mm
+        return depth
+    return (depth * DEPTH_SCALE).astype(np.uint16)
+
+
+def frame_file_path(i: int, encoding: str = "png") -> str:
+    """Path of the RGB image of frame i relative to the dataset directory, as in transforms.json"""
+    if encoding == "packed":
+        return "./rgbs.npy"
+    ext = "png" if encoding == "png" else "npy"
+    return f"./rgbs/{i:03d}.{ext}"
+
+
+def make_frame_dirs(nerf_dir: str, encoding: str = "png") -> None:
+    assert encoding in ENCODINGS, f"Invalid encoding {encoding}! Must be in {', '.join(ENCODINGS)}"
+    util.safe_makedirs(nerf_dir)
+    if encoding != "packed":
+        util.safe_makedirs(osp.join(nerf_dir, "rgbs"))
+        util.safe_makedirs(osp.join(nerf_dir, "depths"))
+
+
+def write_frame(
+    nerf_dir: str,
+    i: int,
+    rgb: np.ndarray,
+    depth: np.ndarray,
+    encoding: str = "png",
+    png_compress_level: int = 6,
+) -> None:
+    """
+    Write the RGB and depth image of frame i (png or npy encoding). The directories must exist,
+    see make_frame_dirs. png_compress_level is the zlib level, lower is faster and larger.
+    """
+    rgb_fname = osp.join(nerf_dir, frame_file_path(i, encoding))
+    depth_fname = osp.join(nerf_dir, "depths", osp.basename(rgb_fname))
+    if encoding == "png":
+        Image.fromarray(rgb.astype(np.uint8)).save(rgb_fname, compress_level=png_compress_level)
+        Image.fromarray(depth_to_uint16(depth)).save(depth_fname, compress_level=png_compress_level)
+    elif encoding == "npy":
+        np.save(rgb_fname, rgb.astype(np.uint8))
+        np.save(depth_fname, depth_to_uint16(depth))
+    else:
+        raise ValueError(f"Frames are not written one by one with the {encoding} encoding")
+
+
+def write_packed_frames(
+    nerf_dir: str,
+    rgbs: Optional[Sequence[np.ndarray]] = None,
+    depths: Optional[Sequence[np.ndarray]] = None,
+) -> None:
+    """Write all the RGB images to rgbs.npy and/or all the depth images to depths.npy"""
+    if rgbs is not None:
+        np.save(osp.join(nerf_dir, "rgbs.npy"), np.stack(rgbs).astype(np.uint8, copy=False))
+    if depths is not None:
+        np.save(osp.join(nerf_dir, "depths.npy"), depth_to_uint16(np.stack(depths)))
+
 
+def write_json(fname: str, data: Dict) -> None:
+    with open(fname, "w") as fp:
+        json.dump(data, fp, indent=2, default=str)
+
+
+def write_transforms(
+    cam_params: Dict,
+    nerf_dir: str,
+    aabb_scale: int = 4,
+    scale: float = 1.0,
+    encoding: str = "png",
+) -> None:
+    """
+    Write transforms_unnormalized.json, transforms.json (normalized poses) and
+    normalization_params.json for the cameras in cam_params (see camera_params)
+    """
+    metadata = []
+    for i, c2w in enumerate(cam_params["c2ws"]):
         # Add this camera info to metadata
-        metadata.append(
-            {
-                "file_path": f"./rgbs/{img_fname}",
-                "transform_matrix": c2w.tolist(),
-            }
-        )
+        frame = {
+            "file_path": frame_file_path(i, encoding),
+            "transform_matrix": c2w.tolist(),
+        }
+        if encoding == "packed":
+            frame["frame_index"] = i
+        metadata.append(frame)
 
     # Form transforms dict
-    intrinsic_matrix = cams.intrinsic_matrix
-    assert intrinsic_matrix.shape == (3, 3)
-
+    intrinsic_matrix = cam_params["intrinsic_matrix"]
     transforms = {
         "fl_x": intrinsic_matrix[0, 0],
         "fl_y": intrinsic_matrix[1, 1],
         "cx": intrinsic_matrix[0, 2],
         "cy": intrinsic_matrix[1, 2],
-        "w": cams.width,
-        "h": cams.height,
+        "w": cam_params["w"],
+        "h": cam_params["h"],
         "aabb_scale": aabb_scale,
         "scale": scale,
     }
@@ -176,6 +253,9 @@ def write_instant_ngp_dataset(
     transforms["camera_angle_y"] = 2 * np.arctan(
         transforms["h"] / (2 * transforms["fl_y"])
     )
+    if encoding != "png":
+        # png is the only encoding the NeRF libraries read, mark the others
+        transforms["encoding"] = encoding
     transforms["frames"] = metadata
 
     # Write transforms_unnormalized.json
@@ -198,4 +278,87 @@ def write_instant_ngp_dataset(
     with open(osp.join(nerf_dir, "normalization_params.json"), "w") as fp:
         json.dump(normalization_params, fp, indent=2)
 
-    print(f"Wrote Instant-NGP dataset to {nerf_dir}")
+
+def mark_complete(nerf_dir: str, encoding: str = "png") -> None:
+    """Atomically write the completion marker of a dataset, after all of its other files"""
+    marker_fname = osp.join(nerf_dir, COMPLETE_MARKER)
+    write_json(marker_fname + ".tmp", {"encoding": encoding})
+    os.replace(marker_fname + ".tmp", marker_fname)
+
+
+def is_complete(nerf_dir: str) -> bool:
+    """Whether all the files of the dataset were written"""
+    return osp.exists(osp.join(nerf_dir, COMPLETE_MARKER))
+
+
+def write_instant_ngp_dataset(
+    cams: "MultiCams",
+    rgbs: List[np.ndarray],
+    depths: List[np.ndarray],
+    nerf_dir: str,
+    aabb_scale: int = 4,
+    scale: float = 1.0,
+    encoding: str = "png",
+    png_compress_level: int = 6,
+    extra_files: Optional[Dict[str, Dict]] = None,
+) -> None:
+    """
+    Write the RGB and depth images and the transforms of a dataset, synchronously. See
+    rndf_robot.nerf.async_writer to write them in the background.
+
+    Args:
+        extra_files (dict): file name -> json content, written to nerf_dir before the marker
+    """
+    cam_params = camera_params(cams)
+
+    # Write RGB and depth images to disk
+    make_frame_dirs(nerf_dir, encoding)
+    if encoding == "packed":
+        write_packed_frames(nerf_dir, rgbs, depths)
+    else:
+        for i, (rgb, depth) in enumerate(zip(rgbs, depths)):
+            write_frame(nerf_dir, i, rgb, depth, encoding, png_compress_level)
+
+    write_transforms(cam_params, nerf_dir, aabb_scale, scale, encoding)
+    for fname, data in (extra_files or {}).items():
+        write_json(osp.join(nerf_dir, fname), data)
+    mark_complete(nerf_dir, encoding)
+
+
+def read_instant_ngp_dataset(nerf_dir: str) -> Dict:
+    """
+    Read a dataset written by write_instant_ngp_dataset, in any encoding
+
+    Returns:
+        dict: transforms (transforms_unnormalized.json), normalization_params, rgbs (N, H, W, 3) uint8
+            and depths (N, H, W) uint16 (in mm, see DEPTH_SCALE)
+    """
+    with open(osp.join(nerf_dir, "transforms_unnormalized.json")) as fp:
+        transforms = json.load(fp)
+    with open(osp.join(nerf_dir, "normalization_params.json")) as fp:
+        normalization_params = json.load(fp)
+
+    encoding = transforms.get("encoding", "png")
+    if encoding == "packed":
+        rgbs = np.load(osp.join(nerf_dir, "rgbs.npy"))
+        depths = np.load(osp.join(nerf_dir, "depths.npy"))
+    else:
+        rgbs, depths = [], []
+        for frame in transforms["frames"]:
+            rgb_fname = osp.join(nerf_dir, frame["file_path"])
+            depth_fname = osp.join(nerf_dir, "depths", osp.basename(rgb_fname))
+            if encoding == "npy":
+                rgbs.append(np.load(rgb_fname))
+                depths.append(np.load(depth_fname))
+            else:
+                with Image.open(rgb_fname) as im:
+                    rgbs.append(np.asarray(im.convert("RGB")))
+                with Image.open(depth_fname) as im:
+                    depths.append(np.asarray(im, dtype=np.uint16))
+        rgbs, depths = np.stack(rgbs), np.stack(depths)
+    return {
+        "transforms": transforms,
+        "normalization_params": normalization_params,
+        "rgbs": rgbs,
+        "depths": depths,
+    }
@@ -0,0 +1,294 @@
+"""
+Packed NeRF datasets: all the trials of an experiment in a few contiguous arrays, instead of
+thousands of small images and json files.
+
+A packed dataset is a folder with:
+- rgbs.npy: (F, H, W, 3) uint8, the frames of all the trials one after the other
+- depths.npy: (F, H, W) uint16, in mm (see rndf_robot.nerf.dataset.DEPTH_SCALE)
+- c2ws.npy: (F, 4, 4) float64, the unnormalized camera poses (Instant-NGP convention, as in
+  transforms_unnormalized.json)
+- intrinsics.npy: (F, 3, 3) float64
+- index.json: written last, the image size and, for every trial, its first frame and number of
+  frames, its normalization parameters and its other json files (rndf_metadata.json, ...)
+
+The arrays are opened as memory maps, so a trial or a frame is a view into the files and
+sampling a batch of rays only reads the pixels in the batch. Pack the trials of an experiment
+and export one back to the instant-ngp layout with:
+
+    python -m rndf_robot.nerf.packed pack <nerf_datasets>/<exp> <packed_dir>
+    python -m rndf_robot.nerf.packed export <packed_dir> <out_dir> --trials trial_0 trial_3
+"""
+import argparse
+import glob
+import json
+import os, os.path as osp
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+from loguru import logger
+
+from rndf_robot.nerf.dataset import (
+    DEPTH_SCALE, ENCODINGS, make_frame_dirs, mark_complete, read_instant_ngp_dataset, write_frame,
+    write_json, write_packed_frames, write_transforms)
+
+
+INDEX_FNAME = 'index.json'
+
+# json files of a trial that are not part of the transforms, kept in the index
+_EXTRA_FILES = ('rndf_metadata.json', 'rndf_metrics.json')
+
+_trial_dir_regex = re.compile(r'trial_(\d+)$')
+
+
+def find_trial_datasets(root: str) -> Dict[str, str]:
+    """
+    The NeRF datasets under root, as trial name -> dataset folder, sorted by trial index. Works
+    for the nerf_datasets layout (trial_<i>/transforms.json) and the eval layout
+    (trial_<i>/nerf_dataset/transforms.json). Unfinished trials (.partial_trial_<i>) are left out.
+    """
+    datasets = {}
+    for trial_dir in glob.glob(osp.join(root, 'trial_*')):
+        match = _trial_dir_regex.search(trial_dir)
+        if match is None:
+            continue
+        for nerf_dir in [trial_dir, osp.join(trial_dir, 'nerf_dataset')]:
+            if osp.exists(osp.join(nerf_dir, 'transforms_unnormalized.json')):
+                datasets[int(match.group(1))] = nerf_dir
+                break
+    return {f'trial_{i}': datasets[i] for i in sorted(datasets)}
+
+
+def pack_nerf_datasets(root: str, packed_dir: str, num_threads: int = 8) -> Dict:
+    """
+    Pack the NeRF datasets of the trials under root (see find_trial_datasets) into packed_dir,
+    which is replaced if it exists. All the frames must have the same size.
+
+    Returns:
+        dict: The index of the packed dataset
+    """
+    datasets = find_trial_datasets(root)
+    assert len(datasets) > 0, f'No NeRF datasets found in {root}'
+
+    # the frame counts and image size are in the transforms, so the arrays can be allocated upfront
+    trials = []
+    n_frames = 0
+    height = width = None
+    for name, nerf_dir in datasets.items():
+        with open(osp.join(nerf_dir, 'transforms_unnormalized.json')) as f:
+            transforms = json.load(f)
+        if height is None:
+            height, width = transforms['h'], transforms['w']
+        assert (transforms['h'], transforms['w']) == (height, width), \
+            f'{nerf_dir} has {transforms["w"]}x{transforms["h"]} frames, the others {width}x{height}'
+        trials.append(dict(name=name, source=osp.abspath(nerf_dir), frame_start=n_frames,
+                           n_frames=len(transforms['frames'])))
+        n_frames += len(transforms['frames'])
+
+    if osp.exists(packed_dir):
+        shutil.rmtree(packed_dir)
+    os.makedirs(packed_dir)
+    open_memmap = np.lib.format.open_memmap
+    rgbs = open_memmap(osp.join(packed_dir, 'rgbs.npy'), mode='w+', dtype=np.uint8, shape=(n_frames, height, width, 3))
+    depths = open_memmap(osp.join(packed_dir, 'depths.npy'), mode='w+', dtype=np.uint16, shape=(n_frames, height, width))
+    c2ws = np.zeros((n_frames, 4, 4))
+    intrinsics = np.zeros((n_frames, 3, 3))
+
+    def pack_trial(trial):
+        # decoding the PNGs releases the GIL, and the trials go to disjoint parts of the arrays
+        dataset = read_instant_ngp_dataset(trial['source'])
+        transforms = dataset['transforms']
+        frames = slice(trial['frame_start'], trial['frame_start'] + trial['n_frames'])
+        assert len(dataset['rgbs']) == trial['n_frames'], f'{trial["source"]} is missing frames'
+        rgbs[frames] = dataset['rgbs']
+        depths[frames] = dataset['depths']
+        c2ws[frames] = [frame['transform_matrix'] for frame in transforms['frames']]
+        intrinsics[frames] = [[transforms['fl_x'], 0, transforms['cx']], [0, transforms['fl_y'], transforms['cy']], [0, 0, 1]]
+
+        trial['aabb_scale'] = transforms['aabb_scale']
+        trial['scale'] = transforms['scale']
+        trial['normalization_params'] = dataset['normalization_params']
+        trial['files'] = {}
+        for fname in _EXTRA_FILES:
+            if osp.exists(osp.join(trial['source'], fname)):
+                with open(osp.join(trial['source'], fname)) as f:
+                    trial['files'][fname] = json.load(f)
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        # list, to raise the errors of the trials
+        list(pool.map(pack_trial, trials))
+    rgbs.flush()
+    depths.flush()
+    del rgbs, depths
+    np.save(osp.join(packed_dir, 'c2ws.npy'), c2ws)
+    np.save(osp.join(packed_dir, 'intrinsics.npy'), intrinsics)
+
+    # the index is written last, a packed dataset without it is incomplete
+    index = dict(n_frames=n_frames, height=height, width=width, depth_scale=DEPTH_SCALE, trials=trials)
+    write_json(osp.join(packed_dir, INDEX_FNAME + '.tmp'), index)
+    os.replace(osp.join(packed_dir, INDEX_FNAME + '.tmp'), osp.join(packed_dir, INDEX_FNAME))
+    logger.info(f'Packed {n_frames} frames of {len(trials)} trials from {root} into {packed_dir}')
+    return index
+
+
+@dataclass
+class PackedTrial:
+    """The frames of one trial, views into the memory maps of the packed dataset"""
+    name: str
+    rgbs: np.ndarray  # (N, H, W, 3) uint8
+    depths: np.ndarray  # (N, H, W) uint16, mm
+    c2ws: np.ndarray  # (N, 4, 4), unnormalized
+    intrinsics: np.ndarray  # (N, 3, 3)
+    info: Dict  # the entry of the trial in the index
+
+    def __len__(self):
+        return len(self.rgbs)
+
+    def normalized_c2ws(self) -> np.ndarray:
+        """The camera poses of transforms.json"""
+        c2ws = self.c2ws.copy()
+        params = self.info['normalization_params']
+        c2ws[:, :3, 3] -= params['translation']
+        c2ws[:, :3, 3] *= params['scale']
+        return c2ws
+
+
+class PackedNeRFDataset:
+    """
+    Read-only access to a packed dataset (see pack_nerf_datasets). The images are memory mapped,
+    only the poses and intrinsics are loaded.
+    """
+    def __init__(self, packed_dir: str):
+        index_fname = osp.join(packed_dir, INDEX_FNAME)
+        assert osp.exists(index_fname), f'{packed_dir} is not a packed NeRF dataset, or it is incomplete'
+        with open(index_fname) as f:
+            self.index = json.load(f)
+        self.packed_dir = packed_dir
+        self.rgbs = np.load(osp.join(packed_dir, 'rgbs.npy'), mmap_mode='r')
+        self.depths = np.load(osp.join(packed_dir, 'depths.npy'), mmap_mode='r')
+        self.c2ws = np.load(osp.join(packed_dir, 'c2ws.npy'))
+        self.intrinsics = np.load(osp.join(packed_dir, 'intrinsics.npy'))
+        self.height, self.width = self.index['height'], self.index['width']
+        self.depth_scale = self.index['depth_scale']
+
+        self.trial_names = [trial['name'] for trial in self.index['trials']]
+        self._trial_idx = {name: i for i, name in enumerate(self.trial_names)}
+        # trial of every frame
+        self.frame_trials = np.repeat(np.arange(len(self.trial_names)), [t['n_frames'] for t in self.index['trials']])
+
+    def __len__(self):
+        """Number of trials"""
+        return len(self.trial_names)
+
+    @property
+    def n_frames(self) -> int:
+        return len(self.rgbs)
+
+    def trial(self, trial: Union[int, str]) -> PackedTrial:
+        """A trial by its position in the dataset or its name (e.g., 'trial_3')"""
+        info = self.index['trials'][self._trial_idx[trial] if isinstance(trial, str) else trial]
+        frames = slice(info['frame_start'], info['frame_start'] + info['n_frames'])
+        return PackedTrial(info['name'], self.rgbs[frames], self.depths[frames], self.c2ws[frames],
+                           self.intrinsics[frames], info)
+
+    def frame(self, trial: Union[int, str], i: int) -> Dict:
+        """Frame i of a trial: rgb and depth (views), c2w and intrinsics"""
+        packed_trial = self.trial(trial)
+        return dict(rgb=packed_trial.rgbs[i], depth=packed_trial.depths[i], c2w=packed_trial.c2ws[i],
+                    intrinsics=packed_trial.intrinsics[i])
+
+    def sample_rays(self, batch_size: int, rng: Optional[np.random.Generator] = None,
+                    trials: Optional[Sequence[Union[int, str]]] = None, normalized: bool = True) -> Dict:
+        """
+        Sample a batch of pixels uniformly over the frames of all the trials (or of the given
+        trials), with their rays in the Instant-NGP convention (camera looking down -z, y up).
+        The batch is sorted by frame and pixel, so the reads from the memory maps are in order.
+
+        Returns:
+            dict: frame (B,), trial (B,), uv (B, 2) pixel coordinates, rgb (B, 3) uint8, depth (B,)
+                float32 in meters (z-depth, 0 is no depth), rays_o and rays_d (B, 3) in the
+                normalized (as in transforms.json) or unnormalized world frame
+        """
+        rng = np.random.default_rng() if rng is None else rng
+        if trials is None:
+            frames = rng.integers(self.n_frames, size=batch_size)
+        else:
+            trial_frames = np.concatenate([
+                np.arange(info['frame_start'], info['frame_start'] + info['n_frames'])
+                for info in (self.index['trials'][self._trial_idx[t] if isinstance(t, str) else t] for t in trials)])
+            frames = trial_frames[rng.integers(len(trial_frames), size=batch_size)]
+        pixels = rng.integers(self.height * self.width, size=batch_size)
+
+        order = np.lexsort((pixels, frames))
+        frames, pixels = frames[order], pixels[order]
+        v, u = np.divmod(pixels, self.width)
+        rgb = np.asarray(self.rgbs[frames, v, u])
+        depth = np.asarray(self.depths[frames, v, u]).astype(np.float32) / self.depth_scale
+
+        intrinsics = self.intrinsics[frames]
+        dirs = np.stack([
+            (u + 0.5 - intrinsics[:, 0, 2]) / intrinsics[:, 0, 0],
+            -(v + 0.5 - intrinsics[:, 1, 2]) / intrinsics[:, 1, 1],
+            -np.ones(batch_size)], axis=-1)
+        c2ws = self.c2ws[frames]
+        rays_d = np.einsum('bij,bj->bi', c2ws[:, :3, :3], dirs)
+        rays_o = c2ws[:, :3, 3].copy()
+        trial_ids = self.frame_trials[frames]
+        if normalized:
+            for trial_id in np.unique(trial_ids):
+                params = self.index['trials'][trial_id]['normalization_params']
+                in_trial = trial_ids == trial_id
+                rays_o[in_trial] = (rays_o[in_trial] - params['translation']) * params['scale']
+        return dict(frame=frames, trial=trial_ids, uv=np.stack([u, v], axis=-1), rgb=rgb, depth=depth,
+                    rays_o=rays_o, rays_d=rays_d)
+
+    def export_instant_ngp(self, trial: Union[int, str], nerf_dir: str, encoding: str = 'png',
+                           png_compress_level: int = 6) -> None:
+        """Write a trial back as a dataset in the layout of rndf_robot.nerf.dataset.write_instant_ngp_dataset"""
+        packed_trial = self.trial(trial)
+        info = packed_trial.info
+        intrinsics = packed_trial.intrinsics[0]
+        assert np.allclose(packed_trial.intrinsics, intrinsics), 'The frames of a trial must share their intrinsics'
+        cam_params = dict(c2ws=list(packed_trial.c2ws), intrinsic_matrix=intrinsics, w=self.width, h=self.height)
+
+        # the depths are written as they are, in mm
+        make_frame_dirs(nerf_dir, encoding)
+        if encoding == 'packed':
+            write_packed_frames(nerf_dir, packed_trial.rgbs, packed_trial.depths)
+        else:
+            for i in range(len(packed_trial)):
+                write_frame(nerf_dir, i, packed_trial.rgbs[i], packed_trial.depths[i], encoding, png_compress_level)
+        write_transforms(cam_params, nerf_dir, info['aabb_scale'], info['scale'], encoding)
+        for fname, data in info['files'].items():
+            write_json(osp.join(nerf_dir, fname), data)
+        mark_complete(nerf_dir, encoding)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Pack NeRF datasets, or export packed trials back to instant-ngp')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    pack_parser = subparsers.add_parser('pack', help='Pack the trials of an experiment')
+    pack_parser.add_argument('root', type=str, help='Folder with the trial_<i> datasets (nerf_datasets or eval layout)')
+    pack_parser.add_argument('packed_dir', type=str)
+    pack_parser.add_argument('--num_threads', type=int, default=8)
+    export_parser = subparsers.add_parser('export', help='Write packed trials in the instant-ngp layout')
+    export_parser.add_argument('packed_dir', type=str)
+    export_parser.add_argument('out_dir', type=str, help='Each trial is written to <out_dir>/<trial name>')
+    export_parser.add_argument('--trials', type=str, nargs='*', default=None, help='Defaults to all the trials')
+    export_parser.add_argument('--encoding', type=str, choices=ENCODINGS, default='png')
+    args = parser.parse_args(argv)
+
+    if args.command == 'pack':
+        pack_nerf_datasets(args.root, args.packed_dir, args.num_threads)
+    else:
+        dataset = PackedNeRFDataset(args.packed_dir)
+        for name in args.trials or dataset.trial_names:
+            dataset.export_instant_ngp(name, osp.join(args.out_dir, name), args.encoding)
+        logger.info(f'Exported {len(args.trials or dataset.trial_names)} trials to {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+TSDF fusion of the depth images of the NeRF datasets into a point cloud or a mesh.
+
+The volume is updated with NumPy, a chunk of voxels at a time (all the frames for one chunk,
+then the next chunk), so the memory for the projections is bounded by the chunk size and not by
+the size of the volume. The datasets of the trials of an experiment are fused in parallel
+processes:
+
+    python -m rndf_robot.nerf.tsdf <nerf_datasets>/<exp> <out_dir> --resolution 192 --mesh
+
+Point clouds are extracted from the zero crossings of the TSDF. Meshes use marching cubes from
+scikit-image, which is only imported to extract a mesh.
+"""
+import argparse
+import json
+import os, os.path as osp
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import trimesh
+from loguru import logger
+
+from rndf_robot.nerf.dataset import DEPTH_SCALE, read_instant_ngp_dataset
+from rndf_robot.nerf.packed import find_trial_datasets
+
+
+class TSDFVolume:
+    """
+    A truncated signed distance volume with colors, over an axis aligned box
+
+    Args:
+        bounds (np.ndarray): (2, 3) min and max corners of the volume
+        voxel_size (float): Edge length of a voxel
+        trunc_voxels (float): Truncation distance, in voxels
+    """
+    def __init__(self, bounds: np.ndarray, voxel_size: float, trunc_voxels: float = 4.0):
+        bounds = np.asarray(bounds, dtype=np.float64)
+        self.voxel_size = voxel_size
+        self.trunc = trunc_voxels * voxel_size
+        self.dims = np.ceil((bounds[1] - bounds[0]) / voxel_size).astype(int)
+        self.origin = bounds[0]
+
+        self.tsdf = np.ones(self.dims, dtype=np.float32)
+        self.weights = np.zeros(self.dims, dtype=np.float32)
+        self.colors = np.zeros((*self.dims, 3), dtype=np.float32)
+
+    def voxel_centers(self, start: int, stop: int) -> np.ndarray:
+        """World coordinates of the centers of the voxels with flat indices [start, stop)"""
+        ijk = np.stack(np.unravel_index(np.arange(start, stop), self.dims), axis=-1)
+        return self.origin + (ijk + 0.5) * self.voxel_size
+
+    def integrate(self, depths: Sequence[np.ndarray], intrinsics: Sequence[np.ndarray], c2ws: Sequence[np.ndarray],
+                  rgbs: Optional[Sequence[np.ndarray]] = None, chunk_size: int = 1 << 18) -> None:
+        """
+        Fuse frames into the volume
+
+        Args:
+            depths (list): (H, W) z-depths in meters, 0 where there is no depth
+            intrinsics (list): (3, 3) camera matrices
+            c2ws (list): (4, 4) camera poses in the Instant-NGP convention (camera looking down -z, y up),
+                as in transforms_unnormalized.json
+            rgbs (list): (H, W, 3) colors, e.g. uint8 (only the pixels the voxels project to are converted to float)
+            chunk_size (int): Number of voxels updated at a time
+        """
+        # float32 is plenty for the projections, and twice as fast
+        w2cs = [np.linalg.inv(c2w).astype(np.float32) for c2w in c2ws]
+        flat_tsdf = self.tsdf.reshape(-1)
+        flat_weights = self.weights.reshape(-1)
+        flat_colors = self.colors.reshape(-1, 3)
+        for start in range(0, flat_tsdf.size, chunk_size):
+            stop = min(start + chunk_size, flat_tsdf.size)
+            points = self.voxel_centers(start, stop).astype(np.float32)
+            tsdf, weights, colors = flat_tsdf[start:stop], flat_weights[start:stop], flat_colors[start:stop]
+
+            for i, (depth, K, w2c) in enumerate(zip(depths, intrinsics, w2cs)):
+                cam_points = points @ w2c[:3, :3].T + w2c[:3, 3]
+                z = -cam_points[:, 2]
+                in_front = z > 1e-6
+                z_safe = np.where(in_front, z, 1.0)
+                u = np.floor(K[0, 0] * cam_points[:, 0] / z_safe + K[0, 2]).astype(np.int64)
+                v = np.floor(-K[1, 1] * cam_points[:, 1] / z_safe + K[1, 2]).astype(np.int64)
+                height, width = depth.shape
+                valid = in_front & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+
+                inds = np.flatnonzero(valid)
+                pixel_depth = depth[v[inds], u[inds]]
+                sdf = pixel_depth - z[inds]
+                # voxels with a depth, that are not too far behind the surface
+                keep = (pixel_depth > 0) & (sdf >= -self.trunc)
+                inds, sdf = inds[keep], sdf[keep]
+
+                w_old = weights[inds]
+                tsdf[inds] = (tsdf[inds] * w_old + np.minimum(1.0, sdf / self.trunc)) / (w_old + 1)
+                if rgbs is not None:
+                    pixel_colors = rgbs[i][v[inds], u[inds]].astype(np.float32)
+                    colors[inds] = (colors[inds] * w_old[:, None] + pixel_colors) / (w_old[:, None] + 1)
+                weights[inds] = w_old + 1
+
+    def extract_point_cloud(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The points where the TSDF crosses zero between two observed neighboring voxels
+
+        Returns:
+            2-element tuple containing
+            - np.ndarray: (N, 3) points
+            - np.ndarray: (N, 3) uint8 colors
+        """
+        points, colors = [], []
+        observed = (self.weights > 0) & (np.abs(self.tsdf) < 1)
+        for axis in range(3):
+            n = self.dims[axis] - 1
+            a = [slice(None)] * 3
+            b = [slice(None)] * 3
+            a[axis], b[axis] = slice(0, n), slice(1, n + 1)
+            a, b = tuple(a), tuple(b)
+            tsdf_a, tsdf_b = self.tsdf[a], self.tsdf[b]
+            crossing = observed[a] & observed[b] & (np.sign(tsdf_a) != np.sign(tsdf_b))
+            ijk = np.argwhere(crossing)
+            ta, tb = tsdf_a[crossing], tsdf_b[crossing]
+            # linear interpolation of the zero crossing between the two voxel centers
+            t = (ta / (ta - tb))[:, None]
+            offset = np.zeros(3)
+            offset[axis] = 1
+            points.append(self.origin + (ijk + 0.5 + t * offset) * self.voxel_size)
+            colors.append((1 - t) * self.colors[a][crossing] + t * self.colors[b][crossing])
+        return np.concatenate(points), np.clip(np.concatenate(colors), 0, 255).astype(np.uint8)
+
+    def extract_mesh(self) -> trimesh.Trimesh:
+        """The zero level set of the TSDF with vertex colors, with marching cubes"""
+        from skimage.measure import marching_cubes
+
+        verts, faces, _, _ = marching_cubes(self.tsdf, level=0, mask=self.weights > 0)
+        vert_inds = np.clip(np.round(verts).astype(int), 0, self.dims - 1)
+        vert_colors = self.colors[vert_inds[:, 0], vert_inds[:, 1], vert_inds[:, 2]]
+        verts = self.origin + (verts + 0.5) * self.voxel_size
+        return trimesh.Trimesh(verts, faces, vertex_colors=np.clip(vert_colors, 0, 255).astype(np.uint8), process=False)
+
+
+def backproject(depth: np.ndarray, K: np.ndarray, c2w: np.ndarray, stride: int = 1) -> np.ndarray:
+    """World points of the pixels with a depth (every stride pixels), for camera poses in the Instant-NGP convention"""
+    v, u = np.nonzero(depth[::stride, ::stride] > 0)
+    u, v = u * stride, v * stride
+    z = depth[v, u]
+    cam_points = np.stack([(u + 0.5 - K[0, 2]) / K[0, 0] * z, -(v + 0.5 - K[1, 2]) / K[1, 1] * z, -z], axis=-1)
+    return cam_points @ c2w[:3, :3].T + c2w[:3, 3]
+
+
+def camera_focus(c2ws: Sequence[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The point closest to the optical axes of the cameras (the point they look at, in least squares),
+    and the distance of every camera to it
+    """
+    origins = np.stack([c2w[:3, 3] for c2w in c2ws])
+    # the cameras look down -z
+    dirs = -np.stack([c2w[:3, 2] for c2w in c2ws])
+    dirs /= np.linalg.norm(dirs, axis=-1, keepdims=True)
+    # projections onto the planes orthogonal to the axes
+    projs = np.eye(3) - dirs[:, :, None] * dirs[:, None, :]
+    focus = np.linalg.lstsq(projs.sum(0), np.einsum('nij,nj->i', projs, origins), rcond=None)[0]
+    return focus, np.linalg.norm(origins - focus, axis=-1)
+
+
+def fuse_nerf_dataset(nerf_dir: str, resolution: int = 128, voxel_size: Optional[float] = None,
+                      bounds: Optional[np.ndarray] = None, depth_max: Optional[float] = None,
+                      trunc_voxels: float = 4.0, chunk_size: int = 1 << 18) -> TSDFVolume:
+    """
+    Fuse the depth images of a NeRF dataset (see rndf_robot.nerf.dataset) in its unnormalized frame.
+
+    The defaults are derived from the point the cameras look at and their (median) distance d to
+    it, so the far background and the far end of the table don't blow up the volume.
+
+    Args:
+        resolution (int): Number of voxels along the longest side of the bounds, if voxel_size is not given
+        bounds (np.ndarray): (2, 3) box to fuse. Defaults to the box around the points of all the frames
+            that are within d / 2 of the point the cameras look at
+        depth_max (float): Ignore the depths further than this (e.g., the far plane), in meters. Defaults
+            to 1.5 d, use np.inf to keep all of them
+    """
+    dataset = read_instant_ngp_dataset(nerf_dir)
+    transforms = dataset['transforms']
+    K = np.array([[transforms['fl_x'], 0, transforms['cx']], [0, transforms['fl_y'], transforms['cy']], [0, 0, 1]])
+    c2ws = [np.asarray(frame['transform_matrix']) for frame in transforms['frames']]
+    focus, cam_dists = camera_focus(c2ws)
+    cam_dist = np.median(cam_dists)
+
+    depths = dataset['depths'].astype(np.float32) / DEPTH_SCALE
+    depths[depths > (1.5 * cam_dist if depth_max is None else depth_max)] = 0
+
+    if bounds is None:
+        points = np.concatenate([backproject(depth, K, c2w, stride=4) for depth, c2w in zip(depths, c2ws)])
+        points = points[np.linalg.norm(points - focus, axis=-1) <= cam_dist / 2]
+        assert len(points) > 0, f'{nerf_dir} has no depth around the point the cameras look at, pass the bounds'
+        bounds = np.stack([points.min(0), points.max(0)])
+    bounds = np.asarray(bounds, dtype=np.float64)
+    if voxel_size is None:
+        voxel_size = np.max(bounds[1] - bounds[0]) / resolution
+    # room for the truncation band around the surface
+    margin = trunc_voxels * voxel_size
+    volume = TSDFVolume(bounds + [[-margin], [margin]], voxel_size, trunc_voxels)
+    volume.integrate(depths, [K] * len(depths), c2ws, dataset['rgbs'], chunk_size=chunk_size)
+    return volume
+
+
+def to_normalized(points: np.ndarray, normalization_params: Dict) -> np.ndarray:
+    """Points in the frame of transforms.json (see rndf_robot.nerf.dataset.normalize_transforms)"""
+    return (points - np.asarray(normalization_params['translation'])) * normalization_params['scale']
+
+
+def _fuse_trial(nerf_dir: str, out_fname: str, mesh: bool, normalized: bool, fuse_kwargs: Dict) -> str:
+    volume = fuse_nerf_dataset(nerf_dir, **fuse_kwargs)
+    if normalized:
+        with open(osp.join(nerf_dir, 'normalization_params.json')) as f:
+            normalization_params = json.load(f)
+    if mesh:
+        geometry = volume.extract_mesh()
+        if normalized:
+            geometry.vertices = to_normalized(geometry.vertices, normalization_params)
+    else:
+        points, colors = volume.extract_point_cloud()
+        if normalized:
+            points = to_normalized(points, normalization_params)
+        geometry = trimesh.PointCloud(points, colors=colors)
+    os.makedirs(osp.dirname(out_fname), exist_ok=True)
+    geometry.export(out_fname)
+    return out_fname
+
+
+def fuse_trials(root: str, out_dir: str, mesh: bool = False, normalized: bool = False, num_workers: int = 8,
+                **fuse_kwargs) -> Dict[str, str]:
+    """
+    Fuse the datasets of all the trials under root (see rndf_robot.nerf.packed.find_trial_datasets)
+    in parallel, and write out_dir/<trial>/fused_mesh.ply or fused_pcd.ply
+
+    Args:
+        normalized (bool): Write the geometry in the frame of transforms.json instead of the world frame
+        fuse_kwargs: See fuse_nerf_dataset
+
+    Returns:
+        dict: trial name -> written file
+    """
+    datasets = find_trial_datasets(root)
+    fname = 'fused_mesh.ply' if mesh else 'fused_pcd.ply'
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = {name: pool.submit(_fuse_trial, nerf_dir, osp.join(out_dir, name, fname), mesh, normalized, fuse_kwargs)
+                   for name, nerf_dir in datasets.items()}
+        written = {name: future.result() for name, future in futures.items()}
+    logger.info(f'Fused {len(written)} trials of {root} into {out_dir}')
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Fuse the depth images of NeRF datasets into point clouds or meshes')
+    parser.add_argument('root', type=str, help='Folder with the trial_<i> datasets (nerf_datasets or eval layout)')
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--mesh', action='store_true', help='Extract meshes (needs scikit-image) instead of point clouds')
+    parser.add_argument('--normalized', action='store_true', help='In the frame of transforms.json')
+    parser.add_argument('--resolution', type=int, default=128)
+    parser.add_argument('--voxel_size', type=float, default=None, help='Overrides --resolution')
+    parser.add_argument('--depth_max', type=float, default=None, help='Ignore depths further than this, in meters (defaults to 1.5x the camera distance)')
+    parser.add_argument('--bounds', type=float, nargs=6, default=None, help='xmin ymin zmin xmax ymax zmax')
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args(argv)
+
+    bounds = np.reshape(args.bounds, (2, 3)) if args.bounds is not None else None
+    fuse_trials(args.root, args.out_dir, mesh=args.mesh, normalized=args.normalized, num_workers=args.num_workers,
+                resolution=args.resolution, voxel_size=args.voxel_size, depth_max=args.depth_max, bounds=bounds)
+
+
+if __name__ == '__main__':
+    main()
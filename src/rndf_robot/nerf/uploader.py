@@ -0,0 +1,245 @@
+"""
+Content-addressed, incremental upload of the NeRF datasets.
+
+The files of a dataset folder are split into chunks that are stored under their sha256 in a
+store, and the dataset is described by a manifest (relative path -> size and chunk hashes)
+that is written last. An upload streams the files chunk by chunk (nothing is staged), in
+parallel, and only sends the chunks the store doesn't have yet. So re-uploading an experiment
+only sends the new or changed trials, and an interrupted upload resumes where it stopped. The
+store checks the hash of every chunk it receives before making it visible.
+
+Stores implement StorageBackend. LocalFSBackend keeps everything in a folder, as a stand-in
+for a remote store:
+
+    python -m rndf_robot.nerf.uploader upload <nerf_datasets>/<exp> <store_dir> --name <exp>
+    python -m rndf_robot.nerf.uploader download <store_dir> <exp> <out_dir>
+"""
+import argparse
+import hashlib
+import json
+import os, os.path as osp
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from loguru import logger
+
+CHUNK_SIZE = 8 << 20
+
+# local cache of the chunk hashes of the files, so unchanged files are not read again
+CACHE_FNAME = '.upload_cache.json'
+
+
+class IntegrityError(IOError):
+    pass
+
+
+class StorageBackend(ABC):
+    """
+    Where the uploader puts its chunks and manifests. Keys are '/' separated paths, and writes
+    must be atomic: a key either doesn't exist or has all of its content.
+    """
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def write(self, key: str, data: bytes, sha256: Optional[str] = None) -> None:
+        """
+        Store data under key. If sha256 is given, raise an IntegrityError instead (and leave key
+        as it was) if the stored copy doesn't have that hash
+        """
+        pass
+
+    @abstractmethod
+    def read(self, key: str) -> bytes:
+        pass
+
+    def missing(self, keys: Iterable[str]) -> List[str]:
+        """The keys that don't exist, backends with a slow exists can batch this"""
+        return [key for key in keys if not self.exists(key)]
+
+
+class LocalFSBackend(StorageBackend):
+    """A store in a local folder"""
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return osp.join(self.root, *key.split('/'))
+
+    def exists(self, key: str) -> bool:
+        return osp.exists(self._path(key))
+
+    def write(self, key: str, data: bytes, sha256: Optional[str] = None) -> None:
+        path = self._path(key)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        # unique per thread, two uploads of the same chunk can race
+        tmp_path = f'{path}.tmp{os.getpid()}_{threading.get_ident()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        if sha256 is not None:
+            # check what was stored, which also catches data that didn't match its hash to begin with
+            with open(tmp_path, 'rb') as f:
+                stored_sha256 = hashlib.sha256(f.read()).hexdigest()
+            if stored_sha256 != sha256:
+                os.remove(tmp_path)
+                raise IntegrityError(f'{key}: stored data does not match its hash {sha256}')
+        os.replace(tmp_path, path)
+
+    def read(self, key: str) -> bytes:
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+
+def chunk_key(sha256: str) -> str:
+    return f'chunks/{sha256[:2]}/{sha256}'
+
+
+def manifest_key(name: str) -> str:
+    return f'manifests/{name}.json'
+
+
+def _list_files(local_dir: str) -> Dict[str, os.stat_result]:
+    files = {}
+    for root, _, fnames in os.walk(local_dir):
+        for fname in fnames:
+            path = osp.join(root, fname)
+            relpath = osp.relpath(path, local_dir).replace(os.sep, '/')
+            if relpath != CACHE_FNAME:
+                files[relpath] = os.stat(path)
+    return files
+
+
+def upload_dataset_dir(local_dir: str, backend: StorageBackend, name: str, num_threads: int = 8,
+                       chunk_size: int = CHUNK_SIZE) -> Dict:
+    """
+    Upload the files of local_dir as dataset name, see the module docstring
+
+    Returns:
+        dict: n_files, n_chunks, and n_uploaded / bytes_uploaded, the chunks that were sent
+    """
+    cache_fname = osp.join(local_dir, CACHE_FNAME)
+    cache = {}
+    if osp.exists(cache_fname):
+        with open(cache_fname) as f:
+            cache = json.load(f)
+    if cache.get('chunk_size') != chunk_size:
+        cache = dict(chunk_size=chunk_size, files={})
+
+    def upload_file(relpath, stat):
+        """Chunk hashes of a file, sending the chunks the store is missing"""
+        cached = cache['files'].get(relpath)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns \
+                and len(backend.missing([chunk_key(h) for h in cached['chunks']])) == 0:
+            return cached, 0, 0
+
+        chunks, n_uploaded, bytes_uploaded = [], 0, 0
+        with open(osp.join(local_dir, relpath), 'rb') as f:
+            for data in iter(lambda: f.read(chunk_size), b''):
+                sha256 = hashlib.sha256(data).hexdigest()
+                if not backend.exists(chunk_key(sha256)):
+                    backend.write(chunk_key(sha256), data, sha256=sha256)
+                    n_uploaded += 1
+                    bytes_uploaded += len(data)
+                chunks.append(sha256)
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, chunks=chunks), n_uploaded, bytes_uploaded
+
+    files = _list_files(local_dir)
+    stats = dict(n_files=len(files), n_chunks=0, n_uploaded=0, bytes_uploaded=0)
+    manifest = dict(chunk_size=chunk_size, files={})
+    with ThreadPoolExecutor(num_threads) as pool:
+        futures = {relpath: pool.submit(upload_file, relpath, stat) for relpath, stat in sorted(files.items())}
+        for i, (relpath, future) in enumerate(futures.items()):
+            entry, n_uploaded, bytes_uploaded = future.result()
+            cache['files'][relpath] = entry
+            manifest['files'][relpath] = dict(size=entry['size'], chunks=entry['chunks'])
+            stats['n_chunks'] += len(entry['chunks'])
+            stats['n_uploaded'] += n_uploaded
+            stats['bytes_uploaded'] += bytes_uploaded
+            if (i + 1) % 1000 == 0:
+                logger.info(f'Uploaded {i + 1}/{len(files)} files of {name}')
+
+    # the manifest goes last, a dataset is only visible once all of its chunks are in the store
+    manifest_data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+    backend.write(manifest_key(name), manifest_data, sha256=hashlib.sha256(manifest_data).hexdigest())
+    cache['files'] = {relpath: entry for relpath, entry in cache['files'].items() if relpath in files}
+    with open(cache_fname + '.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(cache_fname + '.tmp', cache_fname)
+    logger.info(f'Uploaded {name}: {stats["n_files"]} files, sent {stats["n_uploaded"]}/{stats["n_chunks"]} chunks '
+                f'({stats["bytes_uploaded"] / 1e6:.1f} MB)')
+    return stats
+
+
+def load_manifest(backend: StorageBackend, name: str) -> Dict:
+    return json.loads(backend.read(manifest_key(name)))
+
+
+def verify_dataset(backend: StorageBackend, name: str, num_threads: int = 8) -> List[str]:
+    """The files of an uploaded dataset that are missing chunks, or whose chunks don't match their hash"""
+    manifest = load_manifest(backend, name)
+
+    def check(item):
+        relpath, entry = item
+        for sha256 in entry['chunks']:
+            if not backend.exists(chunk_key(sha256)) or hashlib.sha256(backend.read(chunk_key(sha256))).hexdigest() != sha256:
+                return relpath
+        return None
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        return [relpath for relpath in pool.map(check, manifest['files'].items()) if relpath is not None]
+
+
+def download_dataset(backend: StorageBackend, name: str, out_dir: str, num_threads: int = 8) -> None:
+    """Write the files of an uploaded dataset to out_dir, checking the hash of every chunk"""
+    manifest = load_manifest(backend, name)
+
+    def download(item):
+        relpath, entry = item
+        path = osp.join(out_dir, *relpath.split('/'))
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            for sha256 in entry['chunks']:
+                data = backend.read(chunk_key(sha256))
+                if hashlib.sha256(data).hexdigest() != sha256:
+                    raise IntegrityError(f'Chunk {sha256} of {relpath} is corrupted')
+                f.write(data)
+        os.replace(path + '.tmp', path)
+
+    with ThreadPoolExecutor(num_threads) as pool:
+        list(pool.map(download, manifest['files'].items()))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Upload NeRF datasets to a content-addressed store, or download them')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    upload_parser = subparsers.add_parser('upload')
+    upload_parser.add_argument('local_dir', type=str)
+    upload_parser.add_argument('store', type=str, help='Folder of the store')
+    upload_parser.add_argument('--name', type=str, required=True, help='Name of the dataset in the store')
+    upload_parser.add_argument('--num_threads', type=int, default=8)
+    download_parser = subparsers.add_parser('download')
+    download_parser.add_argument('store', type=str)
+    download_parser.add_argument('name', type=str)
+    download_parser.add_argument('out_dir', type=str)
+    verify_parser = subparsers.add_parser('verify')
+    verify_parser.add_argument('store', type=str)
+    verify_parser.add_argument('name', type=str)
+    args = parser.parse_args(argv)
+
+    backend = LocalFSBackend(args.store)
+    if args.command == 'upload':
+        upload_dataset_dir(args.local_dir, backend, args.name, args.num_threads)
+    elif args.command == 'download':
+        download_dataset(backend, args.name, args.out_dir)
+    else:
+        bad_files = verify_dataset(backend, args.name)
+        if len(bad_files) > 0:
+            raise IntegrityError(f'{len(bad_files)} files of {args.name} are missing or corrupted: {bad_files[:10]}')
+        logger.success(f'All the files of {args.name} are intact')
+
+
+if __name__ == '__main__':
+    main()
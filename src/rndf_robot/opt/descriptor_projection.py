@@ -0,0 +1,142 @@
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+
+class DescriptorProjection:
+    """
+    Linear map from full-width NDF descriptors to a low dimensional space, fitted
+    with PCA on a set of demonstration descriptors. Components are sorted by
+    explained variance, so a projection fitted with K components can be truncated
+    to any dimensionality <= K without refitting.
+    """
+    def __init__(self, mean: torch.Tensor, components: torch.Tensor, explained_variance: torch.Tensor,
+                 total_variance: torch.Tensor):
+        """
+        Args:
+            mean (torch.Tensor): D, mean descriptor subtracted before projecting
+            components (torch.Tensor): K x D, principal directions (rows)
+            explained_variance (torch.Tensor): K, variance captured by each component
+            total_variance (torch.Tensor): scalar, total variance of the data the projection was fit on
+        """
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.total_variance = total_variance
+
+    @classmethod
+    def fit(cls, descriptors: torch.Tensor, n_components: int) -> 'DescriptorProjection':
+        """
+        Fit a PCA projection to a set of descriptors
+
+        Args:
+            descriptors (torch.Tensor): ... x D, every row is treated as one sample
+            n_components (int): Number of principal components to keep
+        """
+        desc = descriptors.detach().reshape(-1, descriptors.size(-1)).float()
+        n_components = min(n_components, desc.size(0), desc.size(1))
+        mean = desc.mean(0)
+        _, s, vh = torch.linalg.svd(desc - mean, full_matrices=False)
+        explained_variance = s ** 2 / max(desc.size(0) - 1, 1)
+        return cls(mean, vh[:n_components].contiguous(), explained_variance[:n_components],
+                   explained_variance.sum())
+
+    @property
+    def dim(self) -> int:
+        return self.components.size(0)
+
+    @property
+    def explained_variance_ratio(self) -> float:
+        return (self.explained_variance.sum() / self.total_variance).item()
+
+    def truncate(self, dim: int) -> 'DescriptorProjection':
+        """Return a projection that only keeps the first dim components"""
+        assert 0 < dim <= self.dim, f'Cannot truncate projection with {self.dim} components to {dim}'
+        return DescriptorProjection(self.mean, self.components[:dim], self.explained_variance[:dim],
+                                    self.total_variance)
+
+    def to(self, dev) -> 'DescriptorProjection':
+        return DescriptorProjection(self.mean.to(dev), self.components.to(dev), self.explained_variance.to(dev),
+                                    self.total_variance.to(dev))
+
+    def __call__(self, descriptors: torch.Tensor) -> torch.Tensor:
+        """Project ... x D descriptors to ... x K"""
+        return torch.matmul(descriptors - self.mean, self.components.t())
+
+    def to_npz_dict(self, prefix: str) -> Dict[str, np.ndarray]:
+        """Arrays to store alongside the target descriptors, with keys starting with prefix"""
+        return {
+            f'{prefix}_projection_mean': self.mean.detach().cpu().numpy(),
+            f'{prefix}_projection_components': self.components.detach().cpu().numpy(),
+            f'{prefix}_projection_explained_variance': self.explained_variance.detach().cpu().numpy(),
+            f'{prefix}_projection_total_variance': self.total_variance.detach().cpu().numpy(),
+        }
+
+    @classmethod
+    def from_npz(cls, data, prefix: str) -> Optional['DescriptorProjection']:
+        """Load a projection saved with to_npz_dict, returns None if the file doesn't contain one"""
+        if f'{prefix}_projection_components' not in data:
+            return None
+        return cls(
+            torch.from_numpy(data[f'{prefix}_projection_mean']).float(),
+            torch.from_numpy(data[f'{prefix}_projection_components']).float(),
+            torch.from_numpy(data[f'{prefix}_projection_explained_variance']).float(),
+            torch.from_numpy(np.asarray(data[f'{prefix}_projection_total_variance'])).float())
+
+    def report(self, candidate_descs: torch.Tensor, target_desc: torch.Tensor,
+               dims: Optional[List[int]] = None, n_repeats: int = 10) -> List[Dict]:
+        """
+        Compare matching in the reduced space to matching with full-width descriptors
+
+        Args:
+            candidate_descs (torch.Tensor): M x P x D, descriptors to match against the target
+                (e.g., the aligned demo descriptors)
+            target_desc (torch.Tensor): P x D, target descriptor
+            dims (list): Dimensionalities to evaluate, defaults to powers of two up to self.dim
+            n_repeats (int): Number of repeats used to time the loss computation
+
+        Returns:
+            list: One dict per dimensionality with the explained variance ratio, the correlation
+                between reduced and full L1 losses over the candidates, whether the best candidate
+                is unchanged, and the time per loss evaluation (including projection)
+        """
+        if dims is None:
+            dims = [2 ** i for i in range(1, int(np.log2(self.dim)) + 1)]
+            if self.dim not in dims:
+                dims.append(self.dim)
+
+        def _time_l1(transform, target):
+            # the target is projected once ahead of time, the candidates on every loss evaluation
+            start = time.perf_counter()
+            for _ in range(n_repeats):
+                losses = (transform(candidate_descs) - target[None]).abs().mean(dim=(1, 2))
+            return losses, (time.perf_counter() - start) / n_repeats
+
+        full_losses, full_time = _time_l1(lambda x: x, target_desc)
+        rows = [dict(dim=candidate_descs.size(-1), explained_variance_ratio=1.0, loss_corr=1.0,
+                     same_best=True, l1_time=full_time)]
+        for dim in dims:
+            proj = self.truncate(dim)
+            red_losses, red_time = _time_l1(proj, proj(target_desc))
+            if candidate_descs.size(0) > 1:
+                loss_corr = np.corrcoef(full_losses.cpu().numpy(), red_losses.cpu().numpy())[0, 1]
+            else:
+                loss_corr = float('nan')
+            rows.append(dict(
+                dim=dim,
+                explained_variance_ratio=proj.explained_variance_ratio,
+                loss_corr=float(loss_corr),
+                same_best=bool(torch.argmin(full_losses) == torch.argmin(red_losses)),
+                l1_time=red_time))
+        return rows
+
+
+def format_projection_report(rows: List[Dict]) -> str:
+    lines = ['dim | expl. var | loss corr | same best | L1 time (ms)']
+    for row in rows:
+        lines.append(
+            f'{row["dim"]:>4d} | {row["explained_variance_ratio"]:9.4f} | {row["loss_corr"]:9.4f} | '
+            f'{str(row["same_best"]):>9s} | {row["l1_time"] * 1000:.3f}')
+    return '\n'.join(lines)
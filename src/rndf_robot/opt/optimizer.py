@@ -13,6 +13,7 @@ from tqdm import tqdm
 
 from rndf_robot.utils import util, torch_util, trimesh_util, torch3d_util
 from rndf_robot.utils.plotly_save import plot3d
+from rndf_robot.utils.profiling import maybe_span
 
 
 class OccNetOptimizer:
@@ -40,10 +41,14 @@ class OccNetOptimizer:
         self.cfg = cfg
         self.n_pts = self.cfg.SHAPE_PCD_PTS_N
         self.opt_pts = self.cfg.QUERY_PCD_PTS_N
-        if 'dgcnn' in self.model_type:
+        # the shape latents are computed without autograd, and split into micro-batches that fit
+        # within the memory budget
+        latent_mem_budget_mb = self.cfg.get('LATENT_MEM_BUDGET_MB', 0)
+        self.latent_mem_budget = latent_mem_budget_mb * 1024 ** 2 if latent_mem_budget_mb > 0 else None
+        if 'dgcnn' in self.model_type and self.latent_mem_budget is None:
             self.full_opt = 5   # dgcnn can't fit 10 initialization in memory
         else:
-            # self.full_opt = 5
+            # with a budget, the encoder memory no longer grows with the number of initializations
             self.full_opt = 10
 
         self.noise_scale = noise_scale
@@ -55,6 +60,10 @@ class OccNetOptimizer:
         self.single_object = single_object 
         self.target_info = None
         self.demo_info = None
+        self.desc_projection = None
+        # optional TrialProfiler, the optimizations time their encode/decode/backward phases with it
+        self.profiler = None
+        self.profiler_prefix = 'optimize'
         if self.single_object:
             log_warn('\n\n**** SINGLE OBJECT SET TO TRUE, WILL *NOT* USE A NEW SHAPE AT TEST TIME, AND WILL EXPECT TARGET INFO TO BE SET****\n\n')
 
@@ -106,6 +115,21 @@ class OccNetOptimizer:
         """
         self.target_info = target_info
 
+    def set_profiler(self, profiler, prefix='optimize'):
+        """Time the optimization phases as <prefix>/encode, <prefix>/decode and <prefix>/backward spans of profiler"""
+        self.profiler = profiler
+        self.profiler_prefix = prefix
+
+    def _span(self, name):
+        return maybe_span(self.profiler, f'{self.profiler_prefix}/{name}')
+
+    def set_descriptor_projection(self, desc_projection):
+        """
+        Function to set a DescriptorProjection, so that descriptors are matched in
+        the reduced space during optimization. Pass None to match full descriptors
+        """
+        self.desc_projection = None if desc_projection is None else desc_projection.to(self.dev)
+
     def _get_query_pts_rs(self, ee=True):
         # convert query points to camera frame
         query_pts_world_rs = torch.from_numpy(self.query_pts_origin_real_shape).float().to(self.dev)
@@ -135,8 +159,8 @@ class OccNetOptimizer:
         opt_pts = self.opt_pts
         perturb_scale = self.noise_scale
         perturb_decay = self.noise_decay
-        demo_feats_list = []
-        demo_latents_list = []
+        demo_shape_pcds = []
+        demo_query_pcds = []
         for i in range(len(self.demo_info)):
             # load in information from target
             demo_shape_pts_world = self.demo_info[i]['demo_obj_pts']
@@ -150,21 +174,28 @@ class OccNetOptimizer:
             demo_query_pts_cent_perturbed = demo_query_pts_cent + (torch.randn(demo_query_pts_cent.size()) * perturb_scale).to(dev)
 
             rndperm = torch.randperm(demo_shape_pts_cent.size(0))
-            demo_model_input = dict(
-                point_cloud=demo_shape_pts_cent[None, rndperm[:n_pts], :], 
-                coords=demo_query_pts_cent_perturbed[None, :opt_pts, :])
-            # out = self.model(demo_model_input)
-            # target_act_hat = out['features'].detach()
-            target_latent = self.model.extract_latent(demo_model_input).detach()
-            target_act_hat = self.model.forward_latent(target_latent, demo_model_input['coords']).detach()
-
-            demo_feats_list.append(target_act_hat.squeeze())
-            demo_latents_list.append(target_latent.squeeze())
+            demo_shape_pcds.append(demo_shape_pts_cent[rndperm[:n_pts]])
+            demo_query_pcds.append(demo_query_pts_cent_perturbed[:opt_pts])
+
+        # the demo point clouds can have different sizes, so encode them together as one padded batch
+        demo_point_cloud, demo_mask = torch_util.pad_point_clouds(demo_shape_pcds)
+        demo_coords, _ = torch_util.pad_point_clouds(demo_query_pcds)
+        demo_model_input = dict(point_cloud=demo_point_cloud, mask=demo_mask, coords=demo_coords)
+        with torch.no_grad():
+            target_latent = self.model.extract_latent(demo_model_input, mem_budget=self.latent_mem_budget).detach()
+        target_act_hat_all = self.model.forward_latent(target_latent, demo_model_input['coords']).detach()
+
+        demo_feats_list = [target_act_hat_all[i, :demo_query_pcds[i].size(0)] for i in range(len(demo_query_pcds))]
         target_act_hat_all = torch.stack(demo_feats_list, 0)
         target_act_hat = torch.mean(target_act_hat_all, 0)
         return target_act_hat
 
-    def get_pose_descriptor(self, shape_pts_world_np, external_obj_pose_mat, return_shape_latent=False): 
+    def pose_descriptor_input(self, shape_pts_world_np, external_obj_pose_mat):
+        """
+        Centered (and subsampled) shape and query points for get_pose_descriptors. The points are
+        subsampled here, so preparing the inputs in a loop and encoding them afterwards draws
+        the same random numbers as calling get_pose_descriptor in that loop
+        """
         shape_pts_world = torch.from_numpy(shape_pts_world_np).float().to(self.dev)
         shape_pts_mean = shape_pts_world.mean(0)
         shape_pts_cent = shape_pts_world - shape_pts_mean
@@ -175,16 +206,41 @@ class OccNetOptimizer:
         query_pts_world = util.transform_pcd(self.query_pts_origin, external_obj_pose_mat)
         query_pts_world = torch.from_numpy(query_pts_world).float().to(self.dev)
         query_pts_cent = query_pts_world - shape_pts_mean
+        return shape_pts_cent, query_pts_cent
 
-        model_input = dict(point_cloud=shape_pts_cent.reshape(1, -1, 3), coords=query_pts_cent.reshape(1, -1, 3))
+    def get_pose_descriptors(self, desc_inputs, return_shape_latent=False):
+        """
+        Descriptors of several (shape, query pose) inputs from pose_descriptor_input, encoded
+        together as one padded batch
 
-        latent = self.model.extract_latent(model_input).detach()
-        descriptor = self.model.forward_latent(latent, model_input['coords']).detach()
-        
+        Returns:
+            list: 1 x N_q x D descriptor of every input (and 1 x ... shape latent if return_shape_latent)
+        """
+        if len(desc_inputs) == 1:
+            # no padding needed
+            shape_pts_cent, query_pts_cent = desc_inputs[0]
+            model_input = dict(point_cloud=shape_pts_cent[None], coords=query_pts_cent[None])
+        else:
+            point_cloud, mask = torch_util.pad_point_clouds([shape_pts for shape_pts, _ in desc_inputs])
+            coords, _ = torch_util.pad_point_clouds([query_pts for _, query_pts in desc_inputs])
+            model_input = dict(point_cloud=point_cloud, mask=mask, coords=coords)
+
+        with torch.no_grad():
+            latent = self.model.extract_latent(model_input, mem_budget=self.latent_mem_budget).detach()
+        descriptors = self.model.forward_latent(latent, model_input['coords']).detach()
+
+        descriptors = [descriptors[i:i + 1, :query_pts.size(0)] for i, (_, query_pts) in enumerate(desc_inputs)]
+        if return_shape_latent:
+            return descriptors, [latent[i:i + 1] for i in range(len(desc_inputs))]
+        return descriptors
+
+    def get_pose_descriptor(self, shape_pts_world_np, external_obj_pose_mat, return_shape_latent=False): 
+        desc_inputs = [self.pose_descriptor_input(shape_pts_world_np, external_obj_pose_mat)]
         if return_shape_latent:
-            return descriptor, latent
+            descriptors, latents = self.get_pose_descriptors(desc_inputs, return_shape_latent=True)
+            return descriptors[0], latents[0]
         else:
-            return descriptor
+            return self.get_pose_descriptors(desc_inputs)[0]
 
     def optimize_transform_implicit(self, shape_pts_world_np, ee=True, return_score_list=False, return_final_desc=False, 
                                     target_act_hat=None, visualize=False, *args, **kwargs):
@@ -285,7 +341,15 @@ class OccNetOptimizer:
 
         # set up model input with shape points and the shape latent that will be used throughout
         mi['coords'] = X
-        latent = self.model.extract_latent(mi).detach()
+        with torch.no_grad(), self._span('encode'):
+            latent = self.model.extract_latent(mi, mem_budget=self.latent_mem_budget).detach()
+
+        # match descriptors in the reduced space, if a projection is set
+        t_size = target_act_hat.size()
+        if self.desc_projection is not None:
+            target_match = self.desc_projection(target_act_hat)
+        else:
+            target_match = target_act_hat
 
         if self.mc_vis is not None and visualize:
             # util.meshcat_pcd_show(self.mc_vis, shape_pts_cent.cpu().numpy(), color=[255, 0, 0], name=f'scene/opt/shape_points_centered')
@@ -335,21 +399,26 @@ class OccNetOptimizer:
 
             ###############################################################################
 
-            act_hat = self.model.forward_latent(latent, X_new)
-            t_size = target_act_hat.size()
+            with self._span('decode'):
+                act_hat = self.model.forward_latent(latent, X_new)
+                if self.desc_projection is not None:
+                    act_match = self.desc_projection(act_hat.view((M,) + t_size))
+                else:
+                    act_match = act_hat.view((M,) + t_size)
 
-            losses = [self.loss_fn(act_hat[ii].view(t_size), target_act_hat) for ii in range(M)]
+                losses = [self.loss_fn(act_match[ii], target_match) for ii in range(M)]
 
-            loss = torch.mean(torch.stack(losses))
+                loss = torch.mean(torch.stack(losses))
             if i % 100 == 0:
                 losses_str = ['%f' % val.item() for val in losses]
                 loss_str = ', '.join(losses_str)
                 # log_info(f'i: {i}, losses: {loss_str}')
                 log_debug(f'i: {i}, losses: {loss_str}')
             loss_values.append(loss.item())
-            full_opt.zero_grad()
-            loss.backward()
-            full_opt.step()
+            with self._span('backward'):
+                full_opt.zero_grad()
+                loss.backward()
+                full_opt.step()
 
             # visualize
             if self.mc_vis is not None and visualize:
@@ -423,3 +492,157 @@ class OccNetOptimizer:
                 return tf_list, best_idx, losses
         else:
             return tf_list, best_idx
+
+    def optimize_transform_implicit_batch(self, shape_pts_world_np_list, target_act_hats, query_pts_list=None, ee=True):
+        """
+        Optimize the transformation of the query points for K independent scenes at once, as
+        one batched problem with K x M hypotheses (M random initializations per scene), instead
+        of K separate calls to optimize_transform_implicit
+
+        Args:
+            shape_pts_world_np_list (list): K np.ndarrays, N_k x 3 point cloud of the object in
+                each scene, expressed in the world coordinate system
+            target_act_hats (torch.Tensor or list): Target descriptors, either one P x D tensor
+                shared by all scenes, or one per scene (K x P x D tensor or list of P x D tensors)
+            query_pts_list (list): K np.ndarrays, P x 3 query points for each scene. If None, the
+                query points set on the optimizer are used for all scenes
+            ee (bool): Same as in optimize_transform_implicit
+
+        Returns:
+            4-element tuple of lists with one entry per scene
+            - list: M transformation matrices
+            - int: index of the best transformation
+            - torch.Tensor: M final loss values
+            - torch.Tensor: M x P x D final descriptors
+        """
+        dev = self.dev
+        n_pts = self.n_pts
+        opt_pts = self.opt_pts
+        perturb_scale = self.noise_scale
+        perturb_decay = self.noise_decay
+        K = len(shape_pts_world_np_list)
+        M = self.full_opt
+
+        if query_pts_list is None:
+            query_pts_list = [self.query_pts_origin] * K
+        if isinstance(target_act_hats, (list, tuple)):
+            target_act_hats = torch.stack([t.to(dev) for t in target_act_hats], 0)
+        target_act_hats = target_act_hats.to(dev)
+        if target_act_hats.dim() == 2:
+            target_act_hats = target_act_hats[None].expand(K, -1, -1)
+        t_size = target_act_hats.size()[1:]
+
+        # center the shape points and the query points of every scene
+        shape_pts_cent_list = []
+        query_pts_cent_list = []
+        shape_mean_trans_list = []
+        query_pts_tf_list = []
+        for k in range(K):
+            shape_pts_world = torch.from_numpy(shape_pts_world_np_list[k]).float().to(dev)
+            shape_pts_mean = shape_pts_world.mean(0)
+            shape_pts_cent_list.append(shape_pts_world - shape_pts_mean)
+            shape_mean_trans = np.eye(4)
+            shape_mean_trans[:-1, -1] = shape_pts_mean.cpu().numpy()
+            shape_mean_trans_list.append(shape_mean_trans)
+
+            query_pts_world = torch.from_numpy(query_pts_list[k]).float().to(dev)
+            query_pts_mean = query_pts_world.mean(0)
+            query_pts_cent_list.append((query_pts_world - query_pts_mean)[:opt_pts])
+            query_pts_tf = np.eye(4)
+            query_pts_tf[:-1, -1] = -query_pts_mean.cpu().numpy()
+            query_pts_tf_list.append(query_pts_tf)
+
+        trans_scale = 0.2
+        trans = (torch.rand((K * M, 3)) * trans_scale - trans_scale/2).float().to(dev)
+        rot_idx = np.random.randint(self.rot_grid.shape[0], size=K * M)
+        rot = torch3d_util.matrix_to_axis_angle(torch.from_numpy(self.rot_grid[rot_idx])).float().to(dev)
+
+        rand_rot_idx = np.random.randint(self.rot_grid.shape[0], size=K * M)
+        rand_rot_init = torch3d_util.matrix_to_axis_angle(torch.from_numpy(self.rot_grid[rand_rot_idx])).float()
+        rand_mat_init = torch_util.angle_axis_to_rotation_matrix(rand_rot_init)
+        rand_mat_init = rand_mat_init.view(K * M, 4, 4).float().to(dev)
+
+        # hypotheses are ordered scene by scene: k * M + m
+        X = torch.stack(query_pts_cent_list, 0).repeat_interleave(M, dim=0)
+        X = torch_util.transform_pcd_torch(X, rand_mat_init)
+
+        # random numbers are drawn in the same order as in optimize_transform_implicit, so a
+        # batch with a single scene gives the same result for the same seed
+        shape_pcds = []
+        for shape_pts_cent in shape_pts_cent_list:
+            for _ in range(M):
+                rndperm = torch.randperm(shape_pts_cent.size(0))
+                shape_pcds.append(shape_pts_cent[rndperm[:n_pts]])
+
+        # the scenes' point clouds can have fewer than n_pts points, so they are padded if needed
+        mi_point_cloud, mi_mask = torch_util.pad_point_clouds(shape_pcds)
+        mi = dict(point_cloud=mi_point_cloud)
+        if not mi_mask.all():
+            mi['mask'] = mi_mask
+
+        rot.requires_grad_()
+        trans.requires_grad_()
+        full_opt = torch.optim.Adam([trans, rot], lr=1e-2)
+        full_opt.zero_grad()
+
+        with torch.no_grad(), self._span('encode'):
+            latent = self.model.extract_latent(mi, mem_budget=self.latent_mem_budget).detach()
+
+        # match descriptors in the reduced space, if a projection is set
+        if self.desc_projection is not None:
+            target_match = self.desc_projection(target_act_hats)
+        else:
+            target_match = target_act_hats
+        target_match = target_match.repeat_interleave(M, dim=0)
+
+        for i in tqdm(range(self.opt_iterations)):
+            T_mat = torch_util.angle_axis_to_rotation_matrix(rot).view(K * M, 4, 4)
+            noise_val = (perturb_scale / ((i+1)**(perturb_decay)))
+            noise_vec = (torch.randn(X.size()) * noise_val - noise_val/2).to(dev)
+            X_perturbed = X + noise_vec
+            X_new = torch_util.transform_pcd_torch(X_perturbed, T_mat) + trans[:, None, :].repeat((1, X.size(1), 1))
+
+            with self._span('decode'):
+                act_hat = self.model.forward_latent(latent, X_new)
+                if self.desc_projection is not None:
+                    act_match = self.desc_projection(act_hat.view((K * M,) + t_size))
+                else:
+                    act_match = act_hat.view((K * M,) + t_size)
+
+                # same per-hypothesis L1 loss as optimize_transform_implicit, averaged over the
+                # hypotheses of each scene and summed over scenes, so every scene sees the same
+                # gradients as when it is optimized on its own
+                losses = (act_match - target_match).abs().mean(dim=(1, 2))
+                loss = losses.view(K, M).mean(1).sum()
+            if i % 100 == 0:
+                log_debug(f'i: {i}, mean loss per scene: {", ".join(["%f" % val for val in losses.view(K, M).mean(1).tolist()])}')
+            with self._span('backward'):
+                full_opt.zero_grad()
+                loss.backward()
+                full_opt.step()
+
+        losses = losses.detach().view(K, M)
+        act_hat = act_hat.detach().view((K, M) + t_size)
+        best_idxs = torch.argmin(losses, dim=1).tolist()
+
+        tf_lists = []
+        for k in range(K):
+            tf_list = []
+            for m in range(M):
+                j = k * M + m
+                trans_j, rot_j = trans[j], rot[j]
+                transform_mat_np = torch_util.angle_axis_to_rotation_matrix(rot_j.view(1, -1)).squeeze().detach().cpu().numpy()
+                transform_mat_np[:-1, -1] = trans_j.detach().cpu().numpy()
+
+                rand_query_pts_tf = np.matmul(rand_mat_init[j].detach().cpu().numpy(), query_pts_tf_list[k])
+                transform_mat_np = np.matmul(transform_mat_np, rand_query_pts_tf)
+                transform_mat_np = np.matmul(shape_mean_trans_list[k], transform_mat_np)
+
+                if ee:
+                    T_mat = transform_mat_np
+                else:
+                    T_mat = np.linalg.inv(transform_mat_np)
+                tf_list.append(T_mat)
+            tf_lists.append(tf_list)
+
+        return tf_lists, best_idxs, [losses[k] for k in range(K)], [act_hat[k] for k in range(K)]
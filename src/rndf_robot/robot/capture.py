@@ -0,0 +1,308 @@
+"""
+Faster image and point cloud capture for the cameras of a MultiCams rig.
+
+- Only the buffers that are asked for are rendered and converted (e.g., no segmentation
+  mask for the NeRF views, no color for the observation point clouds).
+- The ray through every pixel of a camera, in the world frame, is computed once and cached,
+  so back-projecting a depth image is a multiply-add, and only the pixels of the segmented
+  objects are back-projected instead of the full image.
+- The cameras can be spread over several renderer processes (RendererPool), each with its
+  own pybullet client that mirrors the bodies registered with it. The images come back
+  through shared memory.
+"""
+import multiprocessing as mp
+import traceback
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pybullet as p
+
+from loguru import logger
+
+from rndf_robot.utils.body_pool import BodyPool
+
+
+class CameraRays:
+    """
+    Pixel rays of a pinhole camera in the world frame. A point at depth d (along the optical
+    axis, as in the depth images) of pixel i is origin + d * dirs[i]
+    """
+    def __init__(self, cam_int_mat: np.ndarray, cam_ext_mat: np.ndarray, width: int, height: int):
+        self.width = width
+        self.height = height
+        # pixel coordinates (u = column, v = row) in the row-major order of the flattened images
+        v, u = np.mgrid[0:height, 0:width].reshape(2, -1)
+        uv_one = np.stack([u, v, np.ones_like(u)]).astype(np.float64)
+        rays_in_cam = np.dot(np.linalg.inv(cam_int_mat), uv_one)
+        self.dirs = np.ascontiguousarray(np.dot(cam_ext_mat[:3, :3], rays_in_cam).T)
+        self.origin = np.asarray(cam_ext_mat[:3, 3], dtype=np.float64)
+
+    def points(self, depth: np.ndarray, pixel_inds: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Back-project the pixels pixel_inds (indices into the flattened image, all of them if None)
+        of a depth image to world frame points
+        """
+        flat_depth = depth.reshape(-1)
+        if pixel_inds is None:
+            return self.origin + self.dirs * flat_depth[:, None]
+        return self.origin + self.dirs[pixel_inds] * flat_depth[pixel_inds, None]
+
+
+# (intrinsics, extrinsics, width, height) -> CameraRays, shared by all the rigs with the same cameras
+_RAYS_CACHE: Dict[Tuple, CameraRays] = {}
+
+
+def camera_rays(cam_int_mat: np.ndarray, cam_ext_mat: np.ndarray, width: int, height: int) -> CameraRays:
+    key = (np.asarray(cam_int_mat).tobytes(), np.asarray(cam_ext_mat).tobytes(), width, height)
+    if key not in _RAYS_CACHE:
+        _RAYS_CACHE[key] = CameraRays(cam_int_mat, cam_ext_mat, width, height)
+    return _RAYS_CACHE[key]
+
+
+def segmented_points(rays: CameraRays, depth: np.ndarray, seg: np.ndarray, body_ids: Sequence[int],
+                     depth_min: float = 0.0, depth_max: float = np.inf) -> Dict[int, np.ndarray]:
+    """
+    World frame points of the pixels of each body in a segmentation mask, with a depth in
+    (depth_min, depth_max)
+
+    Returns:
+        dict: body id -> (N, 3) points
+    """
+    flat_seg = seg.reshape(-1)
+    flat_depth = depth.reshape(-1)
+    points = {}
+    for body_id in body_ids:
+        pixel_inds = np.flatnonzero(flat_seg == body_id)
+        pixel_depths = flat_depth[pixel_inds]
+        pixel_inds = pixel_inds[(pixel_depths > depth_min) & (pixel_depths < depth_max)]
+        points[body_id] = rays.points(depth, pixel_inds)
+    return points
+
+
+class MultiCamCapture:
+    """
+    Capture the images of all the cameras of a MultiCams rig, in the main pybullet client or
+    with a RendererPool, and back-project segmented objects
+    """
+    def __init__(self, multicams, renderer_pool: Optional['RendererPool'] = None):
+        self.multicams = multicams
+        self.renderer_pool = renderer_pool
+
+    def rays(self, i: int) -> CameraRays:
+        cam = self.multicams.cams[i]
+        return camera_rays(cam.cam_int_mat, cam.cam_ext_mat, self.multicams.width, self.multicams.height)
+
+    def register_body(self, body_id: int, spec: Dict, rgba: Optional[Sequence[float]] = None) -> None:
+        """Tell the renderer pool (if any) about a body it has to show, see RendererPool.register_body"""
+        if self.renderer_pool is not None:
+            self.renderer_pool.register_body(body_id, spec, rgba)
+
+    def unregister_body(self, body_id: int) -> None:
+        if self.renderer_pool is not None:
+            self.renderer_pool.unregister_body(body_id)
+
+    def capture(self, get_rgb: bool = True, get_depth: bool = True, get_seg: bool = False
+                ) -> Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]]:
+        """
+        Returns:
+            3-element tuple containing
+            - list: RGB images of the cameras (None if not requested)
+            - list: Depth images
+            - list: Segmentation masks (body ids, -1 for the background)
+        """
+        if self.renderer_pool is not None:
+            return self.renderer_pool.render(get_rgb=get_rgb, get_depth=get_depth, get_seg=get_seg)
+        rgbs, depths, segs = [], [], []
+        for cam in self.multicams.cams:
+            rgb, depth, seg = cam.get_images(get_rgb=get_rgb, get_depth=get_depth, get_seg=get_seg)
+            rgbs.append(rgb)
+            depths.append(depth)
+            segs.append(seg)
+        return rgbs, depths, segs
+
+    def segmented_points(self, depths: Sequence[np.ndarray], segs: Sequence[np.ndarray], body_ids: Sequence[int],
+                         depth_min: float = 0.0, depth_max: float = np.inf) -> Dict[int, List[np.ndarray]]:
+        """
+        Returns:
+            dict: body id -> list with the (N, 3) world frame points of the body seen by each camera
+        """
+        points = {body_id: [] for body_id in body_ids}
+        for i, (depth, seg) in enumerate(zip(depths, segs)):
+            for body_id, pts in segmented_points(self.rays(i), depth, seg, body_ids, depth_min, depth_max).items():
+                points[body_id].append(pts)
+        return points
+
+
+def _load_spec(pb_client, spec: Dict, pos: Sequence[float], ori: Sequence[float]) -> int:
+    if spec['kind'] == 'urdf':
+        return pb_client.load_urdf(spec['file'], pos, ori, scaling=spec.get('scale', 1.0))
+    return pb_client.load_geom(
+        'mesh', mass=0.0, mesh_scale=spec['scale'], visualfile=spec['file'], collifile=spec['file'],
+        base_pos=pos, base_ori=ori)
+
+
+def _spec_file_scale(spec: Dict) -> Tuple[str, List[float]]:
+    """File and scale to pool the bodies of a spec by"""
+    scale = spec.get('scale', 1.0)
+    return spec['file'], list(scale) if isinstance(scale, (list, tuple)) else [scale]
+
+
+def _renderer_main(conn, cam_cfg, n_cams: int, cam_inds: Sequence[int], shm_names: Dict[str, str],
+                   width: int, height: int, opengl_render: bool, shadows: bool) -> None:
+    """Renderer process: mirror the scene it is sent, and render its cameras into shared memory"""
+    from airobot.utils.pb_util import create_pybullet_client
+    from rndf_robot.robot.multicam import MultiCams
+
+    pb_client = create_pybullet_client(gui=False, opengl_render=opengl_render, realtime=False)
+    client_id = pb_client.get_client_id()
+    p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, int(shadows), physicsClientId=client_id)
+    cams = MultiCams(cam_cfg, pb_client, n_cams=n_cams)
+    body_pool = BodyPool(client_id=client_id)
+    # body id in the main client -> body id here
+    mirrored: Dict[int, int] = {}
+
+    shms = {name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in shm_names.items()}
+    n = len(cam_inds)
+    rgb_buf = np.ndarray((n, height, width, 3), dtype=np.uint8, buffer=shms['rgb'].buf)
+    depth_buf = np.ndarray((n, height, width), dtype=np.float32, buffer=shms['depth'].buf)
+    seg_buf = np.ndarray((n, height, width), dtype=np.int32, buffer=shms['seg'].buf)
+    try:
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            scene, get_rgb, get_depth, get_seg = msg
+            try:
+                for main_id in [main_id for main_id in mirrored if main_id not in scene]:
+                    body_pool.release(mirrored.pop(main_id))
+                for main_id, (spec, pos, ori, rgba) in scene.items():
+                    if main_id not in mirrored:
+                        body_file, body_scale = _spec_file_scale(spec)
+                        mirrored[main_id], _ = body_pool.acquire(
+                            body_file, body_scale, lambda: _load_spec(pb_client, spec, pos, ori), pos, ori)
+                        if rgba is not None:
+                            p.changeVisualShape(mirrored[main_id], -1, rgbaColor=rgba, physicsClientId=client_id)
+                    # the poses are of the base inertial frame (like getBasePositionAndOrientation), not the urdf frame
+                    p.resetBasePositionAndOrientation(mirrored[main_id], pos, ori, physicsClientId=client_id)
+
+                # the masks have to show the body ids of the main client
+                lut_size = max(mirrored.values(), default=0) + 2
+                id_lut = np.full(lut_size, -1, dtype=np.int32)
+                for main_id, body_id in mirrored.items():
+                    id_lut[body_id + 1] = main_id
+
+                for j, i in enumerate(cam_inds):
+                    rgb, depth, seg = cams.cams[i].get_images(get_rgb=get_rgb, get_depth=get_depth, get_seg=get_seg)
+                    if get_rgb:
+                        rgb_buf[j] = rgb
+                    if get_depth:
+                        depth_buf[j] = depth
+                    if get_seg:
+                        seg = np.asarray(seg)
+                        in_range = (seg >= -1) & (seg < lut_size - 1)
+                        seg_buf[j] = np.where(in_range, id_lut[np.clip(seg + 1, 0, lut_size - 1)], -1)
+                conn.send(('done', None))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+    finally:
+        for shm in shms.values():
+            shm.close()
+
+
+class RendererPool:
+    """
+    Render the cameras of a MultiCams rig in n_clients processes, each with its own pybullet
+    client. The renderer clients don't run any physics, they mirror the bodies registered with
+    the pool at the poses they have in the main client (by base pose, so articulated bodies
+    have to be in their default configuration). Every camera is always rendered by the same
+    process, into a shared memory buffer.
+    """
+    def __init__(self, cam_cfg, n_cams: int, n_clients: int, client_id: int = 0,
+                 opengl_render: bool = True, shadows: bool = False):
+        self.client_id = client_id
+        self.n_cams = n_cams
+        self.width = cam_cfg.get('WIDTH', 640)
+        self.height = cam_cfg.get('HEIGHT', 480)
+        # body id in the main client -> (spec, rgba)
+        self._bodies: Dict[int, Tuple[Dict, Optional[List[float]]]] = {}
+        self._workers = []
+        ctx = mp.get_context('spawn')
+        for k in range(min(n_clients, n_cams)):
+            cam_inds = list(range(k, n_cams, n_clients))
+            n = len(cam_inds)
+            shms = {
+                'rgb': shared_memory.SharedMemory(create=True, size=n * self.height * self.width * 3),
+                'depth': shared_memory.SharedMemory(create=True, size=n * self.height * self.width * 4),
+                'seg': shared_memory.SharedMemory(create=True, size=n * self.height * self.width * 4),
+            }
+            conn, child_conn = ctx.Pipe()
+            proc = ctx.Process(
+                target=_renderer_main, daemon=True,
+                args=(child_conn, cam_cfg, n_cams, cam_inds, {name: shm.name for name, shm in shms.items()},
+                      self.width, self.height, opengl_render, shadows))
+            proc.start()
+            self._workers.append(dict(proc=proc, conn=conn, cam_inds=cam_inds, shms=shms))
+        logger.info(f'Rendering {n_cams} cameras with {len(self._workers)} renderer processes')
+
+    def register_body(self, body_id: int, spec: Dict, rgba: Optional[Sequence[float]] = None) -> None:
+        """
+        Show a body of the main client in the renders
+
+        Args:
+            spec (dict): How to load the body, dict(kind='urdf', file=..., scale=float) or
+                dict(kind='mesh', file=..., scale=[sx, sy, sz])
+            rgba (list): Color to give the body, if it isn't the one in its files
+        """
+        self._bodies[body_id] = (spec, None if rgba is None else list(rgba))
+
+    def unregister_body(self, body_id: int) -> None:
+        self._bodies.pop(body_id, None)
+
+    def _scene(self) -> Dict:
+        scene = {}
+        for body_id, (spec, rgba) in self._bodies.items():
+            pos, ori = p.getBasePositionAndOrientation(body_id, physicsClientId=self.client_id)
+            scene[body_id] = (spec, list(pos), list(ori), rgba)
+        return scene
+
+    def render(self, get_rgb: bool = True, get_depth: bool = True, get_seg: bool = False
+               ) -> Tuple[List[np.ndarray], List[np.ndarray], List[np.ndarray]]:
+        """Render all the cameras in parallel, the images are returned like MultiCamCapture.capture"""
+        msg = (self._scene(), get_rgb, get_depth, get_seg)
+        for worker in self._workers:
+            worker['conn'].send(msg)
+        rgbs, depths, segs = [None] * self.n_cams, [None] * self.n_cams, [None] * self.n_cams
+        errors = []
+        for worker in self._workers:
+            status, error = worker['conn'].recv()
+            if status == 'error':
+                errors.append(error)
+                continue
+            n = len(worker['cam_inds'])
+            shape = (n, self.height, self.width)
+            rgb_buf = np.ndarray(shape + (3,), dtype=np.uint8, buffer=worker['shms']['rgb'].buf)
+            depth_buf = np.ndarray(shape, dtype=np.float32, buffer=worker['shms']['depth'].buf)
+            seg_buf = np.ndarray(shape, dtype=np.int32, buffer=worker['shms']['seg'].buf)
+            # copies, the buffers are overwritten by the next render
+            for j, i in enumerate(worker['cam_inds']):
+                rgbs[i] = rgb_buf[j].copy() if get_rgb else None
+                depths[i] = depth_buf[j].copy() if get_depth else None
+                segs[i] = seg_buf[j].copy() if get_seg else None
+        if len(errors) > 0:
+            raise RuntimeError('Renderer process failed:\n' + errors[0])
+        return rgbs, depths, segs
+
+    def close(self) -> None:
+        for worker in self._workers:
+            try:
+                worker['conn'].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker['proc'].join(timeout=10)
+            if worker['proc'].is_alive():
+                worker['proc'].kill()
+            for shm in worker['shms'].values():
+                shm.close()
+                shm.unlink()
+        self._workers = []
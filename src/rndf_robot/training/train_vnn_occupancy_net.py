@@ -37,6 +37,8 @@ p.add_argument('--multiview_aug', action='store_true', help='multiview_augmentat
 
 p.add_argument('--checkpoint_path', default=None, help='Checkpoint to trained model.')
 p.add_argument('--dgcnn', action='store_true', help='If you want to use a DGCNN encoder instead of pointnet (requires more GPU memory)')
+p.add_argument('--checkpoint_encoder', action='store_true',
+               help='Recompute the DGCNN encoder layers in the backward pass instead of storing them (less GPU memory, slower)')
 opt = p.parse_args()
 
 train_dataset = dataio.JointOccTrainDataset(128, depth_aug=opt.depth_aug, multiview_aug=opt.multiview_aug, obj_class=opt.obj_class)
@@ -48,7 +50,9 @@ train_dataloader = DataLoader(train_dataset, batch_size=opt.batch_size, shuffle=
 val_dataloader = DataLoader(val_dataset, batch_size=opt.batch_size, shuffle=True,
                             drop_last=True, num_workers=4)
 
-model = vnn_occupancy_network.VNNOccNet(latent_dim=256).cuda()
+assert opt.dgcnn or not opt.checkpoint_encoder, '--checkpoint_encoder only applies to the DGCNN encoder (--dgcnn)'
+model = vnn_occupancy_network.VNNOccNet(
+    latent_dim=256, model_type='dgcnn' if opt.dgcnn else 'pointnet', checkpoint_encoder=opt.checkpoint_encoder).cuda()
 
 if opt.checkpoint_path is not None:
     model.load_state_dict(torch.load(opt.checkpoint_path))
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import pybullet as p
+
+from loguru import logger
+
+
+class BodyPool:
+    """
+    Per-process pool of loaded pybullet bodies, keyed by (mesh file, mesh scale), so that
+    objects that come back in later trials don't have to be loaded from disk again.
+
+    Released bodies are parked: their constraints are removed, and they are made static
+    (mass 0) and moved far away from the scene (out of view of the cameras), each to its own
+    slot so they never touch. Acquiring a parked body restores its mass and resets its pose
+    and velocity. Everything else (color, friction, collision filters, constraints) is up to
+    the caller, like for a freshly loaded body. At most max_parked bodies are kept, the least
+    recently parked ones are removed first.
+    """
+    def __init__(self, client_id: int = 0, max_parked: int = 8,
+                 park_origin: Sequence[float] = (100.0, 100.0, -100.0), park_spacing: float = 2.0):
+        self.client_id = client_id
+        self.max_parked = max_parked
+        self.park_origin = list(park_origin)
+        self.park_spacing = park_spacing
+        # body id -> (key, mass), for all the bodies the pool loaded that still exist
+        self._bodies: Dict[int, Tuple[Tuple, float]] = {}
+        # parked body id -> key, oldest first
+        self._parked: 'OrderedDict[int, Tuple]' = OrderedDict()
+        # body id -> parking slot
+        self._slots: Dict[int, int] = {}
+        self.n_loaded = 0
+        self.n_reused = 0
+
+    @staticmethod
+    def key(mesh_file: str, mesh_scale: Sequence[float]) -> Tuple:
+        return (mesh_file, tuple(float(s) for s in mesh_scale))
+
+    def acquire(self, mesh_file: str, mesh_scale: Sequence[float], load_fn: Callable[[], int],
+                pos: Sequence[float], ori: Sequence[float]) -> Tuple[int, bool]:
+        """
+        Get a body for the mesh at pos/ori, reusing a parked one if possible
+
+        Args:
+            load_fn (callable): Loads the body at pos/ori and returns its id, called if there
+                is no parked body for this mesh and scale
+
+        Returns:
+            2-element tuple containing
+            - int: body id
+            - bool: True if a parked body was reused
+        """
+        key = self.key(mesh_file, mesh_scale)
+        for body_id, parked_key in self._parked.items():
+            if parked_key == key:
+                del self._parked[body_id]
+                mass = self._bodies[body_id][1]
+                p.changeDynamics(body_id, -1, mass=mass, physicsClientId=self.client_id)
+                p.resetBasePositionAndOrientation(body_id, pos, ori, physicsClientId=self.client_id)
+                p.resetBaseVelocity(body_id, [0, 0, 0], [0, 0, 0], physicsClientId=self.client_id)
+                self.n_reused += 1
+                return body_id, True
+
+        body_id = load_fn()
+        self._bodies[body_id] = (key, p.getDynamicsInfo(body_id, -1, physicsClientId=self.client_id)[0])
+        self.n_loaded += 1
+        return body_id, False
+
+    def release(self, body_id: int) -> None:
+        """Park a body that was acquired from the pool (bodies the pool didn't load are removed)"""
+        if body_id not in self._bodies:
+            p.removeBody(body_id, physicsClientId=self.client_id)
+            return
+
+        if self.max_parked <= 0:
+            self._remove(body_id)
+            return
+        self._remove_constraints(body_id)
+        while len(self._parked) >= self.max_parked:
+            oldest_body_id = next(iter(self._parked))
+            logger.debug(f'[BodyPool] Pool is full, removing body {oldest_body_id}')
+            self._remove(oldest_body_id)
+
+        if body_id not in self._slots:
+            used_slots = set(self._slots.values())
+            self._slots[body_id] = min(set(range(len(used_slots) + 1)) - used_slots)
+        park_pos = list(self.park_origin)
+        park_pos[0] += self._slots[body_id] * self.park_spacing
+        p.changeDynamics(body_id, -1, mass=0, physicsClientId=self.client_id)
+        p.resetBaseVelocity(body_id, [0, 0, 0], [0, 0, 0], physicsClientId=self.client_id)
+        p.resetBasePositionAndOrientation(body_id, park_pos, [0, 0, 0, 1], physicsClientId=self.client_id)
+        self._parked[body_id] = self._bodies[body_id][0]
+
+    def parked_body_ids(self) -> List[int]:
+        return list(self._parked.keys())
+
+    def clear(self) -> None:
+        """Remove all the parked bodies from the simulation"""
+        for body_id in list(self._parked.keys()):
+            self._remove(body_id)
+
+    def _remove_constraints(self, body_id: int) -> None:
+        constraint_ids = [p.getConstraintUniqueId(i, physicsClientId=self.client_id)
+                          for i in range(p.getNumConstraints(physicsClientId=self.client_id))]
+        for constraint_id in constraint_ids:
+            info = p.getConstraintInfo(constraint_id, physicsClientId=self.client_id)
+            # parent and child body are the first and third entries
+            if body_id in (info[0], info[2]):
+                p.removeConstraint(constraint_id, physicsClientId=self.client_id)
+
+    def _remove(self, body_id: int) -> None:
+        self._parked.pop(body_id, None)
+        self._slots.pop(body_id, None)
+        del self._bodies[body_id]
+        p.removeBody(body_id, physicsClientId=self.client_id)
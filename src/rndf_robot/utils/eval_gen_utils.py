@@ -79,6 +79,43 @@ def safeRemoveConstraint(cid):
     if cid is not None:
         p.removeConstraint(cid)
 
+
+def step_until_settled(body_ids, max_steps, lin_vel_thresh=1e-3, ang_vel_thresh=1e-2,
+                       min_steps=24, settled_steps=12, client_id=0, step_callback=None):
+    """
+    Advance the simulation with p.stepSimulation (not realtime) until all the bodies
+    have come to rest, or until max_steps steps have been taken
+
+    Args:
+        body_ids (list): pybullet body ids to monitor
+        max_steps (int): step budget, e.g. the number of steps in the time we used to sleep for
+        lin_vel_thresh (float): linear speed (m/s) below which a body counts as at rest
+        ang_vel_thresh (float): angular speed (rad/s) below which a body counts as at rest
+        min_steps (int): always take at least this many steps, bodies that were just reset
+            have zero velocity before gravity acts on them
+        settled_steps (int): number of consecutive steps all bodies need to be at rest for
+        step_callback (callable): if given, called with the step index after every step
+
+    Returns:
+        int: number of steps that were taken
+    """
+    body_ids = [body_id for body_id in body_ids if body_id is not None]
+    n_settled = 0
+    for i in range(max_steps):
+        p.stepSimulation(physicsClientId=client_id)
+        if step_callback is not None:
+            step_callback(i)
+        at_rest = True
+        for body_id in body_ids:
+            lin_vel, ang_vel = p.getBaseVelocity(body_id, physicsClientId=client_id)
+            if np.linalg.norm(lin_vel) > lin_vel_thresh or np.linalg.norm(ang_vel) > ang_vel_thresh:
+                at_rest = False
+                break
+        n_settled = n_settled + 1 if at_rest else 0
+        if i + 1 >= min_steps and n_settled >= settled_steps:
+            return i + 1
+    return max_steps
+
 def object_is_still_grasped(robot, obj_id, right_pad_id, left_pad_id):
     obj_finger_right_info = p.getClosestPoints(bodyA=obj_id, bodyB=robot.arm.robot_id, distance=0.002,
                                             linkIndexA=-1, linkIndexB=right_pad_id)
@@ -0,0 +1,72 @@
+"""
+Append-only JSONL files (one JSON record per line), as used for the evaluation results and
+the per-trial metrics. Appends never corrupt the records that are already there: the partial
+last line a killed writer leaves behind is cut off before the next record is written, and
+readers skip it (and any corrupted line) instead of failing.
+"""
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+from loguru import logger
+
+
+def truncate_partial_line(f, block_size: int = 1 << 16) -> None:
+    """
+    Cut the partial last line (from a killed run) off a file opened in binary append mode, so the
+    next record starts on a line of its own instead of being glued onto the partial one
+    """
+    end = f.seek(0, os.SEEK_END)
+    pos = end
+    while pos > 0:
+        start = max(0, pos - block_size)
+        f.seek(start)
+        i = f.read(pos - start).rfind(b'\n')
+        if i >= 0:
+            start += i + 1
+            break
+        pos = start
+    else:
+        start = 0
+    if start < end:
+        f.truncate(start)
+
+
+def append_jsonl(fname: str, record: Dict, fsync: bool = False) -> None:
+    """
+    Append one record as a line of a JSONL file, after removing a partial last line. With fsync,
+    the record is on disk when this returns
+    """
+    with open(fname, 'a+b') as f:
+        truncate_partial_line(f)
+        f.write((json.dumps(record, default=str) + '\n').encode())
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+
+
+def decode_line(fname: str, line: str) -> Optional[Dict]:
+    """Record of one line of fname, or None (with a warning) if the line is corrupted"""
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        logger.warning(f'Skipping a corrupted line of {fname}: {line[:80]!r}')
+        return None
+
+
+def read_jsonl(fname: str) -> List[Dict]:
+    """Records of a JSONL file. A partial last line (from a killed run) and corrupted lines are skipped"""
+    records = []
+    with open(fname, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            record = decode_line(fname, line)
+            if record is not None:
+                records.append(record)
+    return records
+
+
+def load_jsonl(fnames: Sequence[str]) -> List[Dict]:
+    """Records of one or more JSONL files, in order (see read_jsonl)"""
+    return [record for fname in fnames for record in read_jsonl(fname)]
@@ -3,6 +3,7 @@ import pybullet as p
 import threading
 import pickle
 import copy
+from collections import deque
 from urdfpy import URDF
 from os.path import abspath, dirname, basename, splitext
 from transforms3d.affines import decompose
@@ -16,9 +17,38 @@ from meshcat import transformations as mctf
 from airobot import log_info, log_warn, log_debug, log_critical, set_log_level
 
 from rndf_robot.utils.pb2mc.obj2urdf import obj2urdf
+from rndf_robot.utils.pb2mc.recording import PoseTrackRecording
 from rndf_robot.utils import util, path_util
 
 
+class NullVisualizer:
+    """
+    Stand-in for meshcat.Visualizer that drops everything sent to it, so code that
+    visualizes with meshcat can run headless without a meshcat server
+    """
+    def __getitem__(self, path):
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: None
+
+
+def pose_changed(prev_pose, pose, pos_tol, rot_tol):
+    """
+    Check whether a keyframe pose moved by more than pos_tol (in meters) or rotated by more than
+    rot_tol (in radians) from prev_pose. Poses are dicts with 'position' and 'orientation' (xyzw)
+    """
+    if prev_pose is None:
+        return True
+    pos_delta = np.linalg.norm(np.asarray(pose['position']) - np.asarray(prev_pose['position']))
+    # angle between the two orientations, q and -q are the same rotation
+    quat_dot = min(abs(np.dot(pose['orientation'], prev_pose['orientation'])), 1.0)
+    rot_delta = 2 * np.arccos(quat_dot)
+    return pos_delta > pos_tol or rot_delta > rot_tol
+
+
 class PyBulletMeshcat:
     class LinkTracker:
         def __init__(self,
@@ -62,13 +92,46 @@ class PyBulletMeshcat:
                     position=link_state[4], orientation=link_state[5])
             return {'position': list(position), 'orientation': list(orientation)}
 
-    def __init__(self, pb_client=None, tmp_urdf_dir=None):
-        self.client_id = p.connect(p.SHARED_MEMORY, key=p.SHARED_MEMORY_KEY2)
+    def __init__(self, pb_client=None, tmp_urdf_dir=None, headless=False, max_keyframes=1000,
+                 pos_tol=1e-4, rot_tol=1e-3, client_id=None):
+        """
+        Args:
+            headless (bool): If True, nothing is tracked or sent to meshcat (and the update
+                thread shouldn't be started at all)
+            max_keyframes (int): Number of most recent keyframes kept in self.states. None
+                keeps all of them, which grows without bound if add_keyframe is called in a loop
+            pos_tol (float): A link's transform is only sent to meshcat again once it moved by
+                more than this (in meters) since it was last sent
+            rot_tol (float): Same as pos_tol, for the rotation (in radians)
+            client_id (int): Track the bodies through this pybullet client instead of a new shared
+                memory connection. Keyframes then have to be added from the thread using that client
+        """
+        # a headless recorder doesn't track any objects, so it doesn't need a shared
+        # memory connection to the physics server (which DIRECT clients don't have)
+        self.headless = headless
+        if headless:
+            self.client_id = None
+        elif client_id is not None:
+            self.client_id = client_id
+        else:
+            self.client_id = p.connect(p.SHARED_MEMORY, key=p.SHARED_MEMORY_KEY2)
         self.pb_client = p
-        self.states = []
+        self.max_keyframes = max_keyframes
+        self.pos_tol = pos_tol
+        self.rot_tol = rot_tol
+        self.states = deque(maxlen=max_keyframes)
         self.links = []
+        self.links_dict = {}
         self.current_state = None
         self.known_meshcat_objs = []
+        # meshcat name -> pose that was last sent to meshcat
+        self.published_poses = {}
+        # keyframes are also appended to this while recording (see start_recording)
+        self.recording = None
+        # (model path, scaling) -> (urdf path, parsed URDF), and registration args -> link trackers,
+        # so registering a body again (e.g., one reused from a BodyPool) doesn't parse anything
+        self.urdf_cache = {}
+        self.link_tracker_cache = {}
 
         if tmp_urdf_dir is None:
             self.tmp_urdf_dir = osp.join(path_util.get_rndf_obj_descriptions(), 'tmp_urdf')
@@ -92,23 +155,26 @@ class PyBulletMeshcat:
 
     def clear(self):
         self.acq()
-        self.states = []
+        self.states = deque(maxlen=self.max_keyframes)
         self.links = []
         self.links_dict = {}
         self.current_state = None
         self.known_meshcat_objs = []
+        self.published_poses = {}
+        self.rel()
 
     def remove_object(self, body_id, mc_handler):
         self.acq()
         self.meshcat_scene_lock.acquire()
         link_keys = copy.deepcopy(list(self.links_dict.keys()))
         for k in link_keys:
-            if f'{body_id}::' in k:
+            if k.startswith(f'{body_id}::'):
                 link_name = self.links_dict[k].name
                 mc_name = f'scene/{link_name}'
                 if mc_name in self.known_meshcat_objs:
                     self.known_meshcat_objs.remove(mc_name)
                     mc_handler[mc_name].delete()
+                self.published_poses.pop(mc_name, None)
                 del self.links_dict[k]
         self.meshcat_scene_lock.release()
         self.rel()
@@ -129,6 +195,17 @@ class PyBulletMeshcat:
                 into meshcat, whereas the 'collision' version will almost always be compatible,
                 at the loss of some geometric fidelity
         """
+        if self.headless:
+            return
+        scaling_key = None if scaling is None else tuple(np.asarray(scaling, dtype=float).reshape(-1).tolist())
+        tracker_cache_key = (body_id, model_path, scaling_key, global_scaling, link_geom_type)
+        if tracker_cache_key in self.link_tracker_cache:
+            self.links_lock.acquire()
+            for link_dict_key, link_element in self.link_tracker_cache[tracker_cache_key]:
+                self.links_dict[link_dict_key] = link_element
+            self.links_lock.release()
+            return
+
         link_id_map = dict()
         n = self.pb_client.getNumJoints(body_id)
         log_debug(f'[Register Object] Body_id: {body_id}, n: {n}, client_id: {self.client_id}')
@@ -139,17 +216,23 @@ class PyBulletMeshcat:
             for link_id in range(0, n):
                 link_id_map[self.pb_client.getJointInfo(body_id, link_id)[12].decode('gb2312')] = link_id
 
-        if not model_path.endswith('.urdf'):
-            # build a temp URDf if we are passed just a single .obj or .stl file
-            obj_name = model_path.split('/')[-1].split('.')[0]
-            urdf_str, urdf_path = obj2urdf(model_path, obj_name, save_dir=self.tmp_urdf_dir, scaling=scaling)
+        urdf_cache_key = (model_path, scaling_key)
+        if urdf_cache_key in self.urdf_cache:
+            urdf_path, robot = self.urdf_cache[urdf_cache_key]
         else:
-            urdf_path = model_path
+            if not model_path.endswith('.urdf'):
+                # build a temp URDf if we are passed just a single .obj or .stl file
+                obj_name = model_path.split('/')[-1].split('.')[0]
+                urdf_str, urdf_path = obj2urdf(model_path, obj_name, save_dir=self.tmp_urdf_dir, scaling=scaling)
+            else:
+                urdf_path = model_path
+            robot = URDF.load(urdf_path)
+            self.urdf_cache[urdf_cache_key] = (urdf_path, robot)
 
         dir_path = dirname(abspath(urdf_path))
         file_name = splitext(basename(urdf_path))[0]
         log_debug(f'[Register Object] dir_path: {dir_path}, file_name: {file_name}')
-        robot = URDF.load(urdf_path)
+        link_trackers = []
         for link in robot.links:
             link_id = link_id_map[link.name]
             links_to_use = link.visuals if link_geom_type == 'visual' else link.collisions
@@ -194,10 +277,15 @@ class PyBulletMeshcat:
                             pb_client=self.pb_client)
                     link_dict_key = f'{body_id}::{link_id}'
                     self.links_dict[link_dict_key] = link_element
+                    link_trackers.append((link_dict_key, link_element))
                     self.links_lock.release()
+        self.link_tracker_cache[tracker_cache_key] = link_trackers
 
-    def add_keyframe(self):
+    def add_keyframe(self, t=None):
         # Ideally, call every p.stepSimulation()
+        # t is the time of the keyframe in the recording (see PoseTrackRecording.add_keyframe)
+        if self.headless:
+            return
         self.current_state_lock.acquire()
 
         current_state = {}
@@ -209,26 +297,41 @@ class PyBulletMeshcat:
             self.keyframe_lock.release()
         self.links_lock.release()
 
+        # current_state is rebuilt on every call and never modified, so the history can share it
         self.states.append(current_state)
-        self.current_state = copy.deepcopy(current_state)
+        self.current_state = current_state
+        if self.recording is not None:
+            self.recording.add_keyframe(current_state, self.links_dict.values(), t=t)
 
         self.current_state_lock.release()
 
     def update_meshcat_current_state(self, mc_handler):
+        """
+        Send the current state to meshcat. Only the links that moved by more than pos_tol/rot_tol
+        since their transform was last sent (or that are new) are sent
+        """
+        if self.headless:
+            return
         self.current_state_lock.acquire()
         if self.current_state is None:
             log_info('Don"t yet have a current state, please call "add_keyframe()" to get one')
+            self.current_state_lock.release()
             return
         self.links_lock.acquire()
         for link in self.links_dict.values():
             mc_name = f'scene/{link.name}'
+            if link.name not in self.current_state:
+                # registered after the current state was recorded
+                continue
+            link_pose = self.current_state[link.name]
+            if mc_name in self.known_meshcat_objs and \
+                    not pose_changed(self.published_poses.get(mc_name), link_pose, self.pos_tol, self.rot_tol):
+                continue
             obj_file_to_load = link.mesh_path
             mesh_scale = link.mesh_scale
-            obj_pos = self.current_state[link.name]['position']
-            obj_ori = self.current_state[link.name]['orientation']
-            obj_pose_world_np = np.asarray(obj_pos + obj_ori)
+            obj_pose_world_np = np.asarray(link_pose['position'] + link_pose['orientation'])
             log_debug(f'Object name: {link.name}, Object mesh file: {obj_file_to_load}, Object pose world (meshcat): {",".join(list(map(str, obj_pose_world_np.tolist())))}')
-            
+
             self.meshcat_scene_lock.acquire()
             if mc_name not in self.known_meshcat_objs:
                 mc_handler[mc_name].delete()
@@ -236,12 +339,34 @@ class PyBulletMeshcat:
                 mc_handler[mc_name].set_object(mcg.ObjMeshGeometry.from_file(obj_file_to_load))
             mc_mat = np.matmul(util.matrix_from_pose(util.list2pose_stamped(obj_pose_world_np)), util.scale_matrix(mesh_scale))
             mc_handler[mc_name].set_transform(mc_mat)
+            self.published_poses[mc_name] = link_pose
             self.meshcat_scene_lock.release()
         self.links_lock.release()
         self.current_state_lock.release()
 
+    def start_recording(self):
+        """Start recording the keyframes into per-link pose tracks, to replay them later"""
+        self.current_state_lock.acquire()
+        self.recording = PoseTrackRecording()
+        self.current_state_lock.release()
+
+    def stop_recording(self, fname=None):
+        """
+        Stop recording and save the recording to fname (.npz) if given, see
+        rndf_robot.utils.pb2mc.recording for the format and the replay tool
+
+        Returns:
+            PoseTrackRecording: The recording, or None if nothing was being recorded
+        """
+        self.current_state_lock.acquire()
+        recording, self.recording = self.recording, None
+        self.current_state_lock.release()
+        if recording is not None and fname is not None:
+            recording.save(fname)
+        return recording
+
     def reset(self):
-        self.states = []
+        self.states = deque(maxlen=self.max_keyframes)
 
     def get_formatted_output(self):
         retval = {}
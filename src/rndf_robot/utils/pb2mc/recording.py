@@ -0,0 +1,131 @@
+"""
+Offline recordings of the simulator state, to look at in meshcat later instead of
+streaming every keyframe to a meshcat server while the simulation runs.
+
+A recording is a single .npz file with one pose track per link (float32 timestamps and
+float32 [x, y, z, qx, qy, qz, qw] poses) and a JSON manifest with the name, mesh file
+and mesh scale of every link. Replay it with:
+
+    python -m rndf_robot.utils.pb2mc.recording path/to/meshcat_recording.npz
+"""
+import argparse
+import json
+import os, os.path as osp
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import meshcat
+from meshcat import geometry as mcg
+
+from loguru import logger
+
+from rndf_robot.utils import util
+
+
+class PoseTrackRecording:
+    """Per-link pose tracks, appended to with every keyframe of a PyBulletMeshcat recorder"""
+    def __init__(self):
+        # time of the first keyframe, the times of the tracks are relative to it
+        self.start_time = None
+        # link name -> dict(mesh_path, mesh_scale, times, poses)
+        self.tracks: Dict[str, Dict] = {}
+
+    def add_keyframe(self, state: Dict[str, Dict], links: Iterable, t: Optional[float] = None) -> None:
+        """
+        Args:
+            state (dict): Keyframe from PyBulletMeshcat.add_keyframe, link name -> pose
+            links (iterable): The PyBulletMeshcat.LinkTracker's in the keyframe
+            t (float): Time of the keyframe in seconds, e.g. the simulated time when the physics
+                is stepped. Defaults to the wall clock. Use the same clock for all the keyframes
+        """
+        if t is None:
+            t = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = t
+        t = t - self.start_time
+        for link in links:
+            if link.name not in state:
+                continue
+            track = self.tracks.get(link.name)
+            if track is None:
+                track = dict(mesh_path=link.mesh_path, mesh_scale=np.asarray(link.mesh_scale).tolist(),
+                             times=[], poses=[])
+                self.tracks[link.name] = track
+            track['times'].append(t)
+            track['poses'].append(state[link.name]['position'] + state[link.name]['orientation'])
+
+    def save(self, fname: str) -> None:
+        """Write the recording to fname (.npz), through a temporary file so it is never partial"""
+        manifest = []
+        arrays = {}
+        for i, (name, track) in enumerate(self.tracks.items()):
+            manifest.append(dict(name=name, mesh_path=track['mesh_path'], mesh_scale=track['mesh_scale']))
+            arrays[f'times_{i}'] = np.asarray(track['times'], dtype=np.float32)
+            arrays[f'poses_{i}'] = np.asarray(track['poses'], dtype=np.float32).reshape(-1, 7)
+        tmp_fname = f'{fname}.tmp.{os.getpid()}.npz'
+        np.savez_compressed(tmp_fname, manifest=json.dumps(manifest), **arrays)
+        os.replace(tmp_fname, fname)
+
+
+def load_recording(fname: str) -> Dict[str, Dict]:
+    """
+    Load a recording saved with PoseTrackRecording.save
+
+    Returns:
+        dict: link name -> dict with the mesh_path, mesh_scale, times (T,) and poses (T x 7)
+    """
+    data = np.load(fname)
+    manifest = json.loads(str(data['manifest']))
+    return {
+        entry['name']: dict(mesh_path=entry['mesh_path'], mesh_scale=entry['mesh_scale'],
+                            times=data[f'times_{i}'], poses=data[f'poses_{i}'])
+        for i, entry in enumerate(manifest)
+    }
+
+
+def replay_recording(mc_vis, recording: Dict[str, Dict], speed: float = 1.0, prefix: str = 'scene') -> None:
+    """
+    Play a recording back in meshcat. The keyframes are sent in time order, at speed times
+    the recorded rate (as fast as possible if speed <= 0)
+    """
+    frames = []
+    for name, track in recording.items():
+        mc_name = f'{prefix}/{name}'
+        mc_vis[mc_name].delete()
+        mc_vis[mc_name].set_object(mcg.ObjMeshGeometry.from_file(track['mesh_path']))
+        frames.extend((float(t), name, i) for i, t in enumerate(track['times']))
+    frames.sort(key=lambda frame: frame[0])
+
+    replay_start_time = time.perf_counter()
+    for t, name, i in frames:
+        if speed > 0:
+            wait = t / speed - (time.perf_counter() - replay_start_time)
+            if wait > 0:
+                time.sleep(wait)
+        track = recording[name]
+        pose_mat = util.matrix_from_pose(util.list2pose_stamped(track['poses'][i].astype(np.float64).tolist()))
+        mc_vis[f'{prefix}/{name}'].set_transform(np.matmul(pose_mat, util.scale_matrix(track['mesh_scale'])))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Replay a simulator recording in meshcat')
+    parser.add_argument('recording', type=str, help='Path to a meshcat_recording.npz file')
+    parser.add_argument('--zmq_url', type=str, default='tcp://127.0.0.1:6000')
+    parser.add_argument('--speed', type=float, default=1.0, help='Playback speed, <= 0 plays as fast as possible')
+    parser.add_argument('--loop', action='store_true', help='Keep replaying the recording')
+    args = parser.parse_args(argv)
+
+    assert osp.exists(args.recording), f'Recording {args.recording} does not exist'
+    recording = load_recording(args.recording)
+    logger.info(f'Replaying {len(recording)} links from {args.recording}')
+    mc_vis = meshcat.Visualizer(zmq_url=args.zmq_url)
+    mc_vis['scene'].delete()
+    while True:
+        replay_recording(mc_vis, recording, speed=args.speed)
+        if not args.loop:
+            break
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Lightweight per-trial instrumentation for the evaluation runs: wall clock spans around the
+phases of a trial, plus the peak memory and CPU/thread utilization of the process.
+
+Each trial gets a TrialProfiler, the phases are timed with its span context manager, and
+the trial's record (see TrialProfiler.record) is appended to a JSONL file. Summarize one or
+more of those files (e.g., the files of parallel workers) with:
+
+    python -m rndf_robot.utils.profiling eval_dir/trial_metrics*.jsonl
+"""
+import argparse
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from rndf_robot.utils.jsonl import load_jsonl
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, peak RSS is reported as None there
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process so far, in MB"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return max_rss / (1024 ** 2) if sys.platform == 'darwin' else max_rss / 1024
+
+
+class TrialProfiler:
+    """
+    Accumulates the durations of named spans of one trial into stage_times (name -> seconds,
+    spans with the same name add up), and measures the process' CPU time over the trial.
+
+    Spans can be opened from several threads at once (e.g., the optimization thread of
+    --pipeline). CPU time and peak RSS are process wide, so with overlapping trials they
+    include the work on the other trials in flight.
+
+    Args:
+        sync_cuda (bool): Wait for the queued CUDA kernels before closing a span, so GPU work
+            is attributed to the span that launched it (this slows things down a bit). Torch is
+            only imported for this, processes that don't use it can be profiled without it
+    """
+    def __init__(self, stage_times: Optional[Dict[str, float]] = None, sync_cuda: bool = False):
+        self.stage_times = {} if stage_times is None else stage_times
+        self._cuda = None
+        if sync_cuda:
+            import torch
+            if torch.cuda.is_available():
+                self._cuda = torch.cuda
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    def add(self, name: str, duration: float) -> None:
+        with self._lock:
+            self.stage_times[name] = self.stage_times.get(name, 0.0) + duration
+
+    @contextmanager
+    def span(self, name: str):
+        """Context manager that adds the time spent in its body to stage name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self._cuda is not None:
+                self._cuda.synchronize()
+            self.add(name, time.perf_counter() - start)
+
+    def resources(self) -> Dict:
+        """Wall time, CPU time and utilization since the profiler was created, and the current thread counts"""
+        wall_time = time.perf_counter() - self._start_wall
+        cpu_time = time.process_time() - self._start_cpu
+        return dict(
+            wall_time=wall_time,
+            cpu_time=cpu_time,
+            # average number of busy cores
+            cpu_util=cpu_time / max(wall_time, 1e-9),
+            python_threads=threading.active_count(),
+            # None if the process doesn't use torch
+            torch_threads=sys.modules['torch'].get_num_threads() if 'torch' in sys.modules else None,
+            peak_rss_mb=peak_rss_mb(),
+        )
+
+    def record(self, **extra) -> Dict:
+        """JSON serializable record of the trial, with the stage times, resources and the extra fields"""
+        with self._lock:
+            stage_times = dict(self.stage_times)
+        return dict(extra, start_time=self.start_time, end_time=time.time(),
+                    stage_times=stage_times, **self.resources())
+
+
+@contextmanager
+def maybe_span(profiler: Optional[TrialProfiler], name: str):
+    """profiler.span(name), or nothing if there is no profiler"""
+    if profiler is None:
+        yield
+    else:
+        with profiler.span(name):
+            yield
+
+
+def format_stage_times(stage_times_list: Sequence[Dict[str, float]], wall_time: float) -> str:
+    """
+    Summarize the per-trial stage durations. Nested spans (e.g., setup/capture inside setup)
+    are counted in their parent stage too, and when stages overlap (--pipeline, several
+    workers) the total time spent in the stages is larger than the wall time
+    """
+    stages = []
+    for stage_times in stage_times_list:
+        stages += [stage for stage in stage_times if stage not in stages]
+    width = max([14] + [len(stage) for stage in stages])
+    lines = [f'{"stage":<{width}s} | {"mean (s)":>9s} | {"p95 (s)":>9s} | {"max (s)":>9s} | {"total (s)":>9s} | {"% of wall":>9s}']
+    for stage in stages:
+        times = [stage_times[stage] for stage_times in stage_times_list if stage in stage_times]
+        lines.append(
+            f'{stage:<{width}s} | {np.mean(times):9.2f} | {np.percentile(times, 95):9.2f} | {np.max(times):9.2f} | '
+            f'{np.sum(times):9.2f} | {100 * np.sum(times) / max(wall_time, 1e-9):9.1f}')
+    lines.append(f'{len(stage_times_list)} trials in {wall_time:.2f}s')
+    return '\n'.join(lines)
+
+
+def format_trial_records(records: Sequence[Dict], wall_time: Optional[float] = None) -> str:
+    """
+    Summary table of trial records (see TrialProfiler.record): the stage times, then the
+    resource usage. The wall time defaults to the span from the first trial start to the last trial end
+    """
+    if len(records) == 0:
+        return 'No trials'
+    if wall_time is None:
+        wall_time = max(r['end_time'] for r in records) - min(r['start_time'] for r in records)
+    lines = [format_stage_times([r['stage_times'] for r in records], wall_time)]
+    cpu_util = [r['cpu_util'] for r in records]
+    lines.append(f'CPU utilization (busy cores): mean {np.mean(cpu_util):.2f}, max {np.max(cpu_util):.2f}')
+    torch_threads = [r['torch_threads'] for r in records if r.get('torch_threads') is not None]
+    lines.append(f'Threads: python max {max(r["python_threads"] for r in records)}'
+                 + (f', torch {max(torch_threads)}' if len(torch_threads) > 0 else ''))
+    peak_rss = [r['peak_rss_mb'] for r in records if r.get('peak_rss_mb') is not None]
+    if len(peak_rss) > 0:
+        lines.append(f'Peak RSS: {np.max(peak_rss):.0f} MB')
+    return '\n'.join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description='Summarize the per-trial metrics of evaluation runs')
+    parser.add_argument('metrics', type=str, nargs='+', help='trial_metrics*.jsonl files')
+    args = parser.parse_args(argv)
+    print(format_trial_records(load_jsonl(args.metrics)))
+
+
+if __name__ == '__main__':
+    main()
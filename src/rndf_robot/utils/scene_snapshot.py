@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Dict
+
+import pybullet as p
+
+
+class SceneSnapshots:
+    """
+    Named in-memory snapshots of a pybullet scene, taken with p.saveState and restored with
+    p.restoreState. A snapshot holds the poses and velocities of all the bodies (and the
+    contact cache), so several checks can branch off the exact same scene state instead of
+    resetting the bodies back to their start poses one by one.
+
+    Snapshots don't add or remove bodies or constraints: the scene needs to contain the same
+    bodies when a snapshot is restored, and constraints have to be handled by the caller.
+    """
+    def __init__(self, client_id: int = 0):
+        self.client_id = client_id
+        # name -> pybullet state id
+        self._states: Dict[str, int] = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._states
+
+    def save(self, name: str) -> int:
+        """Snapshot the current state as name (replacing an older snapshot with that name)"""
+        self.remove(name)
+        self._states[name] = p.saveState(physicsClientId=self.client_id)
+        return self._states[name]
+
+    def restore(self, name: str) -> None:
+        """Put the scene back into the state of snapshot name"""
+        assert name in self._states, f'No snapshot named {name}'
+        p.restoreState(stateId=self._states[name], physicsClientId=self.client_id)
+
+    def remove(self, name: str) -> None:
+        state_id = self._states.pop(name, None)
+        if state_id is not None:
+            p.removeState(state_id, physicsClientId=self.client_id)
+
+    def clear(self) -> None:
+        for name in list(self._states.keys()):
+            self.remove(name)
+
+    @contextmanager
+    def branch(self, name: str):
+        """Context manager that starts a branch from snapshot name"""
+        self.restore(name)
+        yield
+
+    def run_branches(self, name: str, checks: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+        """
+        Run each check (in order) on the scene as it was in snapshot name
+
+        Returns:
+            dict: check name -> what the check returned
+        """
+        results = {}
+        for check_name, check in checks.items():
+            with self.branch(name):
+                results[check_name] = check()
+        return results
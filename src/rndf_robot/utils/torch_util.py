@@ -17,6 +17,30 @@ def transform_pcd_torch(pcd, transform):
     return pcd_new
 
 
+def pad_point_clouds(pcds, num_points=None):
+    """
+    Stack point clouds with different numbers of points into a padded batch
+
+    Args:
+        pcds (list): List of N_i x 3 torch.Tensor point clouds
+        num_points (int): Size to pad to, defaults to the largest N_i
+
+    Returns:
+        2-element tuple containing
+        - torch.Tensor: B x N x 3 padded point clouds (padding is zeros)
+        - torch.Tensor: B x N bool mask, True for valid points
+    """
+    if num_points is None:
+        num_points = max([pcd.size(0) for pcd in pcds])
+    padded = pcds[0].new_zeros((len(pcds), num_points, pcds[0].size(-1)))
+    mask = torch.zeros((len(pcds), num_points), dtype=torch.bool, device=pcds[0].device)
+    for i, pcd in enumerate(pcds):
+        n = min(pcd.size(0), num_points)
+        padded[i, :n] = pcd[:n]
+        mask[i, :n] = True
+    return padded, mask
+
+
 EPS = 1e-8
 
 
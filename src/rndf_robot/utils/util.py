@@ -89,7 +89,8 @@ def np2img(np_array, img_file):
 
 def safe_makedirs(dirname):
     if not osp.exists(dirname):
-        os.makedirs(dirname)
+        # exist_ok, in case another process creates it in the meantime
+        os.makedirs(dirname, exist_ok=True)
 
 
 def rand_high_low(bounds):
@@ -731,7 +732,7 @@ def body_world_yaw(current_pose, theta=None):
     return new_pose
 
 
-def rand_body_yaw_transform(pos, min_theta=0.0, max_theta=2*np.pi):
+def rand_body_yaw_transform(pos, min_theta=0.0, max_theta=2*np.pi, rng=None):
     """Given some initial position, sample a Transform that is
     a pure yaw about the world frame orientation, with
     the origin at the current pose position
@@ -740,6 +741,8 @@ def rand_body_yaw_transform(pos, min_theta=0.0, max_theta=2*np.pi):
         pos (np.ndarray): Current position in the world frame 
         min (float, optional): Minimum boundary for sample
         max (float, optional): Maximum boundary for sample
+        rng (np.random.RandomState, optional): Random number generator to sample
+            with, defaults to the global numpy one
 
     Returns:
         np.ndarray: Transformation matrix
@@ -747,7 +750,9 @@ def rand_body_yaw_transform(pos, min_theta=0.0, max_theta=2*np.pi):
     if isinstance(pos, list):
         pos = np.asarray(pos)    
     trans_to_origin = pos
-    theta = np.random.random() * (max_theta - min_theta) + min_theta
+    if rng is None:
+        rng = np.random
+    theta = rng.random_sample() * (max_theta - min_theta) + min_theta
     yaw = R.from_euler('xyz', [0, 0, theta]).as_matrix()[:3, :3]
 
     # translate the source to the origin
@@ -0,0 +1,23 @@
+import pytest
+
+
+def _peak_cpu_memory(fn):
+    import torch
+
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+        out = fn()
+    # count what an op allocates when it starts, and what it frees when it ends
+    deltas = sorted((e.time_range.start if e.self_cpu_memory_usage > 0 else e.time_range.end, e.self_cpu_memory_usage)
+                    for e in prof.function_events)
+    current = peak = 0
+    for _, delta in deltas:
+        current += delta
+        peak = max(peak, current)
+    del out
+    return peak
+
+
+@pytest.fixture
+def peak_cpu_memory():
+    """Function returning the peak CPU memory (in bytes) allocated by torch while running fn, as recorded by the profiler."""
+    return _peak_cpu_memory
@@ -0,0 +1,71 @@
+import json
+import os
+import shutil
+
+import pybullet_data
+import pytest
+
+from rndf_robot.data_gen.precompute_vhacd import (
+    decomposed_path, get_decomposed, load_manifest, manifest_key, precompute, source_mesh_files, VHACD_PARAMS)
+
+
+# low resolution, so the test runs quickly
+_PARAMS = dict(VHACD_PARAMS, resolution=10000)
+
+
+@pytest.fixture
+def mesh_dir(tmp_path):
+    # one flat mesh and one in the ShapeNet layout
+    shutil.copy(os.path.join(pybullet_data.getDataPath(), 'duck.obj'), tmp_path / 'duck.obj')
+    os.makedirs(tmp_path / 'duck_2' / 'models')
+    shutil.copy(os.path.join(pybullet_data.getDataPath(), 'duck.obj'), tmp_path / 'duck_2' / 'models' / 'model_normalized.obj')
+    return tmp_path
+
+
+def test_precompute_and_manifest(mesh_dir):
+    mesh_files = source_mesh_files(str(mesh_dir))
+    assert sorted(mesh_files) == [str(mesh_dir / 'duck.obj'), str(mesh_dir / 'duck_2' / 'models' / 'model_normalized.obj')]
+
+    manifest_path = str(mesh_dir / 'vhacd_manifest.json')
+    with pytest.raises(FileNotFoundError):
+        get_decomposed(mesh_files[0])
+
+    root = str(mesh_dir)
+    manifest = precompute(mesh_files, manifest_path, num_workers=2, params=_PARAMS, root=root)
+    assert load_manifest(manifest_path, root) == manifest
+    assert sorted(manifest.keys()) == ['duck.obj', 'duck_2/models/model_normalized.obj']
+    for obj_file in mesh_files:
+        entry = manifest[manifest_key(obj_file, root)]
+        assert entry['output'] == manifest_key(decomposed_path(obj_file), root)
+        assert os.path.exists(os.path.join(root, entry['output']))
+        assert entry['params'] == _PARAMS
+        assert len(entry['extents']) == 3 and len(entry['bounds']) == 2
+        assert get_decomposed(obj_file, manifest, root=root) == decomposed_path(obj_file)
+    # no temporary files are left behind
+    assert not [fn for fn in os.listdir(mesh_dir) if '.tmp.' in fn]
+    # decomposed meshes aren't picked up as sources
+    assert len(source_mesh_files(str(mesh_dir))) == 2
+
+    # nothing to do the second time
+    mtime = os.path.getmtime(decomposed_path(mesh_files[0]))
+    precompute(mesh_files, manifest_path, num_workers=2, params=_PARAMS, root=root)
+    assert os.path.getmtime(decomposed_path(mesh_files[0])) == mtime
+
+    # the manifest is still valid after moving the directory
+    moved = str(mesh_dir.parent / 'moved')
+    shutil.move(root, moved)
+    moved_manifest = load_manifest(os.path.join(moved, 'vhacd_manifest.json'), moved)
+    for obj_file in source_mesh_files(moved):
+        assert get_decomposed(obj_file, moved_manifest, root=moved) == decomposed_path(obj_file)
+
+
+def test_load_manifest_with_absolute_paths(tmp_path):
+    """Test that manifests written with absolute paths are read with relative ones."""
+    obj_file = str(tmp_path / 'duck.obj')
+    entry = dict(source=obj_file, output=decomposed_path(obj_file), source_sha256='0', params=_PARAMS)
+    with open(tmp_path / 'vhacd_manifest.json', 'w') as f:
+        json.dump({obj_file: entry}, f)
+
+    manifest = load_manifest(str(tmp_path / 'vhacd_manifest.json'), str(tmp_path))
+    assert list(manifest.keys()) == ['duck.obj']
+    assert manifest['duck.obj']['source'] == 'duck.obj' and manifest['duck.obj']['output'] == 'duck_dec.obj'
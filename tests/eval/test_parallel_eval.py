@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from rndf_robot.eval.parallel_eval import merge_worker_results, shard_trials, supervise_workers
+from rndf_robot.eval.results_store import append_result, read_results, results_fname
+
+
+def test_shards_cover_all_trials_once():
+    """Test that the worker shards are disjoint and together contain every trial."""
+    shards = [shard_trials(3, 20, 4, worker_id) for worker_id in range(4)]
+    all_trials = sorted(t for shard in shards for t in shard)
+    assert all_trials == list(range(3, 20))
+
+
+def _write_trial(eval_dir, iteration, place_success, worker_id):
+    append_result(results_fname(eval_dir, worker_id), dict(
+        time=float(iteration), trial=iteration, worker_id=worker_id, place_success=place_success,
+        success_criteria={"touching_surf": place_success}))
+
+
+def test_merge_worker_results(tmp_path):
+    """Test that merging writes the results of all workers into results.jsonl, in trial order."""
+    eval_dir = str(tmp_path)
+    # trials 0 and 2 from one worker, 1 and 3 from another
+    for iteration, success in enumerate([True, False, True, True]):
+        _write_trial(eval_dir, iteration, success, worker_id=iteration % 2)
+
+    merged = merge_worker_results(eval_dir, range(5))
+
+    assert merged["trials"] == [0, 1, 2, 3]
+    assert merged["place_success_list"] == [True, False, True, True]
+    assert merged["success_rate"] == 0.75
+    records = read_results(results_fname(eval_dir))
+    assert [record["trial"] for record in records] == [0, 1, 2, 3]
+
+
+_FAKE_WORKER = """
+import os, sys
+args = sys.argv[1:]
+assert '--pybullet_viz' not in args
+worker_id = int(args[args.index('--worker_id') + 1])
+status_f = os.fdopen(int(args[args.index('--status_fd') + 1]), 'w', buffering=1)
+eval_dir = args[args.index('--eval_dir') + 1]
+status_f.write('ready\\n')
+for line in sys.stdin:
+    for iteration in map(int, line.split()):
+        status_f.write(f'start {iteration}\\n')
+        marker = os.path.join(eval_dir, f'attempted_{iteration}')
+        first_attempt = not os.path.exists(marker)
+        open(marker, 'a').write(str(worker_id))
+        if iteration == 2 and first_attempt:
+            # hang once
+            import time; time.sleep(60)
+        if iteration == 3:
+            # crash every time
+            os.abort()
+        status_f.write(f'done {iteration}\\n')
+"""
+
+
+def test_supervise_workers(tmp_path):
+    """Test that hung and crashed workers are replaced, and that failing trials are retried a bounded number of times."""
+    script = tmp_path / "worker.py"
+    script.write_text(_FAKE_WORKER)
+    eval_dir = tmp_path / "eval"
+    eval_dir.mkdir()
+
+    supervised = supervise_workers(
+        str(script), ["--pybullet_viz", "--eval_dir", str(eval_dir)], range(6), 2, log_dir=str(tmp_path),
+        eval_save_dir=str(eval_dir), trial_timeout=2.0, max_retries=1)
+
+    assert supervised["done"] == [0, 1, 2, 4, 5]
+    assert supervised["failed"] == [3]
+    # trial 3 ran once and was retried once
+    assert len((eval_dir / "attempted_3").read_text()) == 2
+    for worker_id in range(2):
+        assert (tmp_path / f"worker_{worker_id}.log").exists()
+
+
+def test_supervise_workers_gives_up_on_broken_workers(tmp_path):
+    script = tmp_path / "worker.py"
+    script.write_text("import sys; sys.exit(1)\n")
+    with pytest.raises(RuntimeError, match="failed to start"):
+        supervise_workers(str(script), [], range(3), 2, log_dir=str(tmp_path), eval_save_dir=str(tmp_path),
+                          max_retries=1)
+
+
+def test_supervise_workers_stops_the_other_workers_when_giving_up(tmp_path):
+    """Test that the workers still running when the supervisor gives up are killed, not left behind."""
+    script = tmp_path / "worker.py"
+    script.write_text(
+        "import os, sys, time\n"
+        "worker_id = int(sys.argv[sys.argv.index('--worker_id') + 1])\n"
+        "if worker_id == 0:\n"
+        "    sys.exit(1)\n"
+        f"open({str(tmp_path / 'pids')!r}, 'a').write(f'{{os.getpid()}}\\n')\n"
+        "time.sleep(600)\n")
+    with pytest.raises(RuntimeError, match="failed to start"):
+        supervise_workers(str(script), [], range(3), 2, log_dir=str(tmp_path), eval_save_dir=str(tmp_path),
+                          max_retries=1)
+
+    for pid in map(int, (tmp_path / "pids").read_text().split()):
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
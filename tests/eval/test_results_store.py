@@ -0,0 +1,75 @@
+import os
+
+from rndf_robot.eval.results_store import ResultsIndex, append_result, load_run_results, merge_results, results_fname
+
+
+def _record(trial, place_success, exp="mug_on_rack", time=None, **kwargs):
+    return dict(time=float(trial) if time is None else time, exp=exp, trial=trial, parent_class="syn_rack_easy",
+                child_class="mug", place_success=place_success, **kwargs)
+
+
+def _run_dir(root, name):
+    run_dir = os.path.join(str(root), name)
+    os.makedirs(os.path.join(run_dir, "trial_0"))
+    return run_dir
+
+
+def test_restarted_trials_keep_newest_record(tmp_path):
+    """Test that a trial recorded again (e.g., by a restarted run) is read with its newest record."""
+    fname = results_fname(str(tmp_path))
+    append_result(fname, _record(0, False, time=1.0))
+    append_result(fname, _record(1, True, time=2.0))
+    append_result(fname, _record(0, True, time=3.0))
+    with open(fname, "a") as f:
+        f.write('{"trial": 2, "place')
+
+    records = load_run_results(str(tmp_path))
+    assert [(r["trial"], r["place_success"]) for r in records] == [(0, True), (1, True)]
+
+
+def test_append_after_partial_line(tmp_path):
+    """Test that a record appended after a killed run's partial line is not glued onto it."""
+    fname = results_fname(str(tmp_path))
+    append_result(fname, _record(0, True))
+    with open(fname, "a") as f:
+        f.write('{"trial": 1, "pla')
+    append_result(fname, _record(1, False))
+    assert [r["trial"] for r in load_run_results(str(tmp_path))] == [0, 1]
+
+    # lines that were glued together before are skipped, they don't break reading the rest
+    with open(fname, "a") as f:
+        f.write('{"trial": 2, "pla{"trial": 2, "place_success": true}\n')
+    append_result(fname, _record(3, True))
+    assert [r["trial"] for r in load_run_results(str(tmp_path))] == [0, 1, 3]
+
+    index = ResultsIndex(str(tmp_path / "index.sqlite"))
+    assert index.update([str(tmp_path)]) == 3
+    index.close()
+
+
+def test_index_is_incremental(tmp_path):
+    """Test that updating the index only reads appended records, and that queries aggregate over runs."""
+    run_a = _run_dir(tmp_path, "a")
+    run_b = _run_dir(tmp_path, "b")
+    for trial, success in enumerate([True, False, True, True]):
+        append_result(results_fname(run_a), _record(trial, success))
+    append_result(results_fname(run_b, worker_id=0), _record(0, False, exp="bowl_on_mug"))
+
+    index = ResultsIndex(str(tmp_path / "index.sqlite"))
+    assert index.update([str(tmp_path)]) == 5
+    assert index.update([str(tmp_path)]) == 0
+
+    append_result(results_fname(run_b, worker_id=1), _record(1, True, exp="bowl_on_mug"))
+    assert index.update([str(tmp_path)]) == 1
+
+    rows = {row["exp"]: row for row in index.query(["exp"])}
+    assert rows["mug_on_rack"]["n_trials"] == 4 and rows["mug_on_rack"]["success_rate"] == 0.75
+    assert rows["bowl_on_mug"]["n_trials"] == 2 and rows["bowl_on_mug"]["success_rate"] == 0.5
+    assert [row["exp"] for row in index.query(["exp"], where={"exp": "bowl_*"})] == ["bowl_on_mug"]
+
+    # merging the worker files replaces results.jsonl, the trials are not counted twice
+    merge_results(run_b, range(2))
+    assert index.update([str(tmp_path)]) == 2
+    rows = {row["exp"]: row for row in index.query(["exp"])}
+    assert rows["bowl_on_mug"]["n_trials"] == 2
+    index.close()
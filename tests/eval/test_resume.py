@@ -0,0 +1,69 @@
+import os
+
+from rndf_robot.eval.results_store import append_result, results_fname
+from rndf_robot.eval.resume import (
+    clean_unfinished_trials,
+    finalize_trial_dir,
+    load_completed_trials,
+    partial_trial_dir,
+    trial_dir,
+)
+
+
+def _run_trial(eval_dir, iteration, finalize=True, record=True, crash_while_recording=False):
+    os.makedirs(partial_trial_dir(eval_dir, iteration))
+    with open(os.path.join(partial_trial_dir(eval_dir, iteration), "out.txt"), "w") as f:
+        f.write(str(iteration))
+    if finalize:
+        finalize_trial_dir(eval_dir, iteration)
+    if crash_while_recording:
+        with open(results_fname(eval_dir), "a") as f:
+            f.write('{"time": %d.0, "trial": %d, "pla' % (iteration, iteration))
+    elif record:
+        append_result(results_fname(eval_dir), dict(time=float(iteration), trial=iteration, place_success=True))
+
+
+def test_interrupted_trials_are_cleaned_up(tmp_path):
+    """Test that only recorded trials count as completed, and that the outputs of the others are removed."""
+    eval_dir = str(tmp_path)
+    _run_trial(eval_dir, 0)
+    _run_trial(eval_dir, 1)
+    # crashed after moving the folder, before recording the trial
+    _run_trial(eval_dir, 2, record=False)
+    # crashed while writing the outputs
+    _run_trial(eval_dir, 3, finalize=False, record=False)
+
+    completed = load_completed_trials(eval_dir)
+    assert completed == {0, 1}
+    removed = clean_unfinished_trials(eval_dir, range(5), completed)
+
+    assert sorted(removed) == sorted([trial_dir(eval_dir, 2), partial_trial_dir(eval_dir, 3)])
+    assert sorted(os.listdir(eval_dir)) == ["results.jsonl", "trial_0", "trial_1"]
+
+
+def test_finalize_replaces_earlier_run(tmp_path):
+    eval_dir = str(tmp_path)
+    _run_trial(eval_dir, 0)
+    os.makedirs(partial_trial_dir(eval_dir, 0))
+    finalize_trial_dir(eval_dir, 0)
+
+    assert os.listdir(trial_dir(eval_dir, 0)) == []
+    assert not os.path.exists(partial_trial_dir(eval_dir, 0))
+
+
+def test_crash_while_recording_twice(tmp_path):
+    """Test that a run killed while recording a trial can be resumed, also after being killed that way again."""
+    eval_dir = str(tmp_path)
+    _run_trial(eval_dir, 0)
+    _run_trial(eval_dir, 1, crash_while_recording=True)
+
+    for crashed_trial in [1, 2]:
+        completed = load_completed_trials(eval_dir)
+        assert completed == set(range(crashed_trial))
+        assert clean_unfinished_trials(eval_dir, range(4), completed) == [trial_dir(eval_dir, crashed_trial)]
+        _run_trial(eval_dir, crashed_trial)
+        _run_trial(eval_dir, crashed_trial + 1, crash_while_recording=crashed_trial == 1)
+
+    assert load_completed_trials(eval_dir) == {0, 1, 2, 3}
+    with open(results_fname(eval_dir)) as f:
+        assert len(f.readlines()) == 4
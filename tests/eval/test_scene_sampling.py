@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('airobot')
+if 'RNDF_SOURCE_DIR' not in os.environ:
+    pytest.skip('needs RNDF_SOURCE_DIR (source rndf_env.sh)', allow_module_level=True)
+
+from rndf_robot.config.default_eval_cfg import get_eval_cfg_defaults
+from rndf_robot.eval.seeding import trial_rngs
+from rndf_robot.eval.scene_sampling import PCL, make_pc_master_dict, sample_object, sample_object_ids
+
+
+class _FakeDemo(dict):
+    def __init__(self, parent_id, child_id):
+        super().__init__(
+            multi_object_ids=np.array(dict(parent=parent_id, child=child_id), dtype=object),
+            multi_obj_start_obj_pose=np.array(dict(parent=[0.5, 0.2, 1.0, 0, 0, 0, 1], child=[0.5, -0.2, 1.0, 0, 0, 0, 1]),
+                                              dtype=object))
+
+
+def _sample_trial(pc_master_dict, seed, iteration):
+    np_rng, py_rng = trial_rngs(seed, iteration, stream=0)
+    parent_id, child_id = sample_object_ids(pc_master_dict, 0, False, py_rng)
+    objects = {pc: sample_object(pc, pc_master_dict, f'{pc}.obj', f'{pc}_dec.obj', 0, 1.0, rand_mesh_scale=True,
+                                 np_rng=np_rng, py_rng=py_rng) for pc in PCL}
+    return parent_id, child_id, objects
+
+
+def test_trials_are_sampled_deterministically():
+    """Test that a trial gets the same scene from its seed, and that the objects are in their ranges."""
+    cfg = get_eval_cfg_defaults()
+    pc_master_dict = make_pc_master_dict('syn_rack_easy', 'mug', 'random_upright', 'any_pose', cfg, [_FakeDemo('rack', 'mug')])
+    assert pc_master_dict['parent']['demo_ids'] == ['rack']
+
+    parent_id, child_id, objects = _sample_trial(pc_master_dict, 0, 3)
+    assert (parent_id, child_id, objects) == _sample_trial(pc_master_dict, 0, 3)
+    assert _sample_trial(pc_master_dict, 0, 4) != (parent_id, child_id, objects)
+    assert parent_id in pc_master_dict['parent']['test_ids'] and child_id in pc_master_dict['child']['test_ids']
+
+    for pc, obj in objects.items():
+        scale_high, scale_low = pc_master_dict[pc]['scale_hl']
+        assert scale_low <= obj['mesh_scale'][0] <= scale_high
+        y_high, y_low = pc_master_dict[pc]['yhl']
+        assert y_low <= obj['pos'][1] <= y_high
+        assert obj['pos'][2] == pytest.approx(1.0)
+    # racks are always constrained, children loaded in any pose too
+    assert objects['parent']['constrain'] and objects['child']['constrain']
+
+
+def test_demo_pose():
+    cfg = get_eval_cfg_defaults()
+    pc_master_dict = make_pc_master_dict('syn_rack_easy', 'mug', 'demo_pose', 'demo_pose', cfg, [_FakeDemo('rack', 'mug')])
+    assert sample_object_ids(pc_master_dict, 0, True) == ('rack', 'mug')
+    obj = sample_object('child', pc_master_dict, 'mug.obj', 'mug_dec.obj', 0, 1.0)
+    assert obj['pos'] == [0.5, -0.2, 1.0] and obj['mesh_scale'] == [0.3] * 3
+    assert not obj['constrain']
@@ -0,0 +1,39 @@
+import random
+import subprocess
+import sys
+
+import numpy as np
+
+from rndf_robot.eval.seeding import seed_trial, trial_rngs, trial_seed
+
+
+def test_trial_seed_depends_only_on_seed_and_trial():
+    assert trial_seed(0, 5) == trial_seed(0, 5)
+    assert trial_seed(0, 5) != trial_seed(0, 6)
+    assert trial_seed(0, 5) != trial_seed(1, 5)
+    assert trial_seed(0, 5, stream=0) != trial_seed(0, 5, stream=1)
+
+
+def test_trial_rngs_match_reseeded_globals():
+    """Test that the per-trial generators draw the same numbers as the reseeded global generators."""
+    np_rng, py_rng = trial_rngs(3, 7)
+    local_draws = (np_rng.random_sample(), np_rng.rand(2).tolist(), py_rng.random(), py_rng.sample(range(100), 1))
+
+    seed_trial(3, 7)
+    global_draws = (np.random.random(), np.random.rand(2).tolist(), random.random(), random.sample(range(100), 1))
+
+    assert local_draws == global_draws
+
+
+def test_sampling_and_supervision_dont_import_torch():
+    """Test that the seeding, the worker supervision and the profiler (without sync_cuda) don't load torch."""
+    code = (
+        "import sys\n"
+        "from rndf_robot.eval.seeding import trial_rngs\n"
+        "from rndf_robot.eval.parallel_eval import supervise_workers\n"
+        "from rndf_robot.utils.profiling import TrialProfiler\n"
+        "trial_rngs(0, 1)\n"
+        "record = TrialProfiler().record(trial=1)\n"
+        "assert record['torch_threads'] is None\n"
+        "assert 'torch' not in sys.modules, 'torch was imported'\n")
+    subprocess.run([sys.executable, "-c", code], check=True)
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from rndf_robot.model.vnn_occupancy_net_pointnet_dgcnn import DecoderInner
+
+
+@pytest.mark.parametrize("acts", ["all", "inp", "first_rn", "inp_first_rn"])
+def test_forward_features_matches_forward(acts: str):
+    """
+    Test that the pruned features-only forward pass gives the same descriptor as
+    the full forward pass for every supported activation type.
+    """
+    torch.manual_seed(0)
+    decoder = DecoderInner(
+        dim=3, z_dim=32, c_dim=0, hidden_size=32, leaky=True, return_features=True, acts=acts
+    )
+    # fc_1 in the ResNet blocks is zero-initialized, randomize so the blocks are not identity maps
+    for param in decoder.parameters():
+        torch.nn.init.normal_(param, std=0.1)
+
+    p = torch.randn(2, 50, 3)
+    z = torch.randn(2, 32, 3)
+    with torch.no_grad():
+        _, expected_feats = decoder(p, z)
+        feats = decoder.forward_features(p, z)
+
+    assert feats.shape == expected_feats.shape
+    assert torch.allclose(feats, expected_feats, atol=1e-6)
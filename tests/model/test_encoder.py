@@ -0,0 +1,140 @@
+import pytest
+import torch
+
+from rndf_robot.model.vnn_occupancy_net_pointnet_dgcnn import VNNOccNet
+from rndf_robot.utils.torch_util import pad_point_clouds
+
+
+@pytest.mark.parametrize("model_type", ["dgcnn", "pointnet"])
+def test_micro_batched_latent_matches_full_batch(model_type: str):
+    """Test that splitting the batch to fit a memory budget doesn't change the latents."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=16, model_type=model_type).eval()
+    point_cloud = torch.randn(4, 100, 3) * 0.05
+
+    with torch.no_grad():
+        latent = model.extract_latent({"point_cloud": point_cloud})
+        # budget only fits one sample at a time
+        per_sample = model.encoder.estimate_memory_per_sample(100)
+        latent_mb = model.extract_latent({"point_cloud": point_cloud}, mem_budget=per_sample)
+
+    assert torch.allclose(latent, latent_mb, atol=1e-5)
+
+
+@pytest.mark.parametrize("model_type", ["dgcnn", "pointnet"])
+def test_micro_batched_padded_latent_matches_full_batch(model_type: str):
+    """Test micro-batching a padded batch under a budget smaller than one sample (one sample per micro-batch)."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=16, model_type=model_type).eval()
+    point_cloud, mask = pad_point_clouds([torch.randn(n, 3) * 0.05 for n in (100, 40, 70)])
+
+    with torch.no_grad():
+        latent = model.extract_latent({"point_cloud": point_cloud, "mask": mask})
+        latent_mb = model.extract_latent({"point_cloud": point_cloud, "mask": mask}, mem_budget=1)
+
+    assert torch.allclose(latent, latent_mb, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA to measure the peak memory")
+@pytest.mark.parametrize("model_type", ["dgcnn", "pointnet"])
+@pytest.mark.parametrize("requires_grad", [False, True])
+def test_memory_estimate_bounds_peak_memory(model_type: str, requires_grad: bool):
+    """Test that the per-sample memory estimate the micro-batch sizes are based on is an upper bound."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=256, model_type=model_type).cuda().eval()
+    batch_size, num_points = 4, 1500
+    point_cloud = torch.randn(batch_size, num_points, 3, device="cuda") * 0.05
+
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    start = torch.cuda.memory_allocated()
+    with torch.set_grad_enabled(requires_grad):
+        latent = model.extract_latent({"point_cloud": point_cloud})
+    torch.cuda.synchronize()
+    peak = torch.cuda.max_memory_allocated() - start
+    del latent
+
+    assert peak <= batch_size * model.encoder.estimate_memory_per_sample(num_points, requires_grad=requires_grad)
+
+
+@pytest.mark.parametrize("model_type", ["dgcnn", "pointnet"])
+@pytest.mark.parametrize("requires_grad", [False, True])
+def test_memory_estimate_bounds_peak_cpu_memory(model_type: str, requires_grad: bool, peak_cpu_memory):
+    """Test that the per-sample memory estimate is an upper bound of the peak CPU memory measured by the profiler."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=256, model_type=model_type).eval()
+    batch_size, num_points = 2, 300
+    point_cloud = torch.randn(batch_size, num_points, 3) * 0.05
+
+    with torch.set_grad_enabled(requires_grad):
+        peak = peak_cpu_memory(lambda: model.extract_latent({"point_cloud": point_cloud}))
+
+    assert peak <= batch_size * model.encoder.estimate_memory_per_sample(num_points, requires_grad=requires_grad)
+
+
+def test_micro_batching_bounds_peak_cpu_memory(peak_cpu_memory):
+    """Test that the peak memory of a micro-batched dgcnn encoding stays within the budget, whatever the batch size."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=256, model_type="dgcnn").eval()
+    num_points = 300
+    mem_budget = 2 * model.encoder.estimate_memory_per_sample(num_points)
+
+    with torch.no_grad():
+        peaks = [peak_cpu_memory(lambda: model.extract_latent(
+            {"point_cloud": torch.randn(batch_size, num_points, 3) * 0.05}, mem_budget=mem_budget))
+            for batch_size in (2, 10)]
+
+    assert max(peaks) <= mem_budget
+    assert peaks[1] <= 1.1 * peaks[0]
+
+
+def test_dgcnn_checkpointing_gradients():
+    """Test that activation checkpointing in the DGCNN encoder gives the same gradients."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=16, model_type="dgcnn").eval()
+    model_ckpt = VNNOccNet(latent_dim=16, model_type="dgcnn", checkpoint_encoder=True).eval()
+    model_ckpt.load_state_dict(model.state_dict())
+    point_cloud = torch.randn(2, 100, 3) * 0.05
+
+    grads = []
+    for m in [model, model_ckpt]:
+        m.extract_latent({"point_cloud": point_cloud}).sum().backward()
+        grads.append(m.encoder.conv2.map_to_feat.weight.grad)
+
+    assert torch.allclose(grads[0], grads[1], atol=1e-5)
+
+
+def test_dgcnn_checkpointing_train_mode_batch_norm_stats():
+    """Test that the recompute of checkpointed training doesn't update the batch norm running statistics again."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=16, model_type="dgcnn").train()
+    model_ckpt = VNNOccNet(latent_dim=16, model_type="dgcnn", checkpoint_encoder=True).train()
+    model_ckpt.load_state_dict(model.state_dict())
+    point_cloud = torch.randn(2, 100, 3) * 0.05
+
+    for m in [model, model_ckpt]:
+        m.extract_latent({"point_cloud": point_cloud}).sum().backward()
+
+    buffers, buffers_ckpt = dict(model.named_buffers()), dict(model_ckpt.named_buffers())
+    for name, buffer in buffers.items():
+        assert torch.allclose(buffer, buffers_ckpt[name], atol=1e-6), name
+    assert model.encoder.conv2.batchnorm.bn.num_batches_tracked == 1
+    assert torch.allclose(model.encoder.conv2.map_to_feat.weight.grad, model_ckpt.encoder.conv2.map_to_feat.weight.grad,
+                          atol=1e-5)
+    assert all(bn.momentum == 0.1 for bn in model_ckpt.modules() if isinstance(bn, torch.nn.BatchNorm2d))
+
+
+@pytest.mark.parametrize("model_type", ["dgcnn", "pointnet"])
+def test_padded_batch_matches_individual_clouds(model_type: str):
+    """Test that masked encoding of a padded batch matches encoding each cloud on its own."""
+    torch.manual_seed(0)
+    model = VNNOccNet(latent_dim=16, model_type=model_type).eval()
+    pcds = [torch.randn(60, 3) * 0.05, torch.randn(100, 3) * 0.05]
+
+    with torch.no_grad():
+        expected = [model.extract_latent({"point_cloud": pcd[None]})[0] for pcd in pcds]
+        point_cloud, mask = pad_point_clouds(pcds)
+        latent = model.extract_latent({"point_cloud": point_cloud, "mask": mask})
+
+    for i in range(len(pcds)):
+        assert torch.allclose(latent[i], expected[i], atol=1e-5)
@@ -0,0 +1,55 @@
+import gc
+import os
+
+import torch
+import torch.nn as nn
+
+from rndf_robot.model.weight_registry import NDFWeightRegistry
+
+
+def test_restore_only_when_weights_change(tmp_path):
+    """
+    Test that the registry restores the checkpoint weights the first time, skips
+    restoring while the weights are untouched, and restores again after they are
+    modified in place.
+    """
+    checkpoint_fname = str(tmp_path / "model.pth")
+    torch.save(nn.Sequential(nn.Linear(3, 4), nn.BatchNorm1d(4)).state_dict(), checkpoint_fname)
+    expected = torch.load(checkpoint_fname)
+
+    model = nn.Sequential(nn.Linear(3, 4), nn.BatchNorm1d(4))
+    registry = NDFWeightRegistry(cache_dir=str(tmp_path / "cache"))
+
+    assert registry.restore(model, checkpoint_fname)
+    assert not registry.restore(model, checkpoint_fname)
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, expected[name])
+
+    with torch.no_grad():
+        model[0].weight.add_(1.0)
+    assert registry.restore(model, checkpoint_fname)
+    assert torch.equal(model[0].weight, expected["0.weight"])
+
+
+def test_default_cache_dir_and_model_lifetime(tmp_path, monkeypatch):
+    """
+    Test that the flat checkpoints go to the user cache by default, not next to the
+    checkpoint, and that the registry doesn't keep restored models alive.
+    """
+    checkpoint_dir = tmp_path / "weights"
+    checkpoint_dir.mkdir()
+    checkpoint_fname = str(checkpoint_dir / "model.pth")
+    torch.save(nn.Linear(3, 4).state_dict(), checkpoint_fname)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    registry = NDFWeightRegistry()
+    model = nn.Linear(3, 4)
+    assert registry.restore(model, checkpoint_fname)
+    assert os.listdir(checkpoint_dir) == ["model.pth"]
+    assert len(os.listdir(tmp_path / "cache" / "rndf_robot" / "weight_cache")) == 2
+
+    del model
+    gc.collect()
+    assert len(registry._restored) == 0
+    # a new model (which may get the id of the old one) is always restored
+    assert registry.restore(nn.Linear(3, 4), checkpoint_fname)
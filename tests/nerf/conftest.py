@@ -1,6 +1,7 @@
 import json
 import os
 
+import numpy as np
 import pytest
 
 _MODULE_PATH = os.path.dirname(__file__)
@@ -12,3 +13,49 @@ def transforms():
     with open(os.path.join(_MODULE_PATH, "assets", "transforms.json")) as fp:
         transforms = json.load(fp)
     yield transforms
+
+
+class _FakeCam:
+    def __init__(self, i):
+        # on a circle, looking at the origin
+        pos = np.array([np.cos(i), np.sin(i), 1.0])
+        z = -pos / np.linalg.norm(pos)
+        x = np.cross([0, 0, 1], z)
+        x /= np.linalg.norm(x)
+        self.c2w = np.eye(4)
+        self.c2w[:3, :3] = np.stack([x, np.cross(z, x), z], axis=1)
+        self.c2w[:3, 3] = pos
+
+    def get_cam_ext(self):
+        return self.c2w.copy()
+
+
+class _FakeCams:
+    def __init__(self, n_cams=4, width=8, height=6, focal=10.0):
+        self.cams = [_FakeCam(2 * np.pi * i / n_cams) for i in range(n_cams)]
+        self.intrinsic_matrix = np.array([[focal, 0, width / 2], [0, focal, height / 2], [0, 0, 1]])
+        self.width, self.height = width, height
+
+
+def _images(cams, seed=0):
+    """Random RGB (uint8) and depth (float32, meters) images of the cameras"""
+    rng = np.random.RandomState(seed)
+    rgbs = [rng.randint(0, 256, (cams.height, cams.width, 3)).astype(np.uint8) for _ in cams.cams]
+    depths = [rng.uniform(0.5, 2.0, (cams.height, cams.width)).astype(np.float32) for _ in cams.cams]
+    return rgbs, depths
+
+
+@pytest.fixture
+def fake_cams():
+    """Stands in for MultiCams, with only what the dataset writer uses"""
+    return _FakeCams()
+
+
+@pytest.fixture
+def make_cams():
+    return _FakeCams
+
+
+@pytest.fixture
+def make_images():
+    return _images
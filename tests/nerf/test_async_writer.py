@@ -0,0 +1,62 @@
+import json
+import os.path as osp
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from rndf_robot.nerf.async_writer import AsyncDatasetWriter
+from rndf_robot.nerf.dataset import COMPLETE_MARKER, is_complete, write_instant_ngp_dataset
+
+
+def _load_frames(nerf_dir):
+    with open(osp.join(nerf_dir, 'transforms.json')) as f:
+        transforms = json.load(f)
+    encoding = transforms.get('encoding', 'png')
+    if encoding == 'packed':
+        return np.load(osp.join(nerf_dir, 'rgbs.npy')), np.load(osp.join(nerf_dir, 'depths.npy'))
+    rgbs, depths = [], []
+    for frame in transforms['frames']:
+        rgb_fname = osp.join(nerf_dir, frame['file_path'])
+        depth_fname = osp.join(nerf_dir, 'depths', osp.basename(rgb_fname))
+        load = np.load if encoding == 'npy' else (lambda fname: np.asarray(Image.open(fname)))
+        rgbs.append(load(rgb_fname))
+        depths.append(load(depth_fname))
+    return np.stack(rgbs), np.stack(depths)
+
+
+@pytest.mark.parametrize('encoding', ['png', 'npy', 'packed'])
+def test_async_writer_matches_sync(tmp_path, encoding, fake_cams, make_images):
+    """Test that the background writer writes the same files as write_instant_ngp_dataset, and the images losslessly"""
+    cams = fake_cams
+    rgbs, depths = make_images(cams)
+    sync_dir, async_dir = str(tmp_path / 'sync'), str(tmp_path / 'async')
+    write_instant_ngp_dataset(cams, rgbs, depths, sync_dir, encoding=encoding, extra_files={'meta.json': {'a': 1}})
+
+    done = threading.Event()
+    with AsyncDatasetWriter(num_threads=3, encoding=encoding) as writer:
+        writer.submit(cams, rgbs, depths, async_dir, extra_files={'meta.json': {'a': 1}}, on_done=done.set)
+    assert done.is_set() and is_complete(sync_dir) and is_complete(async_dir)
+
+    for fname in ['transforms.json', 'transforms_unnormalized.json', 'normalization_params.json', 'meta.json']:
+        with open(osp.join(sync_dir, fname)) as f_sync, open(osp.join(async_dir, fname)) as f_async:
+            assert json.load(f_sync) == json.load(f_async)
+
+    for nerf_dir in [sync_dir, async_dir]:
+        loaded_rgbs, loaded_depths = _load_frames(nerf_dir)
+        assert np.array_equal(loaded_rgbs, np.stack(rgbs))
+        assert np.array_equal(loaded_depths, (np.stack(depths) * 1000).astype(np.uint16))
+
+
+def test_async_writer_error(tmp_path, fake_cams, make_images):
+    """Test that a failed dataset has no marker, doesn't call on_done, and that its error is raised"""
+    cams = fake_cams
+    rgbs, depths = make_images(cams)
+    rgbs[2] = np.zeros((2, 2, 7), dtype=np.uint8)  # not an image
+    done = threading.Event()
+    writer = AsyncDatasetWriter(num_threads=2, max_pending=1)
+    writer.submit(cams, rgbs, depths, str(tmp_path), on_done=done.set)
+    with pytest.raises(RuntimeError):
+        writer.close()
+    assert not done.is_set() and not osp.exists(osp.join(str(tmp_path), COMPLETE_MARKER))
@@ -0,0 +1,58 @@
+import json
+import os
+import os.path as osp
+
+import pytest
+
+from rndf_robot.nerf.copy_datasets import MANIFEST_FNAME, copy_nerf_datasets
+
+
+def _write(path, content):
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+@pytest.fixture
+def eval_dir(tmp_path):
+    eval_dir = str(tmp_path / 'eval')
+    for i in range(3):
+        _write(osp.join(eval_dir, f'trial_{i}', 'nerf_dataset', 'transforms.json'), json.dumps({'trial': i}))
+        _write(osp.join(eval_dir, f'trial_{i}', 'nerf_dataset', 'rgbs', '000.png'), f'image {i}')
+        _write(osp.join(eval_dir, f'trial_{i}', 'meshcat_recording.npz'), 'not a dataset file')
+    _write(osp.join(eval_dir, '.partial_trial_3', 'nerf_dataset', 'transforms.json'), '{}')
+    _write(osp.join(eval_dir, 'full_exp_cfg.txt'), '{}')
+    _write(osp.join(eval_dir, 'target_descriptors.npz'), 'descriptors')
+    return eval_dir
+
+
+@pytest.mark.parametrize('link', [True, False])
+def test_copy_nerf_datasets(eval_dir, tmp_path, link):
+    """Test that the datasets are synced, and that only the new or changed trials are copied again"""
+    target_dir = str(tmp_path / 'target')
+    stats = copy_nerf_datasets(eval_dir, target_dir, link=link)
+    assert stats == dict(copied=['trial_0', 'trial_1', 'trial_2'], unchanged=[], removed=[])
+    assert sorted(os.listdir(target_dir)) == sorted([
+        'trial_0', 'trial_1', 'trial_2', MANIFEST_FNAME, 'full_exp_cfg.json', 'target_descriptors.npz', 'rndf_debug.json'])
+    assert sorted(os.listdir(osp.join(target_dir, 'trial_1'))) == ['rgbs', 'transforms.json']
+    src, dst = osp.join(eval_dir, 'trial_1', 'nerf_dataset', 'rgbs', '000.png'), osp.join(target_dir, 'trial_1', 'rgbs', '000.png')
+    with open(dst) as f:
+        assert f.read() == 'image 1'
+    assert osp.samefile(src, dst) == link
+
+    assert copy_nerf_datasets(eval_dir, target_dir, link=link) == dict(
+        copied=[], unchanged=['trial_0', 'trial_1', 'trial_2'], removed=[])
+
+    # a rewritten trial (new files, like the eval writes them) and a removed one
+    os.remove(src)
+    _write(src, 'new image 1')
+    os.rename(osp.join(eval_dir, 'trial_2'), osp.join(eval_dir, '.partial_trial_2'))
+    # a stray trial from an older copy
+    _write(osp.join(target_dir, 'trial_7', 'transforms.json'), '{}')
+    assert copy_nerf_datasets(eval_dir, target_dir, link=link) == dict(
+        copied=['trial_1'], unchanged=['trial_0'], removed=['trial_2', 'trial_7'])
+    with open(dst) as f:
+        assert f.read() == 'new image 1'
+    assert not osp.exists(osp.join(target_dir, 'trial_2'))
+    with open(osp.join(target_dir, MANIFEST_FNAME)) as f:
+        assert sorted(json.load(f)['trials']) == ['trial_0', 'trial_1']
@@ -0,0 +1,86 @@
+import json
+import os.path as osp
+
+import numpy as np
+import pytest
+
+from rndf_robot.nerf.dataset import read_instant_ngp_dataset, write_instant_ngp_dataset
+from rndf_robot.nerf.packed import PackedNeRFDataset, find_trial_datasets, pack_nerf_datasets
+
+
+@pytest.fixture
+def packed(tmp_path, fake_cams, make_images):
+    """Three trials in different encodings, in the eval and the nerf_datasets layout, and their packed dataset"""
+    trials = {}
+    for i, (name, encoding, nerf_dir) in enumerate([('trial_0', 'png', 'trial_0/nerf_dataset'),
+                                                    ('trial_1', 'npy', 'trial_1'),
+                                                    ('trial_10', 'packed', 'trial_10')]):
+        rgbs, depths = make_images(fake_cams, seed=i)
+        trials[name] = str(tmp_path / 'eval' / nerf_dir)
+        write_instant_ngp_dataset(fake_cams, rgbs, depths, trials[name], encoding=encoding,
+                                  extra_files={'rndf_metadata.json': {'trial': int(name.split('_')[-1])}})
+    # unfinished trials are not packed
+    (tmp_path / 'eval' / '.partial_trial_2').mkdir()
+    pack_nerf_datasets(str(tmp_path / 'eval'), str(tmp_path / 'packed'), num_threads=2)
+    return trials, PackedNeRFDataset(str(tmp_path / 'packed'))
+
+
+def test_pack(packed):
+    trials, dataset = packed
+    assert find_trial_datasets(osp.dirname(osp.dirname(trials['trial_0']))) == trials
+    assert dataset.trial_names == ['trial_0', 'trial_1', 'trial_10'] and dataset.n_frames == 12
+
+    for name, nerf_dir in trials.items():
+        source = read_instant_ngp_dataset(nerf_dir)
+        trial = dataset.trial(name)
+        assert np.array_equal(trial.rgbs, source['rgbs']) and np.array_equal(trial.depths, source['depths'])
+        # views into the memory maps
+        assert np.shares_memory(trial.rgbs, dataset.rgbs)
+        with open(osp.join(nerf_dir, 'transforms.json')) as f:
+            normalized = [frame['transform_matrix'] for frame in json.load(f)['frames']]
+        assert np.allclose(trial.normalized_c2ws(), normalized)
+        assert trial.info['files'] == {'rndf_metadata.json': {'trial': int(name.split('_')[-1])}}
+
+    frame = dataset.frame('trial_1', 2)
+    assert np.array_equal(frame['rgb'], read_instant_ngp_dataset(trials['trial_1'])['rgbs'][2])
+
+
+@pytest.mark.parametrize('encoding', ['png', 'packed'])
+def test_export(packed, tmp_path, encoding):
+    """Test that exporting a trial gives back the files of its dataset"""
+    trials, dataset = packed
+    out_dir = str(tmp_path / 'export')
+    dataset.export_instant_ngp('trial_0', out_dir, encoding=encoding)
+    exported, source = read_instant_ngp_dataset(out_dir), read_instant_ngp_dataset(trials['trial_0'])
+    assert np.array_equal(exported['rgbs'], source['rgbs']) and np.array_equal(exported['depths'], source['depths'])
+    assert np.allclose(exported['normalization_params']['translation'], source['normalization_params']['translation'])
+    for fname in ['transforms.json', 'rndf_metadata.json']:
+        with open(osp.join(out_dir, fname)) as f_out, open(osp.join(trials['trial_0'], fname)) as f_source:
+            out, source = json.load(f_out), json.load(f_source)
+        if fname == 'transforms.json':
+            out.pop('encoding', None)
+            for frame_out, frame_source in zip(out.pop('frames'), source.pop('frames')):
+                assert np.allclose(frame_out['transform_matrix'], frame_source['transform_matrix'])
+        assert out == source
+
+
+def test_sample_rays(packed):
+    trials, dataset = packed
+    batch = dataset.sample_rays(256, rng=np.random.default_rng(0))
+    assert np.all(np.diff(batch['frame']) >= 0)
+    u, v = batch['uv'].T
+    assert np.array_equal(batch['rgb'], dataset.rgbs[batch['frame'], v, u])
+    assert np.allclose(batch['depth'], dataset.depths[batch['frame'], v, u] / 1000.0)
+
+    # the rays go through their pixel, and look away from the camera
+    frame = batch['frame'][0]
+    K, c2w = dataset.intrinsics[frame], dataset.c2ws[frame]
+    trial = dataset.trial(int(batch['trial'][0]))
+    d_cam = c2w[:3, :3].T @ batch['rays_d'][0]
+    assert d_cam[2] < 0
+    assert np.allclose([K[0, 0] * d_cam[0] / -d_cam[2] + K[0, 2], -K[1, 1] * d_cam[1] / -d_cam[2] + K[1, 2]],
+                       [u[0] + 0.5, v[0] + 0.5])
+    assert np.allclose(batch['rays_o'][0], trial.normalized_c2ws()[frame - trial.info['frame_start'], :3, 3])
+
+    batch = dataset.sample_rays(64, trials=['trial_10'], normalized=False)
+    assert np.all(batch['trial'] == 2) and np.all(batch['frame'] >= 8)
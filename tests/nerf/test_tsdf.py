@@ -0,0 +1,111 @@
+import json
+import os.path as osp
+
+import numpy as np
+import pytest
+import trimesh
+
+from rndf_robot.nerf.dataset import convert_pose, write_instant_ngp_dataset
+from rndf_robot.nerf.tsdf import TSDFVolume, fuse_nerf_dataset, fuse_trials, to_normalized
+
+RADIUS = 0.3
+
+
+def _sphere_depths(cams):
+    """z-depth of a sphere of radius RADIUS at the origin, 0 where the pixel doesn't see it"""
+    K = cams.intrinsic_matrix
+    v, u = np.mgrid[:cams.height, :cams.width]
+    dirs_cam = np.stack([(u + 0.5 - K[0, 2]) / K[0, 0], -(v + 0.5 - K[1, 2]) / K[1, 1], -np.ones(u.shape)], axis=-1)
+    depths = []
+    for cam in cams.cams:
+        c2w = convert_pose(cam.get_cam_ext())
+        o, d = c2w[:3, 3], dirs_cam @ c2w[:3, :3].T
+        # |o + t d| = RADIUS, and t is the z-depth as the directions have a z of -1
+        a, b, c = (d ** 2).sum(-1), 2 * d @ o, o @ o - RADIUS ** 2
+        disc = b ** 2 - 4 * a * c
+        depths.append(np.where(disc > 0, (-b - np.sqrt(np.maximum(disc, 0))) / (2 * a), 0).astype(np.float32))
+    return depths
+
+
+@pytest.fixture
+def sphere_dataset(tmp_path, make_cams):
+    cams = make_cams(n_cams=12, width=64, height=48, focal=60.0)
+    depths = _sphere_depths(cams)
+    rgbs = [np.full((cams.height, cams.width, 3), [200, 100, 50], dtype=np.uint8) for _ in cams.cams]
+    nerf_dir = str(tmp_path / 'eval' / 'trial_0' / 'nerf_dataset')
+    write_instant_ngp_dataset(cams, rgbs, depths, nerf_dir)
+    return nerf_dir
+
+
+def test_fuse_sphere(sphere_dataset):
+    """Test that the fused point cloud is on the sphere, with its color"""
+    volume = fuse_nerf_dataset(sphere_dataset, resolution=48)
+    points, colors = volume.extract_point_cloud()
+    assert len(points) > 500
+    assert np.abs(np.linalg.norm(points, axis=-1) - RADIUS).max() < 2 * volume.voxel_size
+    assert np.all(np.abs(colors.astype(int) - [200, 100, 50]) <= 1)
+
+    # the same in small chunks
+    chunked = fuse_nerf_dataset(sphere_dataset, resolution=48, chunk_size=1000)
+    assert np.allclose(chunked.tsdf, volume.tsdf) and np.array_equal(chunked.weights, volume.weights)
+
+
+def test_default_bounds_ignore_far_background(tmp_path, make_cams):
+    """Test that far background depths (e.g., the far plane) don't blow up the default volume"""
+    cams = make_cams(n_cams=12, width=64, height=48, focal=60.0)
+    depths = [np.where(depth > 0, depth, 20.0).astype(np.float32) for depth in _sphere_depths(cams)]
+    rgbs = [np.full((cams.height, cams.width, 3), [200, 100, 50], dtype=np.uint8) for _ in cams.cams]
+    nerf_dir = str(tmp_path / 'nerf_dataset')
+    write_instant_ngp_dataset(cams, rgbs, depths, nerf_dir)
+
+    volume = fuse_nerf_dataset(nerf_dir, resolution=48)
+    assert volume.voxel_size < 2 * RADIUS / 40
+    points, _ = volume.extract_point_cloud()
+    assert np.abs(np.linalg.norm(points, axis=-1) - RADIUS).max() < 2 * volume.voxel_size
+
+
+def test_tsdf_volume_plane():
+    """A camera looking down at a plane, the TSDF is the truncated distance to it"""
+    volume = TSDFVolume(np.array([[-0.5, -0.5, -0.5], [0.5, 0.5, 0.5]]), voxel_size=0.05, trunc_voxels=2)
+    K = np.array([[50.0, 0, 50], [0, 50.0, 50], [0, 0, 1]])
+    c2w = np.eye(4)
+    c2w[2, 3] = 2.0  # looking down -z, at the plane z = 0
+    volume.integrate([np.full((100, 100), 2.0, dtype=np.float32)], [K], [c2w])
+    z = volume.voxel_centers(0, volume.tsdf.size)[:, 2].reshape(volume.dims)
+    seen = volume.weights > 0
+    assert np.allclose(volume.tsdf[seen], np.minimum(1, z[seen] / volume.trunc), atol=1e-5)
+    assert np.all(z[seen] >= -volume.trunc - 1e-9)
+    points, _ = volume.extract_point_cloud()
+    assert np.allclose(points[:, 2], 0, atol=1e-6)
+
+
+def test_tsdf_volume_uint8_colors():
+    """uint8 colors are fused like the same colors as floats"""
+    K = np.array([[50.0, 0, 50], [0, 50.0, 50], [0, 0, 1]])
+    c2w = np.eye(4)
+    c2w[2, 3] = 2.0
+    depth = np.full((100, 100), 2.0, dtype=np.float32)
+    rgb = np.random.RandomState(0).randint(0, 256, size=(100, 100, 3), dtype=np.uint8)
+    volumes = []
+    for rgbs in ([rgb, rgb], [rgb.astype(np.float32)] * 2):
+        volume = TSDFVolume(np.array([[-0.5, -0.5, -0.5], [0.5, 0.5, 0.5]]), voxel_size=0.05, trunc_voxels=2)
+        volume.integrate([depth, depth], [K, K], [c2w, c2w], rgbs)
+        volumes.append(volume)
+    assert volumes[0].colors.dtype == np.float32
+    assert np.array_equal(volumes[0].colors, volumes[1].colors)
+
+
+def test_fuse_trials(sphere_dataset, tmp_path):
+    out_dir = str(tmp_path / 'fused')
+    written = fuse_trials(str(tmp_path / 'eval'), out_dir, normalized=True, num_workers=2, resolution=32)
+    assert written == {'trial_0': osp.join(out_dir, 'trial_0', 'fused_pcd.ply')}
+    pcd = trimesh.load(written['trial_0'])
+    with open(osp.join(sphere_dataset, 'normalization_params.json')) as f:
+        center = to_normalized(np.zeros(3), json.load(f))
+    assert np.abs(np.linalg.norm(pcd.vertices - center, axis=-1) - RADIUS).max() < 0.05
+
+
+def test_extract_mesh(sphere_dataset):
+    pytest.importorskip('skimage')
+    mesh = fuse_nerf_dataset(sphere_dataset, resolution=48).extract_mesh()
+    assert np.abs(np.linalg.norm(mesh.vertices, axis=-1) - RADIUS).max() < 0.05
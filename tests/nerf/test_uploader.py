@@ -0,0 +1,114 @@
+import builtins
+import hashlib
+import os
+import os.path as osp
+
+import pytest
+
+from rndf_robot.nerf import uploader
+from rndf_robot.nerf.uploader import (
+    IntegrityError, LocalFSBackend, StorageBackend, chunk_key, download_dataset, load_manifest, upload_dataset_dir,
+    verify_dataset)
+
+
+def _write(path, data):
+    os.makedirs(osp.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def dataset_dir(tmp_path):
+    dataset_dir = str(tmp_path / 'dataset')
+    for i in range(3):
+        _write(osp.join(dataset_dir, f'trial_{i}', 'rgbs', '000.png'), bytes([i]) * 100)
+        _write(osp.join(dataset_dir, f'trial_{i}', 'transforms.json'), b'{}')
+    return dataset_dir
+
+
+def test_upload_download(dataset_dir, tmp_path):
+    """Test that only the new chunks are sent, and that the downloaded dataset has the same files"""
+    backend = LocalFSBackend(str(tmp_path / 'store'))
+    stats = upload_dataset_dir(dataset_dir, backend, 'exp/debug', chunk_size=64)
+    # 100 bytes are 2 chunks, the transforms are the same in every trial
+    assert stats['n_files'] == 6 and stats['n_chunks'] == 9 and stats['n_uploaded'] == 7
+
+    assert upload_dataset_dir(dataset_dir, backend, 'exp/debug', chunk_size=64)['n_uploaded'] == 0
+    _write(osp.join(dataset_dir, 'trial_3', 'rgbs', '000.png'), bytes([3]) * 100)
+    assert upload_dataset_dir(dataset_dir, backend, 'exp/debug', chunk_size=64)['n_uploaded'] == 2
+    assert '.upload_cache.json' not in load_manifest(backend, 'exp/debug')['files']
+
+    out_dir = str(tmp_path / 'out')
+    download_dataset(backend, 'exp/debug', out_dir)
+    for trial in range(4):
+        with open(osp.join(out_dir, f'trial_{trial}', 'rgbs', '000.png'), 'rb') as f:
+            assert f.read() == bytes([trial]) * 100
+    assert verify_dataset(backend, 'exp/debug') == []
+
+
+def test_resume_and_integrity(dataset_dir, tmp_path):
+    backend = LocalFSBackend(str(tmp_path / 'store'))
+    with pytest.raises(IntegrityError):
+        backend.write('chunks/aa/aa', b'data', sha256='aa')
+
+    upload_dataset_dir(dataset_dir, backend, 'exp', chunk_size=64)
+    manifest = load_manifest(backend, 'exp')
+    # a chunk that was lost, e.g. by an interrupted upload, is sent again
+    lost = manifest['files']['trial_1/rgbs/000.png']['chunks'][0]
+    os.remove(backend._path(chunk_key(lost)))
+    assert verify_dataset(backend, 'exp') == ['trial_1/rgbs/000.png']
+    assert upload_dataset_dir(dataset_dir, backend, 'exp', chunk_size=64)['n_uploaded'] == 1
+
+    # a corrupted chunk is detected
+    with open(backend._path(chunk_key(lost)), 'wb') as f:
+        f.write(b'corrupted')
+    assert verify_dataset(backend, 'exp') == ['trial_1/rgbs/000.png']
+    with pytest.raises(IntegrityError):
+        download_dataset(backend, 'exp', str(tmp_path / 'out'))
+
+
+def test_write_checks_the_stored_copy(tmp_path, monkeypatch):
+    """Test that a chunk that got corrupted while it was stored is rejected instead of made visible"""
+    backend = LocalFSBackend(str(tmp_path / 'store'))
+    data = b'chunk data'
+    sha256 = hashlib.sha256(data).hexdigest()
+
+    class _DroppingFile:
+        """A file that loses the last byte of what is written to it"""
+        def __init__(self, f):
+            self.f = f
+
+        def write(self, data):
+            return self.f.write(data[:-1])
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.f.close()
+
+    def dropping_open(path, mode='r', *args, **kwargs):
+        f = builtins.open(path, mode, *args, **kwargs)
+        return _DroppingFile(f) if 'w' in mode else f
+
+    monkeypatch.setattr(uploader, 'open', dropping_open, raising=False)
+    with pytest.raises(IntegrityError):
+        backend.write(chunk_key(sha256), data, sha256=sha256)
+    assert not backend.exists(chunk_key(sha256))
+    assert os.listdir(osp.dirname(backend._path(chunk_key(sha256)))) == []
+
+    monkeypatch.undo()
+    backend.write(chunk_key(sha256), data, sha256=sha256)
+    assert backend.read(chunk_key(sha256)) == data
+
+
+def test_storage_backend_is_abstract():
+    class _NoRead(StorageBackend):
+        def exists(self, key):
+            return False
+
+        def write(self, key, data, sha256=None):
+            pass
+
+    with pytest.raises(TypeError):
+        _NoRead()
@@ -0,0 +1,160 @@
+import numpy as np
+import pytest
+import torch
+from yacs.config import CfgNode as CN
+
+# the optimizer depends on airobot (logging and rotation utils) and healpy (rotation grid)
+pytest.importorskip('airobot')
+pytest.importorskip('healpy')
+
+from rndf_robot.model.vnn_occupancy_net_pointnet_dgcnn import VNNOccNet
+from rndf_robot.opt.optimizer import OccNetOptimizer
+
+
+@pytest.fixture
+def optimizer(tmp_path, monkeypatch):
+    # the optimizer saves debug plots in debug_viz/ and visualization/ in the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'visualization').mkdir()
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model = VNNOccNet(latent_dim=32, model_type='pointnet', return_features=True, sigmoid=True)
+    query_pts = np.random.randn(50, 3) * 0.03
+    cfg = CN()
+    cfg.SHAPE_PCD_PTS_N = 200
+    cfg.QUERY_PCD_PTS_N = 50
+    cfg.LATENT_MEM_BUDGET_MB = 0
+    return OccNetOptimizer(model, query_pts=query_pts, cfg=cfg, opt_iterations=20)
+
+
+def _target_desc(optimizer, pcd):
+    with torch.no_grad():
+        latent = optimizer.model.extract_latent({'point_cloud': torch.from_numpy(pcd[None]).float().to(optimizer.dev)})
+        query_pts = torch.from_numpy(optimizer.query_pts_origin[None]).float().to(optimizer.dev)
+        return optimizer.model.forward_latent(latent, query_pts)[0]
+
+
+def test_single_scene_batch_matches_optimize_transform_implicit(optimizer):
+    """
+    Test that a batch with one scene gives the same transforms, losses and best index
+    as optimize_transform_implicit, for the same seed
+    """
+    pcd = np.random.randn(500, 3) * 0.05 + np.array([0.5, 0.0, 1.0])
+    target = _target_desc(optimizer, pcd)
+
+    torch.manual_seed(1)
+    np.random.seed(1)
+    tfs, best_idx, losses, _ = optimizer.optimize_transform_implicit(
+        pcd, ee=False, return_score_list=True, return_final_desc=True, target_act_hat=target)
+
+    torch.manual_seed(1)
+    np.random.seed(1)
+    tfs_batch, best_idxs, losses_batch, _ = optimizer.optimize_transform_implicit_batch([pcd], target, ee=False)
+
+    assert best_idxs == [best_idx]
+    assert np.allclose(np.stack(tfs), np.stack(tfs_batch[0]), atol=1e-5)
+    assert torch.allclose(torch.tensor([float(l) for l in losses]), losses_batch[0].cpu(), atol=1e-6)
+
+
+def test_multi_scene_batch_shapes(optimizer):
+    """
+    Test the outputs for scenes with different point cloud sizes (one smaller than the
+    number of sampled points) and per-scene targets and query points
+    """
+    pcds = [np.random.randn(500, 3) * 0.05 + np.array([0.5, 0.0, 1.0]),
+            np.random.randn(150, 3) * 0.05 + np.array([0.3, 0.2, 1.0])]
+    targets = torch.stack([_target_desc(optimizer, pcd) for pcd in pcds], 0)
+    query_pts_list = [optimizer.query_pts_origin, optimizer.query_pts_origin + 0.01]
+
+    tf_lists, best_idxs, losses, descs = optimizer.optimize_transform_implicit_batch(
+        pcds, targets, query_pts_list=query_pts_list, ee=True)
+
+    M = optimizer.full_opt
+    assert len(tf_lists) == len(best_idxs) == len(losses) == len(descs) == 2
+    for k in range(2):
+        assert len(tf_lists[k]) == M
+        assert tf_lists[k][0].shape == (4, 4)
+        assert losses[k].shape == (M,)
+        assert descs[k].shape[:2] == (M, 50)
+        assert best_idxs[k] == int(torch.argmin(losses[k]))
+
+
+def test_batched_pose_descriptors_match_single(optimizer):
+    """
+    Test that encoding demo clouds of different sizes in one padded batch gives the same
+    descriptors as encoding them one at a time, for the same seed
+    """
+    optimizer.model.eval()
+    pcds = [np.random.randn(n, 3) * 0.05 + np.array([0.5, 0.0, 1.0]) for n in (2000, 700, 300)]
+    poses = [np.eye(4) for _ in pcds]
+    for i, pose in enumerate(poses):
+        pose[:3, 3] = [0.5 + 0.01 * i, 0.0, 1.0]
+
+    torch.manual_seed(2)
+    single = [optimizer.get_pose_descriptor(pcd, pose) for pcd, pose in zip(pcds, poses)]
+    torch.manual_seed(2)
+    batched = optimizer.get_pose_descriptors(
+        [optimizer.pose_descriptor_input(pcd, pose) for pcd, pose in zip(pcds, poses)])
+
+    for desc, desc_batched in zip(single, batched):
+        assert desc.shape == desc_batched.shape == (1, 50, desc.size(-1))
+        assert torch.allclose(desc, desc_batched, atol=1e-5)
+
+
+def _dgcnn_optimizer(budget_mb):
+    torch.manual_seed(0)
+    np.random.seed(0)
+    model = VNNOccNet(latent_dim=32, model_type='dgcnn', return_features=True, sigmoid=True)
+    query_pts = np.random.randn(50, 3) * 0.03
+    cfg = CN()
+    cfg.SHAPE_PCD_PTS_N = 200
+    cfg.QUERY_PCD_PTS_N = 50
+    cfg.LATENT_MEM_BUDGET_MB = budget_mb
+    return OccNetOptimizer(model, query_pts=query_pts, cfg=cfg, opt_iterations=10)
+
+
+def test_dgcnn_micro_batched_optimization_matches_full_batch(tmp_path, monkeypatch):
+    """
+    Test that a memory budget smaller than one initialization (so the latents are computed
+    one initialization at a time) gives the same transforms and losses as a budget that fits
+    all the initializations, for the same seed
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'visualization').mkdir()
+    pcd = np.random.RandomState(0).randn(300, 3) * 0.05 + np.array([0.5, 0.0, 1.0])
+
+    results = []
+    for budget_mb in (1, 1024 ** 2):
+        optimizer = _dgcnn_optimizer(budget_mb)
+        target = _target_desc(optimizer, pcd)
+        torch.manual_seed(1)
+        np.random.seed(1)
+        results.append(optimizer.optimize_transform_implicit(
+            pcd, ee=False, return_score_list=True, return_final_desc=True, target_act_hat=target))
+
+    (tfs, best_idx, losses, _), (tfs_mb, best_idx_mb, losses_mb, _) = results
+    assert len(tfs) == 10 and best_idx == best_idx_mb
+    assert np.allclose(np.stack(tfs), np.stack(tfs_mb), atol=1e-5)
+    assert np.allclose([float(l) for l in losses], [float(l) for l in losses_mb], atol=1e-6)
+
+
+def test_dgcnn_budget_encodes_more_initializations_in_the_same_memory(tmp_path, monkeypatch, peak_cpu_memory):
+    """
+    Test that with a memory budget, dgcnn gets as many initializations as pointnet while the peak memory
+    of encoding them stays at most that of the 5 initializations it is capped to without a budget
+    """
+    monkeypatch.chdir(tmp_path)
+    no_budget = _dgcnn_optimizer(0)
+    # room for the latents of 2 initializations at a time
+    per_sample = no_budget.model.encoder.estimate_memory_per_sample(no_budget.n_pts)
+    budget = _dgcnn_optimizer(2 * per_sample / 1024 ** 2)
+    assert (no_budget.full_opt, budget.full_opt) == (5, 10)
+
+    peaks = []
+    for optimizer in (no_budget, budget):
+        point_cloud = torch.randn(optimizer.full_opt, optimizer.n_pts, 3) * 0.05
+        with torch.no_grad():
+            peaks.append(peak_cpu_memory(lambda: optimizer.model.extract_latent(
+                {'point_cloud': point_cloud}, mem_budget=optimizer.latent_mem_budget)))
+
+    assert peaks[1] <= peaks[0]
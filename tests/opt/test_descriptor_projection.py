@@ -0,0 +1,26 @@
+import numpy as np
+import torch
+
+from rndf_robot.opt.descriptor_projection import DescriptorProjection
+
+
+def test_projection_fit_truncate_and_save(tmp_path):
+    """
+    Test that a PCA projection captures low rank descriptors, and that it can be
+    truncated and round-tripped through an .npz file.
+    """
+    torch.manual_seed(0)
+    basis = torch.randn(8, 64)
+    descs = torch.randn(4, 100, 8) @ basis
+
+    projection = DescriptorProjection.fit(descs, n_components=16)
+    assert projection.dim == 16
+    assert projection(descs).shape == (4, 100, 16)
+    # descriptors are rank 8, so 8 components explain all the variance
+    assert np.isclose(projection.truncate(8).explained_variance_ratio, 1.0, atol=1e-4)
+
+    fname = str(tmp_path / "target_descriptors.npz")
+    np.savez(fname, **projection.to_npz_dict("parent"))
+    loaded = DescriptorProjection.from_npz(np.load(fname), "parent")
+    assert DescriptorProjection.from_npz(np.load(fname), "child") is None
+    assert torch.allclose(loaded.truncate(8)(descs), projection.truncate(8)(descs), atol=1e-4)
@@ -0,0 +1,46 @@
+import numpy as np
+
+from rndf_robot.robot.capture import CameraRays, camera_rays, segmented_points
+
+
+def _camera(width=8, height=6):
+    cam_int_mat = np.array([[10.0, 0.0, width / 2], [0.0, 12.0, height / 2], [0.0, 0.0, 1.0]])
+    angle = np.pi / 5
+    cam_ext_mat = np.eye(4)
+    cam_ext_mat[:3, :3] = [[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]]
+    cam_ext_mat[:3, 3] = [0.5, -0.2, 1.3]
+    return cam_int_mat, cam_ext_mat
+
+
+def _backproject(cam_int_mat, cam_ext_mat, depth):
+    """Full image back-projection, the way the cameras' get_pcd does it"""
+    height, width = depth.shape
+    v, u = np.mgrid[0:height, 0:width].reshape(2, -1)
+    pts_in_cam = np.dot(np.linalg.inv(cam_int_mat), np.stack([u, v, np.ones_like(u)])) * depth.reshape(-1)
+    pts_in_cam = np.concatenate([pts_in_cam, np.ones((1, pts_in_cam.shape[1]))])
+    return np.dot(cam_ext_mat, pts_in_cam)[:3].T
+
+
+def test_rays_match_full_backprojection():
+    cam_int_mat, cam_ext_mat = _camera()
+    depth = np.random.RandomState(0).uniform(0.5, 2.0, size=(6, 8))
+    rays = CameraRays(cam_int_mat, cam_ext_mat, 8, 6)
+
+    np.testing.assert_allclose(rays.points(depth), _backproject(cam_int_mat, cam_ext_mat, depth))
+    assert camera_rays(cam_int_mat, cam_ext_mat, 8, 6) is camera_rays(cam_int_mat.copy(), cam_ext_mat.copy(), 8, 6)
+
+
+def test_only_segmented_pixels_are_backprojected():
+    """Test that each body gets the points of its pixels with a valid depth, in the order of the full image."""
+    cam_int_mat, cam_ext_mat = _camera()
+    depth = np.random.RandomState(1).uniform(0.5, 2.0, size=(6, 8))
+    depth[0, 0] = 0.0
+    seg = np.full((6, 8), -1)
+    seg[:2, :3] = 3
+    seg[4:, 5:] = 7
+
+    points = segmented_points(CameraRays(cam_int_mat, cam_ext_mat, 8, 6), depth, seg, [3, 7, 9])
+    full = _backproject(cam_int_mat, cam_ext_mat, depth)
+    np.testing.assert_allclose(points[3], full[(seg.reshape(-1) == 3) & (depth.reshape(-1) > 0)])
+    np.testing.assert_allclose(points[7], full[seg.reshape(-1) == 7])
+    assert len(points[3]) == 5 and points[9].shape == (0, 3)
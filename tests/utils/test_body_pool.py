@@ -0,0 +1,75 @@
+import numpy as np
+import pybullet as p
+import pybullet_data
+import pytest
+
+from rndf_robot.utils.body_pool import BodyPool
+
+
+@pytest.fixture
+def client_id():
+    client_id = p.connect(p.DIRECT)
+    p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=client_id)
+    p.setGravity(0, 0, -9.8, physicsClientId=client_id)
+    p.loadURDF("plane.urdf", physicsClientId=client_id)
+    yield client_id
+    p.disconnect(physicsClientId=client_id)
+
+
+def _loader(client_id, pos, scale=1.0):
+    def load():
+        return p.loadURDF("cube_small.urdf", pos, globalScaling=scale, physicsClientId=client_id)
+    return load
+
+
+def _step(client_id, n_steps=120):
+    for _ in range(n_steps):
+        p.stepSimulation(physicsClientId=client_id)
+
+
+def test_released_bodies_are_parked_and_reused(client_id):
+    pool = BodyPool(client_id=client_id, max_parked=2)
+    mesh_file = 'cube_small.urdf'
+    body_id, reused = pool.acquire(mesh_file, [1.0] * 3, _loader(client_id, [0, 0, 0.3]), [0, 0, 0.3], [0, 0, 0, 1])
+    assert not reused
+    mass = p.getDynamicsInfo(body_id, -1, physicsClientId=client_id)[0]
+    p.createConstraint(body_id, -1, -1, -1, p.JOINT_FIXED, [0, 0, 0], [0, 0, 0], [0, 0, 0.3],
+                       physicsClientId=client_id)
+
+    # parked bodies are static, unconstrained and out of the way
+    pool.release(body_id)
+    assert pool.parked_body_ids() == [body_id]
+    assert p.getNumConstraints(physicsClientId=client_id) == 0
+    parked_pos = np.array(p.getBasePositionAndOrientation(body_id, physicsClientId=client_id)[0])
+    _step(client_id)
+    assert np.allclose(p.getBasePositionAndOrientation(body_id, physicsClientId=client_id)[0], parked_pos)
+    assert np.linalg.norm(parked_pos) > 50
+
+    # a different scale is a different object
+    other_id, reused = pool.acquire(mesh_file, [2.0] * 3, _loader(client_id, [1, 0, 0.3], 2.0), [1, 0, 0.3], [0, 0, 0, 1])
+    assert not reused and other_id != body_id
+
+    # the same mesh and scale reuses the parked body, which behaves like a new one
+    reused_id, reused = pool.acquire(mesh_file, [1.0] * 3, _loader(client_id, [0, 0, 0.3]), [0, 0.5, 0.3], [0, 0, 0, 1])
+    assert reused and reused_id == body_id
+    assert p.getDynamicsInfo(body_id, -1, physicsClientId=client_id)[0] == mass
+    _step(client_id)
+    pos = p.getBasePositionAndOrientation(body_id, physicsClientId=client_id)[0]
+    assert np.allclose(pos[:2], [0, 0.5], atol=1e-3) and pos[2] < 0.1
+    assert pool.n_loaded == 2 and pool.n_reused == 1
+
+
+def test_pool_size_is_bounded(client_id):
+    pool = BodyPool(client_id=client_id, max_parked=2)
+    body_ids = [pool.acquire(f'mesh_{i}', [1.0] * 3, _loader(client_id, [i, 0, 0.3]), [i, 0, 0.3], [0, 0, 0, 1])[0]
+                for i in range(3)]
+    for body_id in body_ids:
+        pool.release(body_id)
+
+    # the first parked body was removed to make room
+    assert pool.parked_body_ids() == body_ids[1:]
+    assert p.getNumBodies(physicsClientId=client_id) == 3
+
+    pool.clear()
+    assert pool.parked_body_ids() == []
+    assert p.getNumBodies(physicsClientId=client_id) == 1
@@ -0,0 +1,48 @@
+import numpy as np
+import pybullet as p
+import pybullet_data
+import pytest
+
+from rndf_robot.utils.eval_gen_utils import step_until_settled
+
+
+@pytest.fixture
+def client_id():
+    client_id = p.connect(p.DIRECT)
+    p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=client_id)
+    p.setGravity(0, 0, -9.8, physicsClientId=client_id)
+    p.loadURDF("plane.urdf", physicsClientId=client_id)
+    yield client_id
+    p.disconnect(physicsClientId=client_id)
+
+
+def _drop_cube(client_id):
+    cube_id = p.loadURDF("cube_small.urdf", [0, 0, 0.3], physicsClientId=client_id)
+    p.changeDynamics(cube_id, -1, linearDamping=5, angularDamping=5, physicsClientId=client_id)
+    return cube_id
+
+
+def test_step_until_settled_stops_early(client_id):
+    """Test that stepping stops once the dropped cube rests on the plane, before the budget runs out."""
+    cube_id = _drop_cube(client_id)
+    n_steps = step_until_settled([cube_id], max_steps=480, client_id=client_id)
+
+    assert n_steps < 480
+    lin_vel, _ = p.getBaseVelocity(cube_id, physicsClientId=client_id)
+    assert np.linalg.norm(lin_vel) < 1e-3
+    # resting on the plane (cube_small is 5cm wide)
+    assert p.getBasePositionAndOrientation(cube_id, physicsClientId=client_id)[0][2] < 0.03
+
+
+def test_step_until_settled_respects_budget(client_id):
+    """Test that the step budget bounds the number of steps, and that stepping is deterministic."""
+    cube_id = _drop_cube(client_id)
+    assert step_until_settled([cube_id], max_steps=10, client_id=client_id) == 10
+    pos_a = p.getBasePositionAndOrientation(cube_id, physicsClientId=client_id)[0]
+
+    p.resetBasePositionAndOrientation(cube_id, [0, 0, 0.3], [0, 0, 0, 1], physicsClientId=client_id)
+    p.resetBaseVelocity(cube_id, [0, 0, 0], [0, 0, 0], physicsClientId=client_id)
+    step_until_settled([cube_id], max_steps=10, client_id=client_id)
+    pos_b = p.getBasePositionAndOrientation(cube_id, physicsClientId=client_id)[0]
+
+    assert np.allclose(pos_a, pos_b)
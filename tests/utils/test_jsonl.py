@@ -0,0 +1,24 @@
+import io
+
+from rndf_robot.utils.jsonl import append_jsonl, read_jsonl, truncate_partial_line
+
+
+def test_truncate_partial_line_longer_than_a_block():
+    """Test that a partial last line spanning several read blocks is cut off at the last newline."""
+    f = io.BytesIO(b'{"a": 1}\n' + b'x' * 100)
+    truncate_partial_line(f, block_size=16)
+    assert f.getvalue() == b'{"a": 1}\n'
+
+    f = io.BytesIO(b'x' * 100)
+    truncate_partial_line(f, block_size=16)
+    assert f.getvalue() == b''
+
+
+def test_append_and_read_skip_partial_and_corrupted_lines(tmp_path):
+    """Test that appends start on a new line after a partial one, and that reads skip corrupted lines."""
+    fname = str(tmp_path / 'records.jsonl')
+    append_jsonl(fname, {'trial': 0}, fsync=True)
+    with open(fname, 'a') as f:
+        f.write('{"trial": 1, "pla{"trial": 1}\n{"trial": 2, "pla')
+    append_jsonl(fname, {'trial': 3})
+    assert [r['trial'] for r in read_jsonl(fname)] == [0, 3]
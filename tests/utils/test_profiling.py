@@ -0,0 +1,65 @@
+import threading
+import time
+
+from rndf_robot.utils.jsonl import append_jsonl, load_jsonl
+from rndf_robot.utils.profiling import TrialProfiler, format_trial_records, maybe_span
+
+
+def test_spans_accumulate():
+    """Test that spans with the same name add up, also when they are opened from several threads."""
+    profiler = TrialProfiler()
+    with profiler.span('setup/capture'):
+        time.sleep(0.01)
+    with profiler.span('setup/capture'):
+        time.sleep(0.01)
+
+    def work():
+        for _ in range(100):
+            with profiler.span('optimize/decode'):
+                pass
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    with maybe_span(None, 'ignored'):
+        pass
+
+    assert profiler.stage_times['setup/capture'] >= 0.02
+    assert set(profiler.stage_times.keys()) == {'setup/capture', 'optimize/decode'}
+
+
+def test_span_records_time_on_error():
+    profiler = TrialProfiler()
+    try:
+        with profiler.span('execute'):
+            raise ValueError
+    except ValueError:
+        pass
+    assert 'execute' in profiler.stage_times
+
+
+def test_records_roundtrip_and_summary(tmp_path):
+    """Test that trial records can be written, read back (skipping a partial line) and summarized."""
+    fname = str(tmp_path / 'trial_metrics.jsonl')
+    for i in range(3):
+        profiler = TrialProfiler()
+        profiler.add('setup', 0.5)
+        profiler.add('optimize', 1.0 + i)
+        append_jsonl(fname, profiler.record(trial=i, place_success=i % 2 == 0))
+    with open(fname, 'a') as f:
+        f.write('{"trial": 3, "stage_ti')
+
+    records = load_jsonl([fname])
+    assert [r['trial'] for r in records] == [0, 1, 2]
+    assert records[2]['stage_times']['optimize'] == 3.0
+    assert records[0]['peak_rss_mb'] > 0
+    assert records[0]['torch_threads'] >= 1
+
+    summary = format_trial_records(records, wall_time=10.0)
+    assert 'optimize' in summary and '3 trials in 10.00s' in summary
+    assert 'Peak RSS' in summary
+
+    # the next record replaces the partial line instead of being glued onto it
+    append_jsonl(fname, profiler.record(trial=3, place_success=True))
+    assert [r['trial'] for r in load_jsonl([fname])] == [0, 1, 2, 3]
@@ -0,0 +1,139 @@
+import threading
+
+import numpy as np
+import pybullet as p
+import pybullet_data
+import pytest
+
+pytest.importorskip('airobot')
+pytest.importorskip('urdfpy')
+
+from rndf_robot.utils.eval_gen_utils import step_until_settled
+from rndf_robot.utils.pb2mc.pybullet_meshcat import PyBulletMeshcat, pose_changed
+from rndf_robot.utils.pb2mc.recording import load_recording
+
+
+class _RecordingVisualizer:
+    """Counts what is sent to meshcat"""
+    def __init__(self):
+        self.transforms = []
+        self.objects = []
+
+    def __getitem__(self, path):
+        vis = self
+
+        class _Node:
+            def set_object(self, obj):
+                vis.objects.append(path)
+
+            def set_transform(self, mat):
+                vis.transforms.append(path)
+
+            def delete(self):
+                pass
+        return _Node()
+
+
+@pytest.fixture
+def client_id():
+    client_id = p.connect(p.DIRECT)
+    p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=client_id)
+    p.setGravity(0, 0, -9.8, physicsClientId=client_id)
+    p.loadURDF("plane.urdf", physicsClientId=client_id)
+    yield client_id
+    p.disconnect(physicsClientId=client_id)
+
+
+@pytest.fixture
+def recorder(client_id, tmp_path):
+    # track a body of the DIRECT client directly, instead of through a shared memory connection
+    recorder = PyBulletMeshcat(tmp_urdf_dir=str(tmp_path), max_keyframes=5, client_id=client_id)
+
+    mesh_path = tmp_path / 'tri.obj'
+    mesh_path.write_text('v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n')
+    cube_id = p.loadURDF("cube_small.urdf", [0, 0, 0.3], physicsClientId=client_id)
+    recorder.links_dict[f'{cube_id}::-1'] = PyBulletMeshcat.LinkTracker(
+        name='cube', body_id=cube_id, link_id=-1, link_origin=np.eye(4),
+        mesh_path=str(mesh_path), mesh_scale=[1, 1, 1], client_id=client_id)
+    return recorder
+
+
+def test_pose_changed():
+    pose = {'position': [0, 0, 0], 'orientation': [0, 0, 0, 1]}
+    assert pose_changed(None, pose, 1e-4, 1e-3)
+    assert not pose_changed(pose, {'position': [5e-5, 0, 0], 'orientation': [0, 0, 0, 1]}, 1e-4, 1e-3)
+    assert pose_changed(pose, {'position': [1e-3, 0, 0], 'orientation': [0, 0, 0, 1]}, 1e-4, 1e-3)
+    # q and -q are the same rotation
+    assert not pose_changed(pose, {'position': [0, 0, 0], 'orientation': [0, 0, 0, -1]}, 1e-4, 1e-3)
+    small_rot = [0, 0, np.sin(0.01 / 2), np.cos(0.01 / 2)]
+    assert pose_changed(pose, {'position': [0, 0, 0], 'orientation': small_rot}, 1e-4, 1e-3)
+
+
+def test_keyframes_are_bounded(recorder, client_id):
+    for _ in range(20):
+        p.stepSimulation(physicsClientId=client_id)
+        recorder.add_keyframe()
+    assert len(recorder.states) == 5
+    assert recorder.states[-1] is recorder.current_state
+
+
+def test_only_moved_links_are_sent(recorder, client_id):
+    """Test that a transform is only sent to meshcat again after the body moved"""
+    mc_vis = _RecordingVisualizer()
+    recorder.add_keyframe()
+    recorder.update_meshcat_current_state(mc_vis)
+    assert mc_vis.objects == ['scene/cube'] and len(mc_vis.transforms) == 1
+
+    # nothing moved
+    recorder.add_keyframe()
+    recorder.update_meshcat_current_state(mc_vis)
+    assert len(mc_vis.transforms) == 1
+
+    # the cube is falling
+    for _ in range(10):
+        p.stepSimulation(physicsClientId=client_id)
+    recorder.add_keyframe()
+    recorder.update_meshcat_current_state(mc_vis)
+    assert len(mc_vis.transforms) == 2 and len(mc_vis.objects) == 1
+
+
+def test_clear_releases_locks(recorder):
+    recorder.clear()
+    acquired = []
+    th = threading.Thread(target=lambda: acquired.append(recorder.current_state_lock.acquire(timeout=1.0)))
+    th.start()
+    th.join()
+    assert acquired == [True]
+    assert len(recorder.links_dict) == 0 and len(recorder.states) == 0
+
+
+def test_recording_from_stepping_loop(recorder, client_id, tmp_path):
+    """Test recording keyframes of a falling body from the stepping loop"""
+    recorder.start_recording()
+    cube_id = recorder.links_dict[next(iter(recorder.links_dict))].body_id
+    n_steps = step_until_settled([cube_id], max_steps=240, client_id=client_id,
+                                 step_callback=lambda i: recorder.add_keyframe() if i % 4 == 0 else None)
+    recorder.stop_recording(str(tmp_path / 'recording.npz'))
+
+    track = load_recording(str(tmp_path / 'recording.npz'))['cube']
+    assert track['poses'].shape == ((n_steps + 3) // 4, 7)
+    # the cube fell onto the plane
+    assert track['poses'][-1, 2] < track['poses'][0, 2]
+
+
+def test_registering_again_uses_the_cache(client_id, tmp_path, monkeypatch):
+    """Test that registering a (reused) body again doesn't parse its URDF again"""
+    recorder = PyBulletMeshcat(tmp_urdf_dir=str(tmp_path), client_id=client_id)
+    mesh_path = tmp_path / 'tri.obj'
+    mesh_path.write_text('v 0 0 0\nv 1 0 0\nv 0 1 0\nf 1 2 3\n')
+    body_id = p.loadURDF("cube_small.urdf", [0, 0, 0.3], physicsClientId=client_id)
+
+    recorder.register_object(body_id, str(mesh_path), scaling=[1.0, 1.0, 1.0])
+    link_keys = list(recorder.links_dict.keys())
+    assert len(link_keys) == 1
+
+    recorder.remove_object(body_id, _RecordingVisualizer())
+    assert len(recorder.links_dict) == 0
+    monkeypatch.setattr('rndf_robot.utils.pb2mc.pybullet_meshcat.URDF.load', None)
+    recorder.register_object(body_id, str(mesh_path), scaling=[1.0, 1.0, 1.0])
+    assert list(recorder.links_dict.keys()) == link_keys
@@ -0,0 +1,49 @@
+import numpy as np
+import pybullet as p
+import pybullet_data
+import pytest
+
+from rndf_robot.utils.scene_snapshot import SceneSnapshots
+
+
+@pytest.fixture
+def client_id():
+    client_id = p.connect(p.DIRECT)
+    p.setAdditionalSearchPath(pybullet_data.getDataPath(), physicsClientId=client_id)
+    p.setGravity(0, 0, -9.8, physicsClientId=client_id)
+    p.loadURDF("plane.urdf", physicsClientId=client_id)
+    yield client_id
+    p.disconnect(physicsClientId=client_id)
+
+
+def _fall(cube_id, client_id, n_steps=60):
+    for _ in range(n_steps):
+        p.stepSimulation(physicsClientId=client_id)
+    return np.array(p.getBasePositionAndOrientation(cube_id, physicsClientId=client_id)[0])
+
+
+def test_branches_start_from_the_same_state(client_id):
+    """Test that every branch sees the snapshot state, and that branches are reproducible."""
+    cube_id = p.loadURDF("cube_small.urdf", [0, 0, 0.3], physicsClientId=client_id)
+    _fall(cube_id, client_id, n_steps=10)
+    snapshots = SceneSnapshots(client_id=client_id)
+    snapshots.save('start')
+    start_pos = np.array(p.getBasePositionAndOrientation(cube_id, physicsClientId=client_id)[0])
+    start_vel = np.array(p.getBaseVelocity(cube_id, physicsClientId=client_id)[0])
+
+    def pushed():
+        p.resetBaseVelocity(cube_id, [1.0, 0, 0], [0, 0, 0], physicsClientId=client_id)
+        return _fall(cube_id, client_id)
+
+    results = snapshots.run_branches('start', {'pushed': pushed, 'fall': lambda: _fall(cube_id, client_id)})
+    assert list(results) == ['pushed', 'fall']
+    assert results['pushed'][0] > results['fall'][0] + 0.1
+
+    # restoring also restores the velocities, so falling again gives the same result
+    snapshots.restore('start')
+    assert np.allclose(p.getBasePositionAndOrientation(cube_id, physicsClientId=client_id)[0], start_pos)
+    assert np.allclose(p.getBaseVelocity(cube_id, physicsClientId=client_id)[0], start_vel)
+    assert np.allclose(_fall(cube_id, client_id), results['fall'])
+
+    snapshots.clear()
+    assert 'start' not in snapshots